@@ -0,0 +1,23 @@
+"""create data hash reference table
+
+Revision ID: 3b9f0c4e2d17
+Revises: 5aea7b8ff415
+Create Date: 2015-12-15 14:12:08.311905
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b9f0c4e2d17'
+down_revision = '5aea7b8ff415'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # data_hash_reference automatically added, and filled in from the bundle
+    # table by BundleModel.create_tables
+    pass
+
+def downgrade():
+    op.drop_table('data_hash_reference')
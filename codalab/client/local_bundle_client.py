@@ -22,6 +22,7 @@ from codalab.common import (
   PermissionError
 )
 from codalab.client.bundle_client import BundleClient
+from codalab.lib.archive_cache import ArchiveCache
 from codalab.lib.bundle_action import BundleAction
 from codalab.lib import (
     canonicalize,
@@ -30,6 +31,7 @@ from codalab.lib import (
     file_util,
     spec_util,
     formatting,
+    zip_util,
 )
 from codalab.objects.worksheet import Worksheet
 from codalab.objects import permission
@@ -161,6 +163,49 @@ class LocalBundleClient(BundleClient):
             return None
         return path
 
+    # Helper
+    def open_stored_target(self, target):
+        '''
+        If the target's bundle is not on local disk (it is in the cold tier or the
+        backend of the bundle store), return a pair of True and a file handle to
+        the target read from where it is stored (None if it is not a file).
+        Otherwise, return (False, None), and the target should be read from
+        get_target_path.
+        '''
+        check_bundles_have_read_permission(self.model, self._current_user(), [target[0]])
+        bundle = self.model.get_bundle(target[0])
+        if not bundle.data_hash or self.bundle_store.is_local(bundle.data_hash):
+            return (False, None)
+        return (True, self.bundle_store.open_stored_target(bundle.data_hash, target[1]))
+
+    # Helper
+    def open_target_archive_handle(self, target, archive_format=ArchiveCache.TAR_GZ):
+        '''
+        Return a file handle to read the target packed as an archive in
+        |archive_format| (one of ArchiveCache.FORMATS), or None if it does not
+        exist. The data of a bundle with a data hash never changes, so its
+        archives are cached by the bundle store and packed once.
+        '''
+        check_bundles_have_read_permission(self.model, self._current_user(), [target[0]])
+        bundle = self.model.get_bundle(target[0])
+        if bundle.data_hash:
+            if not self.bundle_store.is_local(bundle.data_hash):
+                # Pack just the target, copied from where it is stored, rather
+                # than unfreezing or fetching the bundle.
+                return self.bundle_store.archive_cache.open(
+                    bundle.data_hash, target[1],
+                    lambda: self.bundle_store.stage_stored_target(bundle.data_hash, target[1]), archive_format,
+                    release_path=self.bundle_store.discard_staged_target)
+            return self.bundle_store.archive_cache.open(
+                bundle.data_hash, target[1], lambda: self.get_target_path(target), archive_format)
+        if archive_format not in ArchiveCache.FORMATS:
+            raise UsageError('Unknown archive format: %s' % (archive_format,))
+        path = self.get_target_path(target)
+        if path is None:
+            return None
+        codec = zip_util.NO_COMPRESSION if archive_format == ArchiveCache.TAR else zip_util.PARALLEL_GZIP
+        return zip_util.open_packed_path(path, follow_symlinks=False, exclude_patterns=None, codec=codec)
+
     # Helper
     def get_bundle_target(self, target):
         (bundle_uuid, subpath) = target
@@ -217,12 +262,15 @@ class LocalBundleClient(BundleClient):
         return self.upload_bundle(sources, follow_symlinks, exclude_patterns, git, unpack, remove_sources, info, worksheet_uuid, add_to_worksheet)
 
     @authentication_required
-    def upload_bundle(self, sources, follow_symlinks, exclude_patterns, git, unpack, remove_sources, info, worksheet_uuid, add_to_worksheet):
+    def upload_bundle(self, sources, follow_symlinks, exclude_patterns, git, unpack, remove_sources, info, worksheet_uuid, add_to_worksheet, data_hash=None, packed=False):
         """
-        |sources|, |follow_symlinks|, |exclude_patterns|, |git|, |unpack|, |remove_sources|: see BundleStore.upload()
+        |sources|, |follow_symlinks|, |exclude_patterns|, |git|, |unpack|, |remove_sources|, |packed|: see BundleStore.upload()
         |info|: information about the bundle.
         |worksheet_uuid|: which worksheet to inherit permissions on
         |add_to_worksheet|: whether to add to this worksheet or not.
+        |data_hash|: if |sources| is None, the data hash of data that is already
+            in the bundle store to use (e.g., when the client proved that it has
+            the same data; see BundleRPCServer.finish_upload_bundle_by_hash).
         Note: |sources| could be None (e.g., if we are copying a bundle where we've only kept the metadata).
         """
         worksheet = self.model.get_worksheet(worksheet_uuid, fetch_items=False)
@@ -253,10 +301,13 @@ class LocalBundleClient(BundleClient):
                                                                           exclude_patterns=exclude_patterns,
                                                                           git=git,
                                                                           unpack=unpack,
-                                                                          remove_sources=remove_sources)
+                                                                          remove_sources=remove_sources,
+                                                                          packed=packed)
             metadata.update(bundle_store_metadata)
-        else:
-            data_hash = None
+        elif data_hash is not None:
+            manifest = self.bundle_store.get_manifest(data_hash)
+            precondition(manifest is not None, 'No manifest for %s' % (data_hash,))
+            metadata['data_size'] = manifest.data_size()
         if construct_args.get('data_hash', data_hash) != data_hash:
             print >>sys.stderr, 'ERROR: provided data_hash doesn\'t match: %s versus %s' %\
                                 (construct_args.get('data_hash'), data_hash)
@@ -350,6 +401,11 @@ class LocalBundleClient(BundleClient):
 
     def open_target(self, target):
         check_bundles_have_read_permission(self.model, self._current_user(), [target[0]])
+        (stored, handle) = self.open_stored_target(target)
+        if stored:
+            if handle is None:
+                raise UsageError('Not a file: %s' % (path_util.safe_join(*target),))
+            return handle
         path = self.get_target_path(target)
         path_util.check_isfile(path, 'open_target')
         return open(path)
@@ -505,6 +561,12 @@ class LocalBundleClient(BundleClient):
 
     def get_target_info(self, target, depth):
         check_bundles_have_read_permission(self.model, self._current_user(), [target[0]])
+        bundle = self.model.get_bundle(target[0])
+        if bundle.data_hash:
+            # Bundle data is immutable, so its manifest can answer for it.
+            info = self.bundle_store.get_target_info(bundle.data_hash, target[1], depth)
+            if info is not None:
+                return info
         path = self.get_target_path(target)
         if path is None:
             return None
@@ -512,6 +574,12 @@ class LocalBundleClient(BundleClient):
 
     def cat_target(self, target, out):
         check_bundles_have_read_permission(self.model, self._current_user(), [target[0]])
+        (stored, handle) = self.open_stored_target(target)
+        if stored:
+            if handle is not None:
+                with handle:
+                    file_util.copy(handle, out)
+            return
         path = self.get_target_path(target)
         if path is None:
             return
@@ -526,8 +594,15 @@ class LocalBundleClient(BundleClient):
         '''
         max_total_bytes = None if max_num_lines is None else max_num_lines * self.MAX_BYTES_PER_LINE
         check_bundles_have_read_permission(self.model, self._current_user(), [target[0]])
-        path = self.get_target_path(target)
-        lines = path_util.read_lines(path, max_num_lines, max_total_bytes)
+        (stored, handle) = self.open_stored_target(target)
+        if stored:
+            if handle is None:
+                return None
+            with handle:
+                lines = path_util.read_file_lines(handle, max_num_lines, max_total_bytes)
+        else:
+            path = self.get_target_path(target)
+            lines = path_util.read_lines(path, max_num_lines, max_total_bytes)
         if lines is None:
             return None
 
@@ -541,6 +616,9 @@ class LocalBundleClient(BundleClient):
 
     def open_target_handle(self, target):
         check_bundles_have_read_permission(self.model, self._current_user(), [target[0]])
+        (stored, handle) = self.open_stored_target(target)
+        if stored:
+            return handle
         path = self.get_target_path(target)
         return open(path) if path and os.path.exists(path) else None
 
@@ -553,6 +631,12 @@ class LocalBundleClient(BundleClient):
         # Don't need to download anything because it's already local.
         # Note that we can't really enforce follow_symlinks, but this is okay,
         # because we will follow them when we copy it from the target path.
+        bundle = self.model.get_bundle(target[0])
+        if bundle.data_hash and not self.bundle_store.is_local(bundle.data_hash):
+            # Copy just the target from where it is stored.
+            if not self.bundle_store.export_stored_target(bundle.data_hash, target[1], final_path):
+                raise UsageError('Target does not exist: %s' % (path_util.safe_join(*target),))
+            return
         source_path = self.get_target_path(target)
         path_util.copy(source_path, final_path)
 
@@ -1031,8 +1115,15 @@ class LocalBundleClient(BundleClient):
                 elif mode == 'html':
                     data = self.head_target(data, None)
                 elif mode == 'image':
-                    path = self.get_target_path(data)
-                    data = path_util.base64_encode(path)
+                    (stored, handle) = self.open_stored_target(data)
+                    if stored:
+                        data = None
+                        if handle is not None:
+                            with handle:
+                                data = base64.b64encode(handle.read())
+                    else:
+                        path = self.get_target_path(data)
+                        data = path_util.base64_encode(path)
                 elif mode == 'graph':
                     try:
                         max_lines = int(properties.get('maxlines', self.DEFAULT_CONTENTS_MAX_LINES))
@@ -1043,7 +1134,6 @@ class LocalBundleClient(BundleClient):
                     # Add a 'points' field that contains the contents of the target.
                     for info in data:
                         target = info['target']
-                        path = self.get_target_path(target)
                         contents = self.head_target(target, max_lines, replace_non_unicode=True, base64_encode=False)
                         if contents is not None:
                             # Assume TSV file without header for now, just return each line as a row
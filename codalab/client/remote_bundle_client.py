@@ -5,8 +5,18 @@ the FileServer operations exposed by the RPC server.
 '''
 import os
 import contextlib
+import errno
+import fcntl
+import hashlib
+import httplib
+import json
+import stat
+import Queue
 import sys
+import threading
+import time
 import urllib
+import urlparse
 import tempfile
 import xmlrpclib
 import socket
@@ -20,9 +30,13 @@ from codalab.common import (
 )
 from codalab.lib import (
   file_util,
+  formatting,
   path_util,
+  possession,
   zip_util,
 )
+from codalab.lib.hash_cache import HashCache
+from codalab.lib.manifest import Manifest
 from codalab.server.rpc_file_handle import RPCFileHandle
 
 # Hack to allow 64-bit integers
@@ -33,7 +47,16 @@ class AuthenticatedTransport(xmlrpclib.SafeTransport):
     '''
     Provides an implementation of xmlrpclib.Transport which injects an
     Authorization header into HTTP requests to the remove server.
+
+    Connections are kept alive between requests (HTTP/1.1) in a pool, so that a
+    command that makes many calls doesn't pay for a TCP (and TLS) handshake in
+    each one. Each request takes an idle connection from the pool, or makes a
+    new one, and puts it back once the response has been read, so that threads
+    can share the transport.
     '''
+    # Idle connections beyond this many are closed.
+    MAX_IDLE_CONNECTIONS = 4
+
     def __init__(self, address, get_auth_token):
         '''
         address: the address of the remote server
@@ -46,6 +69,11 @@ class AuthenticatedTransport(xmlrpclib.SafeTransport):
             raise UsageError("Unsupported protocol: expected http://... or https://... but got %s" % address)
         self._url_type = url_type
         self._bearer_token = get_auth_token
+        self._lock = threading.Lock()
+        # Map from host to its idle connections.
+        self._idle_connections = {}
+        # Number of connections made, for benchmarks.
+        self.num_connections = 0
 
     def send_content(self, connection, request_body):
         '''
@@ -61,10 +89,336 @@ class AuthenticatedTransport(xmlrpclib.SafeTransport):
         '''
         Create a connection based on the communication scheme, http vs https.
         '''
-        if self._url_type == "https":
-            return xmlrpclib.SafeTransport.make_connection(self, host)
-        else:
-            return xmlrpclib.Transport.make_connection(self, host)
+        with self._lock:
+            # Always make a new connection: the pool is kept by request, not in
+            # the single connection that Transport caches.
+            self._connection = (None, None)
+            if self._url_type == "https":
+                connection = xmlrpclib.SafeTransport.make_connection(self, host)
+            else:
+                connection = xmlrpclib.Transport.make_connection(self, host)
+            self._connection = (None, None)
+            self.num_connections += 1
+        return connection
+
+    def request(self, host, handler, request_body, verbose=0):
+        '''
+        Overrides Transport.request in order to send the request on a pooled
+        connection. If an idle connection turns out to have been closed by the
+        server, the request is sent again on a new one.
+        '''
+        while True:
+            with self._lock:
+                idle_connections = self._idle_connections.get(host)
+                connection = idle_connections.pop() if idle_connections else None
+            reused = connection is not None
+            if connection is None:
+                connection = self.make_connection(host)
+            try:
+                result = self._single_request(connection, host, handler, request_body, verbose)
+            except xmlrpclib.Fault:
+                # The response was read in full, so the connection can be reused.
+                self._release_connection(host, connection)
+                raise
+            except (socket.error, httplib.BadStatusLine), e:
+                connection.close()
+                stale = isinstance(e, httplib.BadStatusLine) or \
+                    e.errno in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+                if reused and stale:
+                    continue
+                raise
+            except:
+                connection.close()
+                raise
+            self._release_connection(host, connection)
+            return result
+
+    def _single_request(self, connection, host, handler, request_body, verbose):
+        '''
+        Like Transport.single_request, on the given connection.
+        '''
+        if verbose:
+            connection.set_debuglevel(1)
+        self.send_request(connection, handler, request_body)
+        self.send_host(connection, host)
+        self.send_user_agent(connection)
+        self.send_content(connection, request_body)
+        response = connection.getresponse(buffering=True)
+        if response.status == 200:
+            self.verbose = verbose
+            return self.parse_response(response)
+        raise xmlrpclib.ProtocolError(host + handler, response.status, response.reason, response.msg)
+
+    def _release_connection(self, host, connection):
+        '''
+        Put |connection| back in the pool, unless the server closed it (e.g.,
+        an HTTP/1.0 server closes each one after the response).
+        '''
+        if connection.sock is not None:
+            with self._lock:
+                idle_connections = self._idle_connections.setdefault(host, [])
+                if len(idle_connections) < self.MAX_IDLE_CONNECTIONS:
+                    idle_connections.append(connection)
+                    return
+        connection.close()
+
+    def close(self):
+        '''
+        Close the idle connections.
+        '''
+        with self._lock:
+            connections = sum(self._idle_connections.values(), [])
+            self._idle_connections = {}
+        for connection in connections:
+            connection.close()
+
+
+class FileStreamClient(object):
+    '''
+    Streams the contents of file uuids to and from a FileServer as raw bytes
+    over plain HTTP requests (see FileServer), instead of in read_file and
+    write_file calls.
+    '''
+    PATH = '/file'
+
+    # upload_chunks sends chunks of this many bytes.
+    CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, address, get_auth_token):
+        '''
+        address: the address of the remote server
+        get_auth_token: a function which yields the access token for
+          the Bearer authentication scheme.
+        '''
+        (self._url_type, self._netloc) = urlparse.urlsplit(address)[:2]
+        self._bearer_token = get_auth_token
+        self._supported = None
+        # Number of connections made, for benchmarks.
+        self.num_connections = 0
+
+    def _make_connection(self):
+        self.num_connections += 1
+        if self._url_type == 'https':
+            return httplib.HTTPSConnection(self._netloc)
+        return httplib.HTTPConnection(self._netloc)
+
+    def is_supported(self):
+        '''
+        Return whether the server supports streaming. Older servers answer the
+        probe with an error, since they only handle POST.
+        '''
+        if self._supported is None:
+            connection = self._make_connection()
+            try:
+                connection.request('HEAD', self.PATH)
+                self._supported = connection.getresponse().status == 200
+            except (httplib.HTTPException, socket.error):
+                self._supported = False
+            finally:
+                connection.close()
+        return self._supported
+
+    def _start_request(self, method, file_uuid, headers=(), query=None, connection=None):
+        '''
+        Send the request line and headers of a request for |file_uuid| on
+        |connection| (by default, a new one) and return the connection, on which
+        the body can be sent.
+        '''
+        if connection is None:
+            connection = self._make_connection()
+        path = '%s/%s' % (self.PATH, file_uuid)
+        if query:
+            path += '?' + urllib.urlencode(query)
+        connection.putrequest(method, path)
+        token = self._bearer_token()
+        if token is not None and len(token) > 0:
+            connection.putheader("Authorization", "Bearer: {0}".format(token))
+        for (name, value) in headers:
+            connection.putheader(name, value)
+        connection.endheaders()
+        return connection
+
+    def _check_response(self, response, file_uuid):
+        if response.status != 200:
+            response.read()
+            raise UsageError('Could not stream file %s: %s %s' % (file_uuid, response.status, response.reason))
+
+    def _raise_send_error(self, connection, file_uuid):
+        '''
+        Raise the error that sending a request body on |connection| failed with,
+        or rather the response of the server, which may have answered (e.g., to
+        refuse the request) before reading the body.
+        '''
+        exc_info = sys.exc_info()
+        try:
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error):
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._check_response(response, file_uuid)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def upload(self, file_uuid, source_handle, print_status=None):
+        '''
+        Write everything read from |source_handle| to |file_uuid|, sending it
+        with chunked transfer encoding.
+        '''
+        connection = self._start_request('PUT', file_uuid, [
+            ('Content-Type', 'application/octet-stream'),
+            ('Transfer-Encoding', 'chunked'),
+        ])
+        try:
+            try:
+                file_util.copy(source_handle, _ChunkedWriter(connection), autoflush=False, print_status=print_status)
+                connection.send('0\r\n\r\n')
+            except socket.error:
+                self._raise_send_error(connection, file_uuid)
+            response = connection.getresponse()
+            self._check_response(response, file_uuid)
+            response.read()
+        finally:
+            connection.close()
+
+    def upload_chunks(self, file_uuid, source_handle, num_connections, print_status=None, received=None):
+        '''
+        Write everything read from |source_handle| to the temp file |file_uuid|,
+        in CHUNK_SIZE chunks, each sent at its offset with its SHA-1, over
+        |num_connections| connections at once, so that the upload is not limited
+        to a chunk per round trip. Each connection is kept alive for the next
+        chunk, so that a chunk doesn't cost a TCP (and TLS) handshake. Return the (number of bytes, seconds) it took.
+        |received|: map from offset to the (length, SHA-1) of chunks that the
+        server already has (see FileServer.get_upload_session), which are not
+        sent again if they match.
+        '''
+        received = received or {}
+        # At most num_connections chunks wait to be sent, besides the ones
+        # being sent.
+        chunks = Queue.Queue(num_connections)
+        errors = []
+        lock = threading.Lock()
+        progress = {'num_bytes': 0}
+
+        def send_chunks():
+            connection = None
+            try:
+                while True:
+                    chunk = chunks.get()
+                    if chunk is None:
+                        return
+                    if errors:
+                        continue
+                    (offset, data) = chunk
+                    try:
+                        checksum = hashlib.sha1(data).hexdigest()
+                        if received.get(offset) != (len(data), checksum):
+                            connection = self._put_chunk(connection, file_uuid, offset, data, checksum)
+                    except Exception:
+                        errors.append(sys.exc_info())
+                        continue
+                    with lock:
+                        progress['num_bytes'] += len(data)
+                        if print_status:
+                            print >>sys.stderr, "\r%s: %s" % (print_status, formatting.size_str(progress['num_bytes'])),
+                            sys.stderr.flush()
+            finally:
+                if connection is not None:
+                    connection.close()
+
+        threads = [threading.Thread(target=send_chunks) for _ in range(num_connections)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        start_time = time.time()
+        offset = 0
+        try:
+            while not errors:
+                data = source_handle.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                chunks.put((offset, data))
+                offset += len(data)
+        finally:
+            for _ in threads:
+                chunks.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        elapsed = time.time() - start_time
+        if print_status:
+            print >>sys.stderr, "\r%s: %s [done, %s/s]" % (
+                print_status, formatting.size_str(offset), formatting.size_str(offset / elapsed if elapsed else 0))
+        return (offset, elapsed)
+
+    def _put_chunk(self, connection, file_uuid, offset, data, checksum):
+        '''
+        Send the chunk |data| at |offset| of |file_uuid| on |connection|, or on a
+        new one if it is None. Return the connection if the server kept it alive,
+        and None otherwise. If the connection turns out to have been closed by
+        the server (e.g., after its keep-alive timeout), the chunk is sent again
+        on a new one, which is harmless, since it goes to the same offset.
+        '''
+        while True:
+            reused = connection is not None
+            if connection is None:
+                connection = self._make_connection()
+            try:
+                self._start_request('PUT', file_uuid, [
+                    ('Content-Type', 'application/octet-stream'),
+                    ('Content-Length', str(len(data))),
+                    ('Content-SHA1', checksum),
+                ], query={'offset': offset}, connection=connection)
+                try:
+                    connection.send(data)
+                except socket.error:
+                    self._raise_send_error(connection, file_uuid)
+                response = connection.getresponse()
+                self._check_response(response, file_uuid)
+                response.read()
+            except (socket.error, httplib.BadStatusLine), e:
+                connection.close()
+                stale = isinstance(e, httplib.BadStatusLine) or \
+                    e.errno in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+                if reused and stale:
+                    connection = None
+                    continue
+                raise
+            except:
+                connection.close()
+                raise
+            if connection.sock is None:
+                return None
+            return connection
+
+    def open(self, file_uuid):
+        '''
+        Return a file object to read the rest of |file_uuid| from.
+        '''
+        connection = self._start_request('GET', file_uuid)
+        try:
+            response = connection.getresponse()
+            self._check_response(response, file_uuid)
+        except:
+            connection.close()
+            raise
+        # The response keeps the socket open until it is closed.
+        connection.close()
+        return response
+
+
+class _ChunkedWriter(object):
+    '''
+    File-like object that sends what is written to it over |connection| as
+    chunks of a request body with chunked transfer encoding.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def write(self, data):
+        if data:
+            self.connection.send('%x\r\n%s\r\n' % (len(data), data))
+
+    def flush(self):
+        pass
 
 ############################################################
 
@@ -115,12 +469,17 @@ class RemoteBundleClient(BundleClient):
     # Implemented by the BundleRPCServer.
     SERVER_COMMANDS = (
       'finish_upload_bundle',
+      'check_data_hash',
+      'finish_upload_bundle_by_hash',
       'open_target',  # Limited access to files (read)
       'open_target_archive',  # Limited access to files (read)
     )
     # Implemented by the FileServer (superclass of BundleRPCServer).
     FILE_COMMANDS = (
       'open_temp_file',  # Limited access to files (write)
+      'open_upload_session',  # Limited access to files (write)
+      'get_upload_session',
+      'close_upload_session',
       'read_file',
       'readline_file',
       'tell_file',
@@ -131,12 +490,27 @@ class RemoteBundleClient(BundleClient):
     )
     COMMANDS = CLIENT_COMMANDS + SERVER_COMMANDS + FILE_COMMANDS
 
-    def __init__(self, address, get_auth_token, verbose):
+    # Number of connections over which upload_bundle sends chunks at once.
+    UPLOAD_NUM_CONNECTIONS = 4
+    # Number of times upload_bundle resumes an interrupted upload.
+    UPLOAD_NUM_RETRIES = 5
+
+    def __init__(self, address, get_auth_token, verbose, upload_sessions_path=None, hash_cache_path=None):
+        '''
+        upload_sessions_path: file in which to remember the upload sessions of
+          unfinished uploads, so that they are resumed by the next upload of the
+          same source, even by another process.
+        hash_cache_path: file of the HashCache in which to remember the hashes
+          of uploaded files, so that uploading them again doesn't read them.
+        '''
         self.address = address
         self.verbose = verbose
+        self.upload_sessions_path = upload_sessions_path
+        self.hash_cache_path = hash_cache_path
         host = get_address_host(address)
         transport = AuthenticatedTransport(host, lambda cmd: None if cmd == 'login' else get_auth_token(self))
         self.proxy = xmlrpclib.ServerProxy(host, transport=transport, allow_none=True)
+        self.file_stream = FileStreamClient(host, lambda: get_auth_token(self))
         def do_command(command):
             def inner(*args, **kwargs):
                 import time
@@ -175,9 +549,12 @@ class RemoteBundleClient(BundleClient):
         """
         See local_bundle_client.py for documentation on the usage.
         Strategy:
+        0) If the sources are uploaded as they are, we hash them and skip the
+          rest if the server has data with that hash and we prove that we have
+          it (see _upload_bundle_by_hash).
         1) We copy the |sources| to a temporary directory on the server
           (streaming either a tar or tar.gz depending on whether compression is
-          needed).
+          needed; see zip_util.choose_codec).
         2) We politely ask the server to finish_upload_bundle (performs a
           LocalBundleClient.upload_bundle from the temporary directory).
         """
@@ -185,28 +562,167 @@ class RemoteBundleClient(BundleClient):
         if all(path_util.path_is_url(source) for source in sources):
             return self.upload_bundle_url(sources, follow_symlinks, exclude_patterns, git, unpack, remove_sources, info, worksheet_uuid, add_to_worksheet)
 
+        # 0) Skip the upload if the server already has the data.
+        if not follow_symlinks and not exclude_patterns and \
+                not any(path_util.path_is_url(source) or zip_util.path_is_archive(source) for source in sources):
+            result = self._upload_bundle_by_hash(sources, info, worksheet_uuid, add_to_worksheet)
+            if result is not None:
+                return result
+
         # 1) Copy sources up to the server (temporary remote zip file)
         remote_file_uuids = []
         for source in sources:
-            remote_file_uuid = self.open_temp_file(zip_util.add_packed_suffix(os.path.basename(source)))
-            remote_file_uuids.append(remote_file_uuid)
-            dest_handle = RPCFileHandle(remote_file_uuid, self.proxy)
+            codec = None if zip_util.path_is_archive(source) else zip_util.choose_codec(source)
+            name = zip_util.add_packed_suffix(os.path.basename(source), codec)
             if zip_util.path_is_archive(source):
-                source_handle = open(source)
+                open_source = lambda source=source: open(source, 'rb')
             else:
-                source_handle = zip_util.open_packed_path(source, follow_symlinks, exclude_patterns)
+                open_source = lambda source=source, codec=codec: zip_util.open_packed_path(
+                    source, follow_symlinks, exclude_patterns, codec)
                 unpack = True  # We packed it, so we have to unpack it
             status = 'Uploading %s%s to %s' % (source, ' ('+info['uuid']+')' if 'uuid' in info else '', self.address)
-            # FileServer does not expose an API for forcibly flushing writes, so
-            # we rely on closing the file to flush it.
-            file_util.copy(source_handle, dest_handle, autoflush=False, print_status=status)
-            dest_handle.close()
+            if self.file_stream.is_supported():
+                remote_file_uuids.append(self._upload_session(source, name, open_source, status))
+            else:
+                remote_file_uuid = self.open_temp_file(name)
+                remote_file_uuids.append(remote_file_uuid)
+                dest_handle = RPCFileHandle(remote_file_uuid, self.proxy)
+                # FileServer does not expose an API for forcibly flushing writes, so
+                # we rely on closing the file to flush it.
+                file_util.copy(open_source(), dest_handle, autoflush=False, print_status=status)
+                dest_handle.close()
 
         # 2) Install upload (this call will be in charge of deleting the temporary file).
         result = self.finish_upload_bundle(remote_file_uuids, unpack, info, worksheet_uuid, add_to_worksheet)
 
         return result
 
+    def _upload_bundle_by_hash(self, sources, info, worksheet_uuid, add_to_worksheet):
+        '''
+        Hash |sources| as the bundle store would (in either format) and, if the
+        server has data with that hash, answer its challenge to create the
+        bundle from that data. Return the new bundle's uuid, or None if the
+        sources have to be uploaded.
+        '''
+        paths = [path_util.normalize(source) for source in sources]
+        print >>sys.stderr, 'Hashing %s' % (' '.join(paths),)
+        if self.hash_cache_path is None:
+            manifests = [Manifest.from_path(path) for path in paths]
+        else:
+            hash_cache = HashCache(self.hash_cache_path)
+            manifests = [Manifest.from_path(path, hash_file=hash_cache.hash_file) for path in paths]
+            hash_cache.flush()
+        if len(paths) == 1:
+            manifest = manifests[0]
+            path_by_name = None
+        else:
+            # A directory with each of the sources, as in BundleStore.upload.
+            manifest = Manifest()
+            for (path, path_manifest) in zip(paths, manifests):
+                manifest.entries.update(path_manifest.nest(os.path.basename(path)).entries)
+            manifest.add('', stat.S_IFDIR | 0755, 0)
+            path_by_name = dict((os.path.basename(path), path) for path in paths)
+        data_hashes = [
+            path_util.DATA_HASH_PREFIX + manifest.data_hash(),
+            path_util.MERKLE_DATA_HASH_PREFIX + manifest.data_hash(merkle=True),
+        ]
+        try:
+            challenge = self.check_data_hash(data_hashes)
+        except xmlrpclib.Fault:
+            # Older servers don't have check_data_hash.
+            return None
+        if challenge is None:
+            return None
+
+        def read_range(relative_path, offset, length):
+            if path_by_name is None:
+                path = paths[0] + relative_path
+            else:
+                (_, name, rest) = (relative_path.split(os.sep, 2) + [''])[:3]
+                path = os.path.join(path_by_name[name], rest) if rest else path_by_name[name]
+            return possession.read_file_range(path, offset, length)
+
+        answer = possession.answer_challenge(challenge, manifest, read_range)
+        result = self.finish_upload_bundle_by_hash(challenge['challenge_id'], answer, info, worksheet_uuid, add_to_worksheet)
+        if result is None:
+            return None
+        print >>sys.stderr, 'Skipped uploading %s, which the server already has (%s)' % (' '.join(paths), challenge['data_hash'])
+        return result
+
+    def _upload_session(self, source, name, open_source, status):
+        '''
+        Upload what |open_source|() reads to a new upload session named |name|,
+        or to the one that an unfinished upload of |source| left behind, and
+        return its file uuid. After an interruption, the source is read again
+        and only the chunks that the server does not have are sent.
+        '''
+        key = ' '.join((self.address, os.path.abspath(source), name))
+        file_uuid = self._load_upload_sessions().get(key)
+        session = self.get_upload_session(file_uuid) if file_uuid else None
+        if session is None:
+            file_uuid = self.open_upload_session(name)
+            session = {'chunks': []}
+            self._save_upload_session(key, file_uuid)
+        else:
+            print >>sys.stderr, 'Resuming upload of %s (%s uploaded)' % (
+                source, formatting.size_str(session['committed_offset']))
+
+        num_retries = 0
+        while True:
+            received = dict((offset, (length, checksum)) for (offset, length, checksum) in session['chunks'])
+            source_handle = open_source()
+            try:
+                # The server flushes the file at the end of each request.
+                (size, _) = self.file_stream.upload_chunks(
+                    file_uuid, source_handle, self.UPLOAD_NUM_CONNECTIONS, print_status=status, received=received)
+                break
+            except (socket.error, httplib.HTTPException), e:
+                num_retries += 1
+                if num_retries > self.UPLOAD_NUM_RETRIES:
+                    raise UsageError('Failed to upload %s: %s' % (source, e))
+                print >>sys.stderr, '\nUpload of %s interrupted (%s), resuming...' % (source, e)
+                session = self.get_upload_session(file_uuid)
+                if session is None:
+                    raise UsageError('Upload session of %s expired' % (source,))
+            finally:
+                source_handle.close()
+        self.close_upload_session(file_uuid, size)
+        self._save_upload_session(key, None)
+        return file_uuid
+
+    def _load_upload_sessions(self):
+        '''
+        Return the map from upload key to the file uuid of its session.
+        '''
+        if self.upload_sessions_path is None or not os.path.exists(self.upload_sessions_path):
+            return {}
+        with open(self.upload_sessions_path) as f:
+            return json.load(f)
+
+    def _save_upload_session(self, key, file_uuid):
+        '''
+        Remember the upload session of |key|, or forget it if |file_uuid| is None.
+        '''
+        if self.upload_sessions_path is None:
+            return
+        # Other uploads (in this or another process) may be saving their
+        # sessions at the same time, so hold a lock on a file next to it while
+        # updating it, lest one update be lost.
+        with open(self.upload_sessions_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                sessions = self._load_upload_sessions()
+                if file_uuid is None:
+                    sessions.pop(key, None)
+                else:
+                    sessions[key] = file_uuid
+                temp_path = '%s.%s' % (self.upload_sessions_path, os.getpid())
+                with open(temp_path, 'w') as f:
+                    json.dump(sessions, f, indent=2, sort_keys=True)
+                os.rename(temp_path, self.upload_sessions_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
     def open_target_handle(self, target):
         remote_file_uuid = self.open_target(target)
         if remote_file_uuid is not None:
@@ -217,14 +733,26 @@ class RemoteBundleClient(BundleClient):
         handle.close()
         self.finalize_file(handle.file_uuid)
 
+    def open_file_uuid(self, file_uuid):
+        '''
+        Return a file object to read |file_uuid|, which is streamed if the
+        server supports it.
+        '''
+        if self.file_stream.is_supported():
+            return self.file_stream.open(file_uuid)
+        return RPCFileHandle(file_uuid, self.proxy)
+
     def cat_target(self, target, out):
-        source = self.open_target_handle(target)
-        if not source: return
+        source_uuid = self.open_target(target)
+        if source_uuid is None: return
+        source = self.open_file_uuid(source_uuid)
         file_util.copy(source, out)
-        self.close_target_handle(source)
+        source.close()
+        self.finalize_file(source_uuid)
 
     def download_target(self, target, final_path):
         source_uuid = self.open_target_archive(target)
-        source = RPCFileHandle(source_uuid, self.proxy)
+        source = self.open_file_uuid(source_uuid)
         zip_util.unpack(source, final_path)
+        source.close()
         self.finalize_file(source_uuid)
@@ -0,0 +1,228 @@
+'''
+ArchiveCache keeps the archives that bundle targets are packed into for
+downloads (e.g., by `cl download` and `cl cp`), keyed by (data hash, subpath,
+format). The data under a data hash never changes, so neither does its archive,
+and a popular bundle is packed once instead of once per download.
+
+On a miss, the archive is streamed to the reader as it is packed, like
+zip_util.open_packed_path, so the first download doesn't wait for the whole
+archive. What is read is also written to the cache directory under a temporary
+name, which is renamed into place once the reader reaches the end and tar
+succeeded; later requests are served straight from the file. Concurrent misses
+for an archive that is being cached are streamed without caching. Archives
+larger than the cache, and ones that are not read to the end, are not cached.
+Once the cache is over its size, archives are evicted least recently used
+first, by their mtime, which each hit updates; readers of an evicted archive can
+finish, since they have it open.
+'''
+import errno
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from codalab.common import UsageError
+from codalab.lib import file_util, path_util, zip_util
+
+
+class ArchiveCache(object):
+    TAR_GZ = 'tar.gz'
+    TAR = 'tar'
+    FORMATS = (TAR_GZ, TAR)
+
+    # Prefix of the archives being cached. Ones that were left behind (e.g., by
+    # a crash) are removed by evict after STALE_BUILD_TIME.
+    TEMP_PREFIX = 'building-'
+    STALE_BUILD_TIME = 60*60*24
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        path_util.make_directory(self.root)
+        # Paths of the archives being cached, to cache each one once.
+        self.lock = threading.Lock()
+        self.building = set()
+
+    def get_location(self, data_hash, subpath, archive_format):
+        '''
+        Return where the archive of |subpath| in the bundle with the given data
+        hash is cached in |archive_format|.
+        '''
+        return os.path.join(self.root, '%s-%s.%s' % (data_hash, hashlib.sha1(subpath).hexdigest(), archive_format))
+
+    def open(self, data_hash, subpath, get_path, archive_format=TAR_GZ, release_path=None):
+        '''
+        Return a file object to read the archive of |subpath| in the bundle with
+        the given data hash in |archive_format|, packing it from the path that
+        |get_path|() returns (and caching it) if it is not cached. Return None if
+        that path is None (the target does not exist). If |release_path| is given,
+        it is called with that path once the reader is closed, e.g., to remove a
+        copy of the target that get_path made.
+        '''
+        if archive_format not in self.FORMATS:
+            raise UsageError('Unknown archive format %s (must be one of %s)' % (archive_format, ', '.join(self.FORMATS)))
+        archive_path = self.get_location(data_hash, subpath, archive_format)
+        handle = self._open_cached(archive_path)
+        if handle is not None:
+            return handle
+        path = get_path()
+        if path is None:
+            return None
+        release = None if release_path is None else (lambda: release_path(path))
+        codec = zip_util.NO_COMPRESSION if archive_format == self.TAR else zip_util.PARALLEL_GZIP
+        try:
+            (proc, handle) = zip_util.start_pack(path, codec=codec)
+        except:
+            if release is not None:
+                release()
+            raise
+        with self.lock:
+            if archive_path in self.building:
+                return _CachingReader(self, proc, handle, None, release)
+            self.building.add(archive_path)
+        return _CachingReader(self, proc, handle, archive_path, release)
+
+    def _open_cached(self, archive_path):
+        '''
+        Return a file object to read the archive at |archive_path|, marking it as
+        recently used, or None if it is not cached.
+        '''
+        try:
+            handle = open(archive_path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            os.utime(archive_path, None)
+        except OSError, e:
+            # Evicted meanwhile; the handle still reads it.
+            if e.errno != errno.ENOENT:
+                raise
+        return handle
+
+    def evict(self):
+        '''
+        Remove the least recently used archives until the cache fits in
+        max_size, along with stale builds.
+        '''
+        stale_cutoff = time.time() - self.STALE_BUILD_TIME
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                path_stat = os.stat(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            if name.startswith(self.TEMP_PREFIX):
+                if path_stat.st_mtime < stale_cutoff:
+                    self._remove(path)
+                continue
+            entries.append((path_stat.st_mtime, path, path_stat.st_size))
+        total_size = sum(size for (_, _, size) in entries)
+        for (_, path, size) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            self._remove(path)
+            total_size -= size
+
+    def remove(self, data_hash):
+        '''
+        Remove the archives of targets in the bundle with the given data hash.
+        '''
+        for name in os.listdir(self.root):
+            if name.startswith(data_hash + '-'):
+                self._remove(os.path.join(self.root, name))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class _CachingReader(object):
+    '''
+    Reads the archive that the tar process |proc| packs from |handle|, writing
+    what is read to a temporary file in |cache|, which becomes |archive_path|
+    once the archive has been read to the end and tar succeeded. Nothing is
+    cached if |archive_path| is None, or once the archive is larger than the
+    cache. |release|, if not None, is called once tar has exited.
+    '''
+    # How much of the archive close reads if the reader stopped before the end.
+    MAX_DRAIN_SIZE = 1024 * 1024
+
+    def __init__(self, cache, proc, handle, archive_path, release=None):
+        self.cache = cache
+        self.proc = proc
+        self.handle = handle
+        self.archive_path = archive_path
+        self.release = release
+        self.size = 0
+        self.temp_handle = None
+        if archive_path is not None:
+            self.temp_path = os.path.join(cache.root, cache.TEMP_PREFIX + uuid.uuid4().hex)
+            self.temp_handle = open(self.temp_path, 'wb')
+
+    def read(self, num_bytes=None):
+        data = self.handle.read() if num_bytes is None else self.handle.read(num_bytes)
+        if self.temp_handle is not None:
+            self.size += len(data)
+            if self.size > self.cache.max_size:
+                self._discard()
+            elif data:
+                self.temp_handle.write(data)
+            elif num_bytes != 0:
+                self._finish()
+        return data
+
+    def _finish(self):
+        self.temp_handle.close()
+        self.temp_handle = None
+        if self.proc.wait() != 0:
+            self._remove_temp()
+            return
+        try:
+            os.rename(self.temp_path, self.archive_path)
+        except OSError, e:
+            # Removed by evict as stale meanwhile.
+            if e.errno != errno.ENOENT:
+                raise
+        self._release()
+        self.cache.evict()
+
+    def _discard(self):
+        self.temp_handle.close()
+        self.temp_handle = None
+        self._remove_temp()
+
+    def _remove_temp(self):
+        self.cache._remove(self.temp_path)
+        self._release()
+
+    def _release(self):
+        with self.cache.lock:
+            self.cache.building.discard(self.archive_path)
+
+    def close(self):
+        # Readers of tar archives stop at the end of archive marker, before
+        # the padding of the last record (and the end of the gzip stream).
+        # Read what is left, up to a bound, to tell those from readers that
+        # gave up early.
+        num_bytes = 0
+        while self.temp_handle is not None and num_bytes < self.MAX_DRAIN_SIZE:
+            num_bytes += len(self.read(file_util.BUFFER_SIZE))
+        if self.temp_handle is not None:
+            # Not read to the end, so the archive is incomplete.
+            self._discard()
+        self.handle.close()
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        if self.release is not None:
+            self.release()
+            self.release = None
@@ -60,6 +60,7 @@ from codalab.machines.local_machine import LocalMachine
 from codalab.client.local_bundle_client import LocalBundleClient
 from codalab.server.rpc_file_handle import RPCFileHandle
 from codalab.lib.formatting import contents_str
+from codalab.lib.scrubber import Scrubber
 from codalab.lib.completers import (
     CodaLabCompleter,
     WorksheetsCompleter,
@@ -903,7 +904,7 @@ class BundleCLI(object):
         if source_info['data_hash']:
             # Open source (as archive)
             if isinstance(source_client, LocalBundleClient):
-                source = zip_util.open_packed_path(source_client.get_target_path(target), follow_symlinks=False, exclude_patterns=None)
+                source = source_client.open_target_archive_handle(target)
             else:
                 source_file_uuid = source_client.open_target_archive((source_bundle_uuid, ''))
                 source = RPCFileHandle(source_file_uuid, source_client.proxy)
@@ -2163,7 +2164,7 @@ class BundleCLI(object):
 
         worker_config = self.manager.config['workers']
         if args.worker_type == 'local':
-            machine = LocalMachine()
+            machine = LocalMachine(worker_config.get('local'))
         elif args.worker_type in worker_config:
             machine = RemoteMachine(worker_config[args.worker_type])
         else:
@@ -2245,6 +2246,8 @@ class BundleCLI(object):
         ],
         arguments=(
             Commands.Argument('-i', '--dry-run', action='store_true', help='Perform dry run (don\'t actually do it, but see what the command would do).'),
+            Commands.Argument('-n', '--batch-size', type=int, help='Number of unreferenced bundles to delete at a time.'),
+            Commands.Argument('-s', '--sleep', type=float, default=0, help='Seconds to sleep between batches (to limit the load).'),
         ),
     )
     def do_cleanup_command(self, args):
@@ -2254,7 +2257,117 @@ class BundleCLI(object):
         self._fail_if_headless('cleanup')
         self._fail_if_not_local('cleanup')
         client = self.manager.current_client()
-        client.bundle_store.full_cleanup(client.model, args.dry_run)
+        client.bundle_store.full_cleanup(client.model, args.dry_run, batch_size=args.batch_size, sleep_time=args.sleep)
+
+    @Commands.command(
+        'shard-store',
+        help=[
+            'Move bundles in the CodaLab bundle store into the sharded layout (local only).',
+            'Requires "bundle_store_sharded": true in the server section of the config.',
+            'Safe to run while bundles are running; can be interrupted and rerun.',
+        ],
+        arguments=(
+            Commands.Argument('-n', '--max-bundles', type=int, help='Move at most this many bundles.'),
+            Commands.Argument('-s', '--sleep', type=float, default=0, help='Seconds to sleep after moving each bundle.'),
+            Commands.Argument('-f', '--finalize', action='store_true', help='Once all bundles are moved, remove the links left at their old locations.'),
+            Commands.Argument('-i', '--dry-run', action='store_true', help='Perform dry run (don\'t actually do it, but see what the command would do).'),
+        ),
+    )
+    def do_shard_store_command(self, args):
+        """
+        Incrementally migrate the bundle store to the sharded layout.
+        """
+        self._fail_if_headless('shard-store')
+        self._fail_if_not_local('shard-store')
+        client = self.manager.current_client()
+        num_moved = client.bundle_store.migrate_to_sharded(args.max_bundles, args.sleep, args.finalize, args.dry_run)
+        print >>self.stdout, 'Moved %d bundles.' % num_moved
+
+    @Commands.command(
+        'rebalance-store',
+        help=[
+            'Move bundles from fuller volumes of the CodaLab bundle store to emptier ones (local only).',
+            'Volumes are listed in "bundle_store_volumes" in the server section of the config.',
+            'Safe to run while bundles are running; can be interrupted and rerun.',
+        ],
+        arguments=(
+            Commands.Argument('-n', '--max-bundles', type=int, help='Move at most this many bundles.'),
+            Commands.Argument('-s', '--sleep', type=float, default=0, help='Seconds to sleep after moving each bundle.'),
+            Commands.Argument('-t', '--tolerance', type=float, help='Stop once the fractions of free space of the volumes are within this much of each other.'),
+            Commands.Argument('-i', '--dry-run', action='store_true', help='Perform dry run (don\'t actually do it, but see what the command would do).'),
+        ),
+    )
+    def do_rebalance_store_command(self, args):
+        """
+        Incrementally even out the free space of the volumes of the bundle store.
+        """
+        self._fail_if_headless('rebalance-store')
+        self._fail_if_not_local('rebalance-store')
+        client = self.manager.current_client()
+        num_moved = client.bundle_store.rebalance(args.max_bundles, args.sleep, args.tolerance, args.dry_run)
+        print >>self.stdout, 'Moved %d bundles.' % num_moved
+
+    @Commands.command(
+        'freeze-store',
+        help=[
+            'Move bundles that have not been used for a while to the cold tier of the CodaLab bundle store (local only).',
+            'Cold bundles are compressed archives; they are unpacked again when a run needs them.',
+            'Safe to run while bundles are running; can be interrupted and rerun.',
+        ],
+        arguments=(
+            Commands.Argument('-d', '--days', type=float, help='Move bundles not used for this many days (default: "bundle_store_cold_days" in the server section of the config, or 30).'),
+            Commands.Argument('-n', '--max-bundles', type=int, help='Move at most this many bundles.'),
+            Commands.Argument('-s', '--sleep', type=float, default=0, help='Seconds to sleep after moving each bundle.'),
+            Commands.Argument('-i', '--dry-run', action='store_true', help='Perform dry run (don\'t actually do it, but see what the command would do).'),
+        ),
+    )
+    def do_freeze_store_command(self, args):
+        """
+        Incrementally move unused bundles to the cold tier of the bundle store.
+        """
+        self._fail_if_headless('freeze-store')
+        self._fail_if_not_local('freeze-store')
+        client = self.manager.current_client()
+        min_age = None if args.days is None else args.days * 60*60*24
+        num_frozen = client.bundle_store.freeze(min_age, args.max_bundles, args.sleep, args.dry_run)
+        print >>self.stdout, 'Moved %d bundles.' % num_frozen
+
+    @Commands.command(
+        'scrub-store',
+        help=[
+            'Check that the bundles in the CodaLab bundle store still match their data hash (local only).',
+            'Reads are limited to a budget of bytes and I/O operations per second, so that runs are not starved.',
+            'Safe to run while bundles are running; resumes where the last run stopped.',
+        ],
+        arguments=(
+            Commands.Argument('-r', '--rate', default=formatting.size_str(Scrubber.BYTES_PER_SECOND), help='Read at most this many bytes per second (e.g., 20m).'),
+            Commands.Argument('-o', '--iops', type=float, default=Scrubber.OPS_PER_SECOND, help='Do at most this many I/O operations per second.'),
+            Commands.Argument('-n', '--max-bundles', type=int, help='Check at most this many bundles.'),
+            Commands.Argument('-t', '--max-time', type=float, help='Stop after this many seconds.'),
+            Commands.Argument('--restart', action='store_true', help='Start a new pass over the store instead of resuming.'),
+        ),
+    )
+    def do_scrub_store_command(self, args):
+        """
+        Incrementally rehash the bundles of the bundle store and report mismatches.
+        """
+        self._fail_if_headless('scrub-store')
+        self._fail_if_not_local('scrub-store')
+        client = self.manager.current_client()
+        scrubber = Scrubber(client.bundle_store, formatting.parse_size(args.rate), args.iops)
+        def report(data_hash, path, actual_hash):
+            print >>self.stdout, 'MISMATCH %s at %s: %s' % (data_hash, path, actual_hash)
+        metrics = scrubber.run(args.max_bundles, args.max_time, args.restart, report)
+        print >>self.stdout, 'Checked %d bundles (%d files, %s) in %.1fs: %s/s, %.0f ops/s, %.1fs throttled.' % (
+            metrics['num_bundles'], metrics['num_files'], formatting.size_str(metrics['num_bytes']),
+            metrics['elapsed'], formatting.size_str(metrics['bytes_per_second']), metrics['ops_per_second'],
+            metrics['sleep_time'])
+        print >>self.stdout, 'Probe latency: %.1fms before, %s while scrubbing.' % (
+            metrics['probe_baseline'] * 1000,
+            'n/a' if metrics['probe_mean'] is None else
+            '%.1fms mean, %.1fms max' % (metrics['probe_mean'] * 1000, metrics['probe_max'] * 1000))
+        mismatches = scrubber.load_state()['mismatches']
+        print >>self.stdout, '%d mismatches in total (see %s).' % (len(mismatches), scrubber.state_path)
 
     @Commands.command(
         'reset',
@@ -3,20 +3,92 @@ BundleStore is a data store that stores actual bundle data. Bundles are logical
 folders within this data store. This class provides two main methods:
   get_location: return the location of the folder with the given data hash.
   upload: upload a local directory to the store and return its data hash.
+Alongside the data of each bundle, the store keeps its Manifest in manifests/,
+which get_target_info uses to describe the bundle without walking it. New
+bundles are staged in temp/ (see StagingArea), so that moving them into data/
+is a rename.
+
+Optionally, files are deduplicated across bundles: each file is hardlinked to
+an object in objects/ named by its contents hash and permissions, and files
+with the same name there share it. Pooled files are read-only, since writing to
+one would change every bundle that contains it.
+
+Optionally, large files are stored as content-defined chunks in a ChunkStore,
+so that near-duplicate files share storage. Their data/ entries are left empty,
+targets in such a bundle are read from the chunks, and ensure_local reassembles
+the bundle in materialized/ when a run needs it. Materialized bundles are
+evicted least recently used first. Finding the chunks runs at only about 20
+MB/s (see scripts/benchmark-chunking.py), so this slows down uploads of large
+files.
+
+Bundles are stored in one of two layouts under data/:
+  flat: data/0xabcdef..., one directory for all bundles.
+  sharded: data/ab/cd/0xabcdef..., which keeps directories small when there are
+    many bundles.
+New bundles go into the configured layout, but bundles are found in either, so
+an existing store can be moved to the sharded layout incrementally (see
+migrate_to_sharded) while it is in use.
+
+Bundles can be spread over several volumes (see Volume): codalab_home itself
+and any number of other directories, each on its own disk, with its own data/,
+temp/ and objects/. A new bundle is placed on a volume according to the
+placement policy, and the VolumeIndex records which one, so that get_location
+finds it on any volume. rebalance moves bundles from fuller volumes to emptier
+ones while the store is in use.
+
+Bundles that have not been used for a while can be moved to a cold tier (see
+freeze and ColdStore), where each is a compressed archive. Single files and
+information about a cold bundle are read from its archive, and ensure_local
+unpacks it onto a volume again when a run needs it as a dependency.
+
+Optionally, new bundles are stored in a StorageBackend (see storage_backend)
+instead of data/, e.g., an object store, so that storage scales independently
+of the server. Each file of a bundle is an object under data/<data hash> and
+each symlink an object containing its target; the Manifest, which is put last,
+records the directories and permissions and marks the bundle as complete.
+Targets in such a bundle are read from the backend in ranges, and ensure_local
+fetches the whole bundle into materialized/ when a run needs it, which thus
+acts as a cache of the backend, evicted least recently used first.
+
+The archives that targets are packed into for downloads are cached in
+archive_cache/ (see ArchiveCache), since they never change either.
+
+Optionally, new bundles get data hashes in the Merkle format (see
+path_util.hash_merkle_tree), which are told apart from the others by their
+prefix, so both kinds coexist in a store. The same data uploaded with and
+without it gets two data hashes, and is stored twice.
 '''
 import errno
+import itertools
 import os
+import stat
 import time
 import sys
 import uuid
-import tempfile
+from cStringIO import StringIO
 
-from codalab.lib import path_util, file_util, print_util, zip_util
+from codalab.lib import path_util, file_util, formatting, possession, print_util, zip_util
+from codalab.lib.archive_cache import ArchiveCache
+from codalab.lib.chunk_store import ChunkStore
+from codalab.lib.cold_store import ColdStore
+from codalab.lib.hash_cache import HashCache
+from codalab.lib.manifest import Manifest
+from codalab.lib.volume import Volume, VolumeIndex
 from codalab.common import UsageError
 
 class BundleStore(object):
-    DATA_SUBDIRECTORY = 'data'
-    TEMP_SUBDIRECTORY = 'temp'
+    DATA_SUBDIRECTORY = Volume.DATA_SUBDIRECTORY
+    TEMP_SUBDIRECTORY = Volume.TEMP_SUBDIRECTORY
+    MANIFEST_SUBDIRECTORY = 'manifests'
+    OBJECT_SUBDIRECTORY = Volume.OBJECT_SUBDIRECTORY
+    CHUNK_STORE_SUBDIRECTORY = 'chunk_store'
+    MATERIALIZED_SUBDIRECTORY = 'materialized'
+    COLD_SUBDIRECTORY = 'cold'
+    ARCHIVE_CACHE_SUBDIRECTORY = 'archive_cache'
+
+    # Prefixes of the keys of bundle files and of Manifests in the backend.
+    BACKEND_DATA_PREFIX = 'data/'
+    BACKEND_MANIFEST_PREFIX = 'manifests/'
 
     # The amount of time a folder can live in the data and temp
     # directories before it is garbage collected by full_cleanup.
@@ -25,38 +97,633 @@ class BundleStore(object):
     DATA_CLEANUP_TIME = 60
     TEMP_CLEANUP_TIME = 60*60
 
-    def __init__(self, codalab_home):
+    # full_cleanup deletes unreferenced data in batches of this many bundles.
+    CLEANUP_BATCH_SIZE = 100
+
+    # Persistent cache of file hashes (see HashCache). Entries that have not
+    # been used for this long are evicted by full_cleanup.
+    HASH_CACHE_FILE = 'hash_cache.db'
+    HASH_CACHE_CLEANUP_TIME = 60*60*24*30
+
+    # Files smaller than this are not worth deduplicating.
+    DEDUP_MIN_SIZE = 4096
+
+    # Files smaller than this are not worth storing as chunks.
+    CHUNK_MIN_FILE_SIZE = 64 * 1024 * 1024
+    # Default total size of the chunked files in materialized bundles, which
+    # are evicted once they have not been used for MATERIALIZED_MIN_AGE.
+    MATERIALIZED_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+    MATERIALIZED_MIN_AGE = 60*60*24
+
+    # Default total size of the cached archives of downloaded targets (see
+    # ArchiveCache).
+    ARCHIVE_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+    # Default time after which freeze moves unused bundles to the cold tier.
+    # Bundles are marked as used (by their mtime) at most once per
+    # USE_TIME_RESOLUTION.
+    COLD_AGE = 60*60*24*30
+    USE_TIME_RESOLUTION = 60*60*24
+
+    # In the sharded layout, a bundle is stored under SHARD_DEPTH levels of
+    # directories named by consecutive SHARD_WIDTH-character pieces of its hash.
+    SHARD_DEPTH = 2
+    SHARD_WIDTH = 2
+
+    # Placement policies for new bundles: the volume with the most available
+    # space, or each volume in turn (skipping those without room for the bundle).
+    MOST_FREE = 'most_free'
+    ROUND_ROBIN = 'round_robin'
+    PLACEMENT_POLICIES = (MOST_FREE, ROUND_ROBIN)
+    VOLUME_INDEX_FILE = 'volumes.db'
+
+    # rebalance stops once the fractions of free space of the volumes are
+    # within this much of each other.
+    REBALANCE_TOLERANCE = 0.05
+
+    def __init__(self, codalab_home, sharded=False, dedup=False, chunked=False, materialized_cache_size=None,
+                 volumes=None, placement=None, cold_age=None, backend=None, archive_cache_size=None, merkle=False):
         '''
         codalab_home: data/ is where all the bundles are actually stored, temp/ is temporary
+        sharded: whether to store new bundles in the sharded layout
+        dedup: whether to hardlink identical files of new bundles to the object pool
+        chunked: whether to store large files of new bundles as chunks
+        materialized_cache_size: bytes of reassembled files to keep in materialized/
+        volumes: roots of other volumes to store bundles on, besides codalab_home
+        placement: which volume to store new bundles on (one of PLACEMENT_POLICIES)
+        cold_age: seconds after which freeze moves unused bundles to the cold tier
+        backend: StorageBackend to store new bundles in, instead of data/
+        archive_cache_size: bytes of archives of downloaded targets to keep
+        merkle: whether to give new bundles data hashes in the Merkle format
         '''
         self.codalab_home = path_util.normalize(codalab_home)
-        self.data = os.path.join(self.codalab_home, self.DATA_SUBDIRECTORY)
-        self.temp = os.path.join(self.codalab_home, self.TEMP_SUBDIRECTORY)
+        self.sharded = sharded
+        self.dedup = dedup
+        self.chunked = chunked
+        self.merkle = merkle
+        self.materialized_cache_size = materialized_cache_size or self.MATERIALIZED_CACHE_SIZE
+        self.cold_age = cold_age or self.COLD_AGE
+        self.backend = backend
+        self.placement = placement or self.MOST_FREE
+        if self.placement not in self.PLACEMENT_POLICIES:
+            raise UsageError('Unknown placement policy %s (must be one of %s)' % (
+                self.placement, ', '.join(self.PLACEMENT_POLICIES)))
+        # The first volume is codalab_home, whose data/, temp/ and objects/ are
+        # also used for everything that is not specific to a bundle.
+        self.volumes = [Volume(self.codalab_home)] + [Volume(path_util.normalize(root)) for root in volumes or []]
+        self.data = self.volumes[0].data
+        self.temp = self.volumes[0].temp
+        self.objects = self.volumes[0].objects
+        self.staging = self.volumes[0].staging
+        self.manifests = os.path.join(self.codalab_home, self.MANIFEST_SUBDIRECTORY)
+        self.materialized = os.path.join(self.codalab_home, self.MATERIALIZED_SUBDIRECTORY)
         self.make_directories()
+        self.volume_index = VolumeIndex(os.path.join(self.codalab_home, self.VOLUME_INDEX_FILE))
+        self.volume_counter = itertools.count()
+        self.hash_cache = HashCache(os.path.join(self.codalab_home, self.HASH_CACHE_FILE))
+        self.chunk_store = ChunkStore(os.path.join(self.codalab_home, self.CHUNK_STORE_SUBDIRECTORY))
+        self.cold = ColdStore(os.path.join(self.codalab_home, self.COLD_SUBDIRECTORY))
+        self.archive_cache = ArchiveCache(os.path.join(self.codalab_home, self.ARCHIVE_CACHE_SUBDIRECTORY),
+                                          self.ARCHIVE_CACHE_SIZE if archive_cache_size is None else archive_cache_size)
 
     def _reset(self):
         '''
         Delete all stored bundles and then recreate the root directories.
         '''
         # Do not run this function in production!
-        path_util.remove(self.data)
-        path_util.remove(self.temp)
+        for volume in self.volumes:
+            path_util.remove(volume.data)
+            path_util.remove(volume.temp)
+            path_util.remove(volume.objects)
+        path_util.remove(self.manifests)
+        path_util.remove(self.materialized)
+        path_util.remove(self.chunk_store.root)
+        path_util.remove(self.cold.root)
+        path_util.remove(self.archive_cache.root)
+        if self.backend is not None:
+            for key in self.backend.list(self.BACKEND_DATA_PREFIX) + self.backend.list(self.BACKEND_MANIFEST_PREFIX):
+                self.backend.delete(key)
         self.make_directories()
+        self.volume_index.clear()
+        self.hash_cache.clear()
+        self.chunk_store = ChunkStore(self.chunk_store.root)
+        self.cold = ColdStore(self.cold.root)
+        self.archive_cache = ArchiveCache(self.archive_cache.root, self.archive_cache.max_size)
 
     def make_directories(self):
         '''
-        Create the data, and temp directories for this BundleStore.
+        Create the data, temp and objects directories of each volume, and the
+        manifests and materialized directories for this BundleStore.
         '''
-        for path in (self.data, self.temp):
+        for volume in self.volumes:
+            volume.make_directories()
+        for path in (self.manifests, self.materialized):
             path_util.make_directory(path)
 
     def get_location(self, data_hash, relative=False):
         '''
-        Returns the on-disk location of the bundle with the given data hash.
+        Returns the on-disk location of the bundle with the given data hash. This
+        never unpacks or fetches anything, so the location of a bundle that is
+        only in the cold tier or the backend does not exist until ensure_local is
+        called (see is_local), and neither does that of a bundle with chunked
+        files, which is reassembled in materialized/.
+        If relative, return it relative to the directory that a new bundle would
+        be stored in, which is what a symlink from a new bundle needs. Copies in
+        materialized/ can be evicted, so they can't be linked to.
         '''
+        path = self._find_path(data_hash)
+        if path is not None and self._is_chunked(data_hash):
+            # Where _materialize puts it.
+            path = os.path.join(self.materialized, data_hash)
+        elif path is None and self.backend is not None and not self.cold.contains(data_hash):
+            # Where _fetch puts it.
+            path = os.path.join(self.materialized, data_hash)
+        if path is None:
+            path = os.path.join(self.data, self._get_locations(data_hash)[0])
         if relative:
-            return data_hash
-        return os.path.join(self.data, data_hash)
+            if path.startswith(self.materialized + os.sep):
+                raise UsageError('Can\'t link to %s, which is only materialized temporarily' % (data_hash,))
+            # New bundles are _get_depth() directories deep under data/.
+            return os.path.relpath(path, os.path.join(self.data, *(['shard'] * self._get_depth())))
+        return path
+
+    def ensure_local(self, data_hash):
+        '''
+        Make sure that the bundle with the given data hash is on local disk, where
+        get_location finds it, unpacking it first if it is cold or fetching it if
+        it is in the backend, and return its location. This is for bundles that a
+        run needs as a dependency; other readers read bundles from where they are
+        stored (see open_stored_target), so that reading a bundle doesn't
+        unfreeze or download it.
+        '''
+        path = self._find_path(data_hash)
+        if path is None and self.cold.contains(data_hash):
+            path = self._thaw(data_hash)
+        if path is not None:
+            self._mark_used(path)
+            chunked_files = self._list_chunked_files(data_hash)
+            if chunked_files:
+                self._materialize(data_hash, chunked_files)
+        elif self.backend is not None:
+            self._fetch(data_hash)
+        return self.get_location(data_hash)
+
+    def _list_chunked_files(self, data_hash):
+        '''
+        Return ChunkStore.list_files for the bundle with the given data hash,
+        without querying the chunk store unless chunking is enabled or the
+        Manifest of the bundle says it has chunked files.
+        '''
+        if not self.chunked:
+            try:
+                if not Manifest.load(self.get_manifest_location(data_hash)).chunked:
+                    return []
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return []
+        return self.chunk_store.list_files(data_hash)
+
+    def _is_chunked(self, data_hash):
+        return bool(self._list_chunked_files(data_hash))
+
+    def get_data_path(self, data_hash):
+        '''
+        Return the path of the bundle with the given data hash in data/ of any
+        volume, or None if it is not there. The chunked files of a bundle are
+        empty there.
+        '''
+        return self._find_path(data_hash)
+
+    def _mark_used(self, path):
+        '''
+        Record that the bundle at |path| was just used by a run, so that freeze
+        leaves it alone, by updating its mtime (at most once per
+        USE_TIME_RESOLUTION).
+        '''
+        try:
+            if os.stat(path).st_mtime < time.time() - self.USE_TIME_RESOLUTION:
+                os.utime(path, None)
+        except OSError, e:
+            # E.g., the store is read-only for this process.
+            if e.errno not in (errno.EPERM, errno.EACCES, errno.EROFS, errno.ENOENT):
+                raise
+
+    def _get_depth(self):
+        '''
+        Return how many directories deep under data/ new bundles are stored.
+        '''
+        return self.SHARD_DEPTH if self.sharded else 0
+
+    def _get_sharded_location(self, data_hash):
+        '''
+        Return the location relative to data/ of the given data hash in the
+        sharded layout.
+        '''
+        digest = path_util.get_data_hash_digest(data_hash)
+        shards = [digest[i * self.SHARD_WIDTH:(i + 1) * self.SHARD_WIDTH] for i in range(self.SHARD_DEPTH)]
+        return os.path.join(*(shards + [data_hash]))
+
+    def _get_locations(self, data_hash):
+        '''
+        Return the locations relative to data/ where the given data hash could be
+        stored, starting with the one where it would be uploaded to.
+        '''
+        locations = [data_hash, self._get_sharded_location(data_hash)]
+        if self.sharded:
+            locations.reverse()
+        return locations
+
+    def _find_path(self, data_hash):
+        '''
+        Return the path where the given data hash is stored, on any volume, or
+        None if it is not in the store. The volume in the index is tried first.
+        '''
+        volumes = self.volumes
+        if len(volumes) > 1:
+            root = self.volume_index.lookup(data_hash)
+            volumes = sorted(volumes, key=lambda volume: volume.root != root)
+        for volume in volumes:
+            for location in self._get_locations(data_hash):
+                path = os.path.join(volume.data, location)
+                if os.path.lexists(path):
+                    return path
+        return None
+
+    def _split_data_path(self, path):
+        '''
+        Given a path under data/ of any volume, return the (data hash, relative
+        path within the bundle) that it refers to, in either layout, or None.
+        '''
+        for volume in self.volumes:
+            if path.startswith(volume.data + os.sep):
+                components = path[len(volume.data):].split(os.sep)[1:]
+                if components and not components[0].startswith('0x'):
+                    components = components[self.SHARD_DEPTH:]
+                if not components:
+                    return None
+                return (components[0], ''.join(os.sep + component for component in components[1:]))
+        return None
+
+    def list_data_hashes(self, volume=None):
+        '''
+        Return a dict from each data hash on |volume| (by default, the first one)
+        to its location relative to its data/.
+        '''
+        data = (volume or self.volumes[0]).data
+        result = {}
+        shards = ['']
+        for _ in range(self.SHARD_DEPTH):
+            shards = [
+                os.path.join(shard, name)
+                for shard in shards
+                for name in os.listdir(os.path.join(data, shard))
+                if len(name) == self.SHARD_WIDTH and not name.startswith('0x')
+            ]
+        for shard in shards:
+            for name in os.listdir(os.path.join(data, shard)):
+                result[name] = os.path.join(shard, name)
+        # Bundles in the flat layout, skipping links left behind by migrate_to_sharded.
+        for name in os.listdir(data):
+            if name.startswith('0x') and name not in result:
+                result[name] = name
+        return result
+
+    def _get_volume(self, path):
+        '''
+        Return the volume whose data/ |path| is in.
+        '''
+        for volume in self.volumes:
+            if path.startswith(volume.data + os.sep):
+                return volume
+        raise UsageError('Not in the bundle store: %s' % (path,))
+
+    def contains(self, data_hash):
+        '''
+        Return whether the store has the data with the given data hash, in
+        data/ of any volume, the cold tier or the backend.
+        '''
+        if self._find_path(data_hash) is not None or self.cold.contains(data_hash):
+            return True
+        return self.backend is not None and self.backend.stat(self._get_manifest_key(data_hash)) is not None
+
+    def claim(self, data_hash):
+        '''
+        Return whether the store still has the data with the given data hash, for
+        a new bundle that is about to reference it. Like upload, mark the data as
+        recently used, since full_cleanup leaves recent data alone.
+        '''
+        for path in (self._find_path(data_hash), self.cold.get_location(data_hash)):
+            if path is None:
+                continue
+            try:
+                os.utime(path, None)
+                return True
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return self.contains(data_hash)
+
+    def list_data_paths(self):
+        '''
+        Return a dict from each data hash in the store to its path, on any volume.
+        '''
+        result = {}
+        for volume in reversed(self.volumes):
+            for (data_hash, location) in self.list_data_hashes(volume).iteritems():
+                result[data_hash] = os.path.join(volume.data, location)
+        return result
+
+    def get_manifest_location(self, data_hash):
+        '''
+        Returns the location of the Manifest of the bundle with the given data
+        hash. Manifests are always stored in the sharded layout.
+        '''
+        return os.path.join(self.manifests, self._get_sharded_location(data_hash) + '.json')
+
+    def get_manifest(self, data_hash):
+        '''
+        Returns the Manifest of the bundle with the given data hash, or None if
+        it does not have one (e.g., it was uploaded before manifests were saved).
+        Manifests that are only in the backend are downloaded to manifests/.
+        '''
+        manifest_path = self.get_manifest_location(data_hash)
+        try:
+            return Manifest.load(manifest_path)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        if self.backend is None:
+            return None
+        self._make_shard_directories(self.manifests, manifest_path)
+        temp_path = os.path.join(os.path.dirname(manifest_path), '.manifest-' + uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'wb') as f:
+                self.backend.get(self._get_manifest_key(data_hash), f)
+            os.rename(temp_path, manifest_path)
+        except KeyError:
+            return None
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return Manifest.load(manifest_path)
+
+    def _get_manifest_key(self, data_hash):
+        return self.BACKEND_MANIFEST_PREFIX + data_hash + '.json'
+
+    def _get_backend_key(self, data_hash, relative_path):
+        '''
+        Return the key in the backend of the file or symlink at |relative_path|
+        (as returned by path_util.get_relative_path) in the bundle with the
+        given data hash.
+        '''
+        return self.BACKEND_DATA_PREFIX + data_hash + relative_path.replace(os.sep, '/')
+
+    def list_backend_data_hashes(self):
+        '''
+        Return the data hashes of the complete bundles in the backend.
+        '''
+        if self.backend is None:
+            return []
+        prefix = self.BACKEND_MANIFEST_PREFIX
+        return [key[len(prefix):-len('.json')] for key in self.backend.list(prefix) if key.endswith('.json')]
+
+    def get_target_info(self, data_hash, subpath, depth):
+        '''
+        Return path_util.get_info of |subpath| in the bundle with the given data
+        hash as recorded in its Manifest, or None if it has to be computed from
+        the filesystem (there is no Manifest, or the target is or goes through a
+        symlink, or it does not exist).
+        '''
+        if subpath and (os.path.normpath(subpath) != subpath or subpath.startswith(os.pardir)):
+            return None
+        relative_path = os.sep + subpath if subpath else ''
+        if self.is_cold(data_hash):
+            return self.cold.get_info(data_hash, relative_path, depth)
+        manifest = self.get_manifest(data_hash)
+        if manifest is None:
+            return None
+        # Only symlinks are described from the filesystem: those of a bundle
+        # with chunked files from data/, and those of a bundle that is only in
+        # the backend from there.
+        path = self.get_location(data_hash)
+        if not os.path.lexists(path):
+            path = self._find_path(data_hash) or path
+        if self.backend is None or os.path.lexists(path):
+            return manifest.get_info(path_util.safe_join(path, subpath), relative_path, depth)
+        resolved_path = self._resolve_in_backend(data_hash, manifest, relative_path)
+        if resolved_path is None:
+            return {'name': os.path.basename(subpath) or data_hash}
+        if manifest.entries[resolved_path].type == Manifest.LINK:
+            raise UsageError('Following symlink disallowed: %s' % (subpath,))
+        return manifest.get_info(
+            path_util.safe_join(path, subpath), resolved_path, depth,
+            get_link_info=lambda link_path, link_relative_path:
+                self._get_backend_link_info(data_hash, manifest, link_path, link_relative_path))
+
+    def _resolve_in_backend(self, data_hash, manifest, relative_path):
+        '''
+        Return the relative path of the entry of |manifest| at |relative_path| in
+        the bundle with the given data hash in the backend, following the
+        symlinks on the way that stay within the bundle (like ColdStore), or None
+        if there is no such entry.
+        '''
+        name = ''
+        components = [component for component in relative_path.split(os.sep) if component]
+        num_links = 0
+        while components:
+            component = components.pop(0)
+            entry = manifest.entries.get(os.sep + name if name else '')
+            if entry is None:
+                return None
+            if entry.type == Manifest.LINK:
+                num_links += 1
+                link = self.backend.get_range(self._get_backend_key(data_hash, os.sep + name))
+                target = os.path.normpath(os.path.join(os.path.dirname(name), link))
+                if num_links > ColdStore.MAX_LINK_DEPTH or os.path.isabs(target) or \
+                        target == os.pardir or target.startswith(os.pardir + os.sep):
+                    return None
+                name = target if target != os.curdir else ''
+                components.insert(0, component)
+                continue
+            if component == os.pardir:
+                if not name:
+                    return None
+                name = os.path.dirname(name)
+            elif component != os.curdir:
+                name = os.path.join(name, component)
+        relative_path = os.sep + name if name else ''
+        return relative_path if relative_path in manifest.entries else None
+
+    def _get_backend_link_info(self, data_hash, manifest, path, relative_path):
+        '''
+        Return what path_util.get_info returns for the symlink at |relative_path|
+        in the bundle with the given data hash in the backend, which would be at
+        |path|, without its contents.
+        '''
+        target = self.backend.get_range(self._get_backend_key(data_hash, relative_path))
+        result = {'name': os.path.basename(path), 'link': target}
+        target_path = self._resolve_in_backend(data_hash, manifest, relative_path + os.sep + os.curdir)
+        if target_path is None:
+            return result
+        entry = manifest.entries[target_path]
+        if entry.type == Manifest.FILE:
+            result['type'] = 'file'
+            result['size'] = len(target)
+        elif entry.type == Manifest.DIRECTORY:
+            result['type'] = 'directory'
+        result['perm'] = entry.perm & 0777
+        return result
+
+    def is_cold(self, data_hash):
+        '''
+        Return whether the bundle with the given data hash is only in the cold tier.
+        '''
+        return self._find_path(data_hash) is None and self.cold.contains(data_hash)
+
+    def is_local(self, data_hash):
+        '''
+        Return whether the bundle with the given data hash can be read at its
+        get_location. Targets in other bundles, which are only in the cold tier
+        or the backend, or have chunked files, are read from where they are
+        stored (see open_stored_target).
+        '''
+        return os.path.lexists(self.get_location(data_hash))
+
+    def _resolve_in_data(self, path, subpath):
+        '''
+        Return the relative path of the target at |subpath| in the bundle at
+        |path| in data/, following the symlinks on the way that stay within the
+        bundle, or None if there is no such target. Raise a UsageError if the
+        target is a symlink, since those are not followed.
+        '''
+        target_path = path_util.safe_join(path, subpath)
+        if os.path.islink(target_path):
+            raise UsageError('Following symlink disallowed: %s' % (subpath,))
+        if not os.path.exists(target_path):
+            return None
+        (root, real_path) = (os.path.realpath(path), os.path.realpath(target_path))
+        if real_path != root and not real_path.startswith(root + os.sep):
+            return None
+        return path_util.get_relative_path(root, real_path)
+
+    def _get_chunked_contents_hash(self, data_hash, relative_path):
+        for (chunked_path, contents_hash, _) in self._list_chunked_files(data_hash):
+            if chunked_path == relative_path:
+                return contents_hash
+        return None
+
+    def _get_backend_target(self, data_hash, subpath):
+        '''
+        Return the (Manifest, relative path of the entry) of |subpath| in the
+        bundle with the given data hash in the backend, or None if there is no
+        such target. Raise a UsageError if the target is a symlink, since those
+        are not followed.
+        '''
+        manifest = self.get_manifest(data_hash) if self.backend is not None else None
+        if manifest is None:
+            return None
+        relative_path = self._resolve_in_backend(data_hash, manifest, os.sep + subpath if subpath else '')
+        if relative_path is None:
+            return None
+        if manifest.entries[relative_path].type == Manifest.LINK:
+            raise UsageError('Following symlink disallowed: %s' % (subpath,))
+        return (manifest, relative_path)
+
+    def open_stored_target(self, data_hash, subpath):
+        '''
+        Return a file object to read |subpath| in the bundle with the given data
+        hash from where it is stored when it is not local: from data/ and its
+        chunks if it has chunked files, from its archive if it is cold, or
+        streamed from the backend. Return None if it is not a file.
+        '''
+        data_path = self._find_path(data_hash)
+        if data_path is not None:
+            relative_path = self._resolve_in_data(data_path, subpath)
+            if relative_path is None or not os.path.isfile(data_path + relative_path):
+                return None
+            contents_hash = self._get_chunked_contents_hash(data_hash, relative_path)
+            if contents_hash is None:
+                return open(data_path + relative_path, 'rb')
+            return self.chunk_store.open(contents_hash)
+        if self.cold.contains(data_hash):
+            return self.cold.open(data_hash, os.sep + subpath if subpath else '')
+        target = self._get_backend_target(data_hash, subpath)
+        if target is None or target[0].entries[target[1]].type != Manifest.FILE:
+            return None
+        return self.backend.open(self._get_backend_key(data_hash, target[1]))
+
+    def read_range(self, data_hash, relative_path, offset, length):
+        '''
+        Return up to |length| bytes of the file at |relative_path| (as returned by
+        path_util.get_relative_path) in the bundle with the given data hash
+        starting at |offset|, reading a bundle that is not local from its
+        chunks, its archive or the backend.
+        '''
+        if not self.is_local(data_hash):
+            data_path = self._find_path(data_hash)
+            if data_path is not None:
+                contents_hash = self._get_chunked_contents_hash(data_hash, relative_path)
+                if contents_hash is not None:
+                    return self.chunk_store.read_range(contents_hash, offset, length)
+                return possession.read_file_range(data_path + relative_path, offset, length)
+            if self.cold.contains(data_hash):
+                return self.cold.read_range(data_hash, relative_path, offset, length)
+            if self.backend is not None:
+                return self.backend.get_range(self._get_backend_key(data_hash, relative_path), offset, length)
+        return possession.read_file_range(self.get_location(data_hash) + relative_path, offset, length)
+
+    def export_stored_target(self, data_hash, subpath, dest_path):
+        '''
+        Copy just |subpath| in the bundle with the given data hash, which is not
+        local, to |dest_path| from where it is stored, leaving the bundle where it
+        is. Return False if there is no such target.
+        '''
+        data_path = self._find_path(data_hash)
+        if data_path is not None:
+            relative_path = self._resolve_in_data(data_path, subpath)
+            if relative_path is None:
+                return False
+            # Copy it with the chunked files empty, and then fill those in.
+            path_util.copy_tree(data_path + relative_path, dest_path)
+            for (chunked_path, contents_hash, _) in self._list_chunked_files(data_hash):
+                if chunked_path != relative_path and not chunked_path.startswith(relative_path + os.sep):
+                    continue
+                file_path = dest_path + chunked_path[len(relative_path):]
+                perm = stat.S_IMODE(os.lstat(file_path).st_mode)
+                os.chmod(file_path, perm | stat.S_IWUSR)
+                with open(file_path, 'wb') as f:
+                    self.chunk_store.read(contents_hash, f)
+                os.chmod(file_path, perm)
+            return True
+        if self.cold.contains(data_hash):
+            return self.cold.unpack(data_hash, dest_path, os.sep + subpath if subpath else '')
+        target = self._get_backend_target(data_hash, subpath)
+        if target is None:
+            return False
+        self._download(data_hash, target[0], target[1], dest_path)
+        return True
+
+    def stage_stored_target(self, data_hash, subpath):
+        '''
+        Export |subpath| in the bundle with the given data hash, which is not
+        local, into a new staging directory, e.g., to pack it into an archive,
+        and return its path, or None if there is no such target. The caller
+        removes it with discard_staged_target.
+        '''
+        temp_path = self.staging.create('bundle_store_export')
+        path = os.path.join(temp_path, os.path.basename(subpath) or data_hash)
+        try:
+            if self.export_stored_target(data_hash, subpath, path):
+                return path
+        except:
+            self.staging.discard(temp_path)
+            raise
+        self.staging.discard(temp_path)
+        return None
+
+    def discard_staged_target(self, path):
+        self.staging.discard(os.path.dirname(path))
 
     def get_temp_location(self, identifier):
         '''
@@ -71,7 +738,7 @@ class BundleStore(object):
         path_util.make_directory(self.get_temp_location(identifier));
 
 
-    def upload(self, sources, follow_symlinks, exclude_patterns, git, unpack, remove_sources):
+    def upload(self, sources, follow_symlinks, exclude_patterns, git, unpack, remove_sources, copied_from=None, packed=False):
         '''
         |sources|: specifies the locations of the contents to upload.  Each element is either a URL or a local path.
         |follow_symlinks|: for local path(s), whether to follow (resolve) symlinks
@@ -79,6 +746,12 @@ class BundleStore(object):
         |git|: for URL, whether |source| is a git repo to clone.
         |unpack|: for each source in |sources|, whether to unpack it if it's an archive.
         |remove_sources|: remove |sources|.
+        |copied_from|: list of (path, source_path) pairs, where |path| is inside
+            one of the |sources| and is an unmodified copy of |source_path| (e.g.,
+            dependencies of a MakeBundle).  Only used to look up known hashes.
+        |packed|: whether |sources| are named with zip_util.add_packed_suffix
+            (e.g., uploads packed by a RemoteBundleClient), so that uncompressed
+            tar archives are unpacked as well.
 
         If |sources| contains one source, then the bundle contents will be that source.
         Otherwise, the bundle contents will be a directory with each of the sources.
@@ -92,17 +765,92 @@ class BundleStore(object):
         Return a (data_hash, metadata) pair, where the metadata is a dict mapping
         keys to precomputed statistics about the new data directory.
         '''
+        for source in sources:
+            if not path_util.path_is_url(source):
+                path_util.check_isvalid(path_util.normalize(source), 'upload')
+
+        # Create a staging directory in temp/ of the volume that the bundle goes
+        # on and put everything there. Space is reserved for the local files
+        # that are copied or unpacked into it, whose size is known right away,
+        # and for the files in directories once copying them has walked them.
+        num_bytes = 0
+        if not remove_sources:
+            for source in sources:
+                if not path_util.path_is_url(source):
+                    source_path = path_util.normalize(source)
+                    if not os.path.isdir(source_path):
+                        num_bytes += os.path.getsize(source_path)
+        volume = self._choose_volume(sources, remove_sources, num_bytes)
+        temp_path = volume.staging.create('bundle_store_upload', num_bytes)
+        try:
+            return self._upload(volume, temp_path, sources, follow_symlinks, exclude_patterns, git, unpack, remove_sources, copied_from, packed)
+        except:
+            volume.staging.discard(temp_path)
+            raise
+        finally:
+            volume.staging.release(temp_path)
+
+    def _choose_volume(self, sources, remove_sources, num_bytes):
+        '''
+        Return the volume to upload |sources| to. Sources that are removed stay on
+        their volume, so that they are moved with a rename instead of a copy;
+        otherwise, the placement policy decides.
+        '''
+        if len(self.volumes) == 1:
+            return self.volumes[0]
+        if remove_sources:
+            for source in sources:
+                if not path_util.path_is_url(source):
+                    source_path = path_util.normalize(source)
+                    for volume in self.volumes:
+                        if volume.contains(source_path):
+                            return volume
+        return self._place(num_bytes)
+
+    def _place(self, num_bytes):
+        '''
+        Return the volume that a new bundle of |num_bytes| goes on according to
+        the placement policy.
+        '''
+        if self.placement == self.ROUND_ROBIN:
+            volumes = [volume for volume in self.volumes if volume.get_space()[0] >= num_bytes] or self.volumes
+            return volumes[next(self.volume_counter) % len(volumes)]
+        return max(self.volumes, key=lambda volume: volume.get_space()[0])
+
+    def get_staging_area(self):
+        '''
+        Return the StagingArea of the volume that the placement policy picks for
+        a new bundle, in which files that are uploaded to the store later can be
+        put together, so that they are then moved into place with a rename.
+        '''
+        return self._place(0).staging
+
+    def _upload(self, volume, temp_path, sources, follow_symlinks, exclude_patterns, git, unpack, remove_sources, copied_from, packed):
+        '''
+        Helper for upload that puts everything into the staging directory
+        |temp_path| on |volume| and moves the result into place.
+        '''
         to_delete = []
+        # (path, source_path) pairs: files under path are copies of files under
+        # source_path, so we can look their hashes up by source_path.
+        copied_paths = []
 
-        # Create temporary directory as a staging area and put everything there.
-        temp_path = tempfile.mkdtemp('-bundle_store_upload')
+        # Files that are copied or unpacked are hashed on the way in; everything
+        # else is walked and hashed afterwards. Copied and walked files are
+        # looked up in the hash cache first.
         temp_subpaths = []
+        manifests = []
+        if packed:
+            (is_archive, strip_archive_ext) = (zip_util.path_is_packed, zip_util.strip_packed_ext)
+        else:
+            (is_archive, strip_archive_ext) = (zip_util.path_is_archive, zip_util.strip_archive_ext)
         for source in sources:
             # Where to save |source| to (might change this value if we unpack).
             temp_subpath = os.path.join(temp_path, os.path.basename(source))
             if remove_sources:
                 to_delete.append(source)
-            source_unpack = unpack and zip_util.path_is_archive(source)
+            source_unpack = unpack and is_archive(source)
+            manifest = None
 
             if path_util.path_is_url(source):
                 # Download the URL.
@@ -112,92 +860,670 @@ class BundleStore(object):
                 else:
                     file_util.download_url(source, temp_subpath, print_status=True)
                     if source_unpack:
-                        zip_util.unpack(temp_subpath, zip_util.strip_archive_ext(temp_subpath))
+                        manifest = zip_util.unpack(temp_subpath, strip_archive_ext(temp_subpath))
                         path_util.remove(temp_subpath)
-                        temp_subpath = zip_util.strip_archive_ext(temp_subpath)
+                        temp_subpath = strip_archive_ext(temp_subpath)
                 print_util.clear_line()
             else:
                 # Copy the local path.
                 source_path = path_util.normalize(source)
-                path_util.check_isvalid(source_path, 'upload')
 
                 # Recursively copy the directory into a new BundleStore temp directory.
                 print_util.open_line('BundleStore.upload: %s => %s' % (source_path, temp_subpath))
                 if source_unpack:
-                    zip_util.unpack(source_path, zip_util.strip_archive_ext(temp_subpath))
-                    temp_subpath = zip_util.strip_archive_ext(temp_subpath)
+                    manifest = zip_util.unpack(source_path, strip_archive_ext(temp_subpath))
+                    temp_subpath = strip_archive_ext(temp_subpath)
                 else:
                     if remove_sources:
                         path_util.rename(source_path, temp_subpath)
                     else:
-                        path_util.copy(source_path, temp_subpath, follow_symlinks=follow_symlinks, exclude_patterns=exclude_patterns)
+                        # upload reserved space for files already, but not for
+                        # the contents of directories.
+                        reserve = None
+                        if os.path.isdir(source_path):
+                            reserve = lambda num_bytes: volume.staging.reserve(temp_path, num_bytes)
+                        manifest = Manifest.copy(source_path, temp_subpath, follow_symlinks, exclude_patterns,
+                                                 hash_cache=self.hash_cache, reserve=reserve)
+                    for (path, copied_source_path) in copied_from or []:
+                        if path == source_path or path.startswith(source_path + os.sep):
+                            copied_paths.append((temp_subpath + path[len(source_path):], copied_source_path))
                 print_util.clear_line()
 
+            if manifest is None:
+                print_util.open_line('BundleStore.upload: hashing %s' % temp_subpath)
+                manifest = Manifest.from_path(temp_subpath, hash_file=self._make_hash_file(copied_paths),
+                                              copies=self._get_copied_manifests(copied_paths))
+                print_util.clear_line()
             temp_subpaths.append(temp_subpath)
+            manifests.append(manifest)
 
         # If exactly one source, then upload that directly.
         if len(temp_subpaths) == 1:
             to_delete.append(temp_path)
             temp_path = temp_subpaths[0]
+            manifest = manifests[0]
+        else:
+            manifest = Manifest()
+            for (temp_subpath, subpath_manifest) in zip(temp_subpaths, manifests):
+                manifest.entries.update(subpath_manifest.nest(os.path.basename(temp_subpath)).entries)
+            temp_stat = os.lstat(temp_path)
+            manifest.add('', temp_stat.st_mode, temp_stat.st_size)
 
-        # Multiplex between uploading a directory and uploading a file here.
-        # All other path_util calls will use these lists of directories and files.
-        if os.path.isdir(temp_path):
-            dirs_and_files = path_util.recursive_ls(temp_path)
+        # If there is no data with this hash value, move the temporary directory
+        # into the data directory.
+        if self.merkle:
+            data_hash = path_util.MERKLE_DATA_HASH_PREFIX + manifest.data_hash(merkle=True)
         else:
-            dirs_and_files = ([], [temp_path])
-
-        # Hash the contents of the temporary directory, and then if there is no
-        # data with this hash value, move this directory into the data directory.
-        print_util.open_line('BundleStore.upload: hashing %s' % temp_path)
-        data_hash = '0x%s' % (path_util.hash_directory(temp_path, dirs_and_files),)
-        print_util.clear_line()
-        print_util.open_line('BundleStore.upload: computing size of %s' % temp_path)
-        data_size = path_util.get_size(temp_path, dirs_and_files)
-        print_util.clear_line()
-        final_path = os.path.join(self.data, data_hash)
-        if os.path.exists(final_path):
-            # Already exists, just delete it
+            data_hash = path_util.DATA_HASH_PREFIX + manifest.data_hash()
+        data_size = manifest.data_size()
+        self.hash_cache.flush()
+        final_path = self._find_path(data_hash)
+        manifest_path = self.get_manifest_location(data_hash)
+        if final_path is not None:
+            # Already exists, just delete it. Mark the data as recently used, since it
+            # may be unreferenced until the caller creates the bundle for it, and
+            # full_cleanup leaves recent data alone.
+            path_util.remove(temp_path)
+            os.utime(final_path, None)
+        elif self.backend is not None and self._put_backend(data_hash, temp_path, manifest, manifest_path):
             path_util.remove(temp_path)
         else:
+            chunked_paths = set()
+            if self.chunked:
+                chunked_paths = self._chunk(temp_path, manifest, data_hash)
+                manifest.chunked = chunked_paths
+            final_path = os.path.join(volume.data, self._get_locations(data_hash)[0])
+            self._make_shard_directories(volume.data, final_path)
             print >>sys.stderr, 'BundleStore.upload: moving %s to %s' % (temp_path, final_path)
             path_util.rename(temp_path, final_path)
+            if len(self.volumes) > 1:
+                self.volume_index.add(data_hash, volume.root)
+            if self.dedup:
+                num_bytes = self._dedup(volume, final_path, manifest, chunked_paths)
+                print >>sys.stderr, 'BundleStore.upload: deduplicated %s' % (formatting.size_str(num_bytes),)
+
+        # Save the manifest, unless this data was uploaded before with one.
+        if not os.path.exists(manifest_path):
+            self._make_shard_directories(self.manifests, manifest_path)
+            try:
+                manifest.save(manifest_path)
+            except UnicodeDecodeError, e:
+                # Paths that are not UTF-8 can't be saved; get_target_info then
+                # falls back to the filesystem.
+                print >>sys.stderr, 'BundleStore.upload: not saving manifest: %s' % (e,)
 
         # Delete paths.
         for path in to_delete:
             if os.path.exists(path):
                 path_util.remove(path)
 
-        # After this operation there should always be a directory at the final path.
-        assert(os.path.lexists(final_path)), 'Uploaded to %s failed!' % (final_path,)
+        # After this operation there should always be a directory at the final
+        # path, unless the data is in the backend.
+        assert(final_path is None or os.path.lexists(final_path)), 'Uploaded to %s failed!' % (final_path,)
         return (data_hash, {'data_size': data_size})
 
+    def _put_backend(self, data_hash, path, manifest, manifest_path):
+        '''
+        Store the bundle at |path|, whose Manifest is |manifest|, in the backend
+        under the given data hash, unless it is there already, and save the
+        Manifest at |manifest_path|. Return False if the Manifest can't be saved,
+        in which case the bundle has to be stored locally instead.
+        '''
+        self._make_shard_directories(self.manifests, manifest_path)
+        try:
+            manifest.save(manifest_path)
+        except UnicodeDecodeError, e:
+            print >>sys.stderr, 'BundleStore.upload: not storing in backend: %s' % (e,)
+            return False
+        manifest_key = self._get_manifest_key(data_hash)
+        if self.backend.stat(manifest_key) is None:
+            print >>sys.stderr, 'BundleStore.upload: storing %s in backend' % (data_hash,)
+            for (relative_path, entry) in sorted(manifest.entries.iteritems()):
+                key = self._get_backend_key(data_hash, relative_path)
+                if entry.type == Manifest.LINK:
+                    self.backend.put(key, StringIO(os.readlink(path + relative_path)))
+                elif entry.type == Manifest.FILE:
+                    with open(path + relative_path, 'rb') as f:
+                        self.backend.put(key, f)
+        # Put the Manifest last, since it marks the bundle as complete, and again
+        # if the bundle was there already, to mark it as recently used for
+        # full_cleanup.
+        with open(manifest_path, 'rb') as f:
+            self.backend.put(manifest_key, f)
+        return True
+
+    def _fetch(self, data_hash):
+        '''
+        Return the location of a copy in materialized/ of the bundle with the
+        given data hash from the backend, downloading it if needed, or None if
+        it is not in the backend.
+        '''
+        path = os.path.join(self.materialized, data_hash)
+        if os.path.lexists(path):
+            # Mark it as recently used (a bundle that is a symlink keeps its mtime).
+            if not os.path.islink(path):
+                os.utime(path, None)
+            return path
+        if self.backend.stat(self._get_manifest_key(data_hash)) is None:
+            return None
+        manifest = self.get_manifest(data_hash)
+        self._evict_materialized(manifest.data_size())
+
+        print >>sys.stderr, 'BundleStore: fetching %s (%s)' % (data_hash, formatting.size_str(manifest.data_size()))
+        temp_path = os.path.join(self.temp, 'fetch-' + uuid.uuid4().hex)
+        try:
+            self._download(data_hash, manifest, '', temp_path)
+            try:
+                os.rename(temp_path, path)
+            except OSError, e:
+                # Another process fetched it first.
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY, errno.EISDIR):
+                    raise
+        finally:
+            if os.path.lexists(temp_path):
+                path_util.remove(temp_path)
+        return path
+
+    def _download(self, data_hash, manifest, relative_path, dest_path):
+        '''
+        Download the entry at |relative_path| of |manifest| in the bundle with the
+        given data hash in the backend, and everything under it, to |dest_path|.
+        '''
+        # Parents sort before their contents.
+        directories = []
+        for (entry_relative_path, entry) in sorted(manifest.subtree(relative_path).entries.iteritems()):
+            entry_path = dest_path + entry_relative_path
+            key = self._get_backend_key(data_hash, relative_path + entry_relative_path)
+            if entry.type == Manifest.DIRECTORY:
+                os.mkdir(entry_path, 0700)
+                directories.append((entry_path, entry.perm))
+            elif entry.type == Manifest.LINK:
+                os.symlink(self.backend.get_range(key), entry_path)
+            else:
+                with open(entry_path, 'wb') as f:
+                    self.backend.get(key, f)
+                os.chmod(entry_path, entry.perm)
+        for (directory, perm) in reversed(directories):
+            os.chmod(directory, perm)
+
+    def get_object_location(self, contents_hash, perm, volume=None):
+        '''
+        Returns the location in the object pool of |volume| (by default, the
+        first one) of files with the given contents hash and permissions.
+        '''
+        return os.path.join(
+            (volume or self.volumes[0]).objects, contents_hash[:2], contents_hash[2:4], '%s-%04o' % (contents_hash, perm)
+        )
+
+    def _dedup(self, volume, path, manifest, exclude_paths):
+        '''
+        Hardlink every file of the bundle at |path| on |volume|, whose Manifest is
+        |manifest|, to the object pool of that volume (hardlinks can't cross
+        filesystems): files whose contents are already there are replaced
+        with a link to the existing object, and the others become new objects.
+        Pooled files are made read-only, and |manifest| is updated to match.
+        Files at the relative paths in |exclude_paths| are skipped.
+        Return the number of bytes saved.
+        '''
+        num_bytes = 0
+        for (relative_path, entry) in sorted(manifest.entries.iteritems()):
+            if entry.type != Manifest.FILE or entry.size < self.DEDUP_MIN_SIZE or not entry.contents_hash:
+                continue
+            if relative_path in exclude_paths:
+                continue
+            perm = entry.perm & ~0222
+            object_path = self.get_object_location(entry.contents_hash, perm, volume)
+            self._make_shard_directories(volume.objects, object_path)
+            try:
+                linked = self._link_object(volume, path + relative_path, object_path, perm)
+            except OSError, e:
+                # Give up on files we can't link, e.g., because the pool is on a
+                # different filesystem or the object has too many links.
+                if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.EACCES):
+                    raise
+                print >>sys.stderr, 'BundleStore.upload: not deduplicating %s: %s' % (relative_path, e)
+                continue
+            if linked is None:
+                continue
+            manifest.entries[relative_path] = entry._replace(perm=perm)
+            if linked:
+                num_bytes += entry.size
+        return num_bytes
+
+    def _link_object(self, volume, file_path, object_path, perm):
+        '''
+        Make the file at |file_path| on |volume| a hardlink to the object at
+        |object_path|, which is created from the file if it does not exist.
+        Return True if the file was replaced, False if it became the object, and
+        None if it could not be linked.
+        '''
+        file_stat = os.lstat(file_path)
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        try:
+            object_stat = os.lstat(object_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            object_stat = None
+
+        if object_stat is None:
+            os.chmod(file_path, perm)
+            try:
+                os.link(file_path, object_path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                # Another upload added the object first.
+                return self._link_object(volume, file_path, object_path, perm)
+            return False
+        if (object_stat.st_dev, object_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino):
+            return False
+        if object_stat.st_size != file_stat.st_size:
+            # Should not happen, but the object is not what it claims to be.
+            print >>sys.stderr, 'BundleStore.upload: size mismatch for %s' % (object_path,)
+            return None
+        # Replace the file atomically, since the bundle is already visible.
+        temp_path = os.path.join(volume.temp, 'dedup-' + uuid.uuid4().hex)
+        os.link(object_path, temp_path)
+        os.rename(temp_path, file_path)
+        return True
+
+    def _chunk(self, path, manifest, data_hash):
+        '''
+        Store the large files of the bundle at |path|, whose Manifest is
+        |manifest|, in the chunk store and truncate them. Return the set of their
+        relative paths.
+        '''
+        chunked_paths = set()
+        (num_bytes, num_new_bytes) = (0, 0)
+        for (relative_path, entry) in sorted(manifest.entries.iteritems()):
+            if entry.type != Manifest.FILE or entry.size < self.CHUNK_MIN_FILE_SIZE or not entry.contents_hash:
+                continue
+            file_path = path + relative_path
+            if not stat.S_ISREG(os.lstat(file_path).st_mode):
+                continue
+            num_new_bytes += self.chunk_store.put(data_hash, relative_path, file_path, entry.contents_hash)
+            num_bytes += entry.size
+            # Leave an empty file in place, so that the bundle's files and
+            # directories can still be listed and linked.
+            os.chmod(file_path, entry.perm | stat.S_IWUSR)
+            open(file_path, 'w').close()
+            os.chmod(file_path, entry.perm)
+            chunked_paths.add(relative_path)
+        if chunked_paths:
+            print >>sys.stderr, 'BundleStore.upload: stored %s as chunks, %s of them new' % (
+                formatting.size_str(num_bytes), formatting.size_str(num_new_bytes))
+        return chunked_paths
+
+    def _materialize(self, data_hash, chunked_files):
+        '''
+        Return the location of a copy of the bundle with the given data hash in
+        which its |chunked_files| (as returned by ChunkStore.list_files) are
+        reassembled, creating it if needed.
+        '''
+        path = os.path.join(self.materialized, data_hash)
+        if os.path.lexists(path):
+            # Mark it as recently used.
+            os.utime(path, None)
+            return path
+        self._evict_materialized(sum(size for (_, _, size) in chunked_files))
+
+        # Build the copy in temp/, linking the files that are not chunked (or
+        # copying them, if the bundle is on another volume).
+        temp_path = os.path.join(self.temp, 'materialize-' + uuid.uuid4().hex)
+        source_path = self._find_path(data_hash)
+        same_device = os.lstat(source_path).st_dev == os.lstat(self.temp).st_dev
+        chunked_paths = set(relative_path for (relative_path, _, _) in chunked_files)
+        if '' not in chunked_paths:
+            (directories, files, stats) = path_util.scan_tree(source_path)
+            for directory in directories:
+                os.mkdir(temp_path + path_util.get_relative_path(source_path, directory), 0700)
+            for file_path in files:
+                relative_path = path_util.get_relative_path(source_path, file_path)
+                if relative_path in chunked_paths:
+                    continue
+                if stat.S_ISLNK(stats[file_path].st_mode):
+                    os.symlink(os.readlink(file_path), temp_path + relative_path)
+                elif same_device:
+                    os.link(file_path, temp_path + relative_path)
+                else:
+                    path_util.copy_tree(file_path, temp_path + relative_path)
+        for (relative_path, contents_hash, _) in chunked_files:
+            with open(temp_path + relative_path, 'wb') as f:
+                self.chunk_store.read(contents_hash, f)
+            os.chmod(temp_path + relative_path, stat.S_IMODE(os.lstat(source_path + relative_path).st_mode))
+        if '' not in chunked_paths:
+            for directory in directories:
+                os.chmod(temp_path + path_util.get_relative_path(source_path, directory),
+                         stat.S_IMODE(stats[directory].st_mode))
+
+        try:
+            os.rename(temp_path, path)
+        except OSError, e:
+            # Another process materialized it first.
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY, errno.EISDIR):
+                raise
+            path_util.remove(temp_path)
+        return path
+
+    def _thaw(self, data_hash):
+        '''
+        Unpack the cold bundle with the given data hash onto the volume that the
+        placement policy picks and return its path. The archive is kept until
+        full_cleanup removes it, so that readers of the archive can finish and so
+        that freezing the bundle again is cheap.
+        '''
+        num_bytes = self.cold.get_data_size(data_hash)
+        volume = self._place(num_bytes)
+        temp_path = volume.staging.create('bundle_store_thaw', num_bytes)
+        try:
+            temp_subpath = os.path.join(temp_path, data_hash)
+            print >>sys.stderr, 'BundleStore: thawing %s (%s)' % (data_hash, formatting.size_str(num_bytes))
+            self.cold.unpack(data_hash, temp_subpath)
+            path = os.path.join(volume.data, self._get_locations(data_hash)[0])
+            self._make_shard_directories(volume.data, path)
+            try:
+                os.rename(temp_subpath, path)
+            except OSError, e:
+                # Another process thawed it first.
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY, errno.EISDIR):
+                    raise
+                return path
+        finally:
+            volume.staging.discard(temp_path)
+        if len(self.volumes) > 1:
+            self.volume_index.add(data_hash, volume.root)
+        if self.dedup:
+            manifest = self.get_manifest(data_hash)
+            if manifest:
+                self._dedup(volume, path, manifest, set())
+        os.utime(self.cold.get_location(data_hash), None)
+        return path
+
+    def freeze(self, min_age=None, max_bundles=None, sleep_time=0, dry_run=False):
+        '''
+        Move up to |max_bundles| bundles that have not been used for |min_age|
+        seconds (by default, cold_age) to the cold tier, sleeping |sleep_time|
+        seconds after each, and return the number moved.
+
+        This is safe to do while the store is in use and can be interrupted and
+        resumed. Each bundle is archived before its directory is moved into temp/
+        of its volume, where full_cleanup removes it after TEMP_CLEANUP_TIME, so
+        that readers that already found it there can finish. Chunked bundles are
+        left alone, since they are stored compactly already.
+        '''
+        cutoff_time = time.time() - (self.cold_age if min_age is None else min_age)
+        num_frozen = 0
+        for (data_hash, path) in sorted(self.list_data_paths().iteritems()):
+            if max_bundles is not None and num_frozen >= max_bundles:
+                break
+            if os.path.islink(path) or path_util.getmtime(path) >= cutoff_time:
+                continue
+            if self.chunk_store.list_files(data_hash):
+                continue
+            num_frozen += 1
+            if dry_run:
+                print >>sys.stderr, 'freeze: %s' % (path,)
+                continue
+            if not self.cold.contains(data_hash):
+                (num_bytes, num_archive_bytes) = self.cold.pack(data_hash, path, self.temp)
+                print >>sys.stderr, 'freeze: %s (%s => %s)' % (
+                    path, formatting.size_str(num_bytes), formatting.size_str(num_archive_bytes))
+            else:
+                print >>sys.stderr, 'freeze: %s (already archived)' % (path,)
+            self._set_aside(data_hash, path, self._get_volume(path), 'frozen')
+            if len(self.volumes) > 1:
+                self.volume_index.remove(data_hash)
+            if sleep_time:
+                time.sleep(sleep_time)
+        return num_frozen
+
+    def _set_aside(self, data_hash, path, volume, reason):
+        '''
+        Move the bundle with the given data hash at |path| on |volume| into temp/
+        of that volume, along with any link left behind by migrate_to_sharded.
+        Its mtime is reset, since full_cleanup removes old files in temp/ by
+        their mtime.
+        '''
+        old_path = os.path.join(volume.temp, '%s-%s-%s' % (reason, data_hash, uuid.uuid4().hex))
+        os.rename(path, old_path)
+        os.utime(old_path, None)
+        for location in self._get_locations(data_hash):
+            link_path = os.path.join(volume.data, location)
+            if os.path.islink(link_path):
+                os.unlink(link_path)
+
+    def _evict_materialized(self, num_bytes):
+        '''
+        Remove the least recently used materialized bundles until |num_bytes|
+        more bytes of reassembled or fetched files fit in materialized_cache_size.
+        '''
+        cutoff_time = time.time() - self.MATERIALIZED_MIN_AGE
+        entries = []
+        for data_hash in os.listdir(self.materialized):
+            path = os.path.join(self.materialized, data_hash)
+            entries.append((path_util.getmtime(path), path, self._get_materialized_size(data_hash)))
+        total_size = sum(size for (_, _, size) in entries)
+        for (mtime, path, size) in sorted(entries):
+            if total_size + num_bytes <= self.materialized_cache_size or mtime >= cutoff_time:
+                break
+            print >>sys.stderr, 'BundleStore: evicting %s' % (path,)
+            path_util.remove(path)
+            total_size -= size
+
+    def _get_materialized_size(self, data_hash):
+        '''
+        Return how many bytes of the materialized copy of the bundle with the
+        given data hash count towards materialized_cache_size: its chunked files,
+        or all of it if it was fetched from the backend.
+        '''
+        chunked_files = self.chunk_store.list_files(data_hash)
+        if chunked_files:
+            return sum(size for (_, _, size) in chunked_files)
+        manifest = self.get_manifest(data_hash)
+        return manifest.data_size() if manifest else 0
+
+    def _make_hash_file(self, copied_paths):
+        '''
+        Return a function to use as the |hash_file| argument of
+        path_util.hash_directory, which consults the hash cache.
+        |copied_paths|: see upload.
+        '''
+        def hash_file(path):
+            key_path = path
+            for (copy_path, source_path) in copied_paths:
+                if path == copy_path or path.startswith(copy_path + os.sep):
+                    key_path = source_path + path[len(copy_path):]
+                    break
+            return self._hash_file_contents(path, key_path)
+        return hash_file
+
+    def _get_copied_manifests(self, copied_paths):
+        '''
+        Return the (path, Manifest) pairs of the paths in |copied_paths| (see
+        upload) that are copies of something in the store with a Manifest, for
+        Manifest.from_path.
+        '''
+        copies = []
+        for (copy_path, source_path) in copied_paths:
+            data_path = self._split_data_path(source_path)
+            if data_path is None:
+                continue
+            source_manifest = self.get_manifest(data_path[0])
+            if source_manifest is not None:
+                copies.append((copy_path, source_manifest.subtree(data_path[1])))
+        return copies
+
+    def _hash_file_contents(self, path, key_path):
+        '''
+        Return path_util.hash_file_contents(path), where |key_path| is a file with
+        the same contents under which the hash may be cached.
+        '''
+        try:
+            key_stat = os.lstat(key_path)
+        except OSError:
+            key_stat = None
+        if key_stat and (key_path == path or os.lstat(path).st_size == key_stat.st_size):
+            contents_hash = self.hash_cache.lookup_file(key_stat)
+            if contents_hash:
+                return contents_hash
+
+        contents_hash = path_util.hash_file_contents(path)
+        if key_stat:
+            self.hash_cache.add_file(key_stat, contents_hash)
+        return contents_hash
+
     def cleanup(self, model, data_hash, except_bundle_uuids, dry_run):
         '''
         If the given data hash is not needed by any bundle (not in
         except_bundle_uuids), delete the data.
         '''
-        bundles = model.batch_get_bundles(data_hash=data_hash)
-        if all(bundle.uuid in except_bundle_uuids for bundle in bundles):
-            absolute_path = self.get_location(data_hash)
-            print >>sys.stderr, "cleanup: data %s" % absolute_path
-            if not dry_run:
-                path_util.remove(absolute_path)
+        if data_hash not in model.get_data_hash_ref_counts([data_hash], except_bundle_uuids):
+            self._remove_data(data_hash, dry_run)
 
-    def full_cleanup(self, model, dry_run):
+    def _remove_data(self, data_hash, dry_run):
         '''
-        For each data hash in the store, check if it should be garbage collected and
-        delete its data if so. In addition, delete any old temporary files.
+        Delete the data with the given hash, along with everything stored about it.
         '''
-        old_data_files = self.list_old_files(self.data, self.DATA_CLEANUP_TIME)
-        for data_hash in old_data_files:
-            self.cleanup(model, data_hash, [], dry_run)
-        old_temp_files = self.list_old_files(self.temp, self.TEMP_CLEANUP_TIME)
-        for temp_file in old_temp_files:
-            temp_path = os.path.join(self.temp, temp_file)
-            print >>sys.stderr, "cleanup: temp %s" % temp_path
+        # Remove the data along with any link left behind by migrate_to_sharded.
+        for volume in self.volumes:
+            for location in self._get_locations(data_hash):
+                absolute_path = os.path.join(volume.data, location)
+                if os.path.lexists(absolute_path):
+                    print >>sys.stderr, "cleanup: data %s" % absolute_path
+                    if not dry_run:
+                        path_util.remove(absolute_path)
+        if self.backend is not None and self.backend.stat(self._get_manifest_key(data_hash)) is not None:
+            print >>sys.stderr, "cleanup: backend %s" % data_hash
             if not dry_run:
-                path_util.remove(temp_path)
+                # The Manifest goes first, so that the bundle is never seen incomplete.
+                self.backend.delete(self._get_manifest_key(data_hash))
+                self._delete_backend_data(data_hash)
+        manifest_path = self.get_manifest_location(data_hash)
+        if os.path.exists(manifest_path) and not dry_run:
+            os.remove(manifest_path)
+        if self.cold.contains(data_hash):
+            print >>sys.stderr, "cleanup: archive %s" % self.cold.get_location(data_hash)
+        materialized_path = os.path.join(self.materialized, data_hash)
+        if not dry_run:
+            if len(self.volumes) > 1:
+                self.volume_index.remove(data_hash)
+            self.cold.remove(data_hash)
+            self.chunk_store.remove(data_hash)
+            self.archive_cache.remove(data_hash)
+            if os.path.lexists(materialized_path):
+                path_util.remove(materialized_path)
+
+    def _delete_backend_data(self, data_hash):
+        prefix = self._get_backend_key(data_hash, '')
+        for key in [prefix] + self.backend.list(prefix + '/'):
+            self.backend.delete(key)
+
+    def _get_backend_mtime(self, data_hash):
+        '''
+        Return when the bundle with the given data hash was last put in the
+        backend (now, if it is gone meanwhile).
+        '''
+        object_stat = self.backend.stat(self._get_manifest_key(data_hash))
+        return object_stat.mtime if object_stat else time.time()
+
+    def full_cleanup(self, model, dry_run, batch_size=None, sleep_time=0):
+        '''
+        Delete the data that no bundle references, along with any old temporary
+        files. The data that is old enough is checked in batches of |batch_size|
+        with one query for the reference counts of each (see
+        BundleModel.get_data_hash_ref_counts), sleeping for |sleep_time| seconds
+        between batches to limit the load on the filesystem and the database.
+        '''
+        batch_size = batch_size or self.CLEANUP_BATCH_SIZE
+        hot_paths = self.list_data_paths()
+        archive_paths = self.cold.list_data_hashes()
+        backend_hashes = set(self.list_backend_data_hashes())
+        data_paths = dict(archive_paths)
+        data_paths.update(hot_paths)
+        data_hashes = set(data_paths) | backend_hashes
+        # Recent data might be about to get its bundle.
+        data_cleanup_cutoff = time.time() - self.DATA_CLEANUP_TIME
+        candidates = sorted(
+            data_hash for data_hash in data_hashes
+            if (path_util.getmtime(data_paths[data_hash]) if data_hash in data_paths
+                else self._get_backend_mtime(data_hash)) < data_cleanup_cutoff
+        )
+        num_unreferenced = 0
+        for start in range(0, len(candidates), batch_size):
+            if start and sleep_time:
+                time.sleep(sleep_time)
+            batch = candidates[start:start + batch_size]
+            ref_counts = model.get_data_hash_ref_counts(batch)
+            for data_hash in batch:
+                if data_hash not in ref_counts:
+                    num_unreferenced += 1
+                    self._remove_data(data_hash, dry_run)
+        print >>sys.stderr, "cleanup: %d of %d bundles unreferenced" % (num_unreferenced, len(data_hashes))
+        for volume in self.volumes:
+            old_temp_files = self.list_old_files(volume.temp, self.TEMP_CLEANUP_TIME)
+            for temp_file in old_temp_files:
+                # Staging directories may be in use for longer (see StagingArea.reclaim).
+                if volume.staging.is_staging_path(temp_file):
+                    continue
+                temp_path = os.path.join(volume.temp, temp_file)
+                print >>sys.stderr, "cleanup: temp %s" % temp_path
+                if not dry_run:
+                    path_util.remove(temp_path)
+            for temp_path in volume.staging.reclaim(dry_run):
+                print >>sys.stderr, "cleanup: staging %s" % temp_path
+        # Archives of bundles that were thawed, once their readers are done.
+        archive_cutoff = time.time() - self.TEMP_CLEANUP_TIME
+        for (data_hash, archive_path) in sorted(archive_paths.iteritems()):
+            if data_hash in hot_paths and os.path.exists(archive_path) and \
+                    path_util.getmtime(archive_path) < archive_cutoff:
+                print >>sys.stderr, "cleanup: archive %s" % archive_path
+                if not dry_run:
+                    os.remove(archive_path)
+        if self.backend is not None:
+            # Objects of uploads to the backend that never completed.
+            for data_hash in sorted(self._list_incomplete_backend_data_hashes(backend_hashes)):
+                print >>sys.stderr, "cleanup: incomplete backend %s" % data_hash
+                if not dry_run:
+                    self._delete_backend_data(data_hash)
+        if not dry_run:
+            num_removed = self.hash_cache.evict(time.time() - self.HASH_CACHE_CLEANUP_TIME)
+            print >>sys.stderr, "cleanup: %d hash cache entries" % num_removed
+        if not dry_run:
+            self.archive_cache.evict()
+        num_removed = self.chunk_store.collect(dry_run)
+        print >>sys.stderr, "cleanup: %d chunks" % num_removed
+        # Objects that are not linked from any bundle anymore.
+        for volume in self.volumes:
+            (_, object_paths, object_stats) = path_util.scan_tree(volume.objects)
+            for object_path in object_paths:
+                if object_stats[object_path].st_nlink == 1:
+                    print >>sys.stderr, "cleanup: object %s" % object_path
+                    if not dry_run:
+                        os.remove(object_path)
+
+    def _list_incomplete_backend_data_hashes(self, complete_hashes):
+        '''
+        Return the data hashes that have objects but no Manifest in the backend
+        (i.e., not in |complete_hashes|) and were last written more than
+        TEMP_CLEANUP_TIME ago, so that they are not being uploaded anymore.
+        '''
+        cutoff_time = time.time() - self.TEMP_CLEANUP_TIME
+        mtimes = {}
+        prefix = self.BACKEND_DATA_PREFIX
+        for key in self.backend.list(prefix):
+            data_hash = key[len(prefix):].split('/')[0]
+            if data_hash in complete_hashes:
+                continue
+            object_stat = self.backend.stat(key)
+            if object_stat:
+                mtimes[data_hash] = max(mtimes.get(data_hash, 0), object_stat.mtime)
+        # Check again, in case an upload completed meanwhile.
+        return [
+            data_hash for (data_hash, mtime) in mtimes.iteritems()
+            if mtime < cutoff_time and self.backend.stat(self._get_manifest_key(data_hash)) is None
+        ]
 
     def list_old_files(self, path, cleanup_time):
         cleanup_cutoff = time.time() - cleanup_time
@@ -207,3 +1533,207 @@ class BundleStore(object):
             if path_util.getmtime(absolute_path) < cleanup_cutoff:
                 result.append(file)
         return result
+
+    def _make_shard_directories(self, root, path):
+        '''
+        Create the directories under |root| that |path| is in.
+        '''
+        parent = os.path.dirname(path)
+        if parent != root:
+            self._make_shard_directories(root, parent)
+            path_util.make_directory(parent)
+
+    def migrate_to_sharded(self, max_bundles=None, sleep_time=0, finalize=False, dry_run=False):
+        '''
+        Move up to |max_bundles| bundles from the flat layout into the sharded one,
+        sleeping |sleep_time| seconds after each, and return the number moved.
+
+        This is safe to do while the store is in use and can be interrupted and
+        resumed. Each bundle is renamed into place and a symlink to it is left at
+        its old location, so that paths into it keep working. Relative symlinks
+        from the bundle to other bundles are rewritten to account for its new
+        depth. If |finalize|, and every bundle has been moved, rewrite the
+        symlinks between bundles to point to the sharded locations and remove the
+        symlinks left at the old locations. Each volume is migrated separately.
+        '''
+        if not self.sharded:
+            raise UsageError('Bundle store is not configured to use the sharded layout')
+        num_moved = 0
+        for volume in self.volumes:
+            num_moved += self._migrate_volume_to_sharded(
+                volume, None if max_bundles is None else max_bundles - num_moved, sleep_time, finalize, dry_run)
+        return num_moved
+
+    def _migrate_volume_to_sharded(self, volume, max_bundles, sleep_time, finalize, dry_run):
+        '''
+        Helper for migrate_to_sharded that migrates the bundles on |volume|.
+        '''
+        data_locations = self.list_data_hashes(volume)
+        num_moved = 0
+        for (data_hash, location) in sorted(data_locations.iteritems()):
+            if location != data_hash:
+                continue
+            if max_bundles is not None and num_moved >= max_bundles:
+                break
+            new_location = self._get_sharded_location(data_hash)
+            print >>sys.stderr, 'migrate: %s => %s' % (location, new_location)
+            num_moved += 1
+            if dry_run:
+                continue
+            path = os.path.join(volume.data, location)
+            new_path = os.path.join(volume.data, new_location)
+            self._make_shard_directories(volume.data, new_path)
+            os.rename(path, new_path)
+            os.symlink(new_location, path)
+            data_locations[data_hash] = new_location
+            self._relink(volume, new_location, location)
+            if sleep_time:
+                time.sleep(sleep_time)
+
+        if finalize and all(location != data_hash for (data_hash, location) in data_locations.iteritems()):
+            for location in data_locations.itervalues():
+                print >>sys.stderr, 'migrate: relinking %s' % (location,)
+                if not dry_run:
+                    self._relink(volume, location, location)
+            for data_hash in data_locations:
+                path = os.path.join(volume.data, data_hash)
+                if os.path.islink(path):
+                    print >>sys.stderr, 'migrate: removing %s' % (path,)
+                    if not dry_run:
+                        os.unlink(path)
+        return num_moved
+
+    def _relink(self, volume, location, old_location):
+        '''
+        Rewrite the relative symlinks from the bundle at |location| (relative to
+        data/ of |volume|) to other bundles, given that they were created for the
+        bundle at |old_location|. Targets in the flat layout of bundles that are
+        in the sharded layout are changed to the sharded location.
+        '''
+        path = os.path.join(volume.data, location)
+        if os.path.islink(path):
+            links = [path]
+        elif os.path.isdir(path):
+            (_, files, stats) = path_util.scan_tree(path)
+            links = [link for link in files if stat.S_ISLNK(stats[link].st_mode)]
+        else:
+            links = []
+        for link in links:
+            target = os.readlink(link)
+            if os.path.isabs(target):
+                continue
+            link_location = location + link[len(path):]
+            old_link_location = old_location + link[len(path):]
+            resolved = os.path.normpath(os.path.join(os.path.dirname(old_link_location), target))
+            if resolved == old_location or resolved.startswith(old_location + os.sep) or \
+                    resolved.startswith(os.pardir):
+                # Points into the bundle itself or out of the store.
+                continue
+            components = resolved.split(os.sep)
+            if components[0].startswith('0x'):
+                sharded_location = self._get_sharded_location(components[0])
+                if os.path.lexists(os.path.join(volume.data, sharded_location)):
+                    components[0] = sharded_location
+            new_target = os.path.relpath(os.path.join(*components), os.path.dirname(link_location) or os.curdir)
+            if new_target != target:
+                temp_link = os.path.join(volume.temp, 'relink-' + uuid.uuid4().hex)
+                os.symlink(new_target, temp_link)
+                os.rename(temp_link, link)
+
+    def rebalance(self, max_bundles=None, sleep_time=0, tolerance=None, dry_run=False):
+        '''
+        Move up to |max_bundles| bundles from the volume with the smallest
+        fraction of free space to the one with the largest, until the fractions
+        are within |tolerance| (by default, REBALANCE_TOLERANCE) of each other,
+        sleeping |sleep_time| seconds after each. Return the number moved.
+
+        This is safe to do while the store is in use and can be interrupted and
+        resumed. Each bundle is copied to its new volume and recorded in the
+        index before its old copy is moved into temp/ of its old volume, where
+        full_cleanup removes it after TEMP_CLEANUP_TIME, so that readers that
+        already found it there can finish. Bundles with relative symlinks out of
+        themselves (to other bundles) are left in place.
+        '''
+        if tolerance is None:
+            tolerance = self.REBALANCE_TOLERANCE
+        # The space of each volume, as it will be once the moved bundles are gone
+        # from their old volumes.
+        space = dict((volume.root, list(volume.get_space())) for volume in self.volumes)
+
+        data_locations = {}
+        num_moved = 0
+        while len(self.volumes) > 1 and (max_bundles is None or num_moved < max_bundles):
+            volumes = sorted(self.volumes, key=lambda volume: volume.get_free_fraction(space[volume.root]))
+            (source, dest) = (volumes[0], volumes[-1])
+            if dest.get_free_fraction(space[dest.root]) - source.get_free_fraction(space[source.root]) <= tolerance:
+                break
+            if source.root not in data_locations:
+                data_locations[source.root] = sorted(self.list_data_hashes(source).iteritems(), reverse=True)
+            # Find a bundle that does not overshoot.
+            bundle = None
+            while data_locations[source.root] and bundle is None:
+                (data_hash, location) = data_locations[source.root].pop()
+                path = os.path.join(source.data, location)
+                size = self._get_movable_size(path)
+                if size is None:
+                    continue
+                (source_available, source_total) = space[source.root]
+                (dest_available, dest_total) = space[dest.root]
+                new_difference = dest.get_free_fraction((dest_available - size, dest_total)) - \
+                    source.get_free_fraction((source_available + size, source_total))
+                if new_difference >= -tolerance:
+                    bundle = (data_hash, path, size)
+            if bundle is None:
+                break
+            (data_hash, path, size) = bundle
+            print >>sys.stderr, 'rebalance: %s => %s (%s)' % (path, dest.root, formatting.size_str(size))
+            if not dry_run:
+                self._move_to_volume(data_hash, path, source, dest, size)
+            space[source.root][0] += size
+            space[dest.root][0] -= size
+            num_moved += 1
+            if sleep_time:
+                time.sleep(sleep_time)
+        return num_moved
+
+    def _get_movable_size(self, path):
+        '''
+        Return the size of the bundle at |path|, or None if it can't be moved to
+        another volume because it is a symlink or has relative symlinks out of
+        itself.
+        '''
+        if os.path.islink(path):
+            return None
+        if not os.path.isdir(path):
+            return os.lstat(path).st_size
+        (directories, files, stats) = path_util.scan_tree(path)
+        for file_path in files:
+            if stat.S_ISLNK(stats[file_path].st_mode):
+                target = os.readlink(file_path)
+                relative_path = os.path.relpath(file_path, path)
+                resolved = os.path.normpath(os.path.join(os.path.dirname(relative_path), target))
+                if not os.path.isabs(target) and (resolved == os.pardir or resolved.startswith(os.pardir + os.sep)):
+                    return None
+        return sum(stats[entry].st_size for entry in directories + files)
+
+    def _move_to_volume(self, data_hash, path, source, dest, size):
+        '''
+        Helper for rebalance that moves the bundle with the given data hash from
+        |path| on |source| to |dest|.
+        '''
+        temp_path = dest.staging.create('bundle_store_rebalance', size)
+        try:
+            temp_subpath = os.path.join(temp_path, data_hash)
+            path_util.copy_tree(path, temp_subpath)
+            new_path = os.path.join(dest.data, self._get_locations(data_hash)[0])
+            self._make_shard_directories(dest.data, new_path)
+            path_util.rename(temp_subpath, new_path)
+        finally:
+            dest.staging.discard(temp_path)
+        self.volume_index.add(data_hash, dest.root)
+        if self.dedup:
+            manifest = self.get_manifest(data_hash)
+            if manifest:
+                chunked_paths = set(relative_path for (relative_path, _, _) in self.chunk_store.list_files(data_hash))
+                self._dedup(dest, new_path, manifest, chunked_paths)
+        self._set_aside(data_hash, path, source, 'rebalanced')
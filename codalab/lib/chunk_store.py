@@ -0,0 +1,322 @@
+'''
+ChunkStore stores large files as content-defined chunks, so that files which
+differ only in a few places (e.g., successive versions of a model checkpoint)
+share most of their storage.
+
+A file is split wherever a rolling hash (a gear hash) of the last few bytes
+matches a mask, so an insertion or deletion only changes the chunks around it
+instead of shifting every fixed-size block after it. Each chunk is stored once,
+in chunks/ab/cd/<sha1 of chunk>. An index, stored in a SQLite database, records:
+  recipes: the chunks that make up the file with a given contents hash (as
+    computed by path_util.hash_file_contents).
+  files: for each data hash, the files of that bundle stored as chunks.
+'''
+import errno
+import hashlib
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+from codalab.lib import file_util, path_util
+
+
+class ChunkStore(object):
+    CHUNK_SUBDIRECTORY = 'chunks'
+    INDEX_FILE = 'index.db'
+
+    # Chunks are written before the recipes that use them, so collect leaves
+    # chunks younger than this alone.
+    COLLECT_MIN_AGE = 60*60
+
+    # Chunks are between MIN_CHUNK_SIZE and MAX_CHUNK_SIZE bytes long, and
+    # AVERAGE_CHUNK_SIZE (a power of 2) bytes long on average.
+    MIN_CHUNK_SIZE = 256 * 1024
+    AVERAGE_CHUNK_SIZE = 1024 * 1024
+    MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+    # Random values added to the rolling hash for each byte value. The seed is
+    # fixed so that chunk boundaries never change.
+    GEAR = (lambda rng: [rng.getrandbits(32) for _ in range(256)])(random.Random(0x636c))
+    # The GEAR values as 64-bit lanes in hexadecimal (see _find_boundary).
+    GEAR_LANES = map('%016x'.__mod__, GEAR)
+
+    # _find_boundary computes the hash at this many positions at a time.
+    BOUNDARY_WINDOW_SIZE = 64 * 1024
+
+    def __init__(self, root, min_chunk_size=None, average_chunk_size=None, max_chunk_size=None):
+        self.root = root
+        self.chunks = os.path.join(root, self.CHUNK_SUBDIRECTORY)
+        self.min_chunk_size = min_chunk_size or self.MIN_CHUNK_SIZE
+        self.max_chunk_size = max_chunk_size or self.MAX_CHUNK_SIZE
+        # The hash only depends on the last 32 bytes, and its high bits on more of
+        # them than its low bits, so test the high bits.
+        num_bits = (average_chunk_size or self.AVERAGE_CHUNK_SIZE).bit_length() - 1
+        self.mask = ((1 << num_bits) - 1) << (32 - num_bits)
+        # The mask, and the bit above the hash, in each lane of a window and of
+        # the 31 positions before it.
+        self.num_lanes = self.BOUNDARY_WINDOW_SIZE + 31
+        self.lane_mask = int('%016x' % self.mask * self.num_lanes, 16)
+        self.lane_carry = int('%016x' % (1 << 32) * self.num_lanes, 16)
+        for path in (self.root, self.chunks):
+            path_util.make_directory(path)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(root, self.INDEX_FILE), timeout=60, check_same_thread=False)
+        self.connection.text_factory = str
+        with self.lock:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS recipe (
+                  contents_hash TEXT NOT NULL,
+                  chunk_index INTEGER NOT NULL,
+                  chunk_hash TEXT NOT NULL,
+                  size INTEGER NOT NULL,
+                  PRIMARY KEY (contents_hash, chunk_index)
+                );
+                CREATE INDEX IF NOT EXISTS recipe_chunk_hash ON recipe (chunk_hash);
+                CREATE TABLE IF NOT EXISTS file (
+                  data_hash TEXT NOT NULL,
+                  relative_path TEXT NOT NULL,
+                  contents_hash TEXT NOT NULL,
+                  size INTEGER NOT NULL,
+                  PRIMARY KEY (data_hash, relative_path)
+                );
+            ''')
+
+    def iter_chunks(self, file_handle):
+        '''
+        Yield the content-defined chunks of the file |file_handle|.
+        '''
+        buf = ''
+        eof = False
+        while True:
+            while not eof and len(buf) < self.max_chunk_size:
+                data = file_handle.read(file_util.BUFFER_SIZE)
+                if not data:
+                    eof = True
+                buf += data
+            if not buf:
+                return
+            end = self._find_boundary(buf)
+            yield buf[:end]
+            buf = buf[end:]
+
+    def _find_boundary(self, buf):
+        '''
+        Return the length of the first chunk of |buf|, which is at most
+        max_chunk_size bytes long.
+
+        The hash after each byte from min_chunk_size on is updated as
+          hash = ((hash << 1) + GEAR[byte]) & 0xffffffff
+        so it is the sum of GEAR[byte] << k over the byte k positions back, for
+        k < 32 (and no further back than min_chunk_size). A loop over the bytes
+        runs at only a few MB/s, so instead the hash is computed for a window of
+        positions at once, in one long integer with a 64-bit lane per position
+        (the first one in the highest lane), in which the sum never carries into
+        the next lane.
+        '''
+        start = self.min_chunk_size
+        end = min(len(buf), self.max_chunk_size)
+        for offset in xrange(start, end, self.BOUNDARY_WINDOW_SIZE):
+            first = max(start, offset - 31)
+            stop = min(end, offset + self.BOUNDARY_WINDOW_SIZE)
+            lanes = int(''.join(map(self.GEAR_LANES.__getitem__, bytearray(buffer(buf, first, stop - first)))), 16)
+            # Add GEAR[byte] << k to the lane k positions on, for each k < 32.
+            for shift in (63, 126, 252, 504, 1008):
+                lanes += lanes >> shift
+            # Adding the mask to the masked hash carries into the bit above it
+            # unless the masked hash is 0, i.e., unless there is a boundary.
+            # Only the lanes of the window itself are checked.
+            mask = self.lane_mask >> 64 * (self.num_lanes - (stop - first))
+            carry = self.lane_carry >> 64 * (self.num_lanes - (stop - offset))
+            boundaries = ((lanes & mask) + mask) & carry ^ carry
+            if boundaries:
+                # The highest bit set is in the lane of the first boundary.
+                return stop - (boundaries.bit_length() - 33) // 64
+        return end
+
+    def get_chunk_location(self, chunk_hash):
+        return os.path.join(self.chunks, chunk_hash[:2], chunk_hash[2:4], chunk_hash)
+
+    def put(self, data_hash, relative_path, path, contents_hash):
+        '''
+        Store the file at |path| as the file at |relative_path| in the bundle with
+        the given data hash. |contents_hash| is the hash of the file, which is
+        checked. Return the number of bytes of new chunks that were stored.
+        '''
+        num_bytes = 0
+        size = os.path.getsize(path)
+        recipe = None
+        while True:
+            with self.lock:
+                with self.connection:
+                    # Check for the recipe in the same transaction that uses it, in
+                    # case collect deletes it in the meantime.
+                    if recipe is None and self.connection.execute(
+                        'SELECT 1 FROM recipe WHERE contents_hash = ? LIMIT 1', (contents_hash,)
+                    ).fetchone() is None:
+                        recipe = []
+                    else:
+                        self.connection.executemany('INSERT OR REPLACE INTO recipe VALUES (?, ?, ?, ?)', recipe or [])
+                        self.connection.execute(
+                            'INSERT OR REPLACE INTO file VALUES (?, ?, ?, ?)',
+                            (data_hash, relative_path, contents_hash, size),
+                        )
+                        return num_bytes
+            file_hash = hashlib.sha1(path_util.FILE_PREFIX)
+            with open(path, 'rb') as file_handle:
+                for chunk in self.iter_chunks(file_handle):
+                    file_hash.update(chunk)
+                    chunk_hash = hashlib.sha1(chunk).hexdigest()
+                    if self._write_chunk(chunk_hash, chunk):
+                        num_bytes += len(chunk)
+                    recipe.append((contents_hash, len(recipe), chunk_hash, len(chunk)))
+            if file_hash.hexdigest() != contents_hash:
+                raise ValueError('Contents of %s changed while storing it' % (path,))
+
+    def _write_chunk(self, chunk_hash, chunk):
+        '''
+        Write |chunk| unless it is already stored. Return whether it was written.
+        '''
+        chunk_path = self.get_chunk_location(chunk_hash)
+        if os.path.exists(chunk_path):
+            # Mark the chunk as recently used so that collect leaves it alone.
+            os.utime(chunk_path, None)
+            return False
+        for parent in (os.path.dirname(os.path.dirname(chunk_path)), os.path.dirname(chunk_path)):
+            path_util.make_directory(parent)
+        temp_path = '%s.%s' % (chunk_path, uuid.uuid4().hex)
+        with open(temp_path, 'wb') as f:
+            f.write(chunk)
+        os.rename(temp_path, chunk_path)
+        return True
+
+    def list_files(self, data_hash):
+        '''
+        Return a list of (relative path, contents hash, size) triples for the
+        files of the bundle with the given data hash that are stored as chunks.
+        '''
+        with self.lock:
+            return self.connection.execute(
+                'SELECT relative_path, contents_hash, size FROM file WHERE data_hash = ? ORDER BY relative_path',
+                (data_hash,),
+            ).fetchall()
+
+    def _get_recipe(self, contents_hash):
+        '''
+        Return the (chunk hash, size) pairs of the chunks of the file with the
+        given contents hash, in order.
+        '''
+        with self.lock:
+            recipe = self.connection.execute(
+                'SELECT chunk_hash, size FROM recipe WHERE contents_hash = ? ORDER BY chunk_index', (contents_hash,)
+            ).fetchall()
+        if not recipe:
+            raise IOError(errno.ENOENT, 'No chunks stored for %s' % (contents_hash,))
+        return recipe
+
+    def read(self, contents_hash, out):
+        '''
+        Write the file with the given contents hash to the file object |out|.
+        '''
+        for (chunk_hash, _) in self._get_recipe(contents_hash):
+            with open(self.get_chunk_location(chunk_hash), 'rb') as chunk_handle:
+                file_util.copy(chunk_handle, out)
+
+    def open(self, contents_hash):
+        '''
+        Return a file object that reads the file with the given contents hash
+        one chunk at a time.
+        '''
+        return _ChunkReader([self.get_chunk_location(chunk_hash) for (chunk_hash, _) in self._get_recipe(contents_hash)])
+
+    def read_range(self, contents_hash, offset, length):
+        '''
+        Return up to |length| bytes of the file with the given contents hash
+        starting at |offset|, reading only the chunks that they are in.
+        '''
+        result = []
+        for (chunk_hash, size) in self._get_recipe(contents_hash):
+            if length <= 0:
+                break
+            if offset >= size:
+                offset -= size
+                continue
+            with open(self.get_chunk_location(chunk_hash), 'rb') as chunk_handle:
+                chunk_handle.seek(offset)
+                data = chunk_handle.read(min(length, size - offset))
+            result.append(data)
+            length -= len(data)
+            offset = 0
+        return ''.join(result)
+
+    def remove(self, data_hash):
+        '''
+        Forget the files of the bundle with the given data hash. Their chunks are
+        deleted by collect once no other bundle uses them.
+        '''
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM file WHERE data_hash = ?', (data_hash,))
+
+    def collect(self, dry_run=False):
+        '''
+        Delete the recipes and chunks that no file uses anymore and return the
+        number of chunks deleted.
+        '''
+        with self.lock:
+            with self.connection:
+                if not dry_run:
+                    self.connection.execute(
+                        'DELETE FROM recipe WHERE contents_hash NOT IN (SELECT contents_hash FROM file)'
+                    )
+                live_chunks = set(row[0] for row in self.connection.execute(
+                    'SELECT DISTINCT chunk_hash FROM recipe WHERE contents_hash IN (SELECT contents_hash FROM file)'
+                ))
+        num_removed = 0
+        cutoff_time = time.time() - self.COLLECT_MIN_AGE
+        (_, chunk_paths, chunk_stats) = path_util.scan_tree(self.chunks)
+        for chunk_path in chunk_paths:
+            if os.path.basename(chunk_path) not in live_chunks and chunk_stats[chunk_path].st_mtime < cutoff_time:
+                num_removed += 1
+                if not dry_run:
+                    os.remove(chunk_path)
+        return num_removed
+
+
+class _ChunkReader(object):
+    def __init__(self, chunk_paths):
+        self.chunk_paths = chunk_paths
+        self.handle = None
+
+    def read(self, num_bytes=None):
+        if num_bytes is not None and num_bytes < 0:
+            num_bytes = None
+        result = []
+        num_read = 0
+        while num_bytes is None or num_read < num_bytes:
+            if self.handle is None:
+                if not self.chunk_paths:
+                    break
+                self.handle = open(self.chunk_paths.pop(0), 'rb')
+            data = self.handle.read() if num_bytes is None else self.handle.read(num_bytes - num_read)
+            if not data:
+                self.handle.close()
+                self.handle = None
+                continue
+            result.append(data)
+            num_read += len(data)
+        return ''.join(result)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+        self.chunk_paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
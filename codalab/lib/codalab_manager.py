@@ -42,7 +42,7 @@ from codalab.common import UsageError, PermissionError
 from codalab.objects.worksheet import Worksheet
 from codalab.server.auth import User
 from codalab.lib.bundle_store import BundleStore
-from codalab.lib import formatting
+from codalab.lib import formatting, storage_backend
 
 def cached(fn):
     def inner(self):
@@ -255,7 +255,22 @@ class CodaLabManager(object):
 
     @cached
     def bundle_store(self):
-        return BundleStore(self.codalab_home)
+        server_config = self.config.get('server', {})
+        return BundleStore(
+            self.codalab_home,
+            sharded=server_config.get('bundle_store_sharded', False),
+            dedup=server_config.get('bundle_store_dedup', False),
+            # Chunking runs at about 20 MB/s (see scripts/benchmark-chunking.py),
+            # so it adds about a minute per GB of large files to their upload.
+            chunked=server_config.get('bundle_store_chunked', False),
+            materialized_cache_size=formatting.parse_size(server_config.get('bundle_store_materialized_cache_size', '10g')),
+            volumes=server_config.get('bundle_store_volumes', []),
+            placement=server_config.get('bundle_store_placement', BundleStore.MOST_FREE),
+            cold_age=server_config.get('bundle_store_cold_days', 30) * 60*60*24,
+            backend=storage_backend.create_backend(server_config.get('bundle_store_backend')),
+            archive_cache_size=formatting.parse_size(server_config.get('bundle_store_archive_cache_size', '10g')),
+            merkle=server_config.get('bundle_store_merkle', False),
+        )
 
     def apply_alias(self, key):
         return self.config['aliases'].get(key, key)
@@ -399,7 +414,9 @@ class CodaLabManager(object):
                 auth_handler.validate_token(access_token)
         else:
             from codalab.client.remote_bundle_client import RemoteBundleClient
-            client = RemoteBundleClient(address, lambda a_client: self._authenticate(a_client), self.cli_verbose)
+            client = RemoteBundleClient(address, lambda a_client: self._authenticate(a_client), self.cli_verbose,
+                                        upload_sessions_path=os.path.join(self.codalab_home, 'upload_sessions.json'),
+                                        hash_cache_path=os.path.join(self.codalab_home, 'hash_cache.db'))
             self.clients[address] = client
             self._authenticate(client)
         return client
@@ -0,0 +1,294 @@
+'''
+ColdStore holds the bundles of the cold tier of a BundleStore (see
+BundleStore.freeze) as compressed zip archives, one per data hash, sharded like
+manifests: cold/ab/cd/0xabcdef....zip. The central directory of a zip archive is
+an index of the offsets of its members, so single files can be described and
+read without unpacking the rest of the bundle.
+
+Members are named by their path relative to the bundle, with the bundle itself
+stored as ROOT_MEMBER (with a trailing slash if it is a directory, as usual).
+File types and permissions are kept in the high bits of external_attr, as
+Info-ZIP does, and symlinks are stored with their target as contents.
+'''
+import errno
+import os
+import shutil
+import stat
+import time
+import uuid
+import zipfile
+
+from codalab.common import UsageError
+from codalab.lib import path_util
+
+
+class ColdStore(object):
+    ROOT_MEMBER = '.'
+    ARCHIVE_EXT = '.zip'
+
+    # Zip archives can't represent times before 1980.
+    MIN_ZIP_TIME = 315532800
+
+    # How many symlinks to follow when resolving a path within an archive.
+    MAX_LINK_DEPTH = 40
+
+    # How much read_range decompresses at a time to skip to the offset.
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, root):
+        self.root = root
+        path_util.make_directory(self.root)
+
+    def get_location(self, data_hash):
+        '''
+        Return the location of the archive of the bundle with the given data hash.
+        '''
+        digest = path_util.get_data_hash_digest(data_hash)
+        return os.path.join(self.root, digest[0:2], digest[2:4], data_hash + self.ARCHIVE_EXT)
+
+    def contains(self, data_hash):
+        return os.path.exists(self.get_location(data_hash))
+
+    def list_data_hashes(self):
+        '''
+        Return a dict from each data hash in the cold store to the location of its
+        archive.
+        '''
+        result = {}
+        for shard in os.listdir(self.root):
+            for subshard in os.listdir(os.path.join(self.root, shard)):
+                directory = os.path.join(self.root, shard, subshard)
+                for name in os.listdir(directory):
+                    if name.endswith(self.ARCHIVE_EXT):
+                        result[name[:-len(self.ARCHIVE_EXT)]] = os.path.join(directory, name)
+        return result
+
+    def pack(self, data_hash, path, temp_dir):
+        '''
+        Archive the bundle at |path| under the given data hash, building the
+        archive in |temp_dir| first. Return the (number of bytes archived, size of
+        the archive) pair.
+        '''
+        if os.path.isdir(path):
+            (directories, files, stats) = path_util.scan_tree(path)
+            paths = sorted(directories + files)
+        else:
+            (paths, stats) = ([path], {path: os.lstat(path)})
+        temp_path = os.path.join(temp_dir, 'freeze-%s-%s%s' % (data_hash, uuid.uuid4().hex, self.ARCHIVE_EXT))
+        num_bytes = 0
+        try:
+            with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+                for entry_path in paths:
+                    entry_stat = stats[entry_path]
+                    name = entry_path[len(path) + 1:] or self.ROOT_MEMBER
+                    if stat.S_ISREG(entry_stat.st_mode):
+                        # write streams the contents and records the mode.
+                        archive.write(entry_path, name)
+                        num_bytes += entry_stat.st_size
+                        continue
+                    if stat.S_ISDIR(entry_stat.st_mode):
+                        (name, contents) = (name + '/', '')
+                    elif stat.S_ISLNK(entry_stat.st_mode):
+                        contents = os.readlink(entry_path)
+                    else:
+                        continue
+                    info = zipfile.ZipInfo(name, time.localtime(max(entry_stat.st_mtime, self.MIN_ZIP_TIME))[:6])
+                    info.external_attr = (entry_stat.st_mode & 0xFFFF) << 16
+                    archive.writestr(info, contents)
+            with open(temp_path, 'rb') as f:
+                os.fsync(f.fileno())
+            archive_path = self.get_location(data_hash)
+            path_util.make_directory(os.path.dirname(os.path.dirname(archive_path)))
+            path_util.make_directory(os.path.dirname(archive_path))
+            os.rename(temp_path, archive_path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return (num_bytes, os.path.getsize(archive_path))
+
+    def get_data_size(self, data_hash):
+        '''
+        Return the number of bytes that the bundle with the given data hash takes
+        unpacked.
+        '''
+        with zipfile.ZipFile(self.get_location(data_hash)) as archive:
+            return sum(info.file_size for info in archive.infolist())
+
+    def unpack(self, data_hash, dest_path, relative_path=''):
+        '''
+        Recreate the bundle with the given data hash, or the target at
+        |relative_path| in it, at |dest_path|. Return False if there is no such
+        target. Raise a UsageError if the target is a symlink, since those are not
+        followed.
+        '''
+        with zipfile.ZipFile(self.get_location(data_hash)) as archive:
+            root = self._resolve(archive, self._read_index(archive), relative_path)
+            if root is None:
+                return False
+            directories = []
+            for info in archive.infolist():
+                mode = info.external_attr >> 16
+                name = info.filename.rstrip('/')
+                if name == root:
+                    if stat.S_ISLNK(mode):
+                        raise UsageError('Following symlink disallowed: %s' % (relative_path,))
+                    path = dest_path
+                elif root == self.ROOT_MEMBER:
+                    path = os.path.join(dest_path, name)
+                elif name.startswith(root + '/'):
+                    path = os.path.join(dest_path, name[len(root) + 1:])
+                else:
+                    continue
+                if stat.S_ISDIR(mode):
+                    os.mkdir(path, 0700)
+                    directories.append((path, mode))
+                elif stat.S_ISLNK(mode):
+                    os.symlink(archive.read(info), path)
+                else:
+                    with archive.open(info) as source, open(path, 'wb') as dest:
+                        shutil.copyfileobj(source, dest, 1024 * 1024)
+                    os.chmod(path, stat.S_IMODE(mode))
+            # Directories are made read-only (if they should be) innermost first.
+            for (path, mode) in reversed(directories):
+                os.chmod(path, stat.S_IMODE(mode))
+        return True
+
+    def remove(self, data_hash):
+        try:
+            os.remove(self.get_location(data_hash))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _read_index(self, archive):
+        '''
+        Return a dict from the name (without a trailing slash) of each member of
+        |archive| to its ZipInfo.
+        '''
+        return dict((info.filename.rstrip('/'), info) for info in archive.infolist())
+
+    def _resolve(self, archive, index, relative_path):
+        '''
+        Return the name of the member of |archive| at |relative_path| (as returned
+        by path_util.get_relative_path), following the symlinks on the way that
+        stay within the bundle, or None if there is no such member.
+        '''
+        name = self.ROOT_MEMBER
+        components = [component for component in relative_path.split(os.sep) if component]
+        num_links = 0
+        while components:
+            component = components.pop(0)
+            info = index.get(name)
+            if info is None:
+                return None
+            mode = info.external_attr >> 16
+            if stat.S_ISLNK(mode):
+                num_links += 1
+                target = os.path.normpath(os.path.join(os.path.dirname(name), archive.read(info)))
+                if num_links > self.MAX_LINK_DEPTH or os.path.isabs(target) or \
+                        target == os.pardir or target.startswith(os.pardir + os.sep):
+                    return None
+                name = target if target != os.curdir else self.ROOT_MEMBER
+                components.insert(0, component)
+                continue
+            if component == os.pardir:
+                name = os.path.dirname(name) if name != self.ROOT_MEMBER else None
+                if name is None:
+                    return None
+                name = name or self.ROOT_MEMBER
+            elif component != os.curdir:
+                name = component if name == self.ROOT_MEMBER else name + os.sep + component
+        return name if name in index else None
+
+    def get_info(self, data_hash, relative_path, depth):
+        '''
+        Return what path_util.get_info returns for |relative_path| in the bundle
+        with the given data hash, reading only the index of its archive.
+        Raise a UsageError if the target is a symlink, since those are not
+        followed.
+        '''
+        with zipfile.ZipFile(self.get_location(data_hash)) as archive:
+            index = self._read_index(archive)
+            name = self._resolve(archive, index, relative_path)
+            result_name = os.path.basename(relative_path) or data_hash
+            if name is None:
+                return {'name': result_name}
+            if stat.S_ISLNK(index[name].external_attr >> 16):
+                raise UsageError('Following symlink disallowed: %s' % (relative_path,))
+            children = {}
+            for child in index:
+                if child != self.ROOT_MEMBER:
+                    parent = os.path.dirname(child) or self.ROOT_MEMBER
+                    children.setdefault(parent, []).append(child)
+            return self._get_info(archive, index, children, name, result_name, depth)
+
+    def _get_info(self, archive, index, children, name, result_name, depth):
+        info = index[name]
+        mode = info.external_attr >> 16
+        result = {'name': result_name}
+        if stat.S_ISLNK(mode):
+            # Like path_util.get_info: the type and permissions of the target,
+            # and the size of the symlink itself.
+            target = archive.read(info)
+            result['link'] = target
+            target_name = self._resolve(archive, index, name + os.sep + os.curdir)
+            if target_name is None:
+                return result
+            mode = index[target_name].external_attr >> 16
+            if stat.S_ISREG(mode):
+                result['type'] = 'file'
+                result['size'] = len(target)
+            elif stat.S_ISDIR(mode):
+                result['type'] = 'directory'
+        elif stat.S_ISDIR(mode):
+            result['type'] = 'directory'
+            if depth > 0:
+                result['contents'] = [
+                    self._get_info(archive, index, children, child, os.path.basename(child), depth - 1)
+                    for child in sorted(children.get(name, []))
+                ]
+        else:
+            result['type'] = 'file'
+            result['size'] = info.file_size
+        result['perm'] = mode & 0777
+        return result
+
+    def open(self, data_hash, relative_path):
+        '''
+        Return a file object to read the file at |relative_path| in the bundle
+        with the given data hash, or None if there is no such file. Raise a
+        UsageError if the target is a symlink, since those are not followed.
+        '''
+        archive = zipfile.ZipFile(self.get_location(data_hash))
+        try:
+            index = self._read_index(archive)
+            name = self._resolve(archive, index, relative_path)
+            if name is None:
+                return None
+            mode = index[name].external_attr >> 16
+            if stat.S_ISLNK(mode):
+                raise UsageError('Following symlink disallowed: %s' % (relative_path,))
+            if not stat.S_ISREG(mode):
+                return None
+            return archive.open(index[name])
+        finally:
+            # The member stays readable: it has its own handle to the archive.
+            archive.close()
+
+    def read_range(self, data_hash, relative_path, offset, length):
+        '''
+        Return up to |length| bytes of the file at |relative_path| in the bundle
+        with the given data hash starting at |offset|. Members can't seek, so
+        this decompresses the file up to there.
+        '''
+        handle = self.open(data_hash, relative_path)
+        if handle is None:
+            raise IOError(errno.ENOENT, 'No such file in %s' % (data_hash,), relative_path)
+        with handle:
+            while offset > 0:
+                data = handle.read(min(offset, self.READ_SIZE))
+                if not data:
+                    return ''
+                offset -= len(data)
+            return handle.read(length)
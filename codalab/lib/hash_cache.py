@@ -0,0 +1,130 @@
+'''
+HashCache is a persistent cache of file content hashes (as computed by
+path_util.hash_file_contents), stored in a SQLite database. Entries are keyed
+by the (device, inode, size, mtime) of a file on disk, so an entry is valid for
+as long as the file is not modified. Files inside bundles in the BundleStore
+don't need entries, since their hashes are in the bundle's Manifest.
+
+New entries are buffered in memory and written out by flush().
+'''
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+from codalab.lib import path_util
+
+
+class HashCache(object):
+    # A file modified this recently (in seconds) could be modified again without
+    # changing its mtime, so we never cache it by file.
+    RACY_TIME = 2
+
+    def __init__(self, path):
+        self.path = path
+        # The connection is shared by the threads of path_util.hash_files.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.text_factory = str
+        self.pending_files = {}
+        self.pending_touches = set()
+        with self.lock:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS file_hash (
+                  device INTEGER NOT NULL,
+                  inode INTEGER NOT NULL,
+                  size INTEGER NOT NULL,
+                  mtime REAL NOT NULL,
+                  contents_hash TEXT NOT NULL,
+                  last_used REAL NOT NULL,
+                  PRIMARY KEY (device, inode)
+                );
+                DROP TABLE IF EXISTS data_hash;
+            ''')
+
+    def lookup_file(self, file_stat):
+        '''
+        Return the cached hash of the file with the given lstat result, or None.
+        '''
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        key = (file_stat.st_dev, file_stat.st_ino)
+        with self.lock:
+            row = self.pending_files.get(key)
+            if row is None:
+                row = self.connection.execute(
+                    'SELECT size, mtime, contents_hash FROM file_hash WHERE device = ? AND inode = ?', key
+                ).fetchone()
+                if row is None:
+                    return None
+            (size, mtime, contents_hash) = row[:3]
+            if size != file_stat.st_size or mtime != file_stat.st_mtime:
+                return None
+            self.pending_touches.add(key)
+            return contents_hash
+
+    def add_file(self, file_stat, contents_hash):
+        '''
+        Cache the hash of the file with the given lstat result.
+        '''
+        if not stat.S_ISREG(file_stat.st_mode):
+            return
+        if file_stat.st_mtime > time.time() - self.RACY_TIME:
+            return
+        key = (file_stat.st_dev, file_stat.st_ino)
+        with self.lock:
+            self.pending_files[key] = (file_stat.st_size, file_stat.st_mtime, contents_hash)
+
+    def hash_file(self, path):
+        '''
+        Return path_util.hash_file_contents(path), from the cache if it has it and
+        otherwise caching it. Can be used as the |hash_file| argument of
+        path_util.hash_files.
+        '''
+        file_stat = os.lstat(path)
+        contents_hash = self.lookup_file(file_stat)
+        if contents_hash is None:
+            contents_hash = path_util.hash_file_contents(path)
+            self.add_file(file_stat, contents_hash)
+        return contents_hash
+
+    def flush(self):
+        '''
+        Write all buffered entries to the database.
+        '''
+        now = time.time()
+        with self.lock:
+            (pending_files, self.pending_files) = (self.pending_files, {})
+            (pending_touches, self.pending_touches) = (self.pending_touches, set())
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO file_hash VALUES (?, ?, ?, ?, ?, ?)',
+                    [key + row + (now,) for (key, row) in pending_files.iteritems()],
+                )
+                self.connection.executemany(
+                    'UPDATE file_hash SET last_used = ? WHERE device = ? AND inode = ?',
+                    [(now,) + key for key in pending_touches],
+                )
+
+    def evict(self, cutoff_time):
+        '''
+        Remove all entries that have not been used since |cutoff_time|.
+        Return the number of entries removed.
+        '''
+        self.flush()
+        with self.lock:
+            with self.connection:
+                return self.connection.execute(
+                    'DELETE FROM file_hash WHERE last_used < ?', (cutoff_time,)
+                ).rowcount
+
+    def clear(self):
+        '''
+        Remove all entries.
+        '''
+        with self.lock:
+            self.pending_files = {}
+            self.pending_touches = set()
+            with self.connection:
+                self.connection.execute('DELETE FROM file_hash')
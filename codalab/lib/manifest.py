@@ -0,0 +1,255 @@
+'''
+A Manifest describes the contents of a file or directory that is (or is about
+to become) a bundle. For every path in it, relative to the root in the format
+returned by path_util.get_relative_path ('' for the root, '/a/b' for nested
+paths), it records the type, size and permissions as returned by os.lstat and,
+for files and symlinks, the hash of the contents as returned by
+path_util.hash_file_contents.
+
+A Manifest contains everything needed to compute the data hash and size of a
+bundle, so BundleStore.upload can build one while it copies or unpacks the
+bundle instead of walking and reading the data again afterwards. Since bundle
+data is immutable, BundleStore also saves it next to the data so that listing a
+bundle only needs to read the manifest.
+
+The Manifests of bundles that parts of a new bundle were copied from (e.g., the
+dependencies of a MakeBundle) also give the contents hashes of those parts, so
+from_path does not need to hash them again, and merkle_hashes gives the hash of
+every subtree, so that one can be checked without the rest of the bundle.
+'''
+import collections
+import itertools
+import json
+import os
+import stat
+import tempfile
+
+from codalab.lib import path_util
+
+
+ManifestEntry = collections.namedtuple('ManifestEntry', ['type', 'size', 'perm', 'contents_hash'])
+
+
+class Manifest(object):
+    DIRECTORY = 'directory'
+    FILE = 'file'
+    LINK = 'link'
+
+    # Version of the format written by save.
+    VERSION = 1
+
+    def __init__(self, entries=None, chunked=None):
+        # Map from relative path to ManifestEntry.
+        self.entries = entries or {}
+        # Relative paths of the files that BundleStore stored as chunks.
+        self.chunked = chunked or set()
+        # Map from relative path of a directory to the relative paths in it,
+        # built on demand by get_info.
+        self.children = None
+
+    def add(self, relative_path, mode, size, contents_hash=None):
+        '''
+        Record the entry at |relative_path|, which has the given lstat mode and size.
+        '''
+        if stat.S_ISDIR(mode):
+            entry_type = self.DIRECTORY
+        elif stat.S_ISLNK(mode):
+            entry_type = self.LINK
+        else:
+            entry_type = self.FILE
+        self.entries[relative_path] = ManifestEntry(entry_type, size, stat.S_IMODE(mode), contents_hash)
+
+    @classmethod
+    def from_path(cls, path, hash_file=None, copies=None):
+        '''
+        Return the Manifest of the file or directory at |path| by walking and
+        hashing it. |hash_file| is as for path_util.hash_directory.
+        |copies|: (path, Manifest) pairs of paths under |path| that are copies
+        of what the Manifest describes; files in them whose size matches are not
+        hashed, but take their contents hash from the Manifest.
+        '''
+        path_stat = os.lstat(path)
+        if stat.S_ISDIR(path_stat.st_mode):
+            (directories, files, stats) = path_util.scan_tree(path)
+        else:
+            (directories, files, stats) = ([], [path], {path: path_stat})
+        manifest = cls()
+        for directory in directories:
+            directory_stat = stats[directory]
+            manifest.add(path_util.get_relative_path(path, directory), directory_stat.st_mode, directory_stat.st_size)
+        files_to_hash = []
+        for file_name in sorted(files):
+            file_stat = stats[file_name]
+            contents_hash = cls._lookup_copy(copies or [], file_name, file_stat)
+            if contents_hash is None:
+                files_to_hash.append(file_name)
+            else:
+                manifest.add(path_util.get_relative_path(path, file_name), file_stat.st_mode, file_stat.st_size, contents_hash)
+        for (file_name, contents_hash) in itertools.izip(files_to_hash, path_util.hash_files(files_to_hash, hash_file=hash_file)):
+            file_stat = stats[file_name]
+            manifest.add(path_util.get_relative_path(path, file_name), file_stat.st_mode, file_stat.st_size, contents_hash)
+        return manifest
+
+    @classmethod
+    def _lookup_copy(cls, copies, file_name, file_stat):
+        '''
+        Return the contents hash of |file_name|, whose lstat result is
+        |file_stat|, from the Manifest of the copy it is in, or None.
+        '''
+        for (copy_path, copy_manifest) in copies:
+            if file_name == copy_path or file_name.startswith(copy_path + os.sep):
+                entry = copy_manifest.entries.get(file_name[len(copy_path):])
+                if entry is None or entry.contents_hash is None or entry.size != file_stat.st_size:
+                    return None
+                if entry.type != (cls.LINK if stat.S_ISLNK(file_stat.st_mode) else cls.FILE):
+                    return None
+                return entry.contents_hash
+        return None
+
+    @classmethod
+    def copy(cls, source_path, dest_path, follow_symlinks, exclude_patterns, hash_cache=None, reserve=None):
+        '''
+        Copy |source_path| to |dest_path| (see path_util.copy_tree, which also
+        takes |hash_cache| and |reserve|) and return the Manifest of
+        |dest_path|, which is computed while copying.
+        '''
+        manifest = cls()
+        for (relative_path, mode, size, contents_hash) in path_util.copy_tree(
+                source_path, dest_path, follow_symlinks, exclude_patterns, hash_contents=True,
+                hash_cache=hash_cache, reserve=reserve):
+            manifest.add(relative_path, mode, size, contents_hash)
+        return manifest
+
+    def nest(self, name):
+        '''
+        Return a Manifest of a directory containing the contents of this Manifest
+        under |name|. The caller is responsible for adding the new root directory.
+        '''
+        prefix = os.sep + name
+        return Manifest(dict((prefix + relative_path, entry) for (relative_path, entry) in self.entries.iteritems()))
+
+    def subtree(self, relative_path):
+        '''
+        Return the Manifest of the entry at |relative_path| in this Manifest.
+        '''
+        prefix = relative_path + os.sep
+        entries = {}
+        for (path, entry) in self.entries.iteritems():
+            if path == relative_path:
+                entries[''] = entry
+            elif path.startswith(prefix):
+                entries[path[len(relative_path):]] = entry
+        return Manifest(entries)
+
+    def data_hash(self, merkle=False):
+        '''
+        Return the hash of the contents, as computed by path_util.hash_directory
+        (with |merkle|).
+        '''
+        if merkle:
+            return self.merkle_hashes()['']
+        return path_util.hash_relative_paths(*self._get_hash_arguments())
+
+    def merkle_hashes(self):
+        '''
+        Return a dict from every relative path to its hash in the Merkle format
+        (see path_util.hash_merkle_tree).
+        '''
+        return path_util.hash_merkle_tree(*self._get_hash_arguments())
+
+    def _get_hash_arguments(self):
+        '''
+        Return the (relative paths of directories, (relative path, contents hash)
+        pairs of files) of this Manifest.
+        '''
+        directories = []
+        file_hashes = []
+        for (relative_path, entry) in self.entries.iteritems():
+            if entry.type == self.DIRECTORY:
+                directories.append(relative_path)
+            else:
+                file_hashes.append((relative_path, entry.contents_hash))
+        return (directories, file_hashes)
+
+    def data_size(self):
+        '''
+        Return the total size of the contents, as computed by path_util.get_size.
+        '''
+        return sum(entry.size for entry in self.entries.itervalues())
+
+    def save(self, path):
+        '''
+        Write this Manifest to the file at |path|, atomically.
+        '''
+        contents = {
+            'version': self.VERSION,
+            'entries': [
+                [relative_path] + list(entry)
+                for (relative_path, entry) in sorted(self.entries.iteritems())
+            ],
+        }
+        if self.chunked:
+            contents['chunked'] = sorted(self.chunked)
+        (fd, temp_path) = tempfile.mkstemp(prefix='.manifest-', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(contents, f, separators=(',', ':'))
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read a Manifest written by save from the file at |path|.
+        '''
+        with open(path) as f:
+            contents = json.load(f)
+        if contents.get('version') != cls.VERSION:
+            raise ValueError('Unsupported manifest version in %s: %s' % (path, contents.get('version')))
+        return cls(dict(
+            (row[0].encode('utf-8'), ManifestEntry(str(row[1]), row[2], row[3], row[4] and str(row[4])))
+            for row in contents['entries']
+        ), set(relative_path.encode('utf-8') for relative_path in contents.get('chunked', [])))
+
+    def get_info(self, path, relative_path, depth, get_link_info=None):
+        '''
+        Return path_util.get_info(path, depth), where |path| is where the entry at
+        |relative_path| in this Manifest is stored, reading only the Manifest for
+        everything but symlinks, which are described from the filesystem, or by
+        get_link_info(path, relative path) if given. Return None if there is no
+        such entry or it is a symlink.
+        '''
+        entry = self.entries.get(relative_path)
+        if entry is None or entry.type == self.LINK:
+            return None
+        if self.children is None:
+            self.children = collections.defaultdict(list)
+            for child in self.entries:
+                if child:
+                    self.children[child[:child.rindex(os.sep)]].append(child)
+        return self._get_info(path, relative_path, entry, depth, get_link_info)
+
+    def _get_info(self, path, relative_path, entry, depth, get_link_info):
+        if entry.type == self.LINK:
+            if get_link_info is not None:
+                return get_link_info(path, relative_path)
+            # The type and permissions are those of the target, which could be
+            # anywhere.
+            return path_util.get_info(path, depth)
+        result = {'name': os.path.basename(path)}
+        if entry.type == self.FILE:
+            result['type'] = 'file'
+            result['size'] = entry.size
+        else:
+            result['type'] = 'directory'
+            if depth > 0:
+                result['contents'] = [
+                    self._get_info(path + child[len(relative_path):], child, self.entries[child], depth - 1, get_link_info)
+                    for child in sorted(self.children[relative_path])
+                ]
+        result['perm'] = entry.perm & 0777
+        return result
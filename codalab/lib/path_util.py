@@ -6,21 +6,31 @@ There are a few classes of methods provided here:
     normalize, check_isvalid, check_isdir, check_isfile, path_is_url
 
   Functions to list directories and to deal with subpaths of paths:
-    safe_join, get_relative_path, ls, recursive_ls
+    safe_join, get_relative_path, ls, recursive_ls, scan_tree
 
   Functions to read files to compute hashes, write results to stdout, etc:
-    cat, getmtime, get_size, hash_directory, hash_file_contents
+    cat, getmtime, get_size, hash_directory, hash_merkle_tree, hash_files,
+    hash_file_contents, hash_and_copy
 
   Functions that modify that filesystem in controlled ways:
-    copy, make_directory, set_write_permissions, rename, remove
+    copy, copy_tree, link_tree, make_directory, set_write_permissions, rename,
+    remove
 """
+import collections
 import contextlib
+import ctypes
+import ctypes.util
 import errno
+import fcntl
+import fnmatch
+import functools
 import hashlib
 import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
-import subprocess
+import stat
 import sys
 
 from codalab.common import (
@@ -34,6 +44,63 @@ from codalab.lib import file_util, formatting
 BLOCK_SIZE = 0x40000
 FILE_PREFIX = 'file'
 LINK_PREFIX = 'link'
+TREE_PREFIX = 'tree'
+
+# Data hashes are DATA_HASH_PREFIX followed by hash_directory of the bundle, or,
+# in the opt-in Merkle format, MERKLE_DATA_HASH_PREFIX followed by
+# hash_directory(merkle=True). The digests are hexadecimal, so the two never
+# collide, and the number in the Merkle prefix is its version.
+DATA_HASH_PREFIX = '0x'
+MERKLE_DATA_HASH_PREFIX = '0xm1'
+
+# Number of files hashed concurrently by hash_directory. Reading a file and
+# updating a SHA-1 both release the GIL, so a thread pool is enough to keep
+# several disks and cores busy; this also bounds the number of outstanding reads.
+# On a single core the threads only contend for the GIL, so we hash serially.
+HASH_NUM_THREADS = min(8, multiprocessing.cpu_count())
+HASH_CHUNK_SIZE = 32
+
+# Number of files copied concurrently by copy_tree. File contents are copied by
+# the kernel without holding the GIL, so more threads than cores still help
+# (mostly by overlapping the opens, metadata updates and disk latency of many
+# small files).
+COPY_NUM_THREADS = 8
+
+# Largest number of bytes passed to a single copy_file_range or sendfile call.
+KERNEL_COPY_SIZE = 0x40000000
+
+# errno values for which copy_file_range or sendfile cannot be used on a pair
+# of files (e.g., across filesystems on older kernels, or unsupported by the
+# filesystem), in which case _copy_file_contents falls back to the next method.
+KERNEL_COPY_FALLBACK_ERRNOS = frozenset([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP])
+
+# ioctl that makes a file share the blocks of another (copy-on-write), on
+# filesystems that support it (e.g., btrfs and XFS): _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+
+def _get_libc_function(name, argtypes):
+    """
+    Return the function |name| from the C library with the given argument types
+    and an ssize_t result, or None if it is not available. Only used on Linux,
+    where sendfile can copy between regular files.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        function = getattr(ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True), name)
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = argtypes
+    function.restype = ctypes.c_ssize_t
+    return function
+
+# ssize_t copy_file_range(int fd_in, loff_t *off_in, int fd_out, loff_t *off_out, size_t len, unsigned int flags)
+_copy_file_range = _get_libc_function('copy_file_range', [
+    ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint,
+])
+# ssize_t sendfile(int out_fd, int in_fd, off_t *offset, size_t count)
+_sendfile = _get_libc_function('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
 
 
 class TargetPath(unicode):
@@ -182,24 +249,44 @@ def recursive_ls(path):
     when computing the hash of a directory. This function will NOT descend into
     symlinked directories.
     """
-    check_isdir(path, 'recursive_ls')
-    (directories, files) = ([], [])
-    for (root, _, file_names) in os.walk(path):
-        assert(os.path.isabs(root)), 'Got relative root in os.walk: %s' % (root,)
-        directories.append(root)
-        for file_name in file_names:
-            files.append(os.path.join(root, file_name))
-        # os.walk ignores symlinks to directories, but we should count them as files.
-        # However, we can't used the followlinks parameter, because a) we don't want
-        # to descend into directories and b) we could end up in an infinite loop if
-        # we were to pass that flag. Instead, we handle symlinks here:
-        for subpath in os.listdir(root):
-            full_subpath = os.path.join(root, subpath)
-            if os.path.islink(full_subpath) and os.path.isdir(full_subpath):
-                files.append(full_subpath)
+    (directories, files, _) = scan_tree(path)
     return (directories, files)
 
 
+def scan_tree(path):
+    """
+    Return a (list of directories, list of files, dict from path to lstat result)
+    triple for the given directory and all of its nested subdirectories, where
+    the first two are as returned by recursive_ls and the dict covers every path
+    in them.
+
+    This does one listdir per directory and one lstat per entry, which is all
+    that recursive_ls, get_size and hash_directory need between them.
+    """
+    check_isdir(path, 'scan_tree')
+    (directories, files, stats) = ([], [], {path: os.lstat(path)})
+    pending = [path]
+    while pending:
+        directory = pending.pop()
+        assert(os.path.isabs(directory)), 'Got relative directory in scan_tree: %s' % (directory,)
+        directories.append(directory)
+        for name in os.listdir(directory):
+            subpath = os.path.join(directory, name)
+            try:
+                subpath_stat = os.lstat(subpath)
+            except OSError, e:
+                # The entry was removed after we listed the directory.
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            stats[subpath] = subpath_stat
+            if stat.S_ISDIR(subpath_stat.st_mode):
+                pending.append(subpath)
+            else:
+                files.append(subpath)
+    return (directories, files, stats)
+
+
 ################################################################################
 # Functions to read files to compute hashes, write results to stdout, etc.
 ################################################################################
@@ -227,19 +314,26 @@ def read_lines(path, max_num_lines=None, max_total_bytes=None):
     if path is None or not os.path.isfile(path):
         return None
 
-    lines = []
     with open(path, 'rb') as file_handle:
-        num_bytes_read = 0
-        # While we haven't exceeded lines or bytes quota...
-        while (max_num_lines is None or num_bytes_read < max_total_bytes) and \
-              (max_total_bytes is None or len(lines) < max_num_lines):
-            # Read a line
-            line = file_handle.readline(max_total_bytes - num_bytes_read)
-            if not line:
-                break
-            # Update buffer and counts.
-            lines.append(line)
-            num_bytes_read += len(line)
+        return read_file_lines(file_handle, max_num_lines, max_total_bytes)
+
+
+def read_file_lines(file_handle, max_num_lines=None, max_total_bytes=None):
+    """
+    Like read_lines, but read from the file object |file_handle|.
+    """
+    lines = []
+    num_bytes_read = 0
+    # While we haven't exceeded lines or bytes quota...
+    while (max_num_lines is None or num_bytes_read < max_total_bytes) and \
+          (max_total_bytes is None or len(lines) < max_num_lines):
+        # Read a line
+        line = file_handle.readline(max_total_bytes - num_bytes_read)
+        if not line:
+            break
+        # Update buffer and counts.
+        lines.append(line)
+        num_bytes_read += len(line)
     return lines
 
 
@@ -267,10 +361,13 @@ def get_size(path, dirs_and_files=None):
     Get the size (in bytes) of the file or directory at or under the given path.
     Does not include symlinked files and directories.
     """
-    if os.path.islink(path) or not os.path.isdir(path):
-        return os.lstat(path).st_size
-    dirs_and_files = dirs_and_files or recursive_ls(path)
-    return sum(os.lstat(path).st_size for path in itertools.chain(*dirs_and_files))
+    path_stat = os.lstat(path)
+    if not stat.S_ISDIR(path_stat.st_mode):
+        return path_stat.st_size
+    if dirs_and_files:
+        return sum(os.lstat(path).st_size for path in itertools.chain(*dirs_and_files))
+    (_, _, stats) = scan_tree(path)
+    return sum(path_stat.st_size for path_stat in stats.itervalues())
 
 
 def get_info(path, depth):
@@ -282,80 +379,218 @@ def get_info(path, depth):
     """
     result = {}
     result['name'] = os.path.basename(path)
-    if os.path.islink(path):
+    # Type and permissions are those of the target of a symlink, and size that
+    # of the symlink itself, so stat a path at most twice.
+    try:
+        link_stat = os.lstat(path)
+    except OSError:
+        return result
+    path_stat = link_stat
+    if stat.S_ISLNK(link_stat.st_mode):
         result['link'] = os.readlink(path)
-    if os.path.isfile(path):
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            return result
+    if stat.S_ISREG(path_stat.st_mode):
         result['type'] = 'file'
-        result['size'] = get_size(path)
-    elif os.path.isdir(path):
+        result['size'] = link_stat.st_size
+    elif stat.S_ISDIR(path_stat.st_mode):
         result['type'] = 'directory'
         if depth > 0:
             result['contents'] = [get_info(os.path.join(path, file_name), depth-1) for file_name in os.listdir(path)]
-    if os.path.exists(path):
-        result['perm'] = os.stat(path).st_mode & 0777
+    result['perm'] = path_stat.st_mode & 0777
     return result
 
 
-def hash_directory(path, dirs_and_files=None):
+def hash_directory(path, dirs_and_files=None, num_threads=HASH_NUM_THREADS, hash_file=None, merkle=False):
     """
     Return the hash of the contents of the folder at the given path.
     This hash is independent of the path itself - if you were to move the
     directory and call get_hash again, you would get the same result.
+
+    File contents are hashed by up to |num_threads| threads at a time. The
+    result does not depend on |num_threads|.
+    |hash_file|: used instead of hash_file_contents (e.g., to consult a cache).
+    |merkle|: return the root of hash_merkle_tree instead.
     """
     (directories, files) = dirs_and_files or recursive_ls(path)
+    directories = [get_relative_path(path, directory) for directory in directories]
+    files = sorted(files)
+    file_hashes = [
+        (get_relative_path(path, file_name), contents_hash)
+        for (file_name, contents_hash) in itertools.izip(files, hash_files(files, num_threads, hash_file))
+    ]
+    if merkle:
+        return hash_merkle_tree(directories, file_hashes)['']
+    return hash_relative_paths(directories, file_hashes)
+
+
+def hash_relative_paths(directories, file_hashes):
+    """
+    Return the hash of a directory, given the relative paths (as returned by
+    get_relative_path) of all its directories and a list of (relative path,
+    contents hash) pairs for all its files. See hash_directory.
+    """
     # Sort and then hash all directories and then compute a hash of the hashes.
     # This two-level hash is necessary so that the overall hash is unambiguous -
     # if we updated directory_hash with the directory names themselves, then
     # we'd be hashing the concatenation of these names, which could be generated
     # in multiple ways.
     directory_hash = hashlib.sha1()
-    for directory in sorted(directories):
-        relative_path = get_relative_path(path, directory)
+    for relative_path in sorted(directories):
         directory_hash.update(hashlib.sha1(relative_path).hexdigest())
     # Use a similar two-level hashing scheme for all files, but incorporate a
     # hash of both the file name and contents.
     file_hash = hashlib.sha1()
-    for file_name in sorted(files):
-        relative_path = get_relative_path(path, file_name)
+    for (relative_path, contents_hash) in sorted(file_hashes):
         file_hash.update(hashlib.sha1(relative_path).hexdigest())
-        file_hash.update(hash_file_contents(file_name))
+        file_hash.update(contents_hash)
     # Return a hash of the two hashes.
     overall_hash = hashlib.sha1(directory_hash.hexdigest())
     overall_hash.update(file_hash.hexdigest())
     return overall_hash.hexdigest()
 
 
-def hash_file_contents(path):
+def hash_merkle_tree(directories, file_hashes):
+    """
+    Return a dict from every relative path in a directory to its hash in the
+    Merkle format, given the same arguments as hash_relative_paths. The hash of
+    a file or symlink is its contents hash, and the hash of a directory is
+    derived from the names and hashes of its children, so the hash of any
+    subtree only depends on that subtree and can be computed (or checked, or
+    reused) on its own. The hash of the root is at ''.
+    """
+    hashes = dict(file_hashes)
+    children = collections.defaultdict(list)
+    for relative_path in itertools.chain(directories, hashes):
+        if relative_path:
+            (parent, _, name) = relative_path.rpartition(os.sep)
+            children[parent].append((name, relative_path))
+    # Deeper directories first, so that their children are done before them.
+    for directory in sorted(directories, key=lambda relative_path: -relative_path.count(os.sep)):
+        directory_hash = hashlib.sha1(TREE_PREFIX)
+        for (name, relative_path) in sorted(children[directory]):
+            # Names are hashed so that the concatenation is unambiguous.
+            directory_hash.update(hashlib.sha1(name).hexdigest())
+            directory_hash.update(hashes[relative_path])
+        hashes[directory] = directory_hash.hexdigest()
+    return hashes
+
+
+def get_data_hash_digest(data_hash):
+    """
+    Return the digest of |data_hash|, without its prefix.
+    """
+    for prefix in (MERKLE_DATA_HASH_PREFIX, DATA_HASH_PREFIX):
+        if data_hash.startswith(prefix):
+            return data_hash[len(prefix):]
+    return data_hash
+
+
+def is_merkle_data_hash(data_hash):
+    """
+    Return whether |data_hash| is in the Merkle format.
+    """
+    return data_hash.startswith(MERKLE_DATA_HASH_PREFIX)
+
+
+def hash_files(paths, num_threads=HASH_NUM_THREADS, hash_file=None):
+    """
+    Yield hash_file(path) for each of the given paths, in order, where
+    |hash_file| defaults to hash_file_contents.
+    Up to |num_threads| files are read concurrently.
+    """
+    return _imap_threads(hash_file or hash_file_contents, paths, num_threads)
+
+
+def _imap_threads(function, items, num_threads):
+    """
+    Yield function(item) for each of the given items, in order, calling
+    |function| from up to |num_threads| threads concurrently.
+    """
+    num_threads = min(num_threads, len(items))
+    if num_threads <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    # Hand out small items in batches so that queueing overhead does not dominate.
+    chunk_size = max(1, min(HASH_CHUNK_SIZE, len(items) // (num_threads * 4)))
+    pool = ThreadPool(num_threads)
+    try:
+        for result in pool.imap(function, items, chunk_size):
+            yield result
+        pool.close()
+    finally:
+        # Stops the remaining workers if we failed or the caller stopped early.
+        pool.terminate()
+        pool.join()
+
+
+def hash_file_contents(path, on_read=None):
     """
     Return the hash of the file's contents, read in blocks of size BLOCK_SIZE.
+    |on_read|: called with the size of each block after it is read (e.g., to
+    limit the rate of reading).
     """
     message = 'hash_file called with relative path: %s' % (path,)
     precondition(os.path.isabs(path), message)
-    if os.path.islink(path):
-        contents_hash = hashlib.sha1(LINK_PREFIX)
-        contents_hash.update(os.readlink(path))
-    else:
-        contents_hash = hashlib.sha1(FILE_PREFIX)
-        with open(path, 'rb') as file_handle:
-            while True:
-                data = file_handle.read(BLOCK_SIZE)
-                if not data:
-                    break
-                contents_hash.update(data)
+    # Opening with O_NOFOLLOW fails on a symlink, which saves an lstat per file.
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError, e:
+        if e.errno != errno.ELOOP or not os.path.islink(path):
+            raise
+        return hash_link(os.readlink(path))
+    contents_hash = hashlib.sha1(FILE_PREFIX)
+    with os.fdopen(fd, 'rb') as file_handle:
+        while True:
+            data = file_handle.read(BLOCK_SIZE)
+            if on_read:
+                on_read(len(data))
+            if not data:
+                break
+            contents_hash.update(data)
     return contents_hash.hexdigest()
 
 
+def hash_link(target):
+    """
+    Return the hash_file_contents of a symlink pointing to |target|.
+    """
+    contents_hash = hashlib.sha1(LINK_PREFIX)
+    contents_hash.update(target)
+    return contents_hash.hexdigest()
+
+
+def hash_and_copy(source_handle, dest_handle):
+    """
+    Copy all data from |source_handle| to |dest_handle|, hashing it on the way.
+    Return (number of bytes copied, hash_file_contents of the copied file).
+    """
+    contents_hash = hashlib.sha1(FILE_PREFIX)
+    num_bytes = 0
+    while True:
+        data = source_handle.read(file_util.BUFFER_SIZE)
+        if not data:
+            break
+        contents_hash.update(data)
+        dest_handle.write(data)
+        num_bytes += len(data)
+    return (num_bytes, contents_hash.hexdigest())
+
+
 ################################################################################
 # Functions that modify that filesystem in controlled ways.
 ################################################################################
 
 def copy(source_path, dest_path, follow_symlinks=False, exclude_patterns=None):
     """
-    Copy |source_path| to |dest_path|.
+    Copy |source_path| to |dest_path| (see copy_tree).
     Assume dest_path doesn't exist.
     |follow_symlinks|: whether to follow symlinks
     |exclude_patterns|: patterns to not copy
-    Note: this only works in Linux.
     """
     if os.path.exists(dest_path):
         raise path_error('already exists', dest_path)
@@ -364,17 +599,293 @@ def copy(source_path, dest_path, follow_symlinks=False, exclude_patterns=None):
         with open(dest_path, 'wb') as dest:
             file_util.copy(sys.stdin, dest, autoflush=False, print_status='Copying %s to %s' % (source_path, dest_path))
     else:
-        command = [
-            'rsync',
-            '-pr%s' % ('L' if follow_symlinks else 'l'),
-            source_path + ('/' if not os.path.islink(source_path) and os.path.isdir(source_path) else ''),
-            dest_path,
-        ]
-        if exclude_patterns is not None:
-            for pattern in exclude_patterns:
-                command.extend(['--exclude', pattern])
-        if subprocess.call(command) != 0:
-            raise path_error('Unable to copy %s to' % source_path, dest_path)
+        copy_tree(source_path, dest_path, follow_symlinks, exclude_patterns)
+
+
+def copy_tree(source_path, dest_path, follow_symlinks=False, exclude_patterns=None, hash_contents=False, num_threads=None,
+              hash_cache=None, reserve=None):
+    """
+    Copy |source_path| to |dest_path| within this process, with the same
+    semantics as rsync -pr: permissions are preserved, symlinks are copied as
+    symlinks unless |follow_symlinks|, and special files are skipped.
+    |exclude_patterns|: shell patterns to not copy; patterns without a slash are
+        matched against names, others against paths relative to |source_path|.
+
+    The tree is walked once, creating directories and symlinks, and then the
+    contents of up to |num_threads| files are copied concurrently (by default,
+    HASH_NUM_THREADS if |hash_contents| and COPY_NUM_THREADS otherwise).
+
+    Return a list with a (relative path, mode, size, contents hash) tuple for
+    each entry copied, where the relative path is as returned by
+    get_relative_path, mode and size are those of the copy as returned by
+    os.lstat, and the contents hash is as returned by hash_file_contents (only
+    computed for files and symlinks if |hash_contents|; it is read while the
+    file is copied). Directories come after their contents.
+    |hash_cache|: if |hash_contents|, a HashCache to look up the hashes of the
+        source files in (those files are copied without being read) and to add
+        the hashes of the others to.
+    |reserve|: if given, called with the total size of the files to copy once
+        the tree is walked, before their contents are copied (e.g., to reserve
+        space for them with StagingArea.reserve).
+    """
+    if os.path.lexists(dest_path):
+        raise path_error('already exists', dest_path)
+    entries = []
+    if source_path == '/dev/stdin':
+        with open(dest_path, 'wb') as dest:
+            (num_bytes, contents_hash) = hash_and_copy(sys.stdin, dest)
+        entries.append(('', os.lstat(dest_path).st_mode, num_bytes, contents_hash))
+        return entries
+
+    files = []
+    directories = []
+    _copy_tree(source_path, dest_path, '', follow_symlinks, exclude_patterns or [], hash_contents, set(), entries, files, directories)
+    if reserve is not None:
+        reserve(sum(file_info[3].st_size for file_info in files))
+    if num_threads is None:
+        num_threads = HASH_NUM_THREADS if hash_contents else COPY_NUM_THREADS
+    if hash_contents and hash_cache is not None:
+        copy_file = functools.partial(_copy_file_and_cache_hash, hash_cache=hash_cache)
+    else:
+        copy_file = _copy_file_and_hash if hash_contents else _copy_file
+    entries.extend(_imap_threads(copy_file, files, num_threads))
+    # Directories are made read-only (if they should be) only once their
+    # contents are in place, innermost first.
+    for (directory, relative_path, mode) in directories:
+        os.chmod(directory, stat.S_IMODE(mode))
+        directory_stat = os.lstat(directory)
+        entries.append((relative_path, directory_stat.st_mode, directory_stat.st_size, None))
+    return entries
+
+
+def _copy_tree(source_path, dest_path, relative_path, follow_symlinks, exclude_patterns, hash_contents, ancestors, entries, files, directories):
+    """
+    Helper for copy_tree that copies the entry at |source_path|, which is at
+    |relative_path| in the tree. |ancestors| are the (device, inode) pairs of the
+    directories being copied, used to detect cycles when following symlinks.
+    Symlinks are copied and added to |entries| right away, while regular files
+    are added to |files| as (source path, dest path, relative path, stat) tuples
+    and directories to |directories| as (dest path, relative path, mode) tuples,
+    after their contents.
+    """
+    try:
+        source_stat = os.stat(source_path) if follow_symlinks else os.lstat(source_path)
+    except OSError:
+        raise path_error('Unable to copy (broken symlink?)', source_path)
+    mode = source_stat.st_mode
+
+    if stat.S_ISLNK(mode):
+        target = os.readlink(source_path)
+        os.symlink(target, dest_path)
+        entries.append((relative_path, os.lstat(dest_path).st_mode, len(target), hash_link(target) if hash_contents else None))
+    elif stat.S_ISREG(mode):
+        files.append((source_path, dest_path, relative_path, source_stat))
+    elif stat.S_ISDIR(mode):
+        key = (source_stat.st_dev, source_stat.st_ino)
+        if key in ancestors:
+            raise path_error('Unable to copy directory cycle', source_path)
+        ancestors.add(key)
+        # Keep the directory writable until its contents are copied.
+        os.mkdir(dest_path, 0700)
+        for name in sorted(os.listdir(source_path)):
+            child_relative_path = relative_path + os.sep + name
+            child_source_path = os.path.join(source_path, name)
+            if exclude_patterns and _is_excluded(child_source_path, child_relative_path, follow_symlinks, exclude_patterns):
+                continue
+            _copy_tree(child_source_path, os.path.join(dest_path, name), child_relative_path,
+                       follow_symlinks, exclude_patterns, hash_contents, ancestors, entries, files, directories)
+        ancestors.remove(key)
+        directories.append((dest_path, relative_path, mode))
+    elif not relative_path:
+        raise path_error('Unable to copy special file', source_path)
+
+
+def _copy_file(file_info):
+    """
+    Copy a file given as a (source path, dest path, relative path, stat) tuple
+    and return its copy_tree entry, without hashing it.
+    """
+    (source_path, dest_path, relative_path, source_stat) = file_info
+    mode = source_stat.st_mode
+    source_fd = os.open(source_path, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            num_bytes = _copy_file_contents(source_fd, dest_fd)
+            os.fchmod(dest_fd, stat.S_IMODE(mode))
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(source_fd)
+    return (relative_path, stat.S_IFREG | stat.S_IMODE(mode), num_bytes, None)
+
+
+def _copy_file_and_hash(file_info):
+    """
+    Like _copy_file, but also hash the file while copying it.
+    """
+    (source_path, dest_path, relative_path, source_stat) = file_info
+    mode = source_stat.st_mode
+    with open(source_path, 'rb') as source, open(dest_path, 'wb') as dest:
+        (num_bytes, contents_hash) = hash_and_copy(source, dest)
+    os.chmod(dest_path, stat.S_IMODE(mode))
+    return (relative_path, stat.S_IFREG | stat.S_IMODE(mode), num_bytes, contents_hash)
+
+
+def _copy_file_and_cache_hash(file_info, hash_cache):
+    """
+    Like _copy_file_and_hash, but take the hash from |hash_cache| if it has the
+    source file, and otherwise add it there.
+    """
+    source_stat = file_info[3]
+    contents_hash = hash_cache.lookup_file(source_stat)
+    if contents_hash is not None:
+        return _copy_file(file_info)[:3] + (contents_hash,)
+    entry = _copy_file_and_hash(file_info)
+    hash_cache.add_file(source_stat, entry[3])
+    return entry
+
+
+def _copy_file_contents(source_fd, dest_fd):
+    """
+    Copy the rest of the file open as |source_fd| to |dest_fd|, from their
+    current offsets, and return the number of bytes copied. The data is copied
+    inside the kernel with copy_file_range (which can also share the blocks on
+    filesystems that support reflinks) or else sendfile, falling back to reading
+    and writing it when neither works for these files.
+    """
+    num_bytes = 0
+    for kernel_copy in (_copy_file_range, _sendfile):
+        if kernel_copy is None:
+            continue
+        while True:
+            if kernel_copy is _copy_file_range:
+                result = kernel_copy(source_fd, None, dest_fd, None, KERNEL_COPY_SIZE, 0)
+            else:
+                result = kernel_copy(dest_fd, source_fd, None, KERNEL_COPY_SIZE)
+            if result > 0:
+                num_bytes += result
+                continue
+            if result == 0:
+                # Some files (e.g., in /proc) report a size of 0 to the kernel
+                # but have contents when read, so make sure with a read.
+                if num_bytes == 0:
+                    break
+                return num_bytes
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            if error not in KERNEL_COPY_FALLBACK_ERRNOS:
+                raise OSError(error, os.strerror(error))
+            break
+    while True:
+        data = os.read(source_fd, file_util.BUFFER_SIZE)
+        if not data:
+            return num_bytes
+        num_bytes += len(data)
+        while data:
+            data = data[os.write(dest_fd, data):]
+
+
+def link_tree(source_path, dest_path):
+    """
+    Make |dest_path| a read-only view of |source_path| (e.g., a dependency of a
+    run, in the bundle store) that shares its data where possible instead of
+    copying it. Nothing in |source_path| can be modified through |dest_path|:
+      - A file is hardlinked only if the current user (as which runs execute)
+        can neither write to it nor change its permissions, i.e., it is not
+        writable by the user and owned by someone else.
+      - Otherwise, it is reflinked (a copy-on-write clone) if the filesystem
+        supports it, and copied if not.
+      - Directories are created, as read-only, and symlinks are copied as
+        symlinks.
+    When the paths are on different filesystems, every file is copied.
+    Return a Counter of the number of files hardlinked, reflinked and copied.
+    """
+    if os.path.lexists(dest_path):
+        raise path_error('already exists', dest_path)
+    files = []
+    directories = []
+    _copy_tree(source_path, dest_path, '', False, [], False, set(), [], files, directories)
+    same_device = os.lstat(source_path).st_dev == os.lstat(os.path.dirname(os.path.abspath(dest_path))).st_dev
+    link_file = functools.partial(_link_file, same_device=same_device)
+    methods = collections.Counter(_imap_threads(link_file, files, COPY_NUM_THREADS))
+    for (directory, _, mode) in directories:
+        os.chmod(directory, stat.S_IMODE(mode) & ~0222)
+    return methods
+
+
+def _link_file(file_info, same_device):
+    """
+    Helper for link_tree that hardlinks, reflinks or copies a file given as a
+    (source path, dest path, relative path, stat) tuple, and returns which of
+    'hardlink', 'reflink' or 'copy' it did. Only copies unless |same_device|.
+    """
+    (source_path, dest_path, relative_path, source_stat) = file_info
+    if not same_device:
+        _copy_file(file_info)
+        return 'copy'
+    if _is_immutable_for_current_user(source_stat):
+        try:
+            os.link(source_path, dest_path)
+            return 'hardlink'
+        except OSError, e:
+            # Too many links to the file, or the filesystem does not support them.
+            if e.errno not in (errno.EMLINK, errno.EPERM, errno.EXDEV):
+                raise
+    source_fd = os.open(source_path, os.O_RDONLY)
+    try:
+        dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            try:
+                fcntl.ioctl(dest_fd, FICLONE, source_fd)
+                method = 'reflink'
+            except IOError, e:
+                if e.errno not in KERNEL_COPY_FALLBACK_ERRNOS and e.errno not in (errno.ENOTTY, errno.EPERM):
+                    raise
+                _copy_file_contents(source_fd, dest_fd)
+                method = 'copy'
+            os.fchmod(dest_fd, stat.S_IMODE(source_stat.st_mode))
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(source_fd)
+    return method
+
+
+def _is_immutable_for_current_user(file_stat):
+    """
+    Return whether the current user can neither write to the file with the given
+    stat nor change its permissions.
+    """
+    euid = os.geteuid()
+    if euid == 0 or file_stat.st_uid == euid:
+        return False
+    mode = file_stat.st_mode
+    if mode & stat.S_IWOTH:
+        return False
+    return not (mode & stat.S_IWGRP and file_stat.st_gid in [os.getegid()] + os.getgroups())
+
+
+def _is_excluded(path, relative_path, follow_symlinks, exclude_patterns):
+    """
+    Return whether the entry at |path|, which is at |relative_path| in the tree
+    being copied, matches one of |exclude_patterns| (see copy_tree). Like rsync,
+    a pattern ending in a slash only matches directories.
+    """
+    name = os.path.basename(relative_path)
+    for pattern in exclude_patterns:
+        if pattern.endswith('/'):
+            pattern = pattern.rstrip('/')
+            is_dir = os.path.isdir(path) if follow_symlinks else (os.path.isdir(path) and not os.path.islink(path))
+            if not is_dir:
+                continue
+        if '/' in pattern:
+            if fnmatch.fnmatchcase(relative_path.lstrip(os.sep), pattern.lstrip('/')):
+                return True
+        elif fnmatch.fnmatchcase(name, pattern):
+            return True
+    return False
 
 
 def make_directory(path):
@@ -390,16 +901,42 @@ def make_directory(path):
 
 
 def set_write_permissions(path):
-    # Recursively give give write permissions to |path|, so that we can operate
-    # on it.
-    if not os.path.islink(path):  # Don't need write permissions if symlink
-        subprocess.call(['chmod', '-R', 'u+w', path])
+    """
+    Give the owner full permissions on the directories under |path| that lack
+    them, so that we can move or remove it. Files don't need them for that, and
+    they may be hardlinks shared with other bundles, so we leave them alone.
+    """
+    path_stat = os.lstat(path)
+    if not stat.S_ISDIR(path_stat.st_mode):  # Don't need write permissions if symlink
+        return
+    pending = [(path, path_stat)]
+    while pending:
+        (directory, directory_stat) = pending.pop()
+        if directory_stat.st_mode & stat.S_IRWXU != stat.S_IRWXU:
+            os.chmod(directory, stat.S_IMODE(directory_stat.st_mode) | stat.S_IRWXU)
+        for name in os.listdir(directory):
+            subpath = os.path.join(directory, name)
+            subpath_stat = os.lstat(subpath)
+            if stat.S_ISDIR(subpath_stat.st_mode):
+                pending.append((subpath, subpath_stat))
 
 
 def rename(old_path, new_path):
-    # Allow write permissions, or else the move will fail.
-    set_write_permissions(old_path)
-    subprocess.call(['mv', old_path, new_path])
+    """
+    Move |old_path| to |new_path|, which must not exist, even across filesystems.
+    """
+    try:
+        os.rename(old_path, new_path)
+    except OSError, e:
+        if e.errno in (errno.EACCES, errno.EPERM) and os.path.isdir(old_path) and not os.path.islink(old_path):
+            # Moving a directory to another parent updates its '..' entry.
+            os.chmod(old_path, stat.S_IMODE(os.lstat(old_path).st_mode) | stat.S_IWUSR)
+            os.rename(old_path, new_path)
+        elif e.errno == errno.EXDEV:
+            copy_tree(old_path, new_path)
+            remove(old_path)
+        else:
+            raise
 
 
 def remove(path):
@@ -407,15 +944,16 @@ def remove(path):
     Remove the given path, whether it is a directory, file, or link.
     """
     check_isvalid(path, 'remove')
-    set_write_permissions(path)  # Allow permissions
-    if os.path.islink(path):
-        os.unlink(path)
-    elif os.path.isdir(path):
+    if os.path.islink(path) or not os.path.isdir(path):
+        os.remove(path)
+    else:
         try:
             shutil.rmtree(path)
-        except shutil.Error:
-            pass
-    else:
-        os.remove(path)
+        except OSError, e:
+            # Only fix permissions if they get in the way.
+            if e.errno not in (errno.EACCES, errno.EPERM):
+                raise
+            set_write_permissions(path)
+            shutil.rmtree(path)
     if os.path.exists(path):
         print 'Failed to remove %s' % path
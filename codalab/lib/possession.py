@@ -0,0 +1,112 @@
+'''
+Proof that a client has the data of a bundle, so that the upload can be
+skipped when the bundle store already has data with the same data hash. Data
+hashes are shown to anyone who can read a bundle, so knowing one proves
+nothing. Instead, the server picks random byte ranges of the data
+(make_challenge), and the client answers with the SHA-1 of a random nonce
+followed by those bytes (answer_challenge), which it can only compute from the
+data itself.
+
+The ranges are offsets into the contents of the files of the Manifest
+concatenated in the order of their relative paths, so a challenge doesn't
+reveal the names or sizes of the files; both sides map them back to files with
+their own Manifest.
+'''
+import bisect
+import hashlib
+import math
+import os
+import random
+
+from codalab.lib.manifest import Manifest
+
+# Bounds on the number of byte ranges that a challenge asks for, and their size.
+MIN_SAMPLES = 8
+MAX_SAMPLES = 64
+SAMPLE_SIZE = 64 * 1024
+
+_random = random.SystemRandom()
+
+
+def _get_files(manifest):
+    '''
+    Return the (relative path, size) of the nonempty files of |manifest| in the
+    order that challenges concatenate them, the offset of each of them, and
+    their total size.
+    '''
+    files = sorted(
+        (relative_path, entry.size)
+        for (relative_path, entry) in manifest.entries.iteritems()
+        if entry.type == Manifest.FILE and entry.size
+    )
+    starts = []
+    total_size = 0
+    for (_, size) in files:
+        starts.append(total_size)
+        total_size += size
+    return (files, starts, total_size)
+
+
+def get_num_samples(num_files, total_size):
+    '''
+    Return how many ranges to ask for of data with |num_files| nonempty files
+    of |total_size| bytes: more for more files and more bytes, so that missing
+    any part of larger data is about as likely to be caught.
+    '''
+    num_samples = MIN_SAMPLES + int(math.log(num_files, 2)) + int(math.log(1 + total_size // SAMPLE_SIZE, 2))
+    return min(num_samples, MAX_SAMPLES)
+
+
+def make_challenge(manifest):
+    '''
+    Return a challenge for the data described by |manifest|: a dict with a
+    'nonce' and the 'samples' to read, as [offset, length]. Half of the samples
+    start in a file picked uniformly, so that small files are sampled as well,
+    and the rest at a byte picked uniformly. Data without any bytes in files
+    can't be proven to be had (its data hash is all there is to know about
+    it), so return None for it.
+    '''
+    (files, starts, total_size) = _get_files(manifest)
+    if not files:
+        return None
+    length = min(total_size, SAMPLE_SIZE)
+    samples = []
+    for i in range(get_num_samples(len(files), total_size)):
+        if i % 2 == 0:
+            index = _random.randrange(len(files))
+            offset = starts[index] + _random.randrange(files[index][1])
+        else:
+            offset = _random.randrange(total_size)
+        samples.append([min(offset, total_size - length), length])
+    return {'nonce': os.urandom(16).encode('hex'), 'samples': samples}
+
+
+def answer_challenge(challenge, manifest, read_range):
+    '''
+    Return the answer to |challenge| for the data described by |manifest|,
+    where read_range(relative path, offset, length) returns those bytes of one
+    of its files.
+    '''
+    (files, starts, total_size) = _get_files(manifest)
+    answer = hashlib.sha1(challenge['nonce'])
+    for (offset, length) in challenge['samples']:
+        offset = max(0, min(int(offset), total_size))
+        end = min(offset + int(length), total_size)
+        index = bisect.bisect_right(starts, offset) - 1
+        while offset < end:
+            (relative_path, size) = files[index]
+            file_offset = offset - starts[index]
+            file_length = min(size - file_offset, end - offset)
+            answer.update(read_range(relative_path, file_offset, file_length))
+            offset += file_length
+            index += 1
+    return answer.hexdigest()
+
+
+def read_file_range(path, offset, length):
+    '''
+    Return up to |length| bytes of the file at |path| starting at |offset|.
+    '''
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
@@ -0,0 +1,305 @@
+'''
+Scrubber checks that the bundles in data/ of a BundleStore still match their
+data hash, by rehashing them with path_util.hash_directory, to catch silent
+corruption of the disks before the bundles are used.
+
+Rehashing everything at full speed would starve runs of disk bandwidth, so all
+reads go through an IOBudget, which limits the bytes and I/O operations per
+second by sleeping. A pass over the store goes through the bundles in order of
+data hash and records how far it got in a state file after each bundle, so it
+can be interrupted and resumed (e.g., by running `cl scrub-store -n 1000` from
+cron). Mismatches are reported and kept in the state file until the bundle
+checks out again; nothing is deleted or repaired.
+
+While it runs, a probe thread times a small synchronous write in temp/ every
+PROBE_INTERVAL seconds, which is what the foreground (e.g., a run writing its
+output) waits for, and compares it to the same probe before scrubbing started.
+
+Cold bundles (see ColdStore) are checked by the CRCs of their archives when
+they are read, and bundles in a storage backend by the backend, so only the
+bundles in data/ are scrubbed. Large files of chunked bundles are reassembled
+from their chunks as they are hashed.
+
+Bundles with data hashes in the Merkle format can also be checked one target
+at a time (see scrub_target), against the hash of that subtree in their
+Manifest, without reading the rest of the bundle.
+'''
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from codalab.common import UsageError
+from codalab.lib import path_util
+
+
+class IOBudget(object):
+    '''
+    Limits I/O to |bytes_per_second| bytes and |ops_per_second| operations per
+    second on average (None for no limit), allowing bursts of up to
+    BURST_TIME seconds' worth.
+    '''
+    BURST_TIME = 1.0
+
+    def __init__(self, bytes_per_second=None, ops_per_second=None):
+        self.bytes_per_second = bytes_per_second
+        self.ops_per_second = ops_per_second
+        self.lock = threading.Lock()
+        # When the I/O done so far would be done at the budgeted rates, starting
+        # with a full burst.
+        self.bytes_time = self.ops_time = time.time() - self.BURST_TIME
+        self.num_bytes = 0
+        self.num_ops = 0
+        self.sleep_time = 0
+
+    def consume(self, num_bytes=0, num_ops=1):
+        '''
+        Account for |num_bytes| bytes read in |num_ops| operations, sleeping
+        until they fit in the budget.
+        '''
+        with self.lock:
+            now = time.time()
+            self.num_bytes += num_bytes
+            self.num_ops += num_ops
+            delay = 0
+            if self.bytes_per_second:
+                self.bytes_time = max(self.bytes_time, now - self.BURST_TIME) + float(num_bytes) / self.bytes_per_second
+                delay = max(delay, self.bytes_time - now)
+            if self.ops_per_second:
+                self.ops_time = max(self.ops_time, now - self.BURST_TIME) + float(num_ops) / self.ops_per_second
+                delay = max(delay, self.ops_time - now)
+            self.sleep_time += delay
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Scrubber(object):
+    STATE_FILE = 'scrub.json'
+    STATE_VERSION = 1
+
+    # Default budget: a fraction of what a single disk can do.
+    BYTES_PER_SECOND = 20 * 1024 * 1024
+    OPS_PER_SECOND = 100
+
+    # How often the probe thread times a write of PROBE_SIZE bytes, and how
+    # many times it does before scrubbing starts, for the baseline.
+    PROBE_INTERVAL = 5
+    PROBE_SIZE = 4096
+    NUM_BASELINE_PROBES = 3
+
+    def __init__(self, bundle_store, bytes_per_second=None, ops_per_second=None):
+        self.bundle_store = bundle_store
+        self.budget = IOBudget(bytes_per_second, ops_per_second)
+        self.state_path = os.path.join(bundle_store.codalab_home, self.STATE_FILE)
+
+    def load_state(self):
+        '''
+        Return the state saved by the last run, or a new one.
+        '''
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            if state.get('version') == self.STATE_VERSION:
+                return state
+        except IOError:
+            pass
+        return {'version': self.STATE_VERSION, 'cursor': None, 'pass_start': None, 'mismatches': {}}
+
+    def save_state(self, state):
+        temp_path = '%s.%s' % (self.state_path, uuid.uuid4().hex)
+        with open(temp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.rename(temp_path, self.state_path)
+
+    def run(self, max_bundles=None, max_time=None, restart=False, report=None):
+        '''
+        Scrub up to |max_bundles| bundles, for up to |max_time| seconds, picking
+        up where the last run stopped (unless |restart|), and return the metrics
+        of this run (see _get_metrics), which are also saved in the state.
+        |report|: called with (data_hash, path, actual data hash or error message)
+        for each mismatch.
+        '''
+        state = self.load_state()
+        if restart or state['cursor'] is None:
+            state['cursor'] = ''
+            state['pass_start'] = time.time()
+        data_paths = self.bundle_store.list_data_paths()
+        data_hashes = sorted(data_hash for data_hash in data_paths if data_hash > state['cursor'])
+
+        baseline = [self.probe() for _ in range(self.NUM_BASELINE_PROBES)]
+        probes = []
+        stop = threading.Event()
+        probe_thread = threading.Thread(target=self._probe_loop, args=(stop, probes))
+        probe_thread.daemon = True
+        probe_thread.start()
+
+        start_time = time.time()
+        (num_bundles, num_files, num_bytes, num_mismatches) = (0, 0, 0, 0)
+        try:
+            for data_hash in data_hashes:
+                if max_bundles is not None and num_bundles >= max_bundles:
+                    break
+                if max_time is not None and time.time() - start_time >= max_time:
+                    break
+                path = data_paths[data_hash]
+                start_bytes = self.budget.num_bytes
+                try:
+                    (actual_hash, bundle_num_files) = self.scrub_bundle(data_hash, path)
+                except (IOError, OSError), e:
+                    if not os.path.lexists(path):
+                        # Removed or moved meanwhile, e.g., by cleanup or freeze.
+                        continue
+                    (actual_hash, bundle_num_files) = ('error: %s' % (e,), 0)
+                num_bundles += 1
+                num_files += bundle_num_files
+                num_bytes += self.budget.num_bytes - start_bytes
+                if actual_hash == data_hash:
+                    state['mismatches'].pop(data_hash, None)
+                else:
+                    num_mismatches += 1
+                    state['mismatches'][data_hash] = {'path': path, 'actual': actual_hash, 'time': time.time()}
+                    if report:
+                        report(data_hash, path, actual_hash)
+                state['cursor'] = data_hash
+                self.save_state(state)
+            else:
+                # The pass is complete; the next run starts a new one.
+                state['cursor'] = None
+        finally:
+            stop.set()
+            probe_thread.join()
+
+        metrics = self._get_metrics(time.time() - start_time, num_bundles, num_files, num_bytes, num_mismatches, baseline, probes)
+        state['last_run'] = metrics
+        self.save_state(state)
+        return metrics
+
+    def _get_metrics(self, elapsed, num_bundles, num_files, num_bytes, num_mismatches, baseline, probes):
+        '''
+        Return a dict of the metrics of a run: what it read and how fast, how
+        long it slept to stay in its budget, and the latency of the probe
+        before (baseline) and while (mean and max) it scrubbed.
+        '''
+        return {
+            'time': time.time(),
+            'elapsed': elapsed,
+            'num_bundles': num_bundles,
+            'num_files': num_files,
+            'num_bytes': num_bytes,
+            'num_mismatches': num_mismatches,
+            'bytes_per_second': num_bytes / elapsed if elapsed else 0,
+            'ops_per_second': self.budget.num_ops / elapsed if elapsed else 0,
+            'sleep_time': self.budget.sleep_time,
+            'probe_baseline': sorted(baseline)[len(baseline) // 2],
+            'probe_mean': sum(probes) / len(probes) if probes else None,
+            'probe_max': max(probes) if probes else None,
+        }
+
+    def scrub_bundle(self, data_hash, path):
+        '''
+        Return the (data hash, number of files) of the bundle stored at |path|
+        under the given data hash, reading within the budget.
+        '''
+        chunked_files = dict(
+            (relative_path, contents_hash)
+            for (relative_path, contents_hash, _) in self.bundle_store.chunk_store.list_files(data_hash)
+        )
+        if path_util.is_merkle_data_hash(data_hash):
+            (digest, num_files) = self._hash(path, chunked_files, merkle=True)
+            return (path_util.MERKLE_DATA_HASH_PREFIX + digest, num_files)
+        (digest, num_files) = self._hash(path, chunked_files, merkle=False)
+        return (path_util.DATA_HASH_PREFIX + digest, num_files)
+
+    def scrub_target(self, data_hash, subpath):
+        '''
+        Return the (expected, actual) hash of |subpath| in the bundle with the
+        given data hash, which must be in the Merkle format: the hash of the
+        subtree in its Manifest, and that of what is stored, reading only the
+        subtree within the budget. The Manifest is checked against the data hash
+        first; if it does not match, the actual hash is an error message.
+        '''
+        if not path_util.is_merkle_data_hash(data_hash):
+            raise UsageError('Only data hashes in the Merkle format can be checked by target: %s' % (data_hash,))
+        manifest = self.bundle_store.get_manifest(data_hash)
+        if manifest is None:
+            raise UsageError('No manifest for %s' % (data_hash,))
+        hashes = manifest.merkle_hashes()
+        if subpath not in hashes:
+            raise UsageError('%s not found in %s' % (subpath, data_hash))
+        if hashes[''] != path_util.get_data_hash_digest(data_hash):
+            return (hashes[subpath], 'error: manifest does not match the data hash')
+        path = self.bundle_store.get_data_path(data_hash)
+        if path is None:
+            raise UsageError('%s is only in the cold tier or the backend, which check it themselves' % (data_hash,))
+        chunked_files = dict(
+            (relative_path[len(subpath):], contents_hash)
+            for (relative_path, contents_hash, _) in self.bundle_store.chunk_store.list_files(data_hash)
+            if relative_path == subpath or relative_path.startswith(subpath + os.sep)
+        )
+        return (hashes[subpath], self._hash(path + subpath, chunked_files, merkle=True)[0])
+
+    def _hash(self, path, chunked_files, merkle):
+        '''
+        Return the (hash_directory, number of files) of |path|, reading within
+        the budget. |chunked_files|: map from relative path to the contents hash
+        of the files under |path| that are in the chunk store.
+        '''
+        if os.path.isdir(path) and not os.path.islink(path):
+            (directories, files, _) = path_util.scan_tree(path)
+        else:
+            (directories, files) = ([], [path])
+        self.budget.consume(0, len(directories) + len(files))
+
+        def hash_file(file_path):
+            relative_path = path_util.get_relative_path(path, file_path)
+            if relative_path in chunked_files:
+                return self._hash_chunked_file(chunked_files[relative_path])
+            self.budget.consume(0, 1)
+            return path_util.hash_file_contents(file_path, on_read=lambda num_bytes: self.budget.consume(num_bytes, 1))
+
+        digest = path_util.hash_directory(path, (directories, files), num_threads=1, hash_file=hash_file, merkle=merkle)
+        return (digest, len(files))
+
+    def _hash_chunked_file(self, contents_hash):
+        '''
+        Return the hash_file_contents of the file with the given contents hash in
+        the chunk store, reassembled from its chunks.
+        '''
+        budget = self.budget
+
+        class HashWriter(object):
+            def __init__(self):
+                self.hash = hashlib.sha1(path_util.FILE_PREFIX)
+
+            def write(self, data):
+                budget.consume(len(data), 1)
+                self.hash.update(data)
+
+            def flush(self):
+                pass
+
+        writer = HashWriter()
+        self.bundle_store.chunk_store.read(contents_hash, writer)
+        return writer.hash.hexdigest()
+
+    def probe(self):
+        '''
+        Return how many seconds it takes to write and fsync PROBE_SIZE bytes to a
+        new file in temp/.
+        '''
+        probe_path = os.path.join(self.bundle_store.temp, 'scrub-probe-' + uuid.uuid4().hex)
+        start_time = time.time()
+        try:
+            with open(probe_path, 'wb') as f:
+                f.write('\0' * self.PROBE_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
+            return time.time() - start_time
+        finally:
+            os.remove(probe_path)
+
+    def _probe_loop(self, stop, probes):
+        while not stop.wait(self.PROBE_INTERVAL):
+            probes.append(self.probe())
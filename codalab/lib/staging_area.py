@@ -0,0 +1,152 @@
+'''
+StagingArea manages the directories in which new bundles are put together
+before BundleStore.upload moves them into data/, and in which FileServer
+receives uploaded files. It lives in the store's temp/ directory, on the same
+filesystem as data/, so that moving a staged bundle into place is a rename
+instead of a second copy.
+
+Space can be reserved for a staging directory when it is created, and more
+later on as the size of what goes into it becomes known (reserve): either fails
+if the filesystem does not have that much free space on top of what the staging
+directories of this process have reserved. Reservations are released once the staging directory has been moved or removed. Since space
+that is written while a reservation is held counts twice, the check errs on the
+side of refusing uploads when the disk is nearly full.
+
+Each staging directory is named after the host and process that created it,
+so reclaim can remove directories abandoned by a process that died right away,
+and leaves those of other processes alone until they are ABANDONED_TIME old.
+'''
+import errno
+import os
+import socket
+import threading
+import time
+import uuid
+
+from codalab.common import UsageError
+from codalab.lib import formatting, path_util
+
+
+class StagingArea(object):
+    PREFIX = 'staging-'
+
+    # Staging directories of live processes (or of processes on other hosts,
+    # which we can't check) are considered abandoned once they are this old.
+    ABANDONED_TIME = 60*60*24*7
+
+    def __init__(self, root):
+        self.root = root
+        self.hostname = socket.gethostname()
+        path_util.make_directory(self.root)
+        # Map from the staging directories of this process to their reservations.
+        self.lock = threading.Lock()
+        self.reservations = {}
+
+    def is_staging_path(self, name):
+        '''
+        Return whether |name| is the name of a staging directory in the root.
+        '''
+        return name.startswith(self.PREFIX)
+
+    def create(self, tag, num_bytes=0):
+        '''
+        Create a new staging directory, with |tag| in its name, and return its
+        path. Reserve |num_bytes| of space for it, or raise a UsageError if the
+        filesystem does not have that much space available.
+        '''
+        name = '%s%s-%s-%d@%s' % (self.PREFIX, tag, uuid.uuid4().hex, os.getpid(), self.hostname)
+        path = os.path.join(self.root, name)
+        with self.lock:
+            self._check_space(num_bytes)
+            os.mkdir(path)
+            self.reservations[path] = num_bytes
+        return path
+
+    def reserve(self, path, num_bytes):
+        '''
+        Reserve |num_bytes| more of space for the staging directory at |path|, or
+        raise a UsageError if the filesystem does not have that much space
+        available.
+        '''
+        with self.lock:
+            self._check_space(num_bytes)
+            self.reservations[path] = self.reservations.get(path, 0) + num_bytes
+
+    def _check_space(self, num_bytes):
+        '''
+        Raise a UsageError if |num_bytes| more can't be reserved. Called with the
+        lock held.
+        '''
+        available = self.get_free_space() - sum(self.reservations.itervalues())
+        if num_bytes > available:
+            raise UsageError('Not enough disk space to stage %s (%s available)' % (
+                formatting.size_str(num_bytes), formatting.size_str(max(available, 0))))
+
+    def get_free_space(self):
+        '''
+        Return the number of bytes available on the filesystem of the root.
+        '''
+        root_stat = os.statvfs(self.root)
+        return root_stat.f_bavail * root_stat.f_frsize
+
+    def release(self, path):
+        '''
+        Release the space reserved for the staging directory at |path|, once its
+        contents have been moved out or it is about to be removed.
+        '''
+        with self.lock:
+            self.reservations.pop(path, None)
+
+    def discard(self, path):
+        '''
+        Release the staging directory at |path| and remove it.
+        '''
+        if os.path.lexists(path):
+            path_util.remove(path)
+        self.release(path)
+
+    def reclaim(self, dry_run=False):
+        '''
+        Remove the staging directories abandoned by their processes and return
+        their paths.
+        '''
+        cutoff_time = time.time() - self.ABANDONED_TIME
+        with self.lock:
+            live_paths = set(self.reservations)
+        reclaimed = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not self.is_staging_path(name) or path in live_paths:
+                continue
+            try:
+                mtime = os.lstat(path).st_mtime
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            if mtime < cutoff_time or self._is_owner_dead(name):
+                reclaimed.append(path)
+                if not dry_run:
+                    path_util.remove(path)
+        return reclaimed
+
+    def _is_owner_dead(self, name):
+        '''
+        Return whether the staging directory |name| was created by a process on
+        this host that is no longer running.
+        '''
+        (owner, _, hostname) = name.rpartition('@')
+        if hostname != self.hostname:
+            return False
+        try:
+            pid = int(owner.rpartition('-')[2])
+        except ValueError:
+            return False
+        if pid == os.getpid():
+            # Our own directory, but not a live one.
+            return True
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.ESRCH
+        return False
@@ -0,0 +1,332 @@
+'''
+A StorageBackend is where a BundleStore can keep bundle data instead of its
+local data/ directories (see BundleStore.backend), through a small object store
+API: put, get_range, list, stat and delete, on objects named by keys, which are
+'/'-separated strings. Bundles in a backend are fetched into materialized/ when
+a run needs them, and otherwise read in ranges, so that the store can grow
+independently of the server.
+
+Two implementations:
+  FilesystemBackend: keys are paths under a directory, like the local store.
+  ObjectStoreBackend: a stand-in for a remote object store, with a flat
+    namespace, objects that appear atomically when they are complete and an
+    optional latency per request, to benchmark against.
+'''
+import collections
+import errno
+import os
+import shutil
+import stat
+import time
+import urllib
+import uuid
+
+from codalab.common import UsageError
+from codalab.lib import path_util
+
+
+ObjectStat = collections.namedtuple('ObjectStat', ['size', 'mtime'])
+
+
+def create_backend(config):
+    '''
+    Return the StorageBackend described by |config|, a dict with the 'type' of
+    backend (one of BACKEND_TYPES) and its constructor arguments, or None if
+    |config| is empty.
+    '''
+    if not config:
+        return None
+    config = dict(config)
+    backend_type = config.pop('type', None)
+    if backend_type not in BACKEND_TYPES:
+        raise UsageError('Unknown storage backend %s (must be one of %s)' % (
+            backend_type, ', '.join(sorted(BACKEND_TYPES))))
+    config['root'] = path_util.normalize(config['root'])
+    return BACKEND_TYPES[backend_type](**config)
+
+
+def _make_parent_directories(path):
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError, e:
+            # Another put created it first.
+            if e.errno != errno.EEXIST:
+                raise
+
+
+class StorageBackend(object):
+    # get reads objects in ranges of this many bytes.
+    GET_BLOCK_SIZE = 8 * 1024 * 1024
+
+    def put(self, key, source):
+        '''
+        Store the contents of the file object |source| as the object |key|,
+        replacing any existing one. Readers never see a partial object.
+        '''
+        raise NotImplementedError
+
+    def get_range(self, key, offset=0, length=None):
+        '''
+        Return up to |length| bytes (by default, all of them) of the object |key|
+        starting at |offset|. Raise a KeyError if there is no such object.
+        '''
+        raise NotImplementedError
+
+    def list(self, prefix=''):
+        '''
+        Return the sorted keys of the objects whose key starts with |prefix|.
+        '''
+        raise NotImplementedError
+
+    def stat(self, key):
+        '''
+        Return the ObjectStat of the object |key|, or None if there is no such
+        object.
+        '''
+        raise NotImplementedError
+
+    def delete(self, key):
+        '''
+        Delete the object |key|, if it exists.
+        '''
+        raise NotImplementedError
+
+    def get(self, key, dest):
+        '''
+        Write the contents of the object |key| to the file object |dest|.
+        '''
+        offset = 0
+        while True:
+            data = self.get_range(key, offset, self.GET_BLOCK_SIZE)
+            dest.write(data)
+            offset += len(data)
+            if len(data) < self.GET_BLOCK_SIZE:
+                break
+
+    def open(self, key):
+        '''
+        Return a file object that reads the object |key| in ranges of
+        GET_BLOCK_SIZE bytes, so that large objects are streamed.
+        '''
+        return _ObjectReader(self, key)
+
+
+class _ObjectReader(object):
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+        self.offset = 0
+        self.buffer = ''
+        self.done = False
+
+    def read(self, num_bytes=None):
+        if num_bytes is not None and num_bytes < 0:
+            num_bytes = None
+        while not self.done and (num_bytes is None or len(self.buffer) < num_bytes):
+            data = self.backend.get_range(self.key, self.offset, self.backend.GET_BLOCK_SIZE)
+            self.offset += len(data)
+            self.buffer += data
+            self.done = len(data) < self.backend.GET_BLOCK_SIZE
+        if num_bytes is None:
+            num_bytes = len(self.buffer)
+        (result, self.buffer) = (self.buffer[:num_bytes], self.buffer[num_bytes:])
+        return result
+
+    def close(self):
+        self.buffer = ''
+        self.done = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FilesystemBackend(StorageBackend):
+    # Prefix of the names of partially written objects.
+    TEMP_PREFIX = '.put-'
+
+    def __init__(self, root):
+        self.root = root
+        path_util.make_directory(self.root)
+
+    def _get_path(self, key):
+        components = key.split('/')
+        if not key or any(component in ('', os.curdir, os.pardir) for component in components):
+            raise UsageError('Invalid key: %r' % (key,))
+        return os.path.join(self.root, *components)
+
+    def put(self, key, source):
+        path = self._get_path(key)
+        _make_parent_directories(path)
+        temp_path = os.path.join(os.path.dirname(path), self.TEMP_PREFIX + uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'wb') as dest:
+                shutil.copyfileobj(source, dest, self.GET_BLOCK_SIZE)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get_range(self, key, offset=0, length=None):
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                f.seek(offset)
+                return f.read() if length is None else f.read(length)
+        except IOError, e:
+            if e.errno in (errno.ENOENT, errno.EISDIR):
+                raise KeyError(key)
+            raise
+
+    def get(self, key, dest):
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                shutil.copyfileobj(f, dest, self.GET_BLOCK_SIZE)
+        except IOError, e:
+            if e.errno in (errno.ENOENT, errno.EISDIR):
+                raise KeyError(key)
+            raise
+
+    def list(self, prefix=''):
+        # Only walk the deepest directory that the prefix determines.
+        directory = prefix.rpartition('/')[0]
+        base = self._get_path(directory) if directory else self.root
+        if not os.path.isdir(base):
+            return []
+        (_, files, _) = path_util.scan_tree(base)
+        keys = []
+        for path in files:
+            if os.path.basename(path).startswith(self.TEMP_PREFIX):
+                continue
+            key = os.path.relpath(path, self.root).replace(os.sep, '/')
+            if key.startswith(prefix):
+                keys.append(key)
+        return sorted(keys)
+
+    def stat(self, key):
+        try:
+            path_stat = os.stat(self._get_path(key))
+        except OSError, e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return None
+        if not stat.S_ISREG(path_stat.st_mode):
+            return None
+        return ObjectStat(path_stat.st_size, path_stat.st_mtime)
+
+    def delete(self, key):
+        path = self._get_path(key)
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        # Remove the directories that are left empty, like an object store
+        # would not have them.
+        parent = os.path.dirname(path)
+        while parent != self.root:
+            try:
+                os.rmdir(parent)
+            except OSError, e:
+                if e.errno in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                    break
+                raise
+            parent = os.path.dirname(parent)
+
+
+class ObjectStoreBackend(StorageBackend):
+    '''
+    Objects are files in objects/ named by their quoted key. They are written in
+    uploads/ and renamed into place when complete. Every request sleeps for
+    |latency| seconds first, like a round trip to a remote store.
+    '''
+    # Quoted keys are split into directories of this many characters (marked
+    # by a suffix that quoting never produces) to fit in a file name.
+    NAME_LENGTH = 200
+    DIRECTORY_SUFFIX = '~'
+
+    def __init__(self, root, latency=0):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.uploads = os.path.join(root, 'uploads')
+        self.latency = latency
+        path_util.make_directory(self.root)
+        path_util.make_directory(self.objects)
+        path_util.make_directory(self.uploads)
+
+    def _request(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get_path(self, key):
+        if not key:
+            raise UsageError('Invalid key: %r' % (key,))
+        name = urllib.quote(key, safe='')
+        components = []
+        while len(name) > self.NAME_LENGTH:
+            components.append(name[:self.NAME_LENGTH] + self.DIRECTORY_SUFFIX)
+            name = name[self.NAME_LENGTH:]
+        return os.path.join(self.objects, *(components + [name]))
+
+    def put(self, key, source):
+        path = self._get_path(key)
+        self._request()
+        temp_path = os.path.join(self.uploads, uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'wb') as dest:
+                shutil.copyfileobj(source, dest, self.GET_BLOCK_SIZE)
+            _make_parent_directories(path)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get_range(self, key, offset=0, length=None):
+        self._request()
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                f.seek(offset)
+                return f.read() if length is None else f.read(length)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            raise KeyError(key)
+
+    def list(self, prefix=''):
+        self._request()
+        (_, files, _) = path_util.scan_tree(self.objects)
+        keys = (
+            urllib.unquote(os.path.relpath(path, self.objects).replace(self.DIRECTORY_SUFFIX + os.sep, ''))
+            for path in files
+        )
+        return sorted(key for key in keys if key.startswith(prefix))
+
+    def stat(self, key):
+        self._request()
+        try:
+            path_stat = os.stat(self._get_path(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return ObjectStat(path_stat.st_size, path_stat.st_mtime)
+
+    def delete(self, key):
+        self._request()
+        try:
+            os.remove(self._get_path(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+BACKEND_TYPES = {
+    'filesystem': FilesystemBackend,
+    'object_store': ObjectStoreBackend,
+}
@@ -0,0 +1,99 @@
+'''
+A BundleStore can spread its bundles over several volumes (e.g., disks), each a
+directory with its own data/, temp/ and objects/. A bundle is staged in the
+temp/ of the volume it is placed on, so that moving it into data/ is a rename,
+and deduplicated against the objects/ of that volume, since hardlinks can't
+cross filesystems.
+
+VolumeIndex records which volume each bundle was placed on, in a SQLite
+database, so that finding a bundle does not require probing every volume.
+'''
+import os
+import sqlite3
+import threading
+
+from codalab.lib import path_util
+from codalab.lib.staging_area import StagingArea
+
+
+class Volume(object):
+    DATA_SUBDIRECTORY = 'data'
+    TEMP_SUBDIRECTORY = 'temp'
+    OBJECT_SUBDIRECTORY = 'objects'
+
+    def __init__(self, root):
+        self.root = root
+        self.data = os.path.join(root, self.DATA_SUBDIRECTORY)
+        self.temp = os.path.join(root, self.TEMP_SUBDIRECTORY)
+        self.objects = os.path.join(root, self.OBJECT_SUBDIRECTORY)
+        self.make_directories()
+        self.staging = StagingArea(self.temp)
+
+    def make_directories(self):
+        for path in (self.root, self.data, self.temp, self.objects):
+            path_util.make_directory(path)
+
+    def get_space(self):
+        '''
+        Return the (available, total) number of bytes on the filesystem of this
+        volume.
+        '''
+        root_stat = os.statvfs(self.root)
+        return (root_stat.f_bavail * root_stat.f_frsize, root_stat.f_blocks * root_stat.f_frsize)
+
+    def get_free_fraction(self, space=None):
+        '''
+        Return the fraction of this volume's filesystem that is available, given
+        its (available, total) number of bytes |space| (by default, get_space()).
+        '''
+        (available, total) = space or self.get_space()
+        return float(available) / total if total else 0.0
+
+    def contains(self, path):
+        '''
+        Return whether |path| is on the same filesystem as this volume.
+        '''
+        return os.lstat(path).st_dev == os.lstat(self.root).st_dev
+
+
+class VolumeIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.text_factory = str
+        with self.lock:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS placement (
+                  data_hash TEXT NOT NULL PRIMARY KEY,
+                  volume TEXT NOT NULL
+                );
+            ''')
+
+    def lookup(self, data_hash):
+        '''
+        Return the root of the volume that the given data hash was placed on, or None.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT volume FROM placement WHERE data_hash = ?', (data_hash,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def add(self, data_hash, volume_root):
+        '''
+        Record that the given data hash is on the volume at |volume_root|.
+        '''
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO placement VALUES (?, ?)', (data_hash, volume_root))
+
+    def remove(self, data_hash):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM placement WHERE data_hash = ?', (data_hash,))
+
+    def clear(self):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM placement')
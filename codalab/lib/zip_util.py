@@ -7,18 +7,58 @@ The zip files here are not arbitrary: they contain one designated
 file/directory.  In other words, zip files represent unnamed file/directories.
 
 To zip/unzip, we use the standard temp files.
+
+Paths are packed into tar archives, which are compressed with one of CODECS:
+  GZIP: a gzip stream, compressed by one thread.
+  PARALLEL_GZIP: a gzip stream of one gzip member per PARALLEL_GZIP_BLOCK_SIZE
+    block, compressed by several threads (zlib releases the GIL). Any gzip
+    reader can read it, including unpack.
+  NO_COMPRESSION: the tar archive itself, for data that does not compress
+    (see choose_codec), or a fast network.
 """
+import bz2
+import collections
+import contextlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
+import stat
 import sys
 import subprocess
+import tarfile
 import tempfile
+import time
+import zipfile
+import zlib
 
 from codalab.common import UsageError
-from codalab.lib import path_util, print_util, file_util
+from codalab.lib import path_util, print_util, file_util, formatting
+from codalab.lib.manifest import Manifest
 
 # Files with these extensions are considered archive.
 ARCHIVE_EXTS = ['.tar.gz', '.tgz', '.tar.bz2', '.zip']
+# Paths packed by open_packed_path are named with add_packed_suffix, which adds
+# one of these extensions (see get_packed_ext).
+PACKED_EXTS = ARCHIVE_EXTS + ['.tar']
+
+GZIP = 'gzip'
+PARALLEL_GZIP = 'parallel_gzip'
+NO_COMPRESSION = 'none'
+CODECS = (GZIP, PARALLEL_GZIP, NO_COMPRESSION)
+# Default zlib compression level (what gzip uses).
+DEFAULT_COMPRESSION_LEVEL = 6
+
+PARALLEL_GZIP_BLOCK_SIZE = 1024 * 1024
+PARALLEL_GZIP_NUM_THREADS = min(8, multiprocessing.cpu_count())
+
+# choose_codec does not compress paths of which at least this fraction of the
+# bytes is in files with these extensions, which are compressed already.
+COMPRESSED_EXTS = [
+    '.gz', '.tgz', '.bz2', '.xz', '.zip', '.7z', '.npz', '.h5', '.hdf5',
+    '.png', '.jpg', '.jpeg', '.gif', '.mp3', '.mp4', '.avi', '.mkv', '.pdf',
+]
+COMPRESSED_FRACTION = 0.5
 
 # When deciding whether an archive contains a single file/directory, ignore
 # these contents.
@@ -39,61 +79,171 @@ def strip_archive_ext(path):
     raise UsageError('Not an archive: %s' % path)
 
 
-def add_packed_suffix(path):
+def path_is_packed(path):
+    """
+    Like path_is_archive, but for paths named with add_packed_suffix, which
+    might be uncompressed tar archives as well. A user's '.tar' file is not an
+    archive, so it is packed (and named) like any other path.
+    """
+    return any(path.endswith(ext) for ext in PACKED_EXTS)
+
+
+def strip_packed_ext(path):
+    for ext in PACKED_EXTS:
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    raise UsageError('Not a packed path: %s' % path)
+
+
+def get_packed_ext(codec):
+    return '.tar' if codec == NO_COMPRESSION else '.tar.gz'
+
+
+def add_packed_suffix(path, codec=GZIP):
     """
     Add the packed suffix for path if it's not an archive.
     """
     if path_is_archive(path):
         return path
-    return path + '.tar.gz'
+    return path + get_packed_ext(codec)
 
 
-def open_packed_path(source, follow_symlinks, exclude_patterns):
+def choose_codec(source):
     """
-    Return file handle corresponding to |source|, which is either
-    - an archive file: just stream it.
-    - else: turn it into an archive
+    Return the codec to pack the local path |source| with: NO_COMPRESSION if
+    most of its bytes are in files that are compressed already, and otherwise
+    the fastest gzip codec on this machine.
     """
-    if path_is_archive(source):
-        return open(source)
-    args = ['tar', 'cfz', '-', '-C', os.path.dirname(source) or '.', os.path.basename(source)]
+    if os.path.isdir(source) and not os.path.islink(source):
+        (_, files, stats) = path_util.scan_tree(source)
+    else:
+        (files, stats) = ([source], {source: os.lstat(source)})
+    total_size = compressed_size = 0
+    for file_path in files:
+        size = stats[file_path].st_size
+        total_size += size
+        if any(file_path.lower().endswith(ext) for ext in COMPRESSED_EXTS):
+            compressed_size += size
+    if total_size and compressed_size >= COMPRESSED_FRACTION * total_size:
+        return NO_COMPRESSION
+    return PARALLEL_GZIP if PARALLEL_GZIP_NUM_THREADS > 1 else GZIP
+
+
+def _get_pack_args(source, follow_symlinks, exclude_patterns):
+    """
+    Return the command that writes the tar archive of |source| to stdout.
+    """
+    args = ['tar', 'cf', '-', '-C', os.path.dirname(source) or '.', os.path.basename(source)]
     if follow_symlinks:
         args.append('-h')
     if exclude_patterns is not None:
         for pattern in exclude_patterns:
             args.append('--exclude=' + pattern)
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
-    return proc.stdout
+    return args
+
+
+def open_packed_path(source, follow_symlinks, exclude_patterns, codec=GZIP, level=None):
+    """
+    Return file handle corresponding to |source|, which is either
+    - an archive file: just stream it.
+    - else: turn it into an archive, compressed with |codec| at |level|
+      (by default, DEFAULT_COMPRESSION_LEVEL)
+    """
+    if path_is_archive(source):
+        return open(source)
+    proc = subprocess.Popen(_get_pack_args(source, follow_symlinks, exclude_patterns), stdout=subprocess.PIPE)
+    return compress(proc.stdout, codec, level)
+
+
+def start_pack(source, follow_symlinks=False, exclude_patterns=None, codec=GZIP, level=None):
+    """
+    Start packing |source| and return the (tar process, file handle to read the
+    archive compressed with |codec| from). Unlike with open_packed_path, the
+    caller can tell whether the archive is complete: tar exits with 0.
+    """
+    proc = subprocess.Popen(_get_pack_args(source, follow_symlinks, exclude_patterns), stdout=subprocess.PIPE)
+    return (proc, compress(proc.stdout, codec, level))
+
+
+def pack(source, dest_path, follow_symlinks=False, exclude_patterns=None, codec=GZIP, level=None):
+    """
+    Write the archive of |source| compressed with |codec| to |dest_path|,
+    raising an exception if tar fails (unlike open_packed_path, whose reader
+    just sees the archive end).
+    """
+    (proc, handle) = start_pack(source, follow_symlinks, exclude_patterns, codec, level)
+    try:
+        with open(dest_path, 'wb') as dest:
+            shutil.copyfileobj(handle, dest, PARALLEL_GZIP_BLOCK_SIZE)
+    except:
+        proc.kill()
+        proc.wait()
+        raise
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, 'tar')
+
+
+def compress(source_handle, codec, level=None):
+    """
+    Return a file-like object that reads the contents of |source_handle|
+    compressed with |codec| at |level| (by default, DEFAULT_COMPRESSION_LEVEL).
+    """
+    if codec not in CODECS:
+        raise UsageError('Unknown codec %s (must be one of %s)' % (codec, ', '.join(CODECS)))
+    if codec == NO_COMPRESSION:
+        return source_handle
+    level = DEFAULT_COMPRESSION_LEVEL if level is None else level
+    num_threads = PARALLEL_GZIP_NUM_THREADS if codec == PARALLEL_GZIP else 1
+    return _CompressingReader(source_handle, level, num_threads)
 
 
 def unpack(source, dest_path):
     """
     Unpack the archive |source_path| to |dest_path|.
     Note: |source| can be a file handle or a path.
+    Return the Manifest of |dest_path|, which is computed while unpacking.
     """
-    # Unpack to a temporary location.
+    # Unpack to a temporary location next to |dest_path|, so that moving the
+    # result there is a rename.
     # TODO: guard against zip bombs.  Put a maximum limit and enforce it here.
     # In the future, we probably don't want to be unpacking things all over the place.
-    tmp_path = tempfile.mkdtemp('-zip_util.unpack')
-    if isinstance(source, basestring):
-        source_path = source
-        if source_path.endswith('tar.gz') or source_path.endswith('tgz'):
-            exitcode = subprocess.call(['tar', 'xfz', source_path, '-C', tmp_path])
-        elif source_path.endswith('tar.bz2'):
-            exitcode = subprocess.call(['tar', 'xfj', source_path, '-C', tmp_path])
-        elif source_path.endswith('zip'):
-            exitcode = subprocess.call(['unzip', '-q', source_path, '-d', tmp_path])
+    tmp_path = tempfile.mkdtemp('-zip_util.unpack', dir=os.path.dirname(os.path.abspath(dest_path)))
+    unpacker = _Unpacker(tmp_path)
+    try:
+        if isinstance(source, basestring):
+            source_path = source
+            if source_path.endswith('tar.gz') or source_path.endswith('tgz'):
+                with open(source_path, 'rb') as source_handle:
+                    unpacker.unpack_tar(_GzipReader(source_handle))
+            elif source_path.endswith('tar.bz2'):
+                with open(source_path, 'rb') as source_handle:
+                    unpacker.unpack_tar(_DecompressingReader(source_handle, bz2.BZ2Decompressor()))
+            elif source_path.endswith('.tar'):
+                with open(source_path, 'rb') as source_handle:
+                    unpacker.unpack_tar(source_handle)
+            elif source_path.endswith('zip'):
+                unpacker.unpack_zip(source_path)
+            else:
+                raise UsageError('Not an archive: %s' % source_path)
         else:
-            raise UsageError('Not an archive: %s' % source_path)
-        if exitcode != 0:
-            raise UsageError('Error unpacking %s' % source_path)
-    else:
-        # File handle, stream the contents!
-        source_handle = source
-        proc = subprocess.Popen(['tar', 'xfz', '-', '-C', tmp_path], stdin=subprocess.PIPE)
-        file_util.copy(source_handle, proc.stdin, print_status='Downloading and unpacking to %s' % tmp_path)
-        proc.stdin.close()
-        proc.wait()
+            # File handle, stream the contents! It is a tar archive, which is
+            # compressed with gzip if it starts with the gzip magic number.
+            source_path = 'stream'
+            status_handle = _StatusReader(source, 'Downloading and unpacking to %s' % tmp_path)
+            header = status_handle.read(len(GZIP_MAGIC))
+            source_handle = _PrefixedReader(header, status_handle)
+            if header == GZIP_MAGIC:
+                unpacker.unpack_tar(_GzipReader(source_handle))
+            else:
+                unpacker.unpack_tar(source_handle)
+            status_handle.done()
+    except (tarfile.TarError, zipfile.BadZipfile, zlib.error, IOError, EOFError), e:
+        path_util.remove(tmp_path)
+        raise UsageError('Error unpacking %s: %s' % (source_path, e))
+    except:
+        path_util.remove(tmp_path)
+        raise
+    manifest = unpacker.finish()
 
     # Move files into the right place.
     # If archive only contains one path, then use that.
@@ -101,5 +251,310 @@ def unpack(source, dest_path):
     if len(files) == 1:
         path_util.rename(os.path.join(tmp_path, files[0]), dest_path)
         path_util.remove(tmp_path)
+        return manifest.subtree(os.sep + files[0])
     else:
         path_util.rename(tmp_path, dest_path)
+        return manifest
+
+
+class _Unpacker(object):
+    """
+    Extracts the members of archives into a directory, building its Manifest.
+    Like tar and unzip run by a regular user, applies the umask to permissions,
+    restores the mtimes of files and directories, and skips special files.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.manifest = Manifest()
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+        # Permissions of the directories we created, which are only applied in
+        # finish() so that read-only directories can be filled in.
+        self.directory_perms = {'': None}
+        # Mtimes of the directories in the archive, which are only applied in
+        # finish() since adding their contents changes them.
+        self.directory_mtimes = {}
+        self.has_links = False
+
+    def _get_relative_path(self, name):
+        """
+        Return the relative path of the member |name|, or None if it would end up
+        outside the root.
+        """
+        parts = [part for part in name.split('/') if part and part != '.']
+        if not parts or '..' in parts:
+            print >>sys.stderr, 'Skipping archive member: %s' % name
+            return None
+        return ''.join(os.sep + part for part in parts)
+
+    def _prepare(self, relative_path):
+        """
+        Create the parent directories of |relative_path| and remove anything that
+        an earlier member put there. Return its absolute path.
+        """
+        parent = relative_path[:relative_path.rindex(os.sep)]
+        if parent not in self.directory_perms:
+            self._make_directory(parent, 0777)
+        path = self.root + relative_path
+        if self.has_links:
+            # Don't write through symlinks that earlier members created.
+            path_util.check_under_path(os.path.dirname(path), self.root)
+        if relative_path in self.manifest.entries:
+            path_util.remove(path)
+            del self.manifest.entries[relative_path]
+        return path
+
+    def _make_directory(self, relative_path, perm, mtime=None):
+        if relative_path not in self.directory_perms:
+            os.mkdir(self._prepare(relative_path), 0700)
+        self.directory_perms[relative_path] = perm
+        if mtime is not None:
+            self.directory_mtimes[relative_path] = mtime
+
+    def _add_file(self, relative_path, source_handle, perm, mtime):
+        path = self._prepare(relative_path)
+        with open(path, 'wb') as dest_handle:
+            (num_bytes, contents_hash) = path_util.hash_and_copy(source_handle, dest_handle)
+        perm = perm & ~self.umask
+        os.chmod(path, perm)
+        os.utime(path, (mtime, mtime))
+        self.manifest.add(relative_path, stat.S_IFREG | perm, num_bytes, contents_hash)
+
+    def _add_link(self, relative_path, target):
+        os.symlink(target, self._prepare(relative_path))
+        self.manifest.add(relative_path, stat.S_IFLNK | 0777, len(target), path_util.hash_link(target))
+        self.has_links = True
+
+    def _add_hard_link(self, relative_path, target_relative_path):
+        entry = self.manifest.entries.get(target_relative_path)
+        if not entry or entry.type != Manifest.FILE:
+            raise UsageError('Invalid hard link in archive: %s' % relative_path)
+        os.link(self.root + target_relative_path, self._prepare(relative_path))
+        self.manifest.entries[relative_path] = entry
+
+    def unpack_tar(self, source_handle):
+        tar = tarfile.open(fileobj=source_handle, mode='r|')
+        for member in tar:
+            relative_path = self._get_relative_path(member.name)
+            if not relative_path:
+                continue
+            if member.isdir():
+                self._make_directory(relative_path, member.mode & 07777, member.mtime)
+            elif member.isreg():
+                self._add_file(relative_path, tar.extractfile(member), member.mode & 07777, member.mtime)
+            elif member.issym():
+                self._add_link(relative_path, member.linkname)
+            elif member.islnk():
+                self._add_hard_link(relative_path, self._get_relative_path(member.linkname))
+            else:
+                print >>sys.stderr, 'Skipping special file in archive: %s' % member.name
+
+    def unpack_zip(self, source_path):
+        with contextlib.closing(zipfile.ZipFile(source_path)) as archive:
+            for info in archive.infolist():
+                relative_path = self._get_relative_path(info.filename)
+                if not relative_path:
+                    continue
+                mode = info.external_attr >> 16
+                # Zip archives store local times, like unzip restores them.
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                if info.filename.endswith('/'):
+                    self._make_directory(relative_path, (mode & 07777) or 0777, mtime)
+                elif stat.S_ISLNK(mode):
+                    self._add_link(relative_path, archive.read(info))
+                else:
+                    with contextlib.closing(archive.open(info)) as member_handle:
+                        self._add_file(relative_path, member_handle, (mode & 07777) or 0666, mtime)
+
+    def finish(self):
+        """
+        Apply directory permissions and mtimes and return the Manifest of the
+        root.
+        """
+        # Deepest directories first, so that their parents are still writable
+        # and setting their mtimes doesn't change those of the parents.
+        for relative_path in sorted(self.directory_perms, reverse=True):
+            path = self.root + relative_path
+            perm = self.directory_perms[relative_path]
+            if perm is not None:
+                os.chmod(path, perm & ~self.umask)
+            mtime = self.directory_mtimes.get(relative_path)
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+            directory_stat = os.lstat(path)
+            self.manifest.add(relative_path, directory_stat.st_mode, directory_stat.st_size)
+        return self.manifest
+
+
+class _DecompressingReader(object):
+    """
+    File-like object that reads from |source_handle| and decompresses with
+    |decompressor| (a zlib or bz2 decompression object).
+    """
+    # Compressed input is read in small blocks to bound memory use.
+    INPUT_SIZE = 64 * 1024
+
+    def __init__(self, source_handle, decompressor):
+        self.source_handle = source_handle
+        self.decompressor = decompressor
+        self.buffer = ''
+        self.offset = 0
+        self.eof = False
+
+    def _next_input(self):
+        """
+        Return the next block of compressed input ('' at EOF).
+        """
+        return self.source_handle.read(self.INPUT_SIZE)
+
+    def read(self, num_bytes=None):
+        chunks = []
+        while num_bytes is None or num_bytes > 0:
+            if self.offset >= len(self.buffer):
+                if self.eof:
+                    break
+                data = self._next_input()
+                if not data:
+                    self.eof = True
+                (self.buffer, self.offset) = (self.decompressor.decompress(data) if data else '', 0)
+                continue
+            end = len(self.buffer) if num_bytes is None else min(len(self.buffer), self.offset + num_bytes)
+            chunks.append(self.buffer[self.offset:end])
+            if num_bytes is not None:
+                num_bytes -= end - self.offset
+            self.offset = end
+        return ''.join(chunks)
+
+
+class _GzipReader(_DecompressingReader):
+    """
+    Decompresses a gzip stream, which may consist of several gzip members (as
+    written by parallel compressors).
+    """
+    def __init__(self, source_handle):
+        super(_GzipReader, self).__init__(source_handle, zlib.decompressobj(16 + zlib.MAX_WBITS))
+
+    def _next_input(self):
+        unused_data = self.decompressor.unused_data
+        if unused_data.strip('\0'):
+            # The previous member ended; the rest of the input is the next member.
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            return unused_data
+        return self.source_handle.read(self.INPUT_SIZE)
+
+
+GZIP_MAGIC = '\x1f\x8b'
+
+
+class _PrefixedReader(object):
+    """
+    File-like object that reads |prefix| and then the rest of |source_handle|.
+    """
+    def __init__(self, prefix, source_handle):
+        self.prefix = prefix
+        self.source_handle = source_handle
+
+    def read(self, num_bytes=None):
+        if not self.prefix:
+            return self.source_handle.read() if num_bytes is None else self.source_handle.read(num_bytes)
+        if num_bytes is None:
+            (data, self.prefix) = (self.prefix + self.source_handle.read(), '')
+        else:
+            (data, self.prefix) = (self.prefix[:num_bytes], self.prefix[num_bytes:])
+            if len(data) < num_bytes:
+                data += self.source_handle.read(num_bytes - len(data))
+        return data
+
+
+def _gzip_member(data, level):
+    """
+    Return |data| compressed as one gzip member.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _CompressingReader(object):
+    """
+    File-like object that reads from |source_handle| and compresses with gzip
+    at |level|. With several threads, each PARALLEL_GZIP_BLOCK_SIZE block of
+    input becomes its own gzip member, and up to twice as many blocks as there
+    are threads are compressed ahead of the reader.
+    """
+    def __init__(self, source_handle, level, num_threads):
+        self.source_handle = source_handle
+        self.level = level
+        self.num_threads = num_threads
+        if num_threads > 1:
+            self.pool = ThreadPool(num_threads)
+            self.pending = collections.deque()
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.offset = 0
+        self.eof = False
+
+    def _next_output(self):
+        """
+        Return the next block of compressed output ('' at EOF).
+        """
+        if self.num_threads == 1:
+            while not self.eof:
+                data = self.source_handle.read(PARALLEL_GZIP_BLOCK_SIZE)
+                if not data:
+                    self.eof = True
+                    return self.compressor.flush()
+                output = self.compressor.compress(data)
+                if output:
+                    return output
+            return ''
+        while not self.eof and len(self.pending) < 2 * self.num_threads:
+            data = self.source_handle.read(PARALLEL_GZIP_BLOCK_SIZE)
+            if not data:
+                self.eof = True
+                break
+            self.pending.append(self.pool.apply_async(_gzip_member, (data, self.level)))
+        if not self.pending:
+            self.close()
+            return ''
+        return self.pending.popleft().get()
+
+    def read(self, num_bytes=None):
+        chunks = []
+        while num_bytes is None or num_bytes > 0:
+            if self.offset >= len(self.buffer):
+                (self.buffer, self.offset) = (self._next_output(), 0)
+                if not self.buffer:
+                    break
+                continue
+            end = len(self.buffer) if num_bytes is None else min(len(self.buffer), self.offset + num_bytes)
+            chunks.append(self.buffer[self.offset:end])
+            if num_bytes is not None:
+                num_bytes -= end - self.offset
+            self.offset = end
+        return ''.join(chunks)
+
+    def close(self):
+        if self.num_threads > 1:
+            self.pool.terminate()
+        self.source_handle.close()
+
+
+class _StatusReader(object):
+    """
+    File-like object that reads from |source_handle| and prints how much was read.
+    """
+    def __init__(self, source_handle, print_status):
+        self.source_handle = source_handle
+        self.print_status = print_status
+        self.num_bytes = 0
+
+    def read(self, num_bytes=None):
+        data = self.source_handle.read(num_bytes)
+        self.num_bytes += len(data)
+        print >>sys.stderr, "\r%s: %s" % (self.print_status, formatting.size_str(self.num_bytes)),
+        sys.stderr.flush()
+        return data
+
+    def done(self):
+        print >>sys.stderr, "\r%s: %s [done]" % (self.print_status, formatting.size_str(self.num_bytes))
@@ -16,10 +16,12 @@ class LocalMachine(Machine):
     use only, since there is no security.
     Eventually, deprecate this.
     '''
-    def __init__(self):
+    def __init__(self, config=None):
         self.bundle = None
         self.process = None
         self.temp_dir = None
+        # Whether to link dependencies instead of copying them (see path_util.link_tree).
+        self.link_dependencies = (config or {}).get('link_dependencies', False)
 
     def start_bundle(self, bundle, bundle_store, parent_dict, username):
         '''
@@ -34,12 +36,19 @@ class LocalMachine(Machine):
         # copy random files on the system).  Of course in local mode,
         # if some of those symlinks are absolute, the run can
         # read/write those locations.  But we're not sandboxed, so
-        # anything could happen.  The dependencies are copied, so in
-        # practice, this is not a bit worry.
+        # anything could happen.  The dependencies are copied (or linked
+        # read-only), so in practice, this is not a bit worry.
+        bundle.ensure_dependencies_local(bundle_store, parent_dict)
         pairs = bundle.get_dependency_paths(bundle_store, parent_dict, temp_dir)
-        print >>sys.stderr, 'LocalMachine.start_bundle: copying dependencies of %s to %s' % (bundle.uuid, temp_dir)
-        for (source, target) in pairs:
-            path_util.copy(source, target, follow_symlinks=False)
+        if self.link_dependencies:
+            print >>sys.stderr, 'LocalMachine.start_bundle: linking dependencies of %s to %s' % (bundle.uuid, temp_dir)
+            for (source, target) in pairs:
+                methods = path_util.link_tree(source, target)
+                print >>sys.stderr, 'LocalMachine.start_bundle: %s: %s' % (target, dict(methods))
+        else:
+            print >>sys.stderr, 'LocalMachine.start_bundle: copying dependencies of %s to %s' % (bundle.uuid, temp_dir)
+            for (source, target) in pairs:
+                path_util.copy(source, target, follow_symlinks=False)
 
         script_file = temp_dir + '.sh'
         with open(script_file, 'w') as f:
@@ -57,6 +57,9 @@ class RemoteMachine(Machine):
         self.default_request_priority = config.get('request_priority')
         self.default_request_network = config.get('request_network')
 
+        # Whether to link dependencies instead of copying them (see path_util.link_tree).
+        self.link_dependencies = config.get('link_dependencies', False)
+
     def run_command_get_stdout(self, args):
         if self.verbose >= 3: print "=== run_command_get_stdout: %s" % (args,)
         proc = subprocess.Popen(args, stdout=subprocess.PIPE)
@@ -88,11 +91,18 @@ class RemoteMachine(Machine):
         temp_dir = os.path.realpath(temp_dir)  # Follow symlinks
         path_util.make_directory(temp_dir)
 
-        # Copy all the dependencies to that temporary directory.
+        # Copy (or link read-only) all the dependencies to that temporary directory.
+        bundle.ensure_dependencies_local(bundle_store, parent_dict)
         pairs = bundle.get_dependency_paths(bundle_store, parent_dict, temp_dir)
-        print >>sys.stderr, 'RemoteMachine.start_bundle: copying dependencies of %s to %s' % (bundle.uuid, temp_dir)
-        for (source, target) in pairs:
-            path_util.copy(source, target, follow_symlinks=False)
+        if self.link_dependencies:
+            print >>sys.stderr, 'RemoteMachine.start_bundle: linking dependencies of %s to %s' % (bundle.uuid, temp_dir)
+            for (source, target) in pairs:
+                methods = path_util.link_tree(source, target)
+                print >>sys.stderr, 'RemoteMachine.start_bundle: %s: %s' % (target, dict(methods))
+        else:
+            print >>sys.stderr, 'RemoteMachine.start_bundle: copying dependencies of %s to %s' % (bundle.uuid, temp_dir)
+            for (source, target) in pairs:
+                path_util.copy(source, target, follow_symlinks=False)
 
         # Set defaults for the dispatcher.
         docker_image = bundle.metadata.request_docker_image or self.default_docker_image
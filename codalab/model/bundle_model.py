@@ -1,6 +1,8 @@
 '''
 BundleModel is a wrapper around database calls to save and load bundle metadata.
 '''
+import collections
+
 from sqlalchemy import (
     and_,
     or_,
@@ -36,6 +38,7 @@ from codalab.model.tables import (
     bundle_dependency as cl_bundle_dependency,
     bundle_metadata as cl_bundle_metadata,
     bundle_action as cl_bundle_action,
+    data_hash_reference as cl_data_hash_reference,
     group as cl_group,
     group_bundle_permission as cl_group_bundle_permission,
     group_object_permission as cl_group_worksheet_permission,
@@ -95,6 +98,7 @@ class BundleModel(object):
         '''
         db_metadata.create_all(self.engine)
         self._create_default_groups()
+        self._create_data_hash_references()
 
     def do_multirow_insert(self, connection, table, values):
         '''
@@ -559,9 +563,14 @@ class BundleModel(object):
             if condition:
                 clause = and_(clause, self.make_kwargs_clause(cl_bundle, condition))
             with self.engine.begin() as connection:
+                if 'data_hash' in update:
+                    old_data_hashes = self._get_data_hashes(connection, clause)
                 result = connection.execute(
                   cl_bundle.update().where(clause).values(update)
                 )
+                if 'data_hash' in update:
+                    self._update_data_hash_references(
+                      connection, old_data_hashes, [update['data_hash']] * result.rowcount)
                 success = result.rowcount == len(bundle_ids)
                 if success:
                     for bundle in bundles:
@@ -594,6 +603,7 @@ class BundleModel(object):
                 result = connection.execute(cl_bundle.insert().values(bundle_value))
                 self.do_multirow_insert(connection, cl_bundle_dependency, dependency_values)
                 self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
+                self._update_data_hash_references(connection, [], [bundle_value.get('data_hash')])
                 bundle.id = result.lastrowid
 
 
@@ -629,7 +639,12 @@ class BundleModel(object):
         # Perform the actual updates.
         with self.engine.begin() as connection:
             if update:
-                connection.execute(cl_bundle.update().where(clause).values(update))
+                if 'data_hash' in update:
+                    old_data_hashes = self._get_data_hashes(connection, clause)
+                result = connection.execute(cl_bundle.update().where(clause).values(update))
+                if 'data_hash' in update:
+                    self._update_data_hash_references(
+                      connection, old_data_hashes, [update['data_hash']] * result.rowcount)
             if metadata_update:
                 connection.execute(cl_bundle_metadata.delete().where(metadata_clause))
                 self.do_multirow_insert(connection, cl_bundle_metadata, metadata_values)
@@ -647,6 +662,8 @@ class BundleModel(object):
         Delete bundles with the given uuids.
         '''
         with self.engine.begin() as connection:
+            self._update_data_hash_references(
+              connection, self._get_data_hashes(connection, cl_bundle.c.uuid.in_(uuids)), [])
             # We must delete bundles rows in the opposite order that we create them
             # to avoid foreign-key constraint failures.
             connection.execute(cl_group_bundle_permission.delete().where(
@@ -667,7 +684,93 @@ class BundleModel(object):
 
     def remove_data_hash_references(self, uuids):
         with self.engine.begin() as connection:
-            connection.execute(cl_bundle.update().where(cl_bundle.c.uuid.in_(uuids)).values({'data_hash': None}))
+            clause = cl_bundle.c.uuid.in_(uuids)
+            self._update_data_hash_references(connection, self._get_data_hashes(connection, clause), [])
+            connection.execute(cl_bundle.update().where(clause).values({'data_hash': None}))
+
+    #############################################################################
+    # Data hash reference counts follow!
+    #############################################################################
+
+    def _get_data_hashes(self, connection, clause):
+        '''
+        Return the data hashes of the bundles that match |clause|, with repeats.
+        '''
+        rows = connection.execute(select([cl_bundle.c.data_hash]).where(clause)).fetchall()
+        return [row.data_hash for row in rows]
+
+    def _update_data_hash_references(self, connection, old_data_hashes, new_data_hashes):
+        '''
+        Update the reference counts after bundles that had |old_data_hashes| were
+        changed to have |new_data_hashes| (both lists, with repeats and Nones).
+        Data hashes that are no longer referenced are removed from the table.
+        '''
+        deltas = collections.Counter(data_hash for data_hash in new_data_hashes if data_hash)
+        deltas.subtract(data_hash for data_hash in old_data_hashes if data_hash)
+        for (data_hash, delta) in deltas.iteritems():
+            if delta > 0:
+                self.do_add_data_hash_references(connection, data_hash, delta)
+            elif delta < 0:
+                connection.execute(cl_data_hash_reference.update().
+                  where(cl_data_hash_reference.c.data_hash == data_hash).
+                  values(ref_count=cl_data_hash_reference.c.ref_count + delta))
+        if any(delta < 0 for delta in deltas.itervalues()):
+            connection.execute(cl_data_hash_reference.delete().where(cl_data_hash_reference.c.ref_count <= 0))
+
+    def do_add_data_hash_references(self, connection, data_hash, delta):
+        '''
+        Add |delta| to the reference count of |data_hash|, which another
+        transaction may be inserting concurrently.
+
+        This method may be overridden by models that use more powerful SQL dialects.
+        '''
+        # Make sure that there is a row (INSERT OR IGNORE, as SQLite spells it,
+        # doesn't fail if another transaction inserted one) and add to it.
+        connection.execute(cl_data_hash_reference.insert().prefix_with('OR IGNORE').values(
+          data_hash=data_hash, ref_count=0))
+        connection.execute(cl_data_hash_reference.update().where(cl_data_hash_reference.c.data_hash == data_hash).values(
+          ref_count=cl_data_hash_reference.c.ref_count + delta))
+
+    def _create_data_hash_references(self):
+        '''
+        Fill in the reference counts from the bundle table if they are missing (as
+        when the table was just added to an existing database). This is called by
+        create_tables.
+        '''
+        with self.engine.begin() as connection:
+            if connection.execute(select([cl_data_hash_reference.c.data_hash]).limit(1)).fetchone() is not None:
+                return
+            rows = connection.execute(
+              select([cl_bundle.c.data_hash, func.count()]).
+              where(cl_bundle.c.data_hash != None).
+              group_by(cl_bundle.c.data_hash)
+            ).fetchall()
+            self.do_multirow_insert(connection, cl_data_hash_reference, [
+              {'data_hash': row[0], 'ref_count': row[1]} for row in rows
+            ])
+
+    def get_data_hash_ref_counts(self, data_hashes, except_uuids=None):
+        '''
+        Return {data_hash: number of bundles with that data hash, ...} for the
+        given data hashes that are referenced by any bundle, not counting the
+        bundles with uuids in |except_uuids|.
+        '''
+        if not data_hashes:
+            return {}
+        with self.engine.begin() as connection:
+            rows = connection.execute(select([
+              cl_data_hash_reference.c.data_hash, cl_data_hash_reference.c.ref_count,
+            ]).where(cl_data_hash_reference.c.data_hash.in_(data_hashes))).fetchall()
+            ref_counts = dict((row.data_hash, row.ref_count) for row in rows)
+            if except_uuids and ref_counts:
+                rows = connection.execute(
+                  select([cl_bundle.c.data_hash, func.count()]).
+                  where(and_(cl_bundle.c.uuid.in_(except_uuids), cl_bundle.c.data_hash.in_(ref_counts))).
+                  group_by(cl_bundle.c.data_hash)
+                ).fetchall()
+                for row in rows:
+                    ref_counts[row[0]] -= row[1]
+        return dict((data_hash, ref_count) for (data_hash, ref_count) in ref_counts.iteritems() if ref_count > 0)
 
     #############################################################################
     # Worksheet-related model methods follow!
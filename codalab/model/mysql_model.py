@@ -6,6 +6,7 @@ from sqlalchemy import (
     create_engine,
     event,
     exc,
+    text,
 )
 from sqlalchemy.pool import Pool
 
@@ -52,6 +53,13 @@ class MySQLModel(BundleModel):
         if values:
             connection.execute(table.insert().values(values))
 
+    def do_add_data_hash_references(self, connection, data_hash, delta):
+        # One upsert, which can't conflict with a concurrent insert.
+        connection.execute(text(
+            'INSERT INTO data_hash_reference (data_hash, ref_count) VALUES (:data_hash, :delta) '
+            'ON DUPLICATE KEY UPDATE ref_count = ref_count + :delta'
+        ), data_hash=data_hash, delta=delta)
+
     def encode_str(self, value):
         return value.encode('utf-8')
     def decode_str(self, value):
@@ -63,6 +63,16 @@ bundle_dependency = Table(
   sqlite_autoincrement=True,
 )
 
+# For each data_hash, the number of bundles that have it. BundleModel keeps this
+# up to date as bundles are created, updated and deleted, so that the
+# BundleStore can find unreferenced data without loading any bundles.
+data_hash_reference = Table(
+  'data_hash_reference',
+  db_metadata,
+  Column('data_hash', String(63), primary_key=True, nullable=False),
+  Column('ref_count', Integer, nullable=False),
+)
+
 # Stores actions sent from the client to the worker.
 bundle_action = Table(
   'bundle_action',
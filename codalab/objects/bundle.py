@@ -11,8 +11,8 @@ they may override a number of methods of the base class:
   validate: bundle subclasses may require additional validation
   run: bundle subclasses that must be executed must override this method
 
-The base class provides one method, install_dependencies, that may be useful
-when implementing the run method.
+The base class provides two methods, ensure_dependencies_local and
+install_dependencies, that may be useful when implementing the run method.
 '''
 import os
 
@@ -92,6 +92,16 @@ class Bundle(ORMObject):
         '''
         return [spec for spec in cls.METADATA_SPECS if not spec.generated]
 
+    def ensure_dependencies_local(self, bundle_store, parent_dict):
+        '''
+        Make sure that the data of this bundle's dependencies is on local disk
+        (see BundleStore.ensure_local), before they are staged for it to run.
+        '''
+        for dep in self.dependencies:
+            parent = parent_dict[dep.parent_uuid]
+            if parent.data_hash:
+                bundle_store.ensure_local(parent.data_hash)
+
     def get_dependency_paths(self, bundle_store, parent_dict, dest_path, relative_symlinks=False):
         def process_dep(dep):
             parent = parent_dict[dep.parent_uuid]
@@ -136,13 +146,13 @@ class Bundle(ORMObject):
             else:
                 os.symlink(target, link_path)
 
-    def remove_dependencies(self, bundle_store, parent_dict, dest_path):
+    def remove_dependencies(self, dest_path):
         '''
         Remove dependencies (for RunBundles).
         '''
         precondition(os.path.isabs(dest_path), '%s is a relative path!' % (dest_path,))
-        pairs = self.get_dependency_paths(bundle_store, parent_dict, dest_path, relative_symlinks=False)
-        for (target, link_path) in pairs:
+        for dep in self.dependencies:
+            link_path = path_util.safe_join(dest_path, dep.child_path)
             # If the dependency already exists, remove it (this happens when we are reinstalling)
             if os.path.exists(link_path):
                 path_util.remove(link_path)
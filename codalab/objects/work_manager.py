@@ -265,12 +265,18 @@ class Worker(object):
                 temp_dir = status.get('temp_dir')
                 if not temp_dir:
                     temp_dir = bundle.metadata.temp_dir
+                parent_dict = self.get_parent_dict(bundle)
+                copied_from = None
                 if isinstance(bundle, RunBundle):
                     print >>sys.stderr, 'Worker.finalize_bundle: removing dependencies from %s (RunBundle)' % temp_dir
-                    bundle.remove_dependencies(self.bundle_store, self.get_parent_dict(bundle), temp_dir)
+                    bundle.remove_dependencies(temp_dir)
                 else:
                     print >>sys.stderr, 'Worker.finalize_bundle: installing (copying) dependencies to %s (MakeBundle)' % temp_dir
-                    bundle.install_dependencies(self.bundle_store, self.get_parent_dict(bundle), temp_dir, copy=True)
+                    bundle.ensure_dependencies_local(self.bundle_store, parent_dict)
+                    bundle.install_dependencies(self.bundle_store, parent_dict, temp_dir, copy=True)
+                    # The copies have the same contents as the dependencies, whose hashes are cached.
+                    pairs = bundle.get_dependency_paths(self.bundle_store, parent_dict, temp_dir)
+                    copied_from = [(link_path, target) for (target, link_path) in pairs]
 
                 # Note: uploading will move temp_dir to the bundle store.
                 (data_hash, bundle_store_metadata) = self.bundle_store.upload(sources=[temp_dir],
@@ -278,7 +284,8 @@ class Worker(object):
                                                                               exclude_patterns=None,
                                                                               git=False,
                                                                               unpack=False,
-                                                                              remove_sources=True)
+                                                                              remove_sources=True,
+                                                                              copied_from=copied_from)
                 db_update['data_hash'] = data_hash
                 metadata.update(bundle_store_metadata)
             except Exception as e:
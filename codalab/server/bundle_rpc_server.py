@@ -10,15 +10,21 @@ they perform filesystem operations. BundleRPCServer supports variants of these
 methods:
 
   finish_upload_bundle: used to implement RemoteBundleClient.upload_bundle
+  check_data_hash, finish_upload_bundle_by_hash: used by
+    RemoteBundleClient.upload_bundle to skip uploading data that the bundle
+    store already has, once the client proves that it has it (see possession)
   open_target: used to implement RemoteBundleClient.cat_target
 
 Important: each call to open_temp_file, open_target, open_target_archive should
 have a matching call to finalize_file.
 '''
-import tempfile
+import hmac
+import re
+import threading
 import traceback
 import os
 import time
+import uuid
 
 from codalab.common import (
     precondition,
@@ -26,17 +32,33 @@ from codalab.common import (
     PermissionError,
 )
 from codalab.client.remote_bundle_client import RemoteBundleClient
-from codalab.lib import zip_util, path_util
+from codalab.lib import possession, zip_util, path_util
+from codalab.lib.archive_cache import ArchiveCache
 from codalab.server.file_server import FileServer
 
 
 class BundleRPCServer(FileServer):
+    # Data hashes that check_data_hash accepts.
+    DATA_HASH_REGEX = re.compile('^(%s|%s)[0-9a-f]{40}$' % (path_util.MERKLE_DATA_HASH_PREFIX, path_util.DATA_HASH_PREFIX))
+    # Challenges from check_data_hash must be answered within this many seconds.
+    CHALLENGE_TTL = 60*60
+    # A user can have this many unanswered challenges for a data hash, and
+    # gets no more challenges for it after this many wrong answers.
+    MAX_PENDING_CHALLENGES = 2
+    MAX_FAILED_CHALLENGES = 3
+
     def __init__(self, manager):
         self.host = manager.config['server']['host']
         self.port = manager.config['server']['port']
         self.verbose = manager.config['server']['verbose']
         # This server is backed by a LocalBundleClient that processes client commands
         self.client = manager.client('local', is_cli=False)
+        # Map from challenge id to the (user id, data hash, expected answer,
+        # expiration time) of the challenges from check_data_hash, and from
+        # (user id, data hash) to the number of wrong answers.
+        self.challenges = {}
+        self.failed_challenges = {}
+        self.challenges_lock = threading.Lock()
 
         # args might be a large object; summarize it (e.g., take prefixes of lists)
         def compress_args(args):
@@ -54,8 +76,8 @@ class BundleRPCServer(FileServer):
                 return dict((compress_args(k), compress_args(v)) for k, v in args.items())
             return args
 
-        tempdir = tempfile.gettempdir()  # Consider using CodaLab's temp directory
-        FileServer.__init__(self, (self.host, self.port), tempdir, manager.auth_handler())
+        # Stage uploaded files in the bundle store, so that they can be moved into it.
+        FileServer.__init__(self, (self.host, self.port), self.client.bundle_store.get_staging_area, manager.auth_handler())
 
         def wrap(target, command):
             def function_to_register(*args, **kwargs):
@@ -124,7 +146,8 @@ class BundleRPCServer(FileServer):
             remove_sources=True,
             info=info,
             worksheet_uuid=worksheet_uuid,
-            add_to_worksheet=add_to_worksheet)
+            add_to_worksheet=add_to_worksheet,
+            packed=True)
 
         # Remove temporary file
         if file_uuids is not None:
@@ -132,24 +155,105 @@ class BundleRPCServer(FileServer):
                 self.finalize_file(file_uuid)
         return result
 
+    def check_data_hash(self, data_hashes):
+        '''
+        Return a challenge (see possession.make_challenge) for the first of
+        |data_hashes| that is in the bundle store, with its 'data_hash' and a
+        'challenge_id' to answer it with in finish_upload_bundle_by_hash, or None
+        if the store has none of them (that can be challenged) or the current
+        user has too many unanswered or wrongly answered challenges for them.
+        '''
+        bundle_store = self.client.bundle_store
+        user_id = self.client._current_user_id()
+        for data_hash in data_hashes:
+            if not isinstance(data_hash, basestring) or not self.DATA_HASH_REGEX.match(data_hash):
+                raise UsageError('Invalid data hash: %r' % (data_hash,))
+            key = (user_id, data_hash)
+            with self.challenges_lock:
+                now = time.time()
+                for (other_id, (_, _, _, expires)) in self.challenges.items():
+                    if expires < now:
+                        del self.challenges[other_id]
+                pending = sum(1 for challenge in self.challenges.itervalues() if challenge[:2] == key)
+                if pending >= self.MAX_PENDING_CHALLENGES or \
+                   self.failed_challenges.get(key, 0) >= self.MAX_FAILED_CHALLENGES:
+                    continue
+            if not bundle_store.contains(data_hash):
+                continue
+            manifest = bundle_store.get_manifest(data_hash)
+            if manifest is None:
+                continue
+            challenge = possession.make_challenge(manifest)
+            if challenge is None:
+                continue
+            expected = possession.answer_challenge(
+                challenge, manifest,
+                lambda relative_path, offset, length: bundle_store.read_range(data_hash, relative_path, offset, length))
+            challenge_id = uuid.uuid4().hex
+            with self.challenges_lock:
+                self.challenges[challenge_id] = (user_id, data_hash, expected, time.time() + self.CHALLENGE_TTL)
+            challenge.update({'challenge_id': challenge_id, 'data_hash': data_hash})
+            return challenge
+        return None
+
+    def finish_upload_bundle_by_hash(self, challenge_id, answer, info, worksheet_uuid, add_to_worksheet):
+        '''
+        Create a bundle for the data of the challenge |challenge_id| from
+        check_data_hash, if |answer| is right and the challenge was made for the
+        current user, and return its uuid, or None if the data has been removed
+        from the bundle store since (e.g., by full_cleanup), in which case the
+        client uploads it.
+        '''
+        user_id = self.client._current_user_id()
+        with self.challenges_lock:
+            (challenge_user_id, data_hash, expected, expires) = self.challenges.get(challenge_id, (None, None, None, 0))
+            if challenge_user_id != user_id:
+                expires = 0
+            else:
+                self.challenges.pop(challenge_id, None)
+            verified = expires >= time.time() and hmac.compare_digest(str(answer), str(expected))
+            if expected is not None and not verified:
+                key = (user_id, data_hash)
+                self.failed_challenges[key] = self.failed_challenges.get(key, 0) + 1
+        if not verified:
+            raise PermissionError('Could not verify that the data with this data hash is being uploaded')
+        if not self.client.bundle_store.claim(data_hash):
+            return None
+        return self.client.upload_bundle(
+            None,
+            follow_symlinks=False,
+            exclude_patterns=None,
+            git=False,
+            unpack=False,
+            remove_sources=False,
+            info=info,
+            worksheet_uuid=worksheet_uuid,
+            add_to_worksheet=add_to_worksheet,
+            data_hash=data_hash)
+
     def open_target(self, target):
         '''
         Open a read-only file handle to the given bundle target and return a file
         uuid identifying it.
         '''
+        # Files in bundles that are not local are read from where they are stored.
+        (stored, handle) = self.client.open_stored_target(target)
+        if stored:
+            return None if handle is None else self.add_file_handle(target, handle)
         path = self.client.get_target_path(target)
         if path is None:
             return None
         return self.open_file(path)
 
-    def open_target_archive(self, target):
+    def open_target_archive(self, target, archive_format=ArchiveCache.TAR_GZ):
         '''
-        Return file uuid for the archive file.
+        Return file uuid for the archive file, in |archive_format| (one of
+        ArchiveCache.FORMATS).
         '''
-        path = self.client.get_target_path(target)
-        if path is None:
+        handle = self.client.open_target_archive_handle(target, archive_format)
+        if handle is None:
             return None
-        return self.open_packed_path(path)
+        return self.add_file_handle(target, handle)
 
     def serve_forever(self):
         print 'BundleRPCServer serving to %s at port %s...' % ('ALL hosts' if self.host == '' else 'host ' + self.host, self.port)
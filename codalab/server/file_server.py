@@ -10,20 +10,50 @@ all return a file uuid, which is like a Unix file descriptor.
 The other RPC methods on this server are read_file, write_file, and close_file.
 These methods take a file uuid in addition to their regular arguments, and they
 perform the requested operation on the file handle corresponding to that uuid.
+
+Moving file data in XML-RPC calls costs a round trip per buffer, base64 and XML
+parsing, so the contents of a file uuid can also be streamed as raw bytes over
+plain HTTP on the same port, with the same authentication: GET /file/<uuid>
+reads the file to the end, and PUT /file/<uuid> (with a Content-Length or
+chunked transfer encoding) writes the request body to it. HEAD /file tells
+clients that the server supports this.
+
+PUT /file/<uuid>?offset=<offset> writes the body at that offset of a temp file
+instead, so that a client can send the chunks of a file over several
+connections at once, in any order. The body is held in memory until it is
+written, so it can be at most MAX_CHUNK_SIZE bytes. If the request has a
+Content-SHA1 header, the body is only written if it matches. Only temp files
+can be written.
+
+A temp file opened with open_upload_session also records which chunks (offset,
+length and SHA-1) it has received, which get_upload_session returns, so that a
+client whose upload was interrupted can send only the missing chunks, even
+after it restarts. close_upload_session checks that nothing is missing. Sessions
+that are not written to for UPLOAD_SESSION_TTL seconds are discarded.
+
+Connections are kept alive between requests (HTTP/1.1), so that clients can
+make many calls without a new handshake for each one. Responses that can't be
+followed by another request on the same connection (GET, whose body ends when
+the connection is closed, and errors sent before the request body was read)
+close it. Each connection has a thread, so connections that wait for their next
+request for KEEP_ALIVE_TIMEOUT seconds are closed.
 '''
+import hashlib
 import os
 from SimpleXMLRPCServer import (
     SimpleXMLRPCServer,
     SimpleXMLRPCRequestHandler,
 )
 import SocketServer
-import tempfile
 import threading
+import time
+import urlparse
 import uuid
 import xmlrpclib
 
-from codalab.client.remote_bundle_client import RemoteBundleClient
-from codalab.lib import path_util, zip_util
+from codalab.client.remote_bundle_client import FileStreamClient, RemoteBundleClient
+from codalab.common import UsageError
+from codalab.lib import file_util, path_util, zip_util
 
 # Hack to allow 64-bit integers
 xmlrpclib.Marshaller.dispatch[int] = lambda _, v, w : w("<value><i8>%d</i8></value>" % v)
@@ -34,23 +64,193 @@ class AuthenticatedXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
     Simple XML-RPC request handler class which also reads authentication
     information included in HTTP headers.
     """
+    protocol_version = 'HTTP/1.1'
+    # Headers are written one at a time, which Nagle's algorithm would hold
+    # back until the client acknowledges the previous packet.
+    disable_nagle_algorithm = True
+
+    def handle_one_request(self):
+        '''
+        Overrides to close the connection if the next request doesn't come
+        within KEEP_ALIVE_TIMEOUT seconds.
+        '''
+        self.connection.settimeout(self.server.KEEP_ALIVE_TIMEOUT)
+        SimpleXMLRPCRequestHandler.handle_one_request(self)
+
+    def parse_request(self):
+        '''
+        Overrides to lift the idle timeout once the request line has been read,
+        so that slow request bodies and readers of responses (e.g., of streamed
+        files) are not cut off.
+        '''
+        self.connection.settimeout(None)
+        return SimpleXMLRPCRequestHandler.parse_request(self)
 
     def decode_request_content(self, data):
         '''
         Overrides in order to capture Authorization header.
         '''
+        if self.authenticate():
+            return SimpleXMLRPCRequestHandler.decode_request_content(self, data)
+
+    def authenticate(self):
+        '''
+        Validate the token in the Authorization header. Return whether it is
+        valid, and send a 401 response if not.
+        '''
         token = None
         if 'Authorization' in self.headers:
             value = self.headers.get("Authorization", "")
             token = value[8:] if value.startswith("Bearer: ") else ""
 
         if self.server.auth_handler.validate_token(token):
-            return SimpleXMLRPCRequestHandler.decode_request_content(self, data)
+            return True
+        self.send_response(401, "Could not authenticate with OAuth")
+        self.send_header("WWW-Authenticate", "realm=\"https://www.codalab.org\"")
+        self.send_header("Content-length", "0")
+        # The body of a streaming request has not been read.
+        self.send_header("Connection", "close")
+        self.end_headers()
+        return False
+
+    def get_stream_file_handle(self):
+        '''
+        Return the file handle of the file uuid in the path of a streaming
+        request, after authenticating it, or None if a response was sent
+        instead.
+        '''
+        prefix = '/%s/' % (self.server.FILE_SUBDIRECTORY,)
+        if not self.path.startswith(prefix):
+            self.send_error(404)
+            return None
+        if not self.authenticate():
+            return None
+        file_handle = self.server.file_handles.get(self.get_stream_file_uuid())
+        if file_handle is None:
+            self.send_error(404, 'No such file uuid')
+        return file_handle
+
+    def get_stream_file_uuid(self):
+        path = urlparse.urlsplit(self.path).path
+        return path[len(self.server.FILE_SUBDIRECTORY) + 2:]
+
+    def do_HEAD(self):
+        '''
+        Answer the probe of whether streaming is supported.
+        '''
+        if self.path != '/' + self.server.FILE_SUBDIRECTORY:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        '''
+        Stream the rest of a file uuid as the response body, which ends when the
+        connection is closed.
+        '''
+        file_handle = self.get_stream_file_handle()
+        if file_handle is None:
+            return
+        self.send_response(200)
+        self.send_header("Content-type", "application/octet-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        file_util.copy(file_handle, self.wfile, autoflush=False)
+
+    def do_PUT(self):
+        '''
+        Write the request body to a file uuid.
+        '''
+        file_handle = self.get_stream_file_handle()
+        if file_handle is None:
+            return
+        lock = self.server.file_locks.get(self.get_stream_file_uuid())
+        if lock is None:
+            # Other file uuids (e.g., from open_target) are read-only.
+            self.send_error(405, 'Only temp files can be written')
+            return
+        offset = urlparse.parse_qs(urlparse.urlsplit(self.path).query).get('offset')
+        if offset is None:
+            for data in self._read_body():
+                file_handle.write(data)
+            # The data is read from the path (e.g., by finish_upload_bundle)
+            # before the file uuid is finalized.
+            file_handle.flush()
+        else:
+            # Receive the whole chunk before taking the lock, so that chunks on
+            # other connections are received meanwhile, but no more than
+            # MAX_CHUNK_SIZE bytes of it.
+            blocks = []
+            size = 0
+            for block in self._read_body():
+                size += len(block)
+                if size > self.server.MAX_CHUNK_SIZE:
+                    self.send_error(413, 'Chunks can be at most %d bytes' % (self.server.MAX_CHUNK_SIZE,))
+                    return
+                blocks.append(block)
+            data = ''.join(blocks)
+            checksum = hashlib.sha1(data).hexdigest()
+            if self.headers.get('Content-SHA1', checksum) != checksum:
+                self.send_error(400, 'Checksum mismatch')
+                return
+            with lock:
+                file_handle.seek(int(offset[0]))
+                file_handle.write(data)
+                file_handle.flush()
+                session = self.server.upload_sessions.get(self.get_stream_file_uuid())
+                if session is not None:
+                    session.add_chunk(int(offset[0]), len(data), checksum)
+        self.send_response(200)
+        self.send_header("Content-length", "0")
+        self.end_headers()
+
+    def _read_body(self):
+        '''
+        Yield the request body in blocks, with a Content-Length or chunked
+        transfer encoding.
+        '''
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    break
+                for data in self._read_bytes(size):
+                    yield data
+                self.rfile.readline()
+            # Skip the trailer.
+            while self.rfile.readline().strip():
+                pass
         else:
-            self.send_response(401, "Could not authenticate with OAuth")
-            self.send_header("WWW-Authenticate", "realm=\"https://www.codalab.org\"")
-            self.send_header("Content-length", "0")
-            self.end_headers()
+            for data in self._read_bytes(int(self.headers.get('Content-Length', 0))):
+                yield data
+
+    def _read_bytes(self, num_bytes):
+        '''
+        Yield the next |num_bytes| bytes of the request body in blocks.
+        '''
+        while num_bytes:
+            data = self.rfile.read(min(num_bytes, file_util.BUFFER_SIZE))
+            if not data:
+                raise IOError('Request body ended early')
+            yield data
+            num_bytes -= len(data)
+
+    def report_404(self):
+        '''
+        Overrides to close the connection, since the request body has not been
+        read.
+        '''
+        self.close_connection = 1
+        SimpleXMLRPCRequestHandler.report_404(self)
+
+    def log_error(self, format, *args):
+        '''
+        Overrides to not report idle connections that time out.
+        '''
+        if not format.startswith('Request timed out'):
+            SimpleXMLRPCRequestHandler.log_error(self, format, *args)
 
     def send_response(self, code, message=None):
         '''
@@ -62,19 +262,69 @@ class AuthenticatedXMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
 
 
 class AsyncXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
-    pass
+    # Don't wait for the threads of idle keep-alive connections on exit.
+    daemon_threads = True
+
+
+class UploadSession(object):
+    '''
+    Records the chunks of a temp file that have been received, until it
+    expires.
+    '''
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # Map from offset to the (length, SHA-1) of the chunk there.
+        self.chunks = {}
+        self.touch()
+
+    def touch(self):
+        self.expires = time.time() + self.ttl
+
+    def add_chunk(self, offset, length, checksum):
+        self.chunks[offset] = (length, checksum)
+        self.touch()
+
+    def get_committed_offset(self):
+        '''
+        Return up to where everything has been received.
+        '''
+        offset = 0
+        for (chunk_offset, (length, _)) in sorted(self.chunks.iteritems()):
+            if chunk_offset > offset:
+                break
+            offset = max(offset, chunk_offset + length)
+        return offset
+
+    def to_dict(self):
+        return {
+            'chunks': [[offset, length, checksum] for (offset, (length, checksum)) in sorted(self.chunks.iteritems())],
+            'committed_offset': self.get_committed_offset(),
+            'expires': self.expires,
+        }
 
 
 class FileServer(AsyncXMLRPCServer):
     FILE_SUBDIRECTORY = 'file'
 
-    def __init__(self, address, temp, auth_handler):
+    # Upload sessions that are not written to for this long are discarded.
+    UPLOAD_SESSION_TTL = 60*60*24
+    # Connections that wait this long for their next request are closed.
+    KEEP_ALIVE_TIMEOUT = 60
+    # Largest chunk that can be written at an offset.
+    MAX_CHUNK_SIZE = FileStreamClient.CHUNK_SIZE
+
+    def __init__(self, address, get_staging_area, auth_handler):
         # Keep a dictionary mapping file uuids to open file handles and a
         # dictionary mapping temporary file's file uuids to their absolute paths.
         self.file_paths = {}
         self.file_handles = {}
         self.delete_file_paths = {}
-        self.temp = temp
+        # Locks of the temp files, for writes at an offset.
+        self.file_locks = {}
+        # Map from file uuid to UploadSession.
+        self.upload_sessions = {}
+        # Returns the StagingArea in which to create a temp file.
+        self.get_staging_area = get_staging_area
         self.auth_handler = auth_handler
 
         # Register file-like RPC methods to allow for file transfer.
@@ -97,9 +347,16 @@ class FileServer(AsyncXMLRPCServer):
         if not os.path.exists(path) or os.path.islink(path):
             # Note: don't follow symlinks!
             return None
+        return self.add_file_handle(path, open(path, 'rb'))
+
+    def add_file_handle(self, path, file_handle):
+        '''
+        Serve the open read-only file object |file_handle| for |path| and return
+        a uuid identifying it.
+        '''
         file_uuid = uuid.uuid4().hex
         self.file_paths[file_uuid] = path
-        self.file_handles[file_uuid] = open(path, 'rb')
+        self.file_handles[file_uuid] = file_handle
         return file_uuid
 
     def open_packed_path(self, path):
@@ -117,17 +374,67 @@ class FileServer(AsyncXMLRPCServer):
     def open_temp_file(self, name):
         '''
         Open a new temp file with given |name| for writing and return a file
-        uuid identifying it.  Put the file in a temporary directory so the file
-        can have the desired name.
+        uuid identifying it.  Put the file in a staging directory so the file
+        can have the desired name, and so that it can be moved into the bundle
+        store without copying it.
         '''
-        base_path = tempfile.mkdtemp('-file_server_open_temp_file')
+        staging = self.get_staging_area()
+        base_path = staging.create('file_server_open_temp_file')
         path = os.path.join(base_path, name)
         file_uuid = uuid.uuid4().hex
         self.file_paths[file_uuid] = path
         self.file_handles[file_uuid] = open(path, 'wb')
-        self.delete_file_paths[file_uuid] = base_path
+        self.file_locks[file_uuid] = threading.Lock()
+        self.delete_file_paths[file_uuid] = (staging, base_path)
+        return file_uuid
+
+    def open_upload_session(self, name):
+        '''
+        Open a new temp file with given |name| like open_temp_file, recording
+        the chunks written to it, and return a file uuid identifying it.
+        '''
+        self._expire_upload_sessions()
+        file_uuid = self.open_temp_file(name)
+        self.upload_sessions[file_uuid] = UploadSession(self.UPLOAD_SESSION_TTL)
         return file_uuid
 
+    def get_upload_session(self, file_uuid):
+        '''
+        Return the chunks that the upload session |file_uuid| has received (see
+        UploadSession.to_dict), or None if there is no such session (e.g., it
+        expired).
+        '''
+        self._expire_upload_sessions()
+        session = self.upload_sessions.get(file_uuid)
+        if session is None:
+            return None
+        with self.file_locks[file_uuid]:
+            return session.to_dict()
+
+    def close_upload_session(self, file_uuid, size):
+        '''
+        Check that the upload session |file_uuid| has received |size| bytes,
+        dropping anything after them, and close the file.
+        '''
+        session = self.upload_sessions.get(file_uuid)
+        if session is None:
+            raise UsageError('No such upload session: %s' % (file_uuid,))
+        with self.file_locks[file_uuid]:
+            committed_offset = session.get_committed_offset()
+            if committed_offset < size:
+                raise UsageError('Upload session %s is missing data after %d bytes' % (file_uuid, committed_offset))
+            file_handle = self.file_handles[file_uuid]
+            file_handle.truncate(size)
+            file_handle.close()
+            del self.upload_sessions[file_uuid]
+
+    def _expire_upload_sessions(self):
+        now = time.time()
+        for (file_uuid, session) in self.upload_sessions.items():
+            # Only the thread that removes the session finalizes it.
+            if session.expires < now and self.upload_sessions.pop(file_uuid, None) is not None:
+                self.finalize_file(file_uuid)
+
     def read_file(self, file_uuid, num_bytes=None):
         '''
         Read up to num_bytes from the given file uuid. Return an empty buffer
@@ -174,10 +481,15 @@ class FileServer(AsyncXMLRPCServer):
 
     def finalize_file(self, file_uuid):
         '''
-        Remove the record from the file server.
+        Close the given file uuid, if it is still open, and remove the record
+        from the file server.
         '''
         path = self.file_paths.pop(file_uuid)
         file_handle = self.file_handles.pop(file_uuid, None)
-        path = self.delete_file_paths.pop(file_uuid, None)
+        if file_handle is not None:
+            file_handle.close()
+        self.file_locks.pop(file_uuid, None)
+        self.upload_sessions.pop(file_uuid, None)
+        (staging, path) = self.delete_file_paths.pop(file_uuid, (None, None))
         if path:
-            path_util.remove(path)
+            staging.discard(path)
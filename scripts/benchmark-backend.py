@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Benchmark BundleStore with each storage backend on the same workload: the
+# local data/ directories, a FilesystemBackend and an ObjectStoreBackend with a
+# simulated latency per request. Creates a bundle of many small files and a few
+# large ones and times uploading it, fetching it on the first ensure_local
+# (cold) and finding it again in the materialized cache (warm).
+#
+# Usage: benchmark-backend.py [--files 1000] [--size 4096] [--large-files 2] [--large-size 16M] [--latency 0.005]
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codalab.lib import formatting, path_util
+from codalab.lib.bundle_store import BundleStore
+from codalab.lib.storage_backend import FilesystemBackend, ObjectStoreBackend
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--files', type=int, default=1000, help='Number of small files')
+parser.add_argument('--size', type=int, default=4096, help='Size of each small file in bytes')
+parser.add_argument('--dirs', type=int, default=20, help='Number of directories')
+parser.add_argument('--large-files', type=int, default=2, help='Number of large files')
+parser.add_argument('--large-size', default='16m', help='Size of each large file')
+parser.add_argument('--latency', type=float, default=0.005, help='Seconds per object store request')
+parser.add_argument('--gets', type=int, default=100, help='Number of warm ensure_local calls')
+parser.add_argument('--dir', help='Where to create the stores (default: temp directory)')
+args = parser.parse_args()
+
+base = tempfile.mkdtemp('-benchmark-backend', dir=args.dir)
+try:
+    source = os.path.join(base, 'source')
+    os.mkdir(source)
+    for i in range(args.dirs):
+        os.mkdir(os.path.join(source, 'd%d' % i))
+    for i in range(args.files):
+        with open(os.path.join(source, 'd%d' % (i % args.dirs), 'f%d' % i), 'wb') as f:
+            f.write(os.urandom(args.size))
+    large_size = int(formatting.parse_size(args.large_size))
+    for i in range(args.large_files):
+        with open(os.path.join(source, 'large%d' % i), 'wb') as f:
+            for _ in range(0, large_size, 1024 * 1024):
+                f.write(os.urandom(min(1024 * 1024, large_size)))
+    total_size = path_util.get_size(source)
+    print '%d files of %s and %d of %s (%s in total), %.1fms latency' % (
+        args.files, formatting.size_str(args.size), args.large_files, formatting.size_str(large_size),
+        formatting.size_str(total_size), args.latency * 1000)
+    expected_hash = '0x' + path_util.hash_directory(source)
+
+    backends = [
+        ('local', lambda root: None),
+        ('filesystem', FilesystemBackend),
+        ('object', lambda root: ObjectStoreBackend(root, latency=args.latency)),
+    ]
+    print '  %-12s %10s %10s %12s' % ('backend', 'upload', 'cold get', 'warm get')
+    for (name, make_backend) in backends:
+        home = os.path.join(base, name)
+        bundle_store = BundleStore(home, backend=make_backend(os.path.join(base, name + '-backend')))
+        start_time = time.time()
+        (data_hash, _) = bundle_store.upload(sources=[source], follow_symlinks=False, exclude_patterns=None,
+                                             git=False, unpack=False, remove_sources=False)
+        upload_time = time.time() - start_time
+        assert data_hash == expected_hash, name
+
+        # A fresh store, as on another server that shares the backend.
+        bundle_store = BundleStore(home, backend=bundle_store.backend)
+        start_time = time.time()
+        location = bundle_store.ensure_local(data_hash)
+        cold_time = time.time() - start_time
+        assert '0x' + path_util.hash_directory(location) == expected_hash, name
+        start_time = time.time()
+        for _ in range(args.gets):
+            bundle_store.ensure_local(data_hash)
+        warm_time = (time.time() - start_time) / args.gets
+        print '  %-12s %9.2fs %9.2fs %10.3fms' % (name, upload_time, cold_time, warm_time * 1000)
+        path_util.remove(home)
+finally:
+    shutil.rmtree(base)
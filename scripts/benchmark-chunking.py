@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# Benchmark ChunkStore on synthetic near-duplicate files.
+# Writes a random base file and versions of it with small edits (in-place
+# overwrites, insertions, deletions and appends), stores them one after another,
+# and reports how many new bytes each version adds with content-defined chunks
+# compared to fixed-size blocks of the same average size, and the throughput of
+# finding the chunks alone (which bounds that of storing a large file as chunks
+# on upload) and of storing them.
+#
+# Usage: benchmark-chunking.py [--size 64m] [--edits 4]
+
+import argparse
+import hashlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codalab.lib import formatting, path_util
+from codalab.lib.chunk_store import ChunkStore
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', type=formatting.parse_size, default='64m', help='Size of the base file')
+parser.add_argument('--edits', type=int, default=4, help='Number of edits per version')
+parser.add_argument('--edit-size', type=formatting.parse_size, default='4k', help='Size of each edit')
+parser.add_argument('--seed', type=int, default=0, help='Random seed')
+parser.add_argument('--dir', help='Where to create the files (default: temp directory)')
+args = parser.parse_args()
+
+rng = random.Random(args.seed)
+
+
+def random_bytes(size):
+    return ''.join(chr(rng.getrandbits(8)) for _ in xrange(size)) if size < 4096 else os.urandom(size)
+
+
+def overwrite(data):
+    offset = rng.randrange(len(data) - int(args.edit_size))
+    return data[:offset] + random_bytes(int(args.edit_size)) + data[offset + int(args.edit_size):]
+
+
+def insert(data):
+    offset = rng.randrange(len(data))
+    return data[:offset] + random_bytes(int(args.edit_size)) + data[offset:]
+
+
+def delete(data):
+    offset = rng.randrange(len(data) - int(args.edit_size))
+    return data[:offset] + data[offset + int(args.edit_size):]
+
+
+def append(data):
+    return data + random_bytes(int(args.edit_size))
+
+
+def mutate(data, edit):
+    for _ in range(args.edits):
+        data = edit(data)
+    return data
+
+
+base = tempfile.mkdtemp('-benchmark-chunking', dir=args.dir)
+try:
+    chunk_store = ChunkStore(os.path.join(base, 'store'))
+    block_size = chunk_store.AVERAGE_CHUNK_SIZE
+    fixed_blocks = set()
+    data = os.urandom(int(args.size))
+    versions = [('base', data)] + [
+        (edit.__name__, mutate(data, edit)) for edit in (overwrite, insert, delete, append)
+    ]
+    print '%d edits of %s per version, %s average chunks' % (
+        args.edits, formatting.size_str(args.edit_size), formatting.size_str(block_size))
+    print '%-10s %10s %16s %16s %12s %12s' % (
+        'version', 'size', 'new (chunked)', 'new (fixed)', 'chunk MB/s', 'put MB/s')
+    for (i, (name, version)) in enumerate(versions):
+        path = os.path.join(base, 'version%d' % i)
+        with open(path, 'wb') as f:
+            f.write(version)
+        contents_hash = path_util.hash_file_contents(path)
+
+        start_time = time.time()
+        for _ in chunk_store.iter_chunks(io.BytesIO(version)):
+            pass
+        chunk_elapsed = time.time() - start_time
+
+        start_time = time.time()
+        new_bytes = chunk_store.put('0x%d' % i, '', path, contents_hash)
+        elapsed = time.time() - start_time
+
+        fixed_new_bytes = 0
+        for offset in xrange(0, len(version), block_size):
+            block = version[offset:offset + block_size]
+            block_hash = hashlib.sha1(block).hexdigest()
+            if block_hash not in fixed_blocks:
+                fixed_blocks.add(block_hash)
+                fixed_new_bytes += len(block)
+
+        print '%-10s %10s %9s %5.1f%% %9s %5.1f%% %12.1f %12.1f' % (
+            name, formatting.size_str(len(version)),
+            formatting.size_str(new_bytes), 100.0 * new_bytes / len(version),
+            formatting.size_str(fixed_new_bytes), 100.0 * fixed_new_bytes / len(version),
+            len(version) / chunk_elapsed / 1024 / 1024, len(version) / elapsed / 1024 / 1024)
+        os.remove(path)
+finally:
+    shutil.rmtree(base)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# Benchmark path_util.copy, which copies file contents concurrently inside the
+# kernel, against rsync -pr (which it replaced, if rsync is installed) and
+# against a serial read/write copy. Creates a tree of many small files and a
+# few large ones and times copying it with each method.
+#
+# Usage: benchmark-copy.py [--files 5000] [--size 4096] [--large-files 4] [--large-size 64M]
+
+import argparse
+import mock
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codalab.lib import formatting, path_util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--files', type=int, default=5000, help='Number of small files')
+parser.add_argument('--size', type=int, default=4096, help='Size of each small file in bytes')
+parser.add_argument('--dirs', type=int, default=50, help='Number of directories')
+parser.add_argument('--large-files', type=int, default=4, help='Number of large files')
+parser.add_argument('--large-size', default='64m', help='Size of each large file')
+parser.add_argument('--threads', type=int, default=path_util.COPY_NUM_THREADS, help='Number of copy threads')
+parser.add_argument('--dir', help='Where to create the tree (default: temp directory)')
+args = parser.parse_args()
+
+
+def rsync_copy(source_path, dest_path):
+    if subprocess.call(['rsync', '-prl', source_path + '/', dest_path]) != 0:
+        raise Exception('rsync failed')
+
+
+def serial_copy(source_path, dest_path):
+    with mock.patch.multiple(path_util, _copy_file_range=None, _sendfile=None):
+        path_util.copy_tree(source_path, dest_path, num_threads=1)
+
+
+def native_copy(source_path, dest_path):
+    path_util.copy_tree(source_path, dest_path, num_threads=args.threads)
+
+
+base = tempfile.mkdtemp('-benchmark-copy', dir=args.dir)
+try:
+    source = os.path.join(base, 'source')
+    os.mkdir(source)
+    for i in range(args.dirs):
+        os.mkdir(os.path.join(source, 'd%d' % i))
+    for i in range(args.files):
+        with open(os.path.join(source, 'd%d' % (i % args.dirs), 'f%d' % i), 'wb') as f:
+            f.write(os.urandom(args.size))
+    large_size = int(formatting.parse_size(args.large_size))
+    for i in range(args.large_files):
+        with open(os.path.join(source, 'large%d' % i), 'wb') as f:
+            for _ in range(0, large_size, 1024 * 1024):
+                f.write(os.urandom(min(1024 * 1024, large_size)))
+    total_size = path_util.get_size(source)
+    print '%d files of %s and %d of %s (%s in total), %d threads' % (
+        args.files, formatting.size_str(args.size), args.large_files, formatting.size_str(large_size),
+        formatting.size_str(total_size), args.threads)
+    expected_hash = path_util.hash_directory(source)
+
+    methods = [('serial', serial_copy), ('native', native_copy)]
+    if any(os.path.exists(os.path.join(directory, 'rsync')) for directory in os.environ['PATH'].split(os.pathsep)):
+        methods.insert(0, ('rsync', rsync_copy))
+    else:
+        print '  (rsync not found, skipping it)'
+    for (name, copy) in methods:
+        dest = os.path.join(base, name)
+        start_time = time.time()
+        copy(source, dest)
+        elapsed = time.time() - start_time
+        assert path_util.hash_directory(dest) == expected_hash, name
+        print '  %-8s %7.2fs  %s/s' % (name, elapsed, formatting.size_str(total_size / elapsed))
+        path_util.remove(dest)
+finally:
+    shutil.rmtree(base)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+# Benchmark path_util.rename and path_util.remove against the subprocess-based
+# versions they replaced (chmod -R u+w followed by mv or shutil.rmtree).
+# Creates many small bundle-like trees and times moving and then removing each
+# of them with both implementations.
+#
+# Usage: benchmark-fs-ops.py [--trees 200] [--files 100]
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codalab.lib import path_util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--trees', type=int, default=200, help='Number of trees to create')
+parser.add_argument('--files', type=int, default=100, help='Number of files per tree')
+parser.add_argument('--dirs', type=int, default=10, help='Number of directories per tree')
+parser.add_argument('--dir', help='Where to create the trees (default: temp directory)')
+args = parser.parse_args()
+
+
+def old_rename(old_path, new_path):
+    subprocess.call(['chmod', '-R', 'u+w', old_path])
+    subprocess.call(['mv', old_path, new_path])
+
+
+def old_remove(path):
+    subprocess.call(['chmod', '-R', 'u+w', path])
+    shutil.rmtree(path)
+
+
+def make_tree(root):
+    os.mkdir(root)
+    for i in range(args.dirs):
+        os.mkdir(os.path.join(root, 'd%d' % i))
+    for i in range(args.files):
+        with open(os.path.join(root, 'd%d' % (i % args.dirs), 'f%d' % i), 'w') as f:
+            f.write('x')
+
+
+base = tempfile.mkdtemp('-benchmark-fs-ops', dir=args.dir)
+try:
+    print '%d trees of %d files in %d directories' % (args.trees, args.files, args.dirs)
+    for (name, rename, remove) in [('subprocess', old_rename, old_remove), ('native', path_util.rename, path_util.remove)]:
+        paths = [os.path.join(base, 'tree%d' % i) for i in range(args.trees)]
+        for path in paths:
+            make_tree(path)
+
+        start_time = time.time()
+        for path in paths:
+            rename(path, path + '-moved')
+        rename_time = time.time() - start_time
+
+        start_time = time.time()
+        for path in paths:
+            remove(path + '-moved')
+        remove_time = time.time() - start_time
+
+        print '  %-10s rename %6.2fms/tree  remove %6.2fms/tree' % (
+            name, 1000 * rename_time / args.trees, 1000 * remove_time / args.trees)
+finally:
+    shutil.rmtree(base)
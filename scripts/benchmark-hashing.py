@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Benchmark path_util.hash_directory on synthetic bundles.
+# Builds a tree of many small files and a tree of a few huge files, then hashes
+# each with different numbers of threads and checks that the hashes agree.
+#
+# Usage: benchmark-hashing.py [--small-files 10000] [--huge-files 4] [--huge-size 512m]
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codalab.lib import formatting, path_util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--small-files', type=int, default=10000, help='Number of small files to create')
+parser.add_argument('--small-size', type=formatting.parse_size, default='4k', help='Size of each small file')
+parser.add_argument('--huge-files', type=int, default=4, help='Number of huge files to create')
+parser.add_argument('--huge-size', type=formatting.parse_size, default='512m', help='Size of each huge file')
+parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='Thread counts to try')
+parser.add_argument('--dir', help='Where to create the trees (default: temp directory)')
+args = parser.parse_args()
+
+
+def write_random_file(path, size):
+    with open(path, 'wb') as f:
+        while size > 0:
+            n = min(size, 1024 * 1024)
+            f.write(os.urandom(n))
+            size -= n
+
+
+def make_small_tree(root):
+    os.mkdir(root)
+    for i in range(args.small_files):
+        subdir = os.path.join(root, 'd%03d' % (i % 100))
+        if not os.path.exists(subdir):
+            os.mkdir(subdir)
+        write_random_file(os.path.join(subdir, 'f%d' % i), int(args.small_size))
+
+
+def make_huge_tree(root):
+    os.mkdir(root)
+    for i in range(args.huge_files):
+        write_random_file(os.path.join(root, 'f%d' % i), int(args.huge_size))
+
+
+def drop_caches():
+    # Only works as root; otherwise the numbers below are for a warm page cache.
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except IOError:
+        return False
+
+
+base = tempfile.mkdtemp('-benchmark-hashing', dir=args.dir)
+try:
+    for (name, make_tree) in [('small', make_small_tree), ('huge', make_huge_tree)]:
+        root = os.path.join(base, name)
+        make_tree(root)
+        dirs_and_files = path_util.recursive_ls(root)
+        size = path_util.get_size(root, dirs_and_files)
+        print '%s: %d files, %s' % (name, len(dirs_and_files[1]), formatting.size_str(size))
+
+        hashes = set()
+        for num_threads in args.threads:
+            cold = drop_caches()
+            start_time = time.time()
+            hashes.add(path_util.hash_directory(root, dirs_and_files, num_threads=num_threads))
+            elapsed = time.time() - start_time
+            print '  threads=%-3d %6.2fs  %s/s%s' % (
+                num_threads, elapsed, formatting.size_str(size / max(elapsed, 1e-6)), '' if cold else ' (warm cache)')
+        if len(hashes) != 1:
+            print '  ERROR: got different hashes: %s' % sorted(hashes)
+            sys.exit(1)
+finally:
+    shutil.rmtree(base)
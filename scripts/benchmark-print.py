@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# Benchmark the latency of `cl print` of a worksheet on a local BundleRPCServer,
+# through a proxy that delays the data in each direction by a latency, with the
+# server closing each connection after one request (HTTP/1.0, as before
+# keep-alive) and keeping it alive (HTTP/1.1). A new connection costs a round
+# trip for the TCP handshake, which the proxy adds before forwarding any data,
+# and a TLS handshake would add one or two more. Each run uses a new
+# CodaLabManager, like a new `cl` process.
+#
+# Usage: benchmark-print.py [--latency 0.025] [--bundles 10] [--runs 5]
+
+import argparse
+import collections
+import cStringIO
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class LatencyProxy(object):
+    '''
+    Forwards connections on a local port to |address|, delaying the data in
+    each direction by |latency| seconds, and the first data of a connection by
+    another round trip, for the handshake.
+    '''
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, address, latency):
+        self.address = address
+        self.latency = latency
+        self.num_connections = 0
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('localhost', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            client = self.listener.accept()[0]
+            self.num_connections += 1
+            server = socket.create_connection(self.address)
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            # The client would send its first data after the handshake.
+            start_time = time.time() + 3 * self.latency
+            for (source, dest) in ((client, server), (server, client)):
+                self._pipe(source, dest, start_time)
+
+    def _pipe(self, source, dest, start_time):
+        pending = collections.deque()
+        condition = threading.Condition()
+
+        def read():
+            while True:
+                try:
+                    data = source.recv(self.BLOCK_SIZE)
+                except socket.error:
+                    data = ''
+                with condition:
+                    pending.append((max(time.time() + self.latency, start_time), data))
+                    condition.notify()
+                if not data:
+                    return
+
+        def write():
+            while True:
+                with condition:
+                    while not pending:
+                        condition.wait()
+                    (due, data) = pending.popleft()
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    if data:
+                        dest.sendall(data)
+                    else:
+                        dest.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+                if not data:
+                    return
+
+        for target in (read, write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--latency', type=float, default=0.025, help='One-way latency of the proxy in seconds')
+parser.add_argument('--bundles', type=int, default=10, help='Number of bundles on the worksheet')
+parser.add_argument('--runs', type=int, default=5, help='Number of times to print the worksheet')
+args = parser.parse_args()
+
+home = tempfile.mkdtemp('-benchmark-print')
+try:
+    # A local server on a free port, with the metadata in SQLite.
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    with open(os.path.join(home, 'config.json'), 'w') as f:
+        json.dump({
+            'cli': {'verbose': 0, 'default_address': 'local'},
+            'server': {
+                'host': 'localhost',
+                'port': port,
+                'auth': {'class': 'MockAuthHandler'},
+                'verbose': 0,
+                'class': 'SQLiteModel',
+                'engine_url': 'sqlite:///%s' % (os.path.join(home, 'bundle.db'),),
+            },
+            'aliases': {},
+        }, f)
+    os.environ['CODALAB_HOME'] = home
+    from codalab.lib.bundle_cli import BundleCLI
+    from codalab.lib.codalab_manager import CodaLabManager
+    from codalab.server.bundle_rpc_server import BundleRPCServer
+    from codalab.server.file_server import AuthenticatedXMLRPCRequestHandler
+
+    manager = CodaLabManager()
+    # Quiet the setup, which reports its progress on stdout and stderr.
+    saved_fds = (os.dup(1), os.dup(2))
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    for fd in (1, 2):
+        os.dup2(devnull, fd)
+    try:
+        cli = BundleCLI(manager)
+        cli.do_command(['new', 'benchmark'])
+        cli.do_command(['work', 'benchmark'])
+        for i in range(args.bundles):
+            path = os.path.join(home, 'bundle-%d' % (i,))
+            with open(path, 'w') as f:
+                f.write('contents %d\n' % (i,))
+            cli.do_command(['upload', path])
+        server = BundleRPCServer(manager)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for (fd, saved_fd) in zip((1, 2), saved_fds):
+            os.dup2(saved_fd, fd)
+    # Count the calls.
+    num_calls = [0]
+    dispatch = server._dispatch
+    def count_dispatch(method, params):
+        num_calls[0] += 1
+        return dispatch(method, params)
+    server._dispatch = count_dispatch
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    proxy = LatencyProxy(('localhost', port), args.latency)
+    address = 'http://localhost:%d' % (proxy.port,)
+    # Log in ahead of time, as a user of `cl print` would have.
+    token_info = manager.auth_handler().generate_token('credentials', manager.root_user_name(), '')
+    token_info['expires_at'] = time.time() + token_info.pop('expires_in')
+    manager.state['auth'][address] = {'username': manager.root_user_name(), 'token_info': token_info}
+    manager.save_state()
+
+    print 'Printing a worksheet with %d bundles with %.1fms latency' % (args.bundles, args.latency * 1000)
+    print '  %-10s %10s %8s %12s' % ('server', 'time', 'calls', 'connections')
+    for protocol_version in ('HTTP/1.0', 'HTTP/1.1'):
+        AuthenticatedXMLRPCRequestHandler.protocol_version = protocol_version
+        times = []
+        (num_calls[0], num_connections) = (0, proxy.num_connections)
+        for _ in range(args.runs):
+            stdout = cStringIO.StringIO()
+            start_time = time.time()
+            BundleCLI(CodaLabManager(), stdout=stdout).do_command(['print', address + '::benchmark'])
+            times.append(time.time() - start_time)
+        print '  %-10s %9.3fs %8d %12d' % (
+            protocol_version,
+            sorted(times)[len(times) // 2],
+            num_calls[0] // args.runs,
+            (proxy.num_connections - num_connections) // args.runs,
+        )
+    server.shutdown()
+finally:
+    shutil.rmtree(home)
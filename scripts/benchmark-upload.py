@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# Benchmark uploading a file to a FileServer through a local proxy that adds
+# latency: with write_file calls over XML-RPC (one buffer per round trip),
+# streamed over one connection, and in chunks over several connections at once
+# (FileStreamClient.upload_chunks). The proxy delays the data in each direction
+# by the latency and lets at most a window of bytes be in flight per connection,
+# like a TCP window, so that one connection can't go faster than window/latency.
+#
+# Usage: benchmark-upload.py [--size 64m] [--latency 0.05] [--window 256k] [--connections 1,2,4,8]
+
+import argparse
+import collections
+import cStringIO
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codalab.client.remote_bundle_client import FileStreamClient
+from codalab.lib import file_util, formatting
+from codalab.lib.staging_area import StagingArea
+from codalab.server.auth import MockAuthHandler, User
+from codalab.server.file_server import FileServer
+from codalab.server.rpc_file_handle import RPCFileHandle
+
+
+class BenchmarkFileServer(FileServer):
+    verbose = 0
+
+
+class LatencyProxy(object):
+    '''
+    Forwards connections on a local port to |address|, delaying the data in
+    each direction by |latency| seconds, with at most |window| bytes in flight.
+    '''
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, address, latency, window):
+        self.address = address
+        self.latency = latency
+        self.window = window
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('localhost', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            client = self.listener.accept()[0]
+            server = socket.create_connection(self.address)
+            for (source, dest) in ((client, server), (server, client)):
+                self._pipe(source, dest)
+
+    def _pipe(self, source, dest):
+        pending = collections.deque()
+        condition = threading.Condition()
+        in_flight = [0]
+
+        def read():
+            while True:
+                try:
+                    data = source.recv(self.BLOCK_SIZE)
+                except socket.error:
+                    data = ''
+                with condition:
+                    while data and in_flight[0] + len(data) > self.window and in_flight[0]:
+                        condition.wait()
+                    in_flight[0] += len(data)
+                    pending.append((time.time() + self.latency, data))
+                    condition.notify_all()
+                if not data:
+                    return
+
+        def write():
+            while True:
+                with condition:
+                    while not pending:
+                        condition.wait()
+                    (due, data) = pending.popleft()
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    if data:
+                        dest.sendall(data)
+                    else:
+                        dest.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+                with condition:
+                    in_flight[0] -= len(data)
+                    condition.notify_all()
+                if not data:
+                    return
+
+        for target in (read, write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', default='64m', help='Size of the file to upload')
+parser.add_argument('--latency', type=float, default=0.05, help='One-way latency of the proxy in seconds')
+parser.add_argument('--window', default='256k', help='Bytes in flight per connection')
+parser.add_argument('--connections', default='1,2,4,8', help='Numbers of connections for chunked uploads')
+parser.add_argument('--xmlrpc', action='store_true', help='Also upload with write_file calls')
+parser.add_argument('--dir', help='Where to stage the uploads (default: temp directory)')
+args = parser.parse_args()
+
+base = tempfile.mkdtemp('-benchmark-upload', dir=args.dir)
+try:
+    staging = StagingArea(os.path.join(base, 'temp'))
+    server = BenchmarkFileServer(('localhost', 0), lambda: staging, MockAuthHandler([User('root', 0)]))
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    proxy = LatencyProxy(server.server_address, args.latency, int(formatting.parse_size(args.window)))
+    address = 'http://localhost:%d' % (proxy.port,)
+
+    size = int(formatting.parse_size(args.size))
+    contents = os.urandom(size)
+    print 'Uploading %s with %.1fms latency and a %s window' % (
+        formatting.size_str(size), args.latency * 1000, args.window)
+
+    def check(file_uuid):
+        with open(server.file_paths[file_uuid], 'rb') as f:
+            assert f.read() == contents
+        server.finalize_file(file_uuid)
+
+    print '  %-16s %10s %12s' % ('method', 'time', 'throughput')
+
+    def report(name, elapsed):
+        print '  %-16s %9.2fs %10s/s' % (name, elapsed, formatting.size_str(size / elapsed))
+
+    if args.xmlrpc:
+        proxy_server = xmlrpclib.ServerProxy(address, allow_none=True)
+        file_uuid = server.open_temp_file('upload')
+        start_time = time.time()
+        handle = RPCFileHandle(file_uuid, proxy_server)
+        file_util.copy(cStringIO.StringIO(contents), handle, autoflush=False)
+        handle.close()
+        report('xmlrpc', time.time() - start_time)
+        check(file_uuid)
+
+    file_stream = FileStreamClient(address, lambda: None)
+    file_uuid = server.open_temp_file('upload')
+    start_time = time.time()
+    file_stream.upload(file_uuid, cStringIO.StringIO(contents))
+    report('stream', time.time() - start_time)
+    check(file_uuid)
+
+    for num_connections in [int(n) for n in args.connections.split(',')]:
+        file_uuid = server.open_temp_file('upload')
+        (_, elapsed) = file_stream.upload_chunks(file_uuid, cStringIO.StringIO(contents), num_connections)
+        report('chunks x%d' % (num_connections,), elapsed)
+        check(file_uuid)
+    server.shutdown()
+finally:
+    shutil.rmtree(base)
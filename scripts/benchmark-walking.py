@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# Benchmark the filesystem metadata calls made when computing the hash, size and
+# info of a bundle. Builds a synthetic tree and, for both the old os.walk-based
+# code and the current path_util, counts calls to os.stat, os.lstat,
+# os.listdir, os.readlink and os.open (each of which is one syscall) and times
+# the traversal.
+#
+# Usage: benchmark-walking.py [--files 20000] [--dirs 200] [--links 100]
+
+import __builtin__
+import argparse
+import collections
+import hashlib
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codalab.lib import path_util
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--files', type=int, default=20000, help='Number of files to create')
+parser.add_argument('--dirs', type=int, default=200, help='Number of directories to spread them over')
+parser.add_argument('--links', type=int, default=100, help='Number of symlinks to create')
+parser.add_argument('--dir', help='Where to create the tree (default: temp directory)')
+args = parser.parse_args()
+
+COUNTED_FUNCTIONS = ['stat', 'lstat', 'listdir', 'readlink', 'open']
+
+
+def old_recursive_ls(path):
+    # path_util.recursive_ls before scan_tree.
+    (directories, files) = ([], [])
+    for (root, _, file_names) in os.walk(path):
+        directories.append(root)
+        for file_name in file_names:
+            files.append(os.path.join(root, file_name))
+        for subpath in os.listdir(root):
+            full_subpath = os.path.join(root, subpath)
+            if os.path.islink(full_subpath) and os.path.isdir(full_subpath):
+                files.append(full_subpath)
+    return (directories, files)
+
+
+def old_hash_file_contents(path):
+    if os.path.islink(path):
+        return path_util.hash_link(os.readlink(path))
+    contents_hash = hashlib.sha1(path_util.FILE_PREFIX)
+    with open(path, 'rb') as file_handle:
+        contents_hash.update(file_handle.read())
+    return contents_hash.hexdigest()
+
+
+def old_get_info(path, depth):
+    result = {'name': os.path.basename(path)}
+    if os.path.islink(path):
+        result['link'] = os.readlink(path)
+    if os.path.isfile(path):
+        result['type'] = 'file'
+        if os.path.islink(path) or not os.path.isdir(path):
+            result['size'] = os.lstat(path).st_size
+    elif os.path.isdir(path):
+        result['type'] = 'directory'
+        if depth > 0:
+            result['contents'] = [old_get_info(os.path.join(path, name), depth - 1) for name in os.listdir(path)]
+    if os.path.exists(path):
+        result['perm'] = os.stat(path).st_mode & 0777
+    return result
+
+
+def old_upload_metadata(root):
+    dirs_and_files = old_recursive_ls(root)
+    data_hash = path_util.hash_directory(root, dirs_and_files, num_threads=1, hash_file=old_hash_file_contents)
+    size = sum(os.lstat(path).st_size for path in itertools.chain(*dirs_and_files))
+    return (data_hash, size)
+
+
+def new_upload_metadata(root):
+    (directories, files, stats) = path_util.scan_tree(root)
+    data_hash = path_util.hash_directory(root, (directories, files), num_threads=1)
+    size = sum(path_stat.st_size for path_stat in stats.itervalues())
+    return (data_hash, size)
+
+
+def count_calls(function, *args):
+    # Wrap the os functions that make metadata syscalls and count calls to them.
+    counts = collections.Counter()
+    originals = [(os, name, getattr(os, name)) for name in COUNTED_FUNCTIONS]
+    originals.append((__builtin__, 'open', __builtin__.open))
+    def make_wrapper(name, original):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return original(*args, **kwargs)
+        return wrapper
+    for (module, name, original) in originals:
+        setattr(module, name, make_wrapper(name, original))
+    try:
+        start_time = time.time()
+        result = function(*args)
+        elapsed = time.time() - start_time
+    finally:
+        for (module, name, original) in originals:
+            setattr(module, name, original)
+    return (result, counts, elapsed)
+
+
+def make_tree(root):
+    os.mkdir(root)
+    for i in range(args.dirs):
+        os.mkdir(os.path.join(root, 'd%d' % i))
+    for i in range(args.files):
+        with open(os.path.join(root, 'd%d' % (i % args.dirs), 'f%d' % i), 'w') as f:
+            f.write('x' * (i % 100))
+    for i in range(args.links):
+        os.symlink(os.path.join(os.pardir, 'd%d' % ((i + 1) % args.dirs)), os.path.join(root, 'd%d' % (i % args.dirs), 'l%d' % i))
+
+
+def report(name, counts, elapsed):
+    total = sum(counts.values())
+    print '  %-8s %8d calls (%s)  %6.2fs' % (
+        name, total, ', '.join('%s=%d' % (fn, counts[fn]) for fn in COUNTED_FUNCTIONS), elapsed)
+    return total
+
+
+base = tempfile.mkdtemp('-benchmark-walking', dir=args.dir)
+try:
+    root = os.path.join(base, 'tree')
+    make_tree(root)
+    num_entries = args.files + args.dirs + args.links + 1
+    print 'tree: %d entries' % num_entries
+
+    for (label, old_function, new_function, function_args) in [
+        ('hash + size', old_upload_metadata, new_upload_metadata, (root,)),
+        ('info depth=1', old_get_info, path_util.get_info, (root, 1)),
+        ('info depth=2', old_get_info, path_util.get_info, (root, 2)),
+    ]:
+        print label
+        (old_result, old_counts, old_elapsed) = count_calls(old_function, *function_args)
+        (new_result, new_counts, new_elapsed) = count_calls(new_function, *function_args)
+        old_total = report('old', old_counts, old_elapsed)
+        new_total = report('new', new_counts, new_elapsed)
+        print '  %.1fx fewer calls' % (float(old_total) / max(new_total, 1))
+        if old_result != new_result:
+            print '  ERROR: results differ'
+            sys.exit(1)
+finally:
+    shutil.rmtree(base)
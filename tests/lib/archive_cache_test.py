@@ -0,0 +1,121 @@
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from codalab.lib import path_util, zip_util
+from codalab.lib.archive_cache import ArchiveCache
+
+
+class ArchiveCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.cache = ArchiveCache(os.path.join(self.temp_directory, 'cache'), 10 ** 9)
+    self.source = os.path.join(self.temp_directory, 'source')
+    os.mkdir(self.source)
+    with open(os.path.join(self.source, 'file'), 'w') as f:
+      f.write('contents' * 1000)
+    self.data_hash = '0x' + '12' * 20
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def read(self, handle):
+    dest = os.path.join(self.temp_directory, 'dest')
+    zip_util.unpack(handle, dest)
+    handle.close()
+    result = path_util.hash_directory(dest)
+    path_util.remove(dest)
+    return result
+
+  def test_open(self):
+    '''
+    Test that archives are built once and then served from the cache.
+    '''
+    get_path = mock.Mock(return_value=self.source)
+    for _ in range(2):
+      self.assertEqual(self.read(self.cache.open(self.data_hash, '', get_path)), path_util.hash_directory(self.source))
+    self.assertEqual(get_path.call_count, 1)
+    self.assertTrue(os.path.exists(self.cache.get_location(self.data_hash, '', ArchiveCache.TAR_GZ)))
+    self.assertIsNone(self.cache.open(self.data_hash, 'missing', lambda: None))
+
+    self.cache.remove(self.data_hash)
+    self.assertEqual(os.listdir(self.cache.root), [])
+
+  def test_release(self):
+    '''
+    Test that the path that an archive is packed from is released once its
+    reader is closed.
+    '''
+    release_path = mock.Mock()
+    handle = self.cache.open(self.data_hash, '', lambda: self.source, release_path=release_path)
+    self.assertFalse(release_path.called)
+    self.read(handle)
+    release_path.assert_called_once_with(self.source)
+
+  def test_single_build(self):
+    '''
+    Test that concurrent misses for the same archive are all served, and that
+    the archive is cached once.
+    '''
+    get_path = mock.Mock(side_effect=lambda: time.sleep(0.2) or self.source)
+    handles = []
+    threads = [
+      threading.Thread(target=lambda: handles.append(self.cache.open(self.data_hash, '', get_path)))
+      for _ in range(4)
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(handles), 4)
+    self.assertEqual(len(os.listdir(self.cache.root)), 1)
+    for handle in handles:
+      self.assertEqual(self.read(handle), path_util.hash_directory(self.source))
+    self.assertEqual(self.cache.building, set())
+    self.assertEqual(os.listdir(self.cache.root), [
+      os.path.basename(self.cache.get_location(self.data_hash, '', ArchiveCache.TAR_GZ))
+    ])
+
+  def test_not_cached(self):
+    '''
+    Test that archives that are not read to the end, or that are larger than
+    the cache, are served but not cached.
+    '''
+    with mock.patch('codalab.lib.archive_cache._CachingReader.MAX_DRAIN_SIZE', 0):
+      handle = self.cache.open(self.data_hash, '', lambda: self.source)
+      handle.read(10)
+      handle.close()
+    self.assertEqual(os.listdir(self.cache.root), [])
+    # Unless the rest is small enough to read on close.
+    handle = self.cache.open(self.data_hash, '', lambda: self.source)
+    handle.read(10)
+    handle.close()
+    self.assertEqual(len(os.listdir(self.cache.root)), 1)
+    self.cache.remove(self.data_hash)
+
+    self.cache.max_size = 100
+    self.assertEqual(self.read(self.cache.open(self.data_hash, '', lambda: self.source)),
+                     path_util.hash_directory(self.source))
+    self.assertEqual(os.listdir(self.cache.root), [])
+    self.assertEqual(self.cache.building, set())
+
+  def test_evict(self):
+    '''
+    Test that the least recently used archives are evicted once the cache is
+    over its size.
+    '''
+    for subpath in ('a', 'b'):
+      self.read(self.cache.open(self.data_hash, subpath, lambda: self.source))
+    size = os.path.getsize(self.cache.get_location(self.data_hash, 'a', ArchiveCache.TAR_GZ))
+    old_time = time.time() - 60
+    os.utime(self.cache.get_location(self.data_hash, 'b', ArchiveCache.TAR_GZ), (old_time, old_time))
+    self.cache.max_size = 2 * size + 1
+    self.read(self.cache.open(self.data_hash, 'c', lambda: self.source))
+    self.assertEqual(sorted(os.listdir(self.cache.root)), sorted([
+      os.path.basename(self.cache.get_location(self.data_hash, subpath, ArchiveCache.TAR_GZ))
+      for subpath in ('a', 'c')
+    ]))
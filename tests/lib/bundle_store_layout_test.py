@@ -0,0 +1,416 @@
+import mock
+import os
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+from codalab.common import UsageError
+from codalab.lib import path_util
+from codalab.lib.bundle_store import BundleStore
+from codalab.lib.scrubber import Scrubber
+from codalab.lib.storage_backend import ObjectStoreBackend
+
+
+class BundleStoreLayoutTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.home = os.path.join(self.temp_directory, 'home')
+    os.mkdir(self.home)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def upload(self, bundle_store, name, contents, files=(), remove_sources=True):
+    source = os.path.join(self.temp_directory, name)
+    os.mkdir(source)
+    for (file_name, file_contents) in (('file', contents),) + tuple(files):
+      with open(os.path.join(source, file_name), 'w') as f:
+        f.write(file_contents)
+    (data_hash, _) = bundle_store.upload(sources=[source], follow_symlinks=False, exclude_patterns=None,
+                                         git=False, unpack=False, remove_sources=remove_sources)
+    return data_hash
+
+  def read(self, bundle_store, data_hash, path):
+    with open(os.path.join(bundle_store.get_location(data_hash), path)) as f:
+      return f.read()
+
+  def test_sharded_upload(self):
+    '''
+    Test that a sharded store uploads into shards and that both layouts find the data.
+    '''
+    bundle_store = BundleStore(self.home, sharded=True)
+    data_hash = self.upload(bundle_store, 'a', 'a')
+    location = os.path.join(bundle_store.data, data_hash[2:4], data_hash[4:6], data_hash)
+    self.assertEqual(bundle_store.get_location(data_hash), location)
+    self.assertTrue(os.path.isdir(location))
+    self.assertEqual(BundleStore(self.home).get_location(data_hash), location)
+    self.assertEqual(bundle_store.list_data_hashes(), {data_hash: os.path.relpath(location, bundle_store.data)})
+    self.assertEqual(bundle_store.get_location(data_hash, relative=True),
+                     os.path.join(os.pardir, os.pardir, data_hash[2:4], data_hash[4:6], data_hash))
+
+  def test_target_info(self):
+    '''
+    Test that uploads save a manifest that get_target_info reads.
+    '''
+    bundle_store = BundleStore(self.home, sharded=True)
+    data_hash = self.upload(bundle_store, 'a', 'contents')
+    self.assertTrue(os.path.isfile(bundle_store.get_manifest_location(data_hash)))
+    location = bundle_store.get_location(data_hash)
+    os.remove(os.path.join(location, 'file'))  # Show that the manifest is used.
+    info = bundle_store.get_target_info(data_hash, '', 1)
+    self.assertEqual(info['name'], data_hash)
+    self.assertEqual([(item['name'], item['size']) for item in info['contents']], [('file', len('contents'))])
+    self.assertEqual(bundle_store.get_target_info(data_hash, 'file', 0)['type'], 'file')
+    self.assertIsNone(bundle_store.get_target_info(data_hash, 'missing', 0))
+    self.assertIsNone(bundle_store.get_target_info(data_hash, '../file', 0))
+
+  def test_migrate(self):
+    '''
+    Test that migrating moves bundles one at a time and keeps links between them working.
+    '''
+    flat_store = BundleStore(self.home)
+    hash_a = self.upload(flat_store, 'a', 'a')
+    hash_b = self.upload(flat_store, 'b', 'b')
+    # Make b depend on a the way a MakeBundle does.
+    os.symlink(os.path.join(os.pardir, flat_store.get_location(hash_a, relative=True), 'file'),
+               os.path.join(flat_store.get_location(hash_b), 'dep'))
+
+    bundle_store = BundleStore(self.home, sharded=True)
+    for num_moved in (1, 1, 0):
+      self.assertEqual(bundle_store.migrate_to_sharded(max_bundles=1), num_moved)
+      for store in (flat_store, bundle_store):
+        self.assertEqual(self.read(store, hash_a, 'file'), 'a')
+        self.assertEqual(self.read(store, hash_b, 'file'), 'b')
+        self.assertEqual(self.read(store, hash_b, 'dep'), 'a')
+      with open(os.path.join(flat_store.data, hash_b, 'dep')) as f:
+        self.assertEqual(f.read(), 'a')
+
+    bundle_store.migrate_to_sharded(finalize=True)
+    self.assertEqual(sorted(os.listdir(bundle_store.data)), sorted([hash_a[2:4], hash_b[2:4]]))
+    self.assertEqual(self.read(bundle_store, hash_b, 'dep'), 'a')
+    self.assertEqual(sorted(bundle_store.list_data_hashes()), sorted([hash_a, hash_b]))
+
+  def test_dedup(self):
+    '''
+    Test that identical files are hardlinked to one read-only object.
+    '''
+    bundle_store = BundleStore(self.home, dedup=True)
+    shared = 'x' * BundleStore.DEDUP_MIN_SIZE
+    hashes = [self.upload(bundle_store, name, name, [('shared', shared)]) for name in ('a', 'b')]
+    stats = [os.lstat(os.path.join(bundle_store.get_location(data_hash), 'shared')) for data_hash in hashes]
+    self.assertEqual(stats[0].st_ino, stats[1].st_ino)
+    self.assertEqual(stats[0].st_nlink, 3)  # Both bundles and the pool.
+    self.assertFalse(stats[0].st_mode & stat.S_IWUSR)
+    # Small files are left alone, and the data hash is unchanged.
+    self.assertEqual(os.lstat(os.path.join(bundle_store.get_location(hashes[0]), 'file')).st_nlink, 1)
+    for data_hash in hashes:
+      location = bundle_store.get_location(data_hash)
+      self.assertEqual(data_hash, '0x' + path_util.hash_directory(location))
+      self.assertEqual(bundle_store.get_target_info(data_hash, 'shared', 0), path_util.get_info(os.path.join(location, 'shared'), 0))
+
+    # Objects are garbage collected once no bundle uses them.
+    model = mock.Mock()
+    model.get_data_hash_ref_counts.return_value = {}
+    bundle_store.DATA_CLEANUP_TIME = -60
+    bundle_store.full_cleanup(model, dry_run=False)
+    self.assertEqual(bundle_store.list_data_hashes(), {})
+    self.assertEqual(path_util.scan_tree(bundle_store.objects)[1], [])
+
+  def test_chunked(self):
+    '''
+    Test that large files are stored as chunks, read from them, and reassembled
+    by ensure_local.
+    '''
+    bundle_store = BundleStore(self.home, chunked=True)
+    bundle_store.CHUNK_MIN_FILE_SIZE = 1024
+    large = os.urandom(4096)
+    data_hash = self.upload(bundle_store, 'a', 'small', [('large', large)])
+    raw_location = os.path.join(bundle_store.data, data_hash)
+    self.assertEqual(os.path.getsize(os.path.join(raw_location, 'large')), 0)
+    self.assertEqual(bundle_store.get_target_info(data_hash, 'large', 0)['size'], len(large))
+
+    location = bundle_store.get_location(data_hash)
+    self.assertEqual(location, os.path.join(bundle_store.materialized, data_hash))
+    self.assertFalse(bundle_store.is_local(data_hash))
+    with bundle_store.open_stored_target(data_hash, 'large') as handle:
+      self.assertEqual(handle.read(), large)
+    with bundle_store.open_stored_target(data_hash, 'file') as handle:
+      self.assertEqual(handle.read(), 'small')
+    self.assertEqual(bundle_store.read_range(data_hash, os.sep + 'large', 100, 10), large[100:110])
+    dest_path = os.path.join(self.temp_directory, 'export')
+    self.assertTrue(bundle_store.export_stored_target(data_hash, '', dest_path))
+    self.assertEqual(data_hash, '0x' + path_util.hash_directory(dest_path))
+    self.assertRaises(UsageError, bundle_store.get_location, data_hash, relative=True)
+
+    # With chunking disabled, the chunk store is only queried for bundles whose
+    # manifest says that they are chunked.
+    small_hash = self.upload(bundle_store, 'b', 'b')
+    unchunked_store = BundleStore(self.home)
+    with mock.patch.object(unchunked_store.chunk_store, 'list_files') as list_files:
+      self.assertEqual(unchunked_store.get_location(small_hash), os.path.join(bundle_store.data, small_hash))
+      self.assertEqual(unchunked_store.get_location(data_hash), location)
+      self.assertEqual(list_files.call_count, 1)
+
+    self.assertEqual(bundle_store.ensure_local(data_hash), location)
+    self.assertEqual(self.read(bundle_store, data_hash, 'large'), large)
+    self.assertEqual(self.read(bundle_store, data_hash, 'file'), 'small')
+    self.assertEqual(data_hash, '0x' + path_util.hash_directory(location))
+
+    # Evicted copies are materialized again.
+    bundle_store.materialized_cache_size = 0
+    bundle_store.MATERIALIZED_MIN_AGE = -60
+    bundle_store._evict_materialized(0)
+    self.assertFalse(os.path.exists(location))
+    bundle_store.ensure_local(data_hash)
+    self.assertEqual(self.read(bundle_store, data_hash, 'large'), large)
+
+    model = mock.Mock()
+    model.get_data_hash_ref_counts.return_value = {}
+    bundle_store.cleanup(model, data_hash, [], dry_run=False)
+    self.assertFalse(os.path.exists(location))
+    self.assertEqual(bundle_store.chunk_store.list_files(data_hash), [])
+
+  def test_full_cleanup(self):
+    '''
+    Test that full_cleanup deletes only old unreferenced data, checking it in
+    batches.
+    '''
+    bundle_store = BundleStore(self.home)
+    hashes = [self.upload(bundle_store, name, name) for name in ('a', 'b', 'c', 'd')]
+    old_time = time.time() - 2 * BundleStore.DATA_CLEANUP_TIME
+    for data_hash in hashes[:3]:
+      os.utime(bundle_store.get_location(data_hash), (old_time, old_time))
+    model = mock.Mock()
+    # hashes[0] and hashes[1] are referenced and hashes[3] is too recent.
+    model.get_data_hash_ref_counts.side_effect = lambda batch: dict(
+      (data_hash, 1) for data_hash in batch if data_hash in hashes[:2])
+    with mock.patch('time.sleep') as sleep:
+      bundle_store.full_cleanup(model, dry_run=False, batch_size=2, sleep_time=5)
+    self.assertEqual(model.get_data_hash_ref_counts.call_count, 2)
+    self.assertEqual(sleep.call_count, 1)
+    self.assertFalse(any(len(call[0][0]) > 2 for call in model.get_data_hash_ref_counts.call_args_list))
+    self.assertEqual(sorted(bundle_store.list_data_hashes()), sorted([hashes[0], hashes[1], hashes[3]]))
+
+  def test_claim(self):
+    '''
+    Test that claiming data marks it as recent for full_cleanup, and fails once
+    the data is gone.
+    '''
+    bundle_store = BundleStore(self.home)
+    data_hash = self.upload(bundle_store, 'a', 'a')
+    location = bundle_store.get_location(data_hash)
+    old_time = time.time() - 2 * BundleStore.DATA_CLEANUP_TIME
+    os.utime(location, (old_time, old_time))
+    self.assertTrue(bundle_store.claim(data_hash))
+    self.assertGreater(os.path.getmtime(location), old_time)
+
+    path_util.remove(location)
+    self.assertFalse(bundle_store.claim(data_hash))
+
+  def test_volumes(self):
+    '''
+    Test that new bundles are placed on volumes by policy and found on any of them.
+    '''
+    volume_root = os.path.join(self.temp_directory, 'volume')
+    bundle_store = BundleStore(self.home, volumes=[volume_root], placement=BundleStore.ROUND_ROBIN)
+    hashes = [self.upload(bundle_store, name, name, remove_sources=False) for name in ('a', 'b')]
+    self.assertEqual(bundle_store.get_location(hashes[0]), os.path.join(self.home, 'data', hashes[0]))
+    self.assertEqual(bundle_store.get_location(hashes[1]), os.path.join(volume_root, 'data', hashes[1]))
+    self.assertEqual(self.read(BundleStore(self.home, volumes=[volume_root]), hashes[1], 'file'), 'b')
+    self.assertEqual(sorted(bundle_store.list_data_paths()), sorted(hashes))
+    self.assertEqual(bundle_store.get_location(hashes[1], relative=True),
+                     os.path.join(os.pardir, os.pardir, 'volume', 'data', hashes[1]))
+
+    # Removed sources stay on their volume, and otherwise the one with the most space wins.
+    bundle_store = BundleStore(self.home, volumes=[volume_root])
+    bundle_store.volumes[0].get_space = lambda: (10, 100)
+    bundle_store.volumes[1].get_space = lambda: (20, 100)
+    self.assertEqual(os.path.dirname(bundle_store.get_location(self.upload(bundle_store, 'c', 'c'))), bundle_store.data)
+    self.assertEqual(os.path.dirname(bundle_store.get_location(self.upload(bundle_store, 'd', 'd', remove_sources=False))),
+                     os.path.join(volume_root, 'data'))
+
+    model = mock.Mock()
+    model.get_data_hash_ref_counts.return_value = {}
+    bundle_store.cleanup(model, hashes[1], [], dry_run=False)
+    self.assertFalse(os.path.exists(os.path.join(volume_root, 'data', hashes[1])))
+    self.assertIsNone(bundle_store.volume_index.lookup(hashes[1]))
+
+  def test_rebalance(self):
+    '''
+    Test that rebalancing moves bundles to the emptier volume and keeps them readable.
+    '''
+    volume_root = os.path.join(self.temp_directory, 'volume')
+    bundle_store = BundleStore(self.home, volumes=[volume_root])
+    hashes = [self.upload(bundle_store, name, name) for name in ('a', 'b', 'c')]
+    bundle_store.volumes[0].get_space = lambda: (0, 10 ** 9)
+    bundle_store.volumes[1].get_space = lambda: (10 ** 9, 10 ** 9)
+    self.assertEqual(bundle_store.rebalance(max_bundles=2, dry_run=True), 2)
+    self.assertEqual(len(bundle_store.list_data_hashes()), 3)
+
+    self.assertEqual(bundle_store.rebalance(max_bundles=2), 2)
+    moved = bundle_store.list_data_hashes(bundle_store.volumes[1])
+    self.assertEqual(len(moved), 2)
+    self.assertEqual(sorted(bundle_store.list_data_hashes().keys() + moved.keys()), sorted(hashes))
+    for (data_hash, contents) in zip(hashes, ('a', 'b', 'c')):
+      self.assertEqual(self.read(BundleStore(self.home, volumes=[volume_root]), data_hash, 'file'), contents)
+    # The old copies are removed by full_cleanup once they are old.
+    self.assertEqual(len([name for name in os.listdir(bundle_store.temp) if name.startswith('rebalanced-')]), 2)
+
+    # Bundles that are balanced are left alone.
+    bundle_store.volumes[0].get_space = lambda: (10 ** 9, 10 ** 9)
+    self.assertEqual(bundle_store.rebalance(), 0)
+
+  def test_freeze(self):
+    '''
+    Test that unused bundles are archived, read from their archives and unpacked
+    again only when a run needs them.
+    '''
+    bundle_store = BundleStore(self.home, sharded=True)
+    hashes = [self.upload(bundle_store, name, name * 1000) for name in ('a', 'b')]
+    old_time = time.time() - 2 * BundleStore.COLD_AGE
+    os.utime(bundle_store.get_location(hashes[0]), (old_time, old_time))
+    self.assertEqual(bundle_store.freeze(dry_run=True), 1)
+    self.assertFalse(bundle_store.is_cold(hashes[0]))
+    self.assertEqual(bundle_store.freeze(), 1)
+    self.assertTrue(bundle_store.is_cold(hashes[0]))
+    self.assertFalse(bundle_store.is_cold(hashes[1]))
+    self.assertEqual(bundle_store.list_data_hashes().keys(), hashes[1:])
+    self.assertTrue(bundle_store.contains(hashes[0]))
+    self.assertTrue(bundle_store.contains(hashes[1]))
+    self.assertFalse(bundle_store.contains('0x' + '12' * 20))
+
+    info = bundle_store.get_target_info(hashes[0], '', 1)
+    self.assertEqual(info['contents'], [{'name': 'file', 'type': 'file', 'size': 1000, 'perm': info['contents'][0]['perm']}])
+    handle = bundle_store.open_stored_target(hashes[0], 'file')
+    self.assertEqual(handle.read(), 'a' * 1000)
+    handle.close()
+    self.assertEqual(bundle_store.read_range(hashes[0], os.sep + 'file', 998, 10), 'aa')
+    dest_path = os.path.join(self.temp_directory, 'export')
+    self.assertTrue(bundle_store.export_stored_target(hashes[0], '', dest_path))
+    self.assertEqual(os.listdir(dest_path), ['file'])
+    self.assertFalse(bundle_store.export_stored_target(hashes[0], 'missing', dest_path + '2'))
+    path = bundle_store.stage_stored_target(hashes[0], 'file')
+    self.assertEqual(os.path.basename(path), 'file')
+    bundle_store.discard_staged_target(path)
+    self.assertFalse(os.path.exists(os.path.dirname(path)))
+    location = bundle_store.get_location(hashes[0])
+    self.assertEqual(location, os.path.join(bundle_store.data, hashes[0][2:4], hashes[0][4:6], hashes[0]))
+    self.assertFalse(os.path.exists(location))
+    self.assertTrue(bundle_store.is_cold(hashes[0]))
+
+    # Unpacked again for a run; the archive stays until full_cleanup.
+    self.assertEqual(bundle_store.ensure_local(hashes[0]), location)
+    self.assertEqual(self.read(bundle_store, hashes[0], 'file'), 'a' * 1000)
+    self.assertFalse(bundle_store.is_cold(hashes[0]))
+    self.assertTrue(bundle_store.cold.contains(hashes[0]))
+    model = mock.Mock()
+    model.get_data_hash_ref_counts.side_effect = lambda batch: dict((data_hash, 1) for data_hash in batch)
+    bundle_store.TEMP_CLEANUP_TIME = -60
+    bundle_store.full_cleanup(model, dry_run=False)
+    self.assertFalse(bundle_store.cold.contains(hashes[0]))
+    self.assertEqual(sorted(bundle_store.list_data_hashes()), sorted(hashes))
+
+  def test_backend(self):
+    '''
+    Test that bundles are stored in the backend, read from there, fetched into
+    materialized/ only for runs, and deleted from the backend by cleanup.
+    '''
+    backend = ObjectStoreBackend(os.path.join(self.temp_directory, 'backend'))
+    bundle_store = BundleStore(self.home, backend=backend)
+    source = os.path.join(self.temp_directory, 'a')
+    os.makedirs(os.path.join(source, 'dir'))
+    with open(os.path.join(source, 'dir', 'file'), 'w') as f:
+      f.write('contents')
+    os.chmod(os.path.join(source, 'dir', 'file'), 0755)
+    os.symlink('dir/file', os.path.join(source, 'link'))
+    expected_hash = '0x' + path_util.hash_directory(source)
+    (data_hash, _) = bundle_store.upload(sources=[source], follow_symlinks=False, exclude_patterns=None,
+                                         git=False, unpack=False, remove_sources=False)
+    self.assertEqual(data_hash, expected_hash)
+    self.assertEqual(bundle_store.list_data_hashes(), {})
+    self.assertEqual(bundle_store.list_backend_data_hashes(), [data_hash])
+    self.assertTrue(bundle_store.contains(data_hash))
+    self.assertEqual(backend.list('data/'), ['data/%s/dir/file' % data_hash, 'data/%s/link' % data_hash])
+
+    # Described from the manifest, which is downloaded if needed, and read in
+    # ranges, without fetching the bundle.
+    os.remove(bundle_store.get_manifest_location(data_hash))
+    self.assertEqual(bundle_store.get_target_info(data_hash, 'dir', 1)['contents'][0]['size'], len('contents'))
+    info = bundle_store.get_target_info(data_hash, '', 1)
+    self.assertEqual(info['contents'][1], {'name': 'link', 'link': 'dir/file', 'type': 'file', 'size': len('dir/file'), 'perm': 0755})
+    self.assertRaises(UsageError, bundle_store.get_target_info, data_hash, 'link', 0)
+    self.assertFalse(bundle_store.is_local(data_hash))
+    with bundle_store.open_stored_target(data_hash, 'dir/file') as handle:
+      self.assertEqual(handle.read(), 'contents')
+    self.assertIsNone(bundle_store.open_stored_target(data_hash, 'dir'))
+    self.assertRaises(UsageError, bundle_store.open_stored_target, data_hash, 'link')
+    self.assertEqual(bundle_store.read_range(data_hash, os.sep + os.path.join('dir', 'file'), 3, 2), 'te')
+    dest_path = os.path.join(self.temp_directory, 'export')
+    self.assertTrue(bundle_store.export_stored_target(data_hash, 'dir', dest_path))
+    self.assertEqual(os.listdir(dest_path), ['file'])
+    location = bundle_store.get_location(data_hash)
+    self.assertEqual(location, os.path.join(bundle_store.materialized, data_hash))
+    self.assertFalse(os.path.exists(location))
+
+    self.assertEqual(bundle_store.ensure_local(data_hash), location)
+    self.assertEqual(data_hash, '0x' + path_util.hash_directory(location))
+    self.assertEqual(os.readlink(os.path.join(location, 'link')), 'dir/file')
+    self.assertEqual(stat.S_IMODE(os.stat(os.path.join(location, 'dir', 'file')).st_mode), 0755)
+    self.assertEqual(self.read(BundleStore(self.home, backend=backend), data_hash, 'link'), 'contents')
+
+    # Evicted copies are fetched again.
+    bundle_store.materialized_cache_size = 0
+    bundle_store.MATERIALIZED_MIN_AGE = -60
+    bundle_store._evict_materialized(0)
+    self.assertFalse(os.path.exists(location))
+    bundle_store.ensure_local(data_hash)
+    self.assertEqual(self.read(bundle_store, data_hash, 'dir/file'), 'contents')
+
+    # Uploading it again only refreshes the manifest.
+    self.assertEqual(self.upload(bundle_store, 'b', 'b'), self.upload(bundle_store, 'c', 'b'))
+    self.assertEqual(len(bundle_store.list_backend_data_hashes()), 2)
+
+    model = mock.Mock()
+    model.get_data_hash_ref_counts.return_value = {}
+    bundle_store.cleanup(model, data_hash, [], dry_run=False)
+    self.assertFalse(os.path.exists(location))
+    self.assertEqual(len(bundle_store.list_backend_data_hashes()), 1)
+    self.assertEqual(len(backend.list('data/')), 1)
+
+  def test_merkle(self):
+    '''
+    Test that a store with Merkle hashing gives new bundles data hashes in that
+    format, which coexist with the others, and checks targets on their own.
+    '''
+    data_hash = self.upload(BundleStore(self.home, sharded=True), 'a', 'a')
+    bundle_store = BundleStore(self.home, sharded=True, merkle=True)
+    merkle_hash = self.upload(bundle_store, 'b', 'a', files=[('other', 'b')])
+    self.assertTrue(merkle_hash.startswith(path_util.MERKLE_DATA_HASH_PREFIX))
+    self.assertFalse(path_util.is_merkle_data_hash(data_hash))
+    location = bundle_store.get_location(merkle_hash)
+    self.assertEqual(merkle_hash, path_util.MERKLE_DATA_HASH_PREFIX + path_util.hash_directory(location, merkle=True))
+    digest = path_util.get_data_hash_digest(merkle_hash)
+    self.assertEqual(os.path.relpath(location, bundle_store.data), os.path.join(digest[0:2], digest[2:4], merkle_hash))
+    self.assertEqual(sorted(bundle_store.list_data_hashes()), sorted([data_hash, merkle_hash]))
+    self.assertEqual(self.read(bundle_store, data_hash, 'file'), 'a')
+
+    scrubber = Scrubber(bundle_store)
+    self.assertEqual(scrubber.scrub_bundle(merkle_hash, location), (merkle_hash, 2))
+    (expected, actual) = scrubber.scrub_target(merkle_hash, '/other')
+    self.assertEqual(actual, expected)
+    os.chmod(os.path.join(location, 'other'), 0644)
+    with open(os.path.join(location, 'other'), 'w') as f:
+      f.write('c')
+    (expected, actual) = scrubber.scrub_target(merkle_hash, '/other')
+    self.assertNotEqual(actual, expected)
+    self.assertEqual(scrubber.scrub_target(merkle_hash, '/file')[0], scrubber.scrub_target(merkle_hash, '/file')[1])
+    self.assertRaises(UsageError, scrubber.scrub_target, data_hash, '/file')
+
+    # Chunked files are checked from their chunks.
+    chunked_store = BundleStore(self.home, sharded=True, merkle=True, chunked=True)
+    chunked_store.CHUNK_MIN_FILE_SIZE = 1024
+    chunked_hash = self.upload(chunked_store, 'c', os.urandom(4096))
+    (expected, actual) = Scrubber(chunked_store).scrub_target(chunked_hash, '/file')
+    self.assertEqual(actual, expected)
@@ -4,14 +4,15 @@ import os
 import sys
 import unittest
 
+from codalab.lib import path_util
 from codalab.lib.bundle_store import BundleStore
 
 class BundleStoreTest(unittest.TestCase):
-    @mock.patch('codalab.lib.bundle_store.tempfile')
+    @mock.patch('codalab.lib.bundle_store.Manifest')
     @mock.patch('codalab.lib.bundle_store.uuid')
     @mock.patch('codalab.lib.bundle_store.path_util')
     @mock.patch('codalab.lib.bundle_store.os', new_callable=mock.Mock)
-    def test_upload(self, mock_os, mock_path_util, mock_uuid, mock_tempfile):
+    def test_upload(self, mock_os, mock_path_util, mock_uuid, mock_manifest):
         '''
         Tries to upload a bundle: should copy bundle into temp, hash and move
         it in to the data directory.
@@ -25,6 +26,16 @@ class BundleStoreTest(unittest.TestCase):
             self.root = root
             self.data = os.path.join(root, BundleStore.DATA_SUBDIRECTORY)
             self.temp = os.path.join(root, BundleStore.TEMP_SUBDIRECTORY)
+            self.manifests = os.path.join(root, BundleStore.MANIFEST_SUBDIRECTORY)
+            self.hash_cache = mock.Mock()
+            self.sharded = False
+            self.dedup = False
+            self.chunked = False
+            self.merkle = False
+            self.staging = mock.Mock()
+            self.volumes = [mock.Mock(data=self.data, temp=self.temp, staging=self.staging)]
+            self.volume_index = mock.Mock()
+            self.backend = None
 
         bundle_store = MockBundleStore('mock_root')
 
@@ -38,27 +49,24 @@ class BundleStoreTest(unittest.TestCase):
         def exists(path):
             return path in global_paths
         mock_os.path.exists = exists
+        mock_os.path.lexists = exists
+        mock_os.path.dirname = os.path.dirname
 
-        ### tempfile
+        ### StagingArea
 
-        def mkdtemp(suffix):
-            path = os.path.join(bundle_store.temp, 'tmp12345' + suffix)
+        def create(tag, num_bytes=0):
+            path = os.path.join(bundle_store.temp, 'staging-' + tag)
             global_paths.add(path)
             return path
-        mock_tempfile.mkdtemp = mkdtemp
+        bundle_store.staging.create = create
 
         ### path_util
 
         mock_path_util.normalize = lambda x : x
         mock_path_util.recursive_ls = lambda x : []
         mock_path_util.path_is_url = lambda x : False
-
-        def copy(source_path, dest_path, follow_symlinks, exclude_patterns):
-            print 'copy', source_path, dest_path
-            self.assertIn(source_path, global_paths)
-            self.assertNotIn(dest_path, global_paths)
-            global_paths.add(dest_path)
-        mock_path_util.copy = copy
+        mock_path_util.DATA_HASH_PREFIX = path_util.DATA_HASH_PREFIX
+        mock_path_util.get_data_hash_digest = path_util.get_data_hash_digest
 
         def rename(source_path, dest_path):
             print 'rename', source_path, dest_path
@@ -74,10 +82,26 @@ class BundleStoreTest(unittest.TestCase):
             global_paths.remove(path)
         mock_path_util.remove = remove
 
-        def hash_directory(path, dirs_and_files=None):
+        ### Manifest
+
+        def make_manifest():
+            manifest = mock.Mock()
+            manifest.entries = {}
+            manifest.data_hash = lambda merkle=False : '12345'
+            return manifest
+
+        def copy(source_path, dest_path, follow_symlinks, exclude_patterns, hash_cache=None, reserve=None):
+            print 'copy', source_path, dest_path
+            self.assertIn(source_path, global_paths)
+            self.assertNotIn(dest_path, global_paths)
+            global_paths.add(dest_path)
+            return make_manifest()
+        mock_manifest.copy = copy
+
+        def from_path(path, hash_file=None, copies=None):
             self.assertIn(path, global_paths)
-            return '12345'
-        mock_path_util.hash_directory = hash_directory
+            return make_manifest()
+        mock_manifest.from_path = from_path
 
         ### Main: upload!
 
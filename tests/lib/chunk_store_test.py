@@ -0,0 +1,94 @@
+import io
+import mock
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from codalab.lib import path_util
+from codalab.lib.chunk_store import ChunkStore
+
+
+class ChunkStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.chunk_store = ChunkStore(os.path.join(self.temp_directory, 'store'),
+                                  min_chunk_size=256, average_chunk_size=1024, max_chunk_size=4096)
+    rng = random.Random(1)
+    self.data = ''.join(chr(rng.randint(0, 255)) for _ in range(64 * 1024))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def chunk(self, data):
+    return list(self.chunk_store.iter_chunks(io.BytesIO(data)))
+
+  def write_file(self, name, data):
+    path = os.path.join(self.temp_directory, name)
+    with open(path, 'wb') as f:
+      f.write(data)
+    return (path, path_util.hash_file_contents(path))
+
+  def test_chunk_sizes(self):
+    '''
+    Test that chunks cover the data and respect the size limits.
+    '''
+    chunks = self.chunk(self.data)
+    self.assertEqual(''.join(chunks), self.data)
+    self.assertTrue(all(256 < len(chunk) <= 4096 for chunk in chunks[:-1]))
+    self.assertTrue(len(chunks) > 16)
+
+  def test_boundaries(self):
+    '''
+    Test that the boundaries are those of the gear hash computed byte by byte,
+    across windows and with runs of repeated bytes.
+    '''
+    def find_boundary(buf):
+      (start, end, hash_value) = (256, min(len(buf), 4096), 0)
+      for i in range(start, end):
+        hash_value = ((hash_value << 1) + ChunkStore.GEAR[ord(buf[i])]) & 0xffffffff
+        if not hash_value & self.chunk_store.mask:
+          return i + 1
+      return end
+
+    with mock.patch.object(ChunkStore, 'BOUNDARY_WINDOW_SIZE', 100):
+      chunk_store = ChunkStore(self.chunk_store.root, min_chunk_size=256, average_chunk_size=1024, max_chunk_size=4096)
+      for offset in range(0, len(self.data), 997):
+        for buf in (self.data[offset:offset + 5000], '\0' * offset + self.data[offset:offset + 500]):
+          self.assertEqual(chunk_store._find_boundary(buf), find_boundary(buf))
+
+  def test_insertion_changes_few_chunks(self):
+    '''
+    Test that inserting bytes only changes the chunks around the insertion.
+    '''
+    chunks = self.chunk(self.data)
+    mutated = self.chunk(self.data[:30000] + 'inserted' + self.data[30000:])
+    self.assertLessEqual(len(set(mutated) - set(chunks)), 2)
+
+  def test_put_and_read(self):
+    '''
+    Test that stored files are reassembled, share chunks and are collected.
+    '''
+    (path, contents_hash) = self.write_file('a', self.data)
+    self.assertEqual(self.chunk_store.put('0x1', '/a', path, contents_hash), len(self.data))
+    mutated = self.data[:1000] + 'x' + self.data[1001:]
+    (mutated_path, mutated_hash) = self.write_file('b', mutated)
+    self.assertLess(self.chunk_store.put('0x2', '/b', mutated_path, mutated_hash), 4096)
+    self.assertEqual(self.chunk_store.list_files('0x2'), [('/b', mutated_hash, len(mutated))])
+    out = io.BytesIO()
+    self.chunk_store.read(mutated_hash, out)
+    self.assertEqual(out.getvalue(), mutated)
+    with self.chunk_store.open(mutated_hash) as handle:
+      self.assertEqual(handle.read(1000) + handle.read(), mutated)
+    self.assertEqual(self.chunk_store.read_range(mutated_hash, 999, 4096), mutated[999:999 + 4096])
+    self.assertEqual(self.chunk_store.read_range(mutated_hash, len(mutated) - 2, 10), mutated[-2:])
+    self.assertRaises(ValueError, self.chunk_store.put, '0x3', '/a', path, '0' * 40)
+
+    self.chunk_store.remove('0x2')
+    self.chunk_store.COLLECT_MIN_AGE = -60
+    self.assertGreater(self.chunk_store.collect(), 0)
+    out = io.BytesIO()
+    self.chunk_store.read(contents_hash, out)
+    self.assertEqual(out.getvalue(), self.data)
+    self.assertRaises(IOError, self.chunk_store.read, mutated_hash, io.BytesIO())
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from codalab.common import UsageError
+from codalab.lib import path_util
+from codalab.lib.cold_store import ColdStore
+
+
+class ColdStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.cold = ColdStore(os.path.join(self.temp_directory, 'cold'))
+    self.data_hash = '0x' + '12' * 20
+    self.source = os.path.join(self.temp_directory, 'source')
+    os.makedirs(os.path.join(self.source, 'dir', 'subdir'))
+    with open(os.path.join(self.source, 'dir', 'file'), 'w') as f:
+      f.write('line 1\nline 2\n' * 1000)
+    os.chmod(os.path.join(self.source, 'dir', 'file'), 0755)
+    open(os.path.join(self.source, 'empty'), 'w').close()
+    os.symlink('dir', os.path.join(self.source, 'link'))
+    os.symlink('../../outside', os.path.join(self.source, 'dir', 'escape'))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def test_pack_unpack(self):
+    '''
+    Test that unpacking an archive recreates the bundle exactly.
+    '''
+    (num_bytes, num_archive_bytes) = self.cold.pack(self.data_hash, self.source, self.temp_directory)
+    self.assertEqual(num_bytes, len('line 1\nline 2\n') * 1000)
+    self.assertLess(num_archive_bytes, num_bytes)
+    self.assertEqual(self.cold.list_data_hashes(), {self.data_hash: self.cold.get_location(self.data_hash)})
+    dest = os.path.join(self.temp_directory, 'dest')
+    self.cold.unpack(self.data_hash, dest)
+    self.assertEqual(path_util.hash_directory(dest), path_util.hash_directory(self.source))
+    self.assertEqual(os.lstat(os.path.join(dest, 'dir', 'file')).st_mode, os.lstat(os.path.join(self.source, 'dir', 'file')).st_mode)
+    self.assertEqual(os.readlink(os.path.join(dest, 'link')), 'dir')
+
+    # A bundle that is a single file.
+    file_hash = '0x' + '34' * 20
+    self.cold.pack(file_hash, os.path.join(self.source, 'dir', 'file'), self.temp_directory)
+    self.cold.unpack(file_hash, os.path.join(self.temp_directory, 'file'))
+    self.assertEqual(path_util.hash_file_contents(os.path.join(self.temp_directory, 'file')),
+                     path_util.hash_file_contents(os.path.join(self.source, 'dir', 'file')))
+    self.cold.remove(file_hash)
+    self.assertFalse(self.cold.contains(file_hash))
+
+  def test_read(self):
+    '''
+    Test that files and information are read from the archive like from the
+    filesystem, following symlinks within the bundle.
+    '''
+    self.cold.pack(self.data_hash, self.source, self.temp_directory)
+    for subpath in ('dir', 'dir/file', 'dir/subdir', 'empty', 'missing', 'link/file'):
+      info = self.cold.get_info(self.data_hash, os.sep + subpath, 1)
+      expected = path_util.get_info(os.path.join(self.source, subpath), 1)
+      for item in (info, expected):
+        item.get('contents', []).sort(key=lambda child: child['name'])
+      self.assertEqual(info, expected)
+    self.assertEqual(self.cold.get_info(self.data_hash, '', 0)['name'], self.data_hash)
+    self.assertRaises(UsageError, self.cold.get_info, self.data_hash, '/link', 0)
+
+    handle = self.cold.open(self.data_hash, '/link/file')
+    self.assertEqual(path_util.read_file_lines(handle, 2, 100), ['line 1\n', 'line 2\n'])
+    handle.close()
+    self.assertIsNone(self.cold.open(self.data_hash, '/dir'))
+    self.assertIsNone(self.cold.open(self.data_hash, '/dir/escape/x'))
+    self.assertRaises(UsageError, self.cold.open, self.data_hash, '/link')
@@ -0,0 +1,94 @@
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from codalab.lib import path_util
+from codalab.lib.bundle_store import BundleStore
+from codalab.lib.hash_cache import HashCache
+
+
+class HashCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.cache = HashCache(os.path.join(self.temp_directory, 'cache.db'))
+    self.file_path = os.path.join(self.temp_directory, 'file')
+    with open(self.file_path, 'w') as f:
+      f.write('contents')
+    # Make the file old enough to be cached.
+    old_time = time.time() - 10
+    os.utime(self.file_path, (old_time, old_time))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def test_file_entries(self):
+    '''
+    Test that file entries are keyed by inode and invalidated by changes.
+    '''
+    file_stat = os.lstat(self.file_path)
+    self.assertIsNone(self.cache.lookup_file(file_stat))
+    self.cache.add_file(file_stat, 'hash')
+    self.assertEqual(self.cache.lookup_file(file_stat), 'hash')
+    # Entries survive reopening the cache once flushed.
+    self.cache.flush()
+    self.assertEqual(HashCache(self.cache.path).lookup_file(file_stat), 'hash')
+    # Modifying the file invalidates the entry.
+    with open(self.file_path, 'a') as f:
+      f.write('more')
+    self.assertIsNone(self.cache.lookup_file(os.lstat(self.file_path)))
+
+  def test_racy_files_are_not_cached(self):
+    '''
+    Test that files modified within RACY_TIME are not cached.
+    '''
+    os.utime(self.file_path, None)
+    file_stat = os.lstat(self.file_path)
+    self.cache.add_file(file_stat, 'hash')
+    self.assertIsNone(self.cache.lookup_file(file_stat))
+
+  def test_hash_file(self):
+    '''
+    Test that hash_file hashes a file only the first time.
+    '''
+    expected_hash = path_util.hash_file_contents(self.file_path)
+    with mock.patch('codalab.lib.path_util.hash_file_contents', wraps=path_util.hash_file_contents) as hash_file:
+      self.assertEqual(self.cache.hash_file(self.file_path), expected_hash)
+      self.assertEqual(self.cache.hash_file(self.file_path), expected_hash)
+      self.assertEqual(hash_file.call_count, 1)
+
+  def test_evict(self):
+    '''
+    Test that evict removes unused entries.
+    '''
+    file_stat = os.lstat(self.file_path)
+    self.cache.add_file(file_stat, 'hash')
+    self.cache.flush()
+    self.assertEqual(self.cache.evict(time.time() - 60), 0)
+    self.assertEqual(self.cache.lookup_file(file_stat), 'hash')
+    self.assertEqual(self.cache.evict(time.time() + 60), 1)
+    self.assertIsNone(self.cache.lookup_file(file_stat))
+
+  def test_bundle_store_upload(self):
+    '''
+    Test that uploading a local directory hashes it while copying and caches
+    the hashes of its files, so that uploading it again doesn't hash them.
+    '''
+    source = os.path.join(self.temp_directory, 'source')
+    os.mkdir(source)
+    shutil.move(self.file_path, os.path.join(source, 'file'))
+    home = os.path.join(self.temp_directory, 'home')
+    os.mkdir(home)
+    bundle_store = BundleStore(home)
+    with mock.patch('codalab.lib.path_util.hash_file_contents', wraps=path_util.hash_file_contents) as hash_file:
+      (data_hash, _) = bundle_store.upload(sources=[source], follow_symlinks=False, exclude_patterns=None,
+                                           git=False, unpack=False, remove_sources=False)
+      self.assertEqual(hash_file.call_count, 0)
+    self.assertEqual(data_hash, '0x' + path_util.hash_directory(bundle_store.get_location(data_hash)))
+    self.assertIsNotNone(bundle_store.hash_cache.lookup_file(os.lstat(os.path.join(source, 'file'))))
+    with mock.patch('codalab.lib.path_util.hash_and_copy') as hash_and_copy:
+      self.assertEqual(bundle_store.upload(sources=[source], follow_symlinks=False, exclude_patterns=None,
+                                           git=False, unpack=False, remove_sources=False)[0], data_hash)
+      self.assertEqual(hash_and_copy.call_count, 0)
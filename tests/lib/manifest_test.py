@@ -0,0 +1,127 @@
+import mock
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+from codalab.lib import path_util, zip_util
+from codalab.lib.manifest import Manifest
+
+
+class ManifestTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.source = os.path.join(self.temp_directory, 'source')
+    os.makedirs(os.path.join(self.source, 'dir', 'subdir'))
+    for (name, contents) in [('file', 'contents'), ('dir/file', 'more contents'), ('dir/subdir/empty', ''), ('skip.pyc', 'x')]:
+      with open(os.path.join(self.source, name), 'w') as f:
+        f.write(contents)
+    os.chmod(os.path.join(self.source, 'file'), 0755)
+    os.symlink('file', os.path.join(self.source, 'link'))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def check_manifest(self, manifest, path):
+    self.assertEqual(manifest.data_hash(), path_util.hash_directory(path))
+    self.assertEqual(manifest.data_size(), path_util.get_size(path))
+    self.assertEqual(manifest.data_hash(), Manifest.from_path(path).data_hash())
+
+  def test_copy(self):
+    '''
+    Test that Manifest.copy copies the tree and hashes it on the way.
+    '''
+    dest = os.path.join(self.temp_directory, 'dest')
+    manifest = Manifest.copy(self.source, dest, False, ['*.pyc'])
+    self.check_manifest(manifest, dest)
+    self.assertFalse(os.path.exists(os.path.join(dest, 'skip.pyc')))
+    self.assertTrue(os.path.islink(os.path.join(dest, 'link')))
+    self.assertEqual(os.stat(os.path.join(dest, 'file')).st_mode & 0777, 0755)
+    self.assertEqual(manifest.entries['/dir/file'].type, Manifest.FILE)
+
+  def test_copy_file(self):
+    '''
+    Test that Manifest.copy works on a single file.
+    '''
+    dest = os.path.join(self.temp_directory, 'dest')
+    manifest = Manifest.copy(os.path.join(self.source, 'file'), dest, False, None)
+    self.assertEqual(manifest.data_hash(), Manifest.from_path(dest).data_hash())
+    self.assertEqual(manifest.data_size(), len('contents'))
+
+  def test_unpack(self):
+    '''
+    Test that zip_util.unpack returns the Manifest of what it unpacked.
+    '''
+    archive = os.path.join(self.temp_directory, 'source.tar.gz')
+    with tarfile.open(archive, 'w:gz') as tar:
+      tar.add(self.source, arcname='source')
+    dest = os.path.join(self.temp_directory, 'dest')
+    self.check_manifest(zip_util.unpack(archive, dest), dest)
+
+    archive = os.path.join(self.temp_directory, 'source.zip')
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+      zip_file.write(os.path.join(self.source, 'file'), 'file')
+      zip_file.write(os.path.join(self.source, 'dir', 'file'), 'dir/file')
+    dest = os.path.join(self.temp_directory, 'dest-zip')
+    self.check_manifest(zip_util.unpack(archive, dest), dest)
+
+  def test_save_and_get_info(self):
+    '''
+    Test that a saved Manifest describes the bundle like path_util.get_info does.
+    '''
+    manifest = Manifest.from_path(self.source)
+    manifest_path = os.path.join(self.temp_directory, 'manifest.json')
+    manifest.save(manifest_path)
+    loaded = Manifest.load(manifest_path)
+    self.assertEqual(loaded.entries, manifest.entries)
+    self.assertEqual(loaded.data_hash(), manifest.data_hash())
+    self.assertEqual(loaded.chunked, set())
+    manifest.chunked = set(['/a.txt'])
+    manifest.save(manifest_path)
+    self.assertEqual(Manifest.load(manifest_path).chunked, set(['/a.txt']))
+
+    def normalize(info):
+      if 'contents' in info:
+        info['contents'] = sorted((normalize(item) for item in info['contents']), key=lambda item: item['name'])
+      return info
+    for (relative_path, depth) in [('', 0), ('', 1), ('', 2), ('/dir', 1), ('/file', 0)]:
+      path = self.source + relative_path
+      self.assertEqual(normalize(loaded.get_info(path, relative_path, depth)),
+                       normalize(path_util.get_info(path, depth)))
+    self.assertIsNone(loaded.get_info(self.source + '/link', '/link', 0))
+    self.assertIsNone(loaded.get_info(self.source + '/missing', '/missing', 0))
+
+  def test_merkle(self):
+    '''
+    Test that the hash of every subtree in the Merkle format only depends on
+    that subtree, and that copies take their hashes from their Manifest.
+    '''
+    manifest = Manifest.from_path(self.source)
+    hashes = manifest.merkle_hashes()
+    self.assertEqual(hashes[''], path_util.hash_directory(self.source, merkle=True))
+    self.assertEqual(hashes[''], manifest.data_hash(merkle=True))
+    self.assertNotEqual(hashes[''], manifest.data_hash())
+    self.assertEqual(hashes['/dir'], path_util.hash_directory(os.path.join(self.source, 'dir'), merkle=True))
+    self.assertEqual(hashes['/file'], path_util.hash_file_contents(os.path.join(self.source, 'file')))
+    self.assertEqual(manifest.subtree('/dir').data_hash(merkle=True), hashes['/dir'])
+
+    # Changing a file changes the hashes on its path only.
+    with open(os.path.join(self.source, 'dir', 'subdir', 'empty'), 'w') as f:
+      f.write('x')
+    changed = Manifest.from_path(self.source).merkle_hashes()
+    self.assertEqual([path for path in sorted(hashes) if hashes[path] != changed[path]],
+                     ['', '/dir', '/dir/subdir', '/dir/subdir/empty'])
+
+    dest = os.path.join(self.temp_directory, 'dest')
+    os.mkdir(dest)
+    shutil.copytree(os.path.join(self.source, 'dir'), os.path.join(dest, 'dep'))
+    with open(os.path.join(dest, 'dep', 'file'), 'w') as f:
+      f.write('modified')
+    known = Manifest.from_path(os.path.join(self.source, 'dir'))
+    hash_file = mock.Mock(side_effect=path_util.hash_file_contents)
+    copied = Manifest.from_path(dest, hash_file=hash_file, copies=[(os.path.join(dest, 'dep'), known)])
+    # Only the file whose size differs is hashed.
+    hash_file.assert_called_once_with(os.path.join(dest, 'dep', 'file'))
+    self.assertEqual(copied.merkle_hashes()['/dep/subdir'], changed['/dir/subdir'])
@@ -1,4 +1,7 @@
+import ctypes
+import errno
 import hashlib
+import mock
 import os
 import shutil
 import stat
@@ -59,6 +62,40 @@ class PathUtilFSTest(unittest.TestCase):
     self.assertEqual(set(directories), set(self.bundle_directories))
     self.assertEqual(set(files), set(self.bundle_files))
 
+  def test_scan_tree(self):
+    '''
+    Test that scan_tree lists the same paths as recursive_ls along with their
+    lstat results, and does not descend into symlinked directories.
+    '''
+    link_path = os.path.join(self.bundle_path, 'blah', 'link')
+    os.symlink(os.path.join(self.bundle_path, 'asdf'), link_path)
+    (directories, files, stats) = path_util.scan_tree(self.bundle_path)
+    self.assertEqual(set(directories), set(self.bundle_directories))
+    self.assertEqual(set(files), set(self.bundle_files + [link_path]))
+    self.assertEqual(set(stats), set(directories + files))
+    self.assertTrue(stat.S_ISLNK(stats[link_path].st_mode))
+    self.assertEqual(stats[self.bundle_files[0]].st_size, len(self.contents))
+    self.assertEqual(path_util.get_size(self.bundle_path), sum(s.st_size for s in stats.itervalues()))
+
+  def test_get_info(self):
+    '''
+    Test that get_info describes files, directories and symlinks.
+    '''
+    link_path = os.path.join(self.bundle_path, 'link')
+    os.symlink('foo', link_path)
+    os.symlink('missing', os.path.join(self.bundle_path, 'broken'))
+    info = path_util.get_info(self.bundle_path, 1)
+    self.assertEqual(info['type'], 'directory')
+    contents = dict((item['name'], item) for item in info['contents'])
+    self.assertEqual(set(contents), set(['asdf', 'blah', 'foo', 'link', 'broken']))
+    self.assertEqual(contents['foo']['type'], 'file')
+    self.assertEqual(contents['foo']['size'], len(self.contents))
+    self.assertEqual(contents['link']['type'], 'file')
+    self.assertEqual(contents['link']['link'], 'foo')
+    self.assertEqual(contents['link']['perm'], contents['foo']['perm'])
+    self.assertEqual(contents['broken'], {'name': 'broken', 'link': 'missing'})
+    self.assertNotIn('contents', contents['asdf'])
+
   def test_hash_file_contests(self):
     '''
     Test that hash_file_contents reads a file and hashes its contents.
@@ -77,3 +114,138 @@ class PathUtilFSTest(unittest.TestCase):
     os.symlink(link_target, symlink_path)
     link_hash = path_util.hash_file_contents(symlink_path)
     self.assertEqual(link_hash, expected_hash)
+
+  def test_hash_directory_parallel(self):
+    '''
+    Test that hashing files concurrently does not change the directory hash.
+    '''
+    for i in range(20):
+      with open(os.path.join(self.bundle_path, 'blah', 'file%d' % (i,)), 'w') as fd:
+        fd.write(self.contents * i)
+    serial_hash = path_util.hash_directory(self.bundle_path, num_threads=1)
+    for num_threads in (2, 4, 64):
+      self.assertEqual(path_util.hash_directory(self.bundle_path, num_threads=num_threads), serial_hash)
+
+  def make_read_only(self):
+    for path in self.bundle_files + self.bundle_directories[::-1]:
+      os.chmod(path, 0500 if os.path.isdir(path) else 0400)
+
+  def test_remove_read_only(self):
+    '''
+    Test that remove deletes trees with read-only directories.
+    '''
+    self.make_read_only()
+    path_util.remove(self.bundle_path)
+    self.assertFalse(os.path.exists(self.bundle_path))
+
+  def test_rename(self):
+    '''
+    Test that rename moves read-only trees, also across filesystems.
+    '''
+    os.symlink('foo', os.path.join(self.bundle_path, 'link'))
+    self.make_read_only()
+    expected_hash = path_util.hash_directory(self.bundle_path)
+    new_path = os.path.join(self.temp_directory, 'sub', 'renamed')
+    os.mkdir(os.path.dirname(new_path))
+    path_util.rename(self.bundle_path, new_path)
+    self.assertFalse(os.path.exists(self.bundle_path))
+    self.assertEqual(path_util.hash_directory(new_path), expected_hash)
+
+    real_rename = os.rename
+    def cross_device_rename(old_path, new_path):
+      if old_path.startswith(self.temp_directory):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+      real_rename(old_path, new_path)
+    with mock.patch('os.rename', cross_device_rename):
+      path_util.rename(new_path, self.bundle_path)
+    self.assertFalse(os.path.exists(new_path))
+    self.assertEqual(path_util.hash_directory(self.bundle_path), expected_hash)
+    self.assertEqual(os.lstat(os.path.join(self.bundle_path, 'foo')).st_mode & 0777, 0400)
+    path_util.remove(self.bundle_path)
+
+  def test_copy(self):
+    '''
+    Test that copy preserves permissions and symlinks, skips excluded entries
+    and follows symlinks only when asked to.
+    '''
+    os.symlink('foo', os.path.join(self.bundle_path, 'link'))
+    with open(os.path.join(self.bundle_path, 'blah', 'excluded.pyc'), 'w') as fd:
+      fd.write(self.contents)
+    os.chmod(os.path.join(self.bundle_path, 'foo'), 0751)
+    self.make_read_only()
+    copy_path = os.path.join(self.temp_directory, 'copy')
+    path_util.copy(self.bundle_path, copy_path, exclude_patterns=['*.pyc'])
+    self.assertFalse(os.path.exists(os.path.join(copy_path, 'blah', 'excluded.pyc')))
+    self.assertEqual(os.readlink(os.path.join(copy_path, 'link')), 'foo')
+    for path in self.bundle_files + self.bundle_directories:
+      copied_path = os.path.join(copy_path, os.path.relpath(path, self.bundle_path))
+      self.assertEqual(os.lstat(copied_path).st_mode, os.lstat(path).st_mode)
+    self.assertRaises(Exception, path_util.copy, self.bundle_path, copy_path)
+
+    followed_path = os.path.join(self.temp_directory, 'followed')
+    path_util.copy(self.bundle_path, followed_path, follow_symlinks=True)
+    self.assertFalse(os.path.islink(os.path.join(followed_path, 'link')))
+    self.assertEqual(path_util.hash_file_contents(os.path.join(followed_path, 'link')),
+                     path_util.hash_file_contents(os.path.join(followed_path, 'foo')))
+    path_util.remove(copy_path)
+    path_util.remove(followed_path)
+
+  def test_copy_file_contents_fallbacks(self):
+    '''
+    Test that file contents are copied the same way by every copy method.
+    '''
+    source_path = os.path.join(self.temp_directory, 'large')
+    with open(source_path, 'wb') as fd:
+      fd.write(os.urandom(3 * 1024 * 1024 + 17))
+    expected_hash = path_util.hash_file_contents(source_path)
+    methods = [
+      {'_copy_file_range': path_util._copy_file_range},
+      {'_copy_file_range': None},
+      {'_copy_file_range': None, '_sendfile': None},
+    ]
+    for (i, method) in enumerate(methods):
+      dest_path = os.path.join(self.temp_directory, 'copy%d' % (i,))
+      with mock.patch.multiple(path_util, **method):
+        path_util.copy(source_path, dest_path)
+      self.assertEqual(path_util.hash_file_contents(dest_path), expected_hash)
+    # A kernel copy that is unsupported for these files falls back to the next method.
+    def unsupported_copy_file_range(*args):
+      ctypes.set_errno(errno.EXDEV)
+      return -1
+    dest_path = os.path.join(self.temp_directory, 'copy-exdev')
+    with mock.patch.object(path_util, '_copy_file_range', unsupported_copy_file_range):
+      path_util.copy(source_path, dest_path)
+    self.assertEqual(path_util.hash_file_contents(dest_path), expected_hash)
+
+  def test_link_tree(self):
+    '''
+    Test that link_tree hardlinks only files the current user cannot modify,
+    copies (or reflinks) the rest, and makes directories read-only.
+    '''
+    os.symlink('foo', os.path.join(self.bundle_path, 'link'))
+    # Only the owner can write to read_only_file, while anyone can write to the others.
+    read_only_file = self.bundle_files[1]
+    for path in self.bundle_files:
+      os.chmod(path, 0644 if path == read_only_file else 0666)
+    expected_hash = path_util.hash_directory(self.bundle_path)
+    owner = os.lstat(read_only_file).st_uid
+
+    link_path = os.path.join(self.temp_directory, 'linked')
+    with mock.patch('os.geteuid', return_value=owner + 1):
+      methods = path_util.link_tree(self.bundle_path, link_path)
+    self.assertEqual(methods['hardlink'], 1)
+    self.assertEqual(methods['reflink'] + methods['copy'], len(self.bundle_files) - 1)
+    self.assertEqual(path_util.hash_directory(link_path), expected_hash)
+    linked_file = os.path.join(link_path, os.path.relpath(read_only_file, self.bundle_path))
+    self.assertEqual(os.lstat(linked_file).st_ino, os.lstat(read_only_file).st_ino)
+    for directory in self.bundle_directories:
+      linked_directory = os.path.join(link_path, os.path.relpath(directory, self.bundle_path))
+      self.assertEqual(os.lstat(linked_directory).st_mode & 0222, 0)
+    path_util.remove(link_path)
+    self.assertTrue(os.path.exists(read_only_file))
+
+    # The owner of a file could make it writable, so it is never hardlinked.
+    with mock.patch('os.geteuid', return_value=owner):
+      methods = path_util.link_tree(self.bundle_path, link_path)
+    self.assertEqual(methods['hardlink'], 0)
+    self.assertNotEqual(os.lstat(linked_file).st_ino, os.lstat(read_only_file).st_ino)
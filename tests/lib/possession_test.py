@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from codalab.lib import possession
+from codalab.lib.manifest import Manifest
+
+
+class PossessionTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def make_source(self, name, contents):
+    source = os.path.join(self.temp_directory, name)
+    os.makedirs(os.path.join(source, 'dir'))
+    with open(os.path.join(source, 'dir', 'large'), 'wb') as f:
+      f.write(contents)
+    with open(os.path.join(source, 'small'), 'wb') as f:
+      f.write('small')
+    open(os.path.join(source, 'empty'), 'w').close()
+    return source
+
+  def answer(self, challenge, source):
+    return possession.answer_challenge(
+      challenge, Manifest.from_path(source),
+      lambda relative_path, offset, length: possession.read_file_range(source + relative_path, offset, length))
+
+  def test_challenge(self):
+    '''
+    Test that a challenge samples the nonempty files without naming them and
+    can only be answered with the data.
+    '''
+    contents = os.urandom(3 * possession.SAMPLE_SIZE)
+    source = self.make_source('source', contents)
+    challenge = possession.make_challenge(Manifest.from_path(source))
+    self.assertEqual(len(challenge['samples']), possession.get_num_samples(2, len(contents) + 5))
+    for (offset, length) in challenge['samples']:
+      self.assertEqual(length, possession.SAMPLE_SIZE)
+      self.assertLessEqual(offset + length, len(contents) + 5)
+    self.assertEqual(self.answer(challenge, source), self.answer(challenge, self.make_source('copy', contents)))
+    self.assertNotEqual(self.answer(challenge, source), self.answer(challenge, self.make_source('other', os.urandom(len(contents)))))
+    self.assertNotEqual(possession.make_challenge(Manifest.from_path(source))['nonce'], challenge['nonce'])
+
+    # A range that spans files reads the end of one and the start of the next.
+    ranges = []
+    possession.answer_challenge(
+      {'nonce': '', 'samples': [[len(contents) - 2, 4]]}, Manifest.from_path(source),
+      lambda relative_path, offset, length: ranges.append((relative_path, offset, length)) or '')
+    self.assertEqual(ranges, [('/dir/large', len(contents) - 2, 2), ('/small', 0, 2)])
+
+    # Without any data, there is nothing to prove.
+    self.assertIsNone(possession.make_challenge(Manifest.from_path(os.path.join(source, 'empty'))))
+
+  def test_num_samples(self):
+    '''
+    Test that more files and bytes get more samples, up to MAX_SAMPLES.
+    '''
+    self.assertEqual(possession.get_num_samples(1, 1), possession.MIN_SAMPLES)
+    self.assertGreater(possession.get_num_samples(100, 1), possession.MIN_SAMPLES)
+    self.assertGreater(possession.get_num_samples(1, 100 * possession.SAMPLE_SIZE), possession.MIN_SAMPLES)
+    self.assertEqual(possession.get_num_samples(10 ** 9, 10 ** 15), possession.MAX_SAMPLES)
@@ -0,0 +1,72 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from codalab.lib.bundle_store import BundleStore
+from codalab.lib.scrubber import IOBudget, Scrubber
+
+
+class ScrubberTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.bundle_store = BundleStore(os.path.join(self.temp_directory, 'home'))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def upload(self, name, contents):
+    source = os.path.join(self.temp_directory, name)
+    os.mkdir(source)
+    with open(os.path.join(source, 'file'), 'w') as f:
+      f.write(contents)
+    (data_hash, _) = self.bundle_store.upload(sources=[source], follow_symlinks=False, exclude_patterns=None,
+                                              git=False, unpack=False, remove_sources=True)
+    return data_hash
+
+  def test_budget(self):
+    '''
+    Test that the budget sleeps once the I/O goes over either rate.
+    '''
+    with mock.patch('time.time', return_value=100.0), mock.patch('time.sleep') as sleep:
+      budget = IOBudget(bytes_per_second=1000, ops_per_second=10)
+      budget.consume(500, 1)
+      self.assertFalse(sleep.called)
+      budget.consume(1500, 1)
+      self.assertAlmostEqual(sleep.call_args[0][0], 1.0)
+      budget.consume(0, 20)
+      self.assertAlmostEqual(sleep.call_args[0][0], 1.2)
+    self.assertEqual((budget.num_bytes, budget.num_ops), (2000, 22))
+    self.assertAlmostEqual(budget.sleep_time, 2.2)
+
+  def test_run(self):
+    '''
+    Test that scrubbing reports corrupted bundles and resumes where it stopped.
+    '''
+    contents = dict((self.upload(name, name * 100), name * 100) for name in ('a', 'b', 'c'))
+    hashes = sorted(contents)
+    with open(os.path.join(self.bundle_store.get_location(hashes[1]), 'file'), 'w') as f:
+      f.write('corrupted')
+    scrubber = Scrubber(self.bundle_store, bytes_per_second=10 ** 9, ops_per_second=10 ** 6)
+    report = mock.Mock()
+    metrics = scrubber.run(max_bundles=1, report=report)
+    self.assertEqual((metrics['num_bundles'], metrics['num_files'], metrics['num_bytes']), (1, 1, 100))
+    self.assertEqual(scrubber.load_state()['cursor'], hashes[0])
+    self.assertFalse(report.called)
+
+    # A new scrubber resumes, and the pass completes.
+    scrubber = Scrubber(self.bundle_store)
+    metrics = scrubber.run(report=report)
+    self.assertEqual((metrics['num_bundles'], metrics['num_mismatches']), (2, 1))
+    self.assertEqual(report.call_args[0][:2], (hashes[1], self.bundle_store.get_location(hashes[1])))
+    state = scrubber.load_state()
+    self.assertIsNone(state['cursor'])
+    self.assertEqual(state['mismatches'].keys(), [hashes[1]])
+    self.assertEqual(state['last_run']['num_bundles'], 2)
+
+    # Bundles that check out again are no longer reported.
+    with open(os.path.join(self.bundle_store.get_location(hashes[1]), 'file'), 'w') as f:
+      f.write(contents[hashes[1]])
+    self.assertEqual(scrubber.run()['num_bundles'], 3)
+    self.assertEqual(scrubber.load_state()['mismatches'], {})
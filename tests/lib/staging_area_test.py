@@ -0,0 +1,113 @@
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from codalab.common import UsageError
+from codalab.lib.bundle_store import BundleStore
+from codalab.lib.staging_area import StagingArea
+
+
+class StagingAreaTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.staging = StagingArea(os.path.join(self.temp_directory, 'temp'))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def test_reservations(self):
+    '''
+    Test that creating a staging directory fails without enough free space,
+    counting the space reserved by other staging directories.
+    '''
+    with mock.patch.object(self.staging, 'get_free_space', return_value=1000):
+      path = self.staging.create('first', 600)
+      self.assertTrue(os.path.isdir(path))
+      self.assertRaises(UsageError, self.staging.create, 'second', 600)
+      self.staging.release(path)
+      self.staging.discard(self.staging.create('second', 600))
+    self.assertTrue(os.path.isdir(path))
+    self.staging.discard(path)
+    self.assertFalse(os.path.exists(path))
+
+    # Reservations can grow once the size of what is staged is known.
+    with mock.patch.object(self.staging, 'get_free_space', return_value=1000):
+      path = self.staging.create('first', 300)
+      self.staging.reserve(path, 300)
+      self.assertRaises(UsageError, self.staging.reserve, path, 600)
+      self.assertEqual(self.staging.reservations[path], 600)
+      self.staging.discard(path)
+
+  def test_reclaim(self):
+    '''
+    Test that reclaim removes the staging directories of dead processes and old
+    ones, but not those in use or other files.
+    '''
+    live_path = self.staging.create('live')
+    with mock.patch('os.getpid', return_value=2**22 + 1):
+      dead_path = self.staging.create('dead')
+    with mock.patch.object(self.staging, 'hostname', 'other'):
+      other_host_path = self.staging.create('other')
+      old_path = self.staging.create('old')
+    self.staging.release(dead_path)
+    self.staging.release(other_host_path)
+    self.staging.release(old_path)
+    old_time = time.time() - StagingArea.ABANDONED_TIME - 10
+    os.utime(old_path, (old_time, old_time))
+    other_path = os.path.join(self.staging.root, 'dedup-1234')
+    os.mkdir(other_path)
+
+    self.assertEqual(sorted(self.staging.reclaim(dry_run=True)), sorted([dead_path, old_path]))
+    self.assertTrue(os.path.exists(dead_path))
+    self.assertEqual(sorted(self.staging.reclaim()), sorted([dead_path, old_path]))
+    for path in (live_path, other_host_path, other_path):
+      self.assertTrue(os.path.exists(path))
+    for path in (dead_path, old_path):
+      self.assertFalse(os.path.exists(path))
+
+  def test_bundle_store_upload(self):
+    '''
+    Test that BundleStore.upload stages in its temp directory and leaves nothing
+    behind, also when the upload fails.
+    '''
+    home = os.path.join(self.temp_directory, 'home')
+    os.mkdir(home)
+    bundle_store = BundleStore(home)
+    source = os.path.join(self.temp_directory, 'source')
+    with open(source, 'w') as f:
+      f.write('contents')
+    with mock.patch('codalab.lib.bundle_store.path_util.rename', wraps=os.rename) as rename:
+      bundle_store.upload(sources=[source], follow_symlinks=False, exclude_patterns=None,
+                          git=False, unpack=False, remove_sources=False)
+      (staged_path, final_path) = rename.call_args[0]
+    self.assertEqual(os.path.dirname(os.path.dirname(staged_path)), bundle_store.temp)
+    self.assertEqual(os.listdir(bundle_store.temp), [])
+    self.assertEqual(bundle_store.staging.reservations, {})
+
+    # Directories are not walked for their size before they are copied.
+    directory = os.path.join(self.temp_directory, 'directory')
+    os.mkdir(directory)
+    shutil.copy(source, directory)
+    with mock.patch('codalab.lib.bundle_store.path_util.get_size') as get_size, \
+         mock.patch.object(bundle_store.staging, 'reserve', wraps=bundle_store.staging.reserve) as reserve:
+      bundle_store.upload(sources=[directory], follow_symlinks=False, exclude_patterns=None,
+                          git=False, unpack=False, remove_sources=False)
+      self.assertEqual(get_size.call_count, 0)
+      self.assertEqual(reserve.call_args[0][1], len('contents'))
+    self.assertEqual(bundle_store.staging.reservations, {})
+
+    with mock.patch('codalab.lib.bundle_store.Manifest.copy', side_effect=IOError('failed')):
+      self.assertRaises(IOError, bundle_store.upload, sources=[source], follow_symlinks=False,
+                        exclude_patterns=None, git=False, unpack=False, remove_sources=False)
+    self.assertEqual(os.listdir(bundle_store.temp), [])
+    self.assertEqual(bundle_store.staging.reservations, {})
+
+    # A missing source is reported as such, before anything is staged.
+    missing = os.path.join(self.temp_directory, 'missing')
+    self.assertRaises(UsageError, bundle_store.upload, sources=[source, missing], follow_symlinks=False,
+                      exclude_patterns=None, git=False, unpack=False, remove_sources=False)
+    self.assertEqual(os.listdir(bundle_store.temp), [])
+    self.assertEqual(bundle_store.staging.reservations, {})
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from codalab.common import UsageError
+from codalab.lib.storage_backend import create_backend, FilesystemBackend, ObjectStoreBackend
+
+
+class StorageBackendTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def check_backend(self, backend):
+    long_key = 'data/' + '/'.join(['x' * 100] * 5)
+    for (key, contents) in (('data/0x1/a', 'a' * 100), ('data/0x1/b/c', ''), ('data/0x12', 'file'),
+                            ('manifests/0x1.json', '{}'), (long_key, 'long')):
+      backend.put(key, StringIO(contents))
+    self.assertEqual(backend.get_range('data/0x1/a'), 'a' * 100)
+    self.assertEqual(backend.get_range('data/0x1/a', 90), 'a' * 10)
+    self.assertEqual(backend.get_range('data/0x1/a', 10, 5), 'a' * 5)
+    self.assertEqual(backend.get_range('data/0x1/b/c'), '')
+    self.assertEqual(backend.get_range(long_key), 'long')
+    self.assertRaises(KeyError, backend.get_range, 'data/0x1/missing')
+    self.assertRaises(KeyError, backend.get_range, 'data/0x1/b')
+
+    # get reads in blocks.
+    backend.GET_BLOCK_SIZE = 7
+    dest = StringIO()
+    backend.get('data/0x1/a', dest)
+    self.assertEqual(dest.getvalue(), 'a' * 100)
+    self.assertRaises(KeyError, backend.get, 'data/0x1/missing', StringIO())
+    with backend.open('data/0x1/a') as handle:
+      self.assertEqual(handle.read(10), 'a' * 10)
+      self.assertEqual(handle.read(), 'a' * 90)
+      self.assertEqual(handle.read(), '')
+
+    self.assertEqual(backend.list('data/0x1/'), ['data/0x1/a', 'data/0x1/b/c'])
+    self.assertEqual(backend.list('data/0x1'), ['data/0x1/a', 'data/0x1/b/c', 'data/0x12'])
+    self.assertEqual(backend.list('manifests/'), ['manifests/0x1.json'])
+    self.assertEqual(len(backend.list()), 5)
+    self.assertEqual(backend.stat('data/0x1/a').size, 100)
+    self.assertIsNone(backend.stat('data/0x1/b'))
+    self.assertIsNone(backend.stat('data/0x1/missing'))
+
+    # Objects are replaced whole.
+    backend.put('data/0x12', StringIO('new'))
+    self.assertEqual(backend.get_range('data/0x12'), 'new')
+
+    for key in backend.list():
+      backend.delete(key)
+    backend.delete('data/0x1/a')
+    self.assertEqual(backend.list(), [])
+
+  def test_filesystem(self):
+    backend = FilesystemBackend(os.path.join(self.temp_directory, 'store'))
+    self.check_backend(backend)
+    self.assertEqual(os.listdir(backend.root), [])
+    self.assertRaises(UsageError, backend.put, 'data/../x', StringIO(''))
+
+  def test_object_store(self):
+    self.check_backend(ObjectStoreBackend(os.path.join(self.temp_directory, 'store')))
+
+  def test_create_backend(self):
+    self.assertIsNone(create_backend(None))
+    backend = create_backend({'type': 'object_store', 'root': os.path.join(self.temp_directory, 'store'), 'latency': 0.01})
+    self.assertIsInstance(backend, ObjectStoreBackend)
+    self.assertEqual(backend.latency, 0.01)
+    self.assertRaises(UsageError, create_backend, {'type': 'tape', 'root': self.temp_directory})
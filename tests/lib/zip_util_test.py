@@ -0,0 +1,99 @@
+import gzip
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+
+from codalab.lib import path_util, zip_util
+
+
+class ZipUtilTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.source = os.path.join(self.temp_directory, 'source')
+    os.makedirs(os.path.join(self.source, 'dir'))
+    with open(os.path.join(self.source, 'dir', 'text'), 'w') as f:
+      f.write('line\n' * 100000)
+    with open(os.path.join(self.source, 'random'), 'wb') as f:
+      f.write(os.urandom(50000))
+    os.symlink('dir/text', os.path.join(self.source, 'link'))
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def test_codecs(self):
+    '''
+    Test that archives packed with each codec unpack to the same contents, from
+    a file or a stream.
+    '''
+    expected_hash = path_util.hash_directory(self.source)
+    with mock.patch.multiple(zip_util, PARALLEL_GZIP_NUM_THREADS=4, PARALLEL_GZIP_BLOCK_SIZE=16 * 1024):
+      for codec in zip_util.CODECS:
+        for level in (None, 1):
+          archive = os.path.join(self.temp_directory, zip_util.add_packed_suffix('archive', codec))
+          zip_util.pack(self.source, archive, codec=codec, level=level)
+          dest = os.path.join(self.temp_directory, 'dest')
+          zip_util.unpack(archive, dest)
+          self.assertEqual(path_util.hash_directory(dest), expected_hash)
+          path_util.remove(dest)
+          zip_util.unpack(zip_util.open_packed_path(self.source, False, None, codec, level), dest)
+          self.assertEqual(path_util.hash_directory(dest), expected_hash)
+          path_util.remove(dest)
+          if codec != zip_util.NO_COMPRESSION:
+            # Any gzip reader can read it.
+            with gzip.open(archive) as f:
+              self.assertGreater(len(f.read()), 550000)
+            self.assertLess(os.path.getsize(archive), 100000)
+          os.remove(archive)
+    self.assertRaises(Exception, zip_util.pack, os.path.join(self.temp_directory, 'missing'),
+                      os.path.join(self.temp_directory, 'archive.tar.gz'))
+
+  def test_choose_codec(self):
+    '''
+    Test that data that is mostly compressed already is not compressed again.
+    '''
+    self.assertNotEqual(zip_util.choose_codec(self.source), zip_util.NO_COMPRESSION)
+    os.rename(os.path.join(self.source, 'dir', 'text'), os.path.join(self.source, 'dir', 'text.gz'))
+    self.assertEqual(zip_util.choose_codec(self.source), zip_util.NO_COMPRESSION)
+    self.assertNotEqual(zip_util.choose_codec(os.path.join(self.source, 'random')), zip_util.NO_COMPRESSION)
+
+  def test_packed_names(self):
+    '''
+    Test that a user's uncompressed tar archive is not an archive, but is
+    packed under a name that strips back to its own.
+    '''
+    self.assertFalse(zip_util.path_is_archive('data.tar'))
+    self.assertEqual(zip_util.add_packed_suffix('data.tar.gz', zip_util.NO_COMPRESSION), 'data.tar.gz')
+    for codec in zip_util.CODECS:
+      name = zip_util.add_packed_suffix('data.tar', codec)
+      self.assertTrue(zip_util.path_is_packed(name))
+      self.assertEqual(zip_util.strip_packed_ext(name), 'data.tar')
+    self.assertEqual(zip_util.strip_packed_ext(zip_util.add_packed_suffix('data', zip_util.NO_COMPRESSION)), 'data')
+
+  def test_mtimes(self):
+    '''
+    Test that unpacking restores the mtimes of files and directories.
+    '''
+    mtime = 978307200  # 2001-01-01
+    for path in (os.path.join(self.source, 'dir', 'text'), os.path.join(self.source, 'dir'), self.source):
+      os.utime(path, (mtime, mtime))
+    archive = os.path.join(self.temp_directory, 'archive.tar.gz')
+    zip_util.pack(self.source, archive)
+    dest = os.path.join(self.temp_directory, 'dest')
+    zip_util.unpack(archive, dest)
+    self.assertEqual(os.path.getmtime(os.path.join(dest, 'dir', 'text')), mtime)
+    self.assertEqual(os.path.getmtime(os.path.join(dest, 'dir')), mtime)
+    path_util.remove(dest)
+
+    archive = os.path.join(self.temp_directory, 'archive.zip')
+    date_time = (2001, 1, 1, 12, 0, 0)
+    with zipfile.ZipFile(archive, 'w') as f:
+      f.writestr(zipfile.ZipInfo('dir/', date_time), '')
+      f.writestr(zipfile.ZipInfo('dir/file', date_time), 'contents')
+    zip_util.unpack(archive, dest)
+    expected_mtime = time.mktime(date_time + (0, 0, -1))
+    self.assertEqual(os.path.getmtime(os.path.join(dest, 'file')), expected_mtime)
+    self.assertEqual(os.path.getmtime(dest), expected_mtime)
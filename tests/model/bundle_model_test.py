@@ -81,6 +81,10 @@ class MockBundle(object):
   def validate(self):
     self._validate_called = True
 
+  def update_in_memory(self, update):
+    for (field, value) in update.iteritems():
+      setattr(self, field, value)
+
   def to_dict(self):
     result = dict(self._fields)
     result['metadata'] = metadata_to_dicts(result['uuid'], result['metadata'])
@@ -116,3 +120,38 @@ class BundleModelTest(unittest.TestCase):
       retrieved_bundle = self.model.get_bundle(bundle.uuid)
     self.assertTrue(isinstance(retrieved_bundle, MockBundle))
     self.assertTrue(retrieved_bundle._validate_called)
+
+  def test_data_hash_references(self):
+    bundle = MockBundle()
+    self.model.save_bundle(bundle)
+    with mock.patch.dict(MockBundle._fields, uuid='other_uuid'):
+      self.model.save_bundle(MockBundle())
+    self.assertEqual(self.model.get_data_hash_ref_counts(['my_data_hash', 'x']), {'my_data_hash': 2})
+    self.assertEqual(self.model.get_data_hash_ref_counts(['my_data_hash'], ['other_uuid']), {'my_data_hash': 1})
+
+    self.model.update_bundle(bundle, {'data_hash': 'new_data_hash'})
+    self.assertEqual(self.model.get_data_hash_ref_counts(['my_data_hash', 'new_data_hash']),
+                     {'my_data_hash': 1, 'new_data_hash': 1})
+    self.model.remove_data_hash_references(['my_uuid'])
+    self.assertEqual(self.model.get_data_hash_ref_counts(['my_data_hash', 'new_data_hash']), {'my_data_hash': 1})
+    self.model.delete_bundles(['other_uuid'])
+    self.assertEqual(self.model.get_data_hash_ref_counts(['my_data_hash', 'new_data_hash']), {})
+
+  def test_data_hash_references_race(self):
+    '''
+    Test that a first reference that another transaction inserted meanwhile is
+    added to, without failing the transaction.
+    '''
+    self.model.save_bundle(MockBundle())
+    with self.engine.begin() as connection:
+      self.model.do_add_data_hash_references(connection, 'my_data_hash', 2)
+      self.model.do_add_data_hash_references(connection, 'new_data_hash', 1)
+    self.assertEqual(self.model.get_data_hash_ref_counts(['my_data_hash', 'new_data_hash']),
+                     {'my_data_hash': 3, 'new_data_hash': 1})
+
+  def test_data_hash_references_backfill(self):
+    self.model.save_bundle(MockBundle())
+    with self.engine.begin() as connection:
+      connection.execute(db_metadata.tables['data_hash_reference'].delete())
+    self.model.create_tables()
+    self.assertEqual(self.model.get_data_hash_ref_counts(['my_data_hash']), {'my_data_hash': 1})
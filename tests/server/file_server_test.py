@@ -0,0 +1,202 @@
+import cStringIO
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import xmlrpclib
+
+from codalab.client.remote_bundle_client import AuthenticatedTransport, FileStreamClient
+from codalab.common import UsageError
+from codalab.lib.staging_area import StagingArea
+from codalab.server.auth import MockAuthHandler, User
+from codalab.server.file_server import FileServer
+
+
+class TestFileServer(FileServer):
+  verbose = 0
+
+
+class FileServerTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    staging = StagingArea(os.path.join(self.temp_directory, 'temp'))
+    self.server = TestFileServer(('localhost', 0), lambda: staging, MockAuthHandler([User('root', 0)]))
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    address = 'http://localhost:%d' % (self.server.server_address[1],)
+    self.address = address
+    self.tokens = []
+    self.file_stream = FileStreamClient(address, lambda: self.tokens.append(True) or 'token')
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.thread.join()
+    self.server.server_close()
+    shutil.rmtree(self.temp_directory)
+
+  def test_stream(self):
+    '''
+    Test that file uuids are written and read as raw bytes over HTTP.
+    '''
+    self.assertTrue(self.file_stream.is_supported())
+    contents = ''.join(chr(i % 256) for i in range(3 * 1024 * 1024 + 17))
+    file_uuid = self.server.open_temp_file('upload')
+    self.file_stream.upload(file_uuid, cStringIO.StringIO(contents))
+    path = self.server.file_paths[file_uuid]
+    with open(path, 'rb') as f:
+      self.assertEqual(f.read(), contents)
+    self.server.finalize_file(file_uuid)
+    self.assertFalse(os.path.exists(path))
+
+    path = os.path.join(self.temp_directory, 'download')
+    with open(path, 'wb') as f:
+      f.write(contents)
+    file_uuid = self.server.open_file(path)
+    self.server.read_file(file_uuid, 17)
+    handle = self.file_stream.open(file_uuid)
+    self.assertEqual(handle.read(), contents[17:])
+    handle.close()
+    self.server.finalize_file(file_uuid)
+    self.assertEqual(len(self.tokens), 2)
+
+    self.assertRaises(UsageError, self.file_stream.open, file_uuid)
+
+  def test_upload_chunks(self):
+    '''
+    Test that chunks sent over several connections, each reused for the next
+    chunk, are put together by offset.
+    '''
+    self.file_stream.CHUNK_SIZE = 1000
+    contents = ''.join(chr(i % 251) for i in range(10 * 1000 + 1))
+    file_uuid = self.server.open_temp_file('upload')
+    self.assertEqual(self.file_stream.upload_chunks(file_uuid, cStringIO.StringIO(contents), 3)[0], len(contents))
+    self.assertEqual(self.file_stream.num_connections, 3)
+    with open(self.server.file_paths[file_uuid], 'rb') as f:
+      self.assertEqual(f.read(), contents)
+    self.server.finalize_file(file_uuid)
+
+    # Only temp files can be written at an offset.
+    path = os.path.join(self.temp_directory, 'read-only')
+    open(path, 'w').close()
+    file_uuid = self.server.open_file(path)
+    self.assertRaises(UsageError, self.file_stream.upload_chunks, file_uuid, cStringIO.StringIO(contents), 2)
+    # Nor written at all, also when the body is too large to be sent before
+    # the server refuses it.
+    self.assertRaises(UsageError, self.file_stream.upload, file_uuid, cStringIO.StringIO('x' * 16 * 1024 * 1024))
+    with open(path) as f:
+      self.assertEqual(f.read(), '')
+    self.server.finalize_file(file_uuid)
+
+    # Chunks are at most MAX_CHUNK_SIZE bytes.
+    self.server.MAX_CHUNK_SIZE = 1000
+    self.file_stream.CHUNK_SIZE = 1001
+    file_uuid = self.server.open_temp_file('upload')
+    self.assertRaises(UsageError, self.file_stream.upload_chunks, file_uuid, cStringIO.StringIO(contents), 1)
+    self.server.finalize_file(file_uuid)
+
+  def test_upload_session(self):
+    '''
+    Test that an upload session records the chunks it received, so that an
+    interrupted upload only sends the missing ones, and that it expires.
+    '''
+    self.file_stream.CHUNK_SIZE = 1000
+    contents = ''.join(chr(i % 251) for i in range(5500))
+    file_uuid = self.server.open_upload_session('upload')
+
+    class InterruptedReader(object):
+      def __init__(self):
+        self.source = cStringIO.StringIO(contents)
+      def read(self, num_bytes):
+        if self.source.tell() >= 3000:
+          raise IOError('interrupted')
+        return self.source.read(num_bytes)
+    self.assertRaises(IOError, self.file_stream.upload_chunks, file_uuid, InterruptedReader(), 1)
+    session = self.server.get_upload_session(file_uuid)
+    self.assertEqual(session['committed_offset'], 3000)
+    self.assertEqual([chunk[:2] for chunk in session['chunks']], [[0, 1000], [1000, 1000], [2000, 1000]])
+    self.assertRaises(UsageError, self.server.close_upload_session, file_uuid, len(contents))
+
+    received = dict((offset, (length, checksum)) for (offset, length, checksum) in session['chunks'])
+    put_chunk = self.file_stream._put_chunk
+    with mock.patch.object(self.file_stream, '_put_chunk', side_effect=put_chunk) as mock_put_chunk:
+      self.file_stream.upload_chunks(file_uuid, cStringIO.StringIO(contents), 2, received=received)
+    self.assertEqual(sorted(call[0][2] for call in mock_put_chunk.call_args_list), [3000, 4000, 5000])
+    path = self.server.file_paths[file_uuid]
+    self.server.close_upload_session(file_uuid, len(contents))
+    with open(path, 'rb') as f:
+      self.assertEqual(f.read(), contents)
+    self.assertIsNone(self.server.get_upload_session(file_uuid))
+    self.server.finalize_file(file_uuid)
+
+    # Sessions that are not written to expire.
+    self.server.UPLOAD_SESSION_TTL = -1
+    file_uuid = self.server.open_upload_session('upload')
+    path = self.server.file_paths[file_uuid]
+    self.assertIsNone(self.server.get_upload_session(file_uuid))
+    self.assertFalse(os.path.exists(path))
+    self.assertNotIn(file_uuid, self.server.file_paths)
+
+  def test_keep_alive(self):
+    '''
+    Test that calls reuse pooled connections, also after faults and from
+    several threads, and that connections closed by the server are replaced.
+    '''
+    self.server.KEEP_ALIVE_TIMEOUT = 0.5
+    transport = AuthenticatedTransport(self.address, lambda command: 'token')
+    proxy = xmlrpclib.ServerProxy(self.address, transport=transport, allow_none=True)
+    path = os.path.join(self.temp_directory, 'read')
+    with open(path, 'wb') as f:
+      f.write('contents')
+    file_uuid = self.server.open_file(path)
+    self.assertEqual(proxy.read_file(file_uuid, 4).data, 'cont')
+    self.assertRaises(xmlrpclib.Fault, proxy.read_file, 'no-such-uuid')
+    self.assertEqual(proxy.read_file(file_uuid, 100).data, 'ents')
+    self.assertEqual(transport.num_connections, 1)
+
+    results = []
+    def tell():
+      for _ in range(10):
+        results.append(proxy.tell_file(file_uuid))
+    threads = [threading.Thread(target=tell) for _ in range(3)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, [8] * 30)
+    self.assertLessEqual(transport.num_connections, 4)
+
+    # Idle connections are closed by the server.
+    num_connections = transport.num_connections
+    time.sleep(1)
+    self.assertEqual(proxy.tell_file(file_uuid), 8)
+    self.assertEqual(transport.num_connections, num_connections + 1)
+    transport.close()
+    self.server.finalize_file(file_uuid)
+
+    # The timeout only applies between requests, not to slow request bodies.
+    class SlowReader(object):
+      def __init__(self):
+        self.source = cStringIO.StringIO('slow contents')
+      def read(self, num_bytes):
+        time.sleep(0.5)
+        return self.source.read(4)
+    file_uuid = self.server.open_temp_file('upload')
+    self.file_stream.upload(file_uuid, SlowReader())
+    with open(self.server.file_paths[file_uuid], 'rb') as f:
+      self.assertEqual(f.read(), 'slow contents')
+    self.server.finalize_file(file_uuid)
+
+    # Chunks are sent again on a new connection when the server closed the
+    # idle one.
+    self.server.KEEP_ALIVE_TIMEOUT = 0.1
+    self.file_stream.CHUNK_SIZE = 4
+    num_connections = self.file_stream.num_connections
+    file_uuid = self.server.open_temp_file('upload')
+    self.file_stream.upload_chunks(file_uuid, SlowReader(), 1)
+    with open(self.server.file_paths[file_uuid], 'rb') as f:
+      self.assertEqual(f.read(), 'slow contents')
+    self.assertGreater(self.file_stream.num_connections, num_connections + 1)
+    self.server.finalize_file(file_uuid)